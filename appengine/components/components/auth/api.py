@@ -32,6 +32,7 @@ from components.datastore_utils import config as ds_config
 from components import utils
 
 from . import config
+from . import globmatch
 from . import ipaddr
 from . import model
 from . import realms
@@ -343,6 +344,17 @@ class AuthDB(object):
     self._ip_whitelists = ip_whitelists
     self._ip_whitelist_assignments = ip_whitelist_assignments
 
+    # Parsed IP whitelists, for faster checks: {str -> ipaddr.SubnetSet}.
+    self._ip_whitelist_sets = {}
+    for name, subnets in ip_whitelists.items():
+      subnet_set = ipaddr.SubnetSet()
+      for net in subnets:
+        try:
+          subnet_set.add(ipaddr.subnet_from_string(net))
+        except ValueError as exc:
+          logging.error('Bad subnet %r in IP whitelist %s: %s', net, name, exc)
+      self._ip_whitelist_sets[name] = subnet_set
+
     # Secrets are loaded lazily in get_secret.
     self._secrets_lock = threading.Lock()
     self._secrets = {}
@@ -380,6 +392,9 @@ class AuthDB(object):
     self._nested_idx = None
     self._owned_idx = None
 
+    # Lazily built {group name => globmatch.GlobSet with all its globs}.
+    self._glob_sets = {}
+
   def _init_realms(self, realms_pb, registered_perms):
     """Preprocesses realms_pb2.Realms into a slightly more efficient form.
 
@@ -602,7 +617,8 @@ class AuthDB(object):
         if ident_as_bytes in group_obj.members:
           return True
 
-        if any(glob.match(identity) for glob in group_obj.globs):
+        if (group_obj.globs and self._group_glob_set(
+            group_name, group_obj).match(ident_as_bytes)):
           return True
 
         return any(is_member(nested) for nested in group_obj.nested)
@@ -612,6 +628,18 @@ class AuthDB(object):
 
     return is_member(group_name)
 
+  def _group_glob_set(self, group_name, group_obj):
+    """Returns globmatch.GlobSet that matches identities against group's globs.
+
+    Identities are matched in their 'kind:name' form against globs in their
+    'kind:pattern' form, which is equivalent to IdentityGlob.match.
+    """
+    glob_set = self._glob_sets.get(group_name)
+    if glob_set is None:
+      glob_set = globmatch.GlobSet(g.to_bytes() for g in group_obj.globs)
+      self._glob_sets[group_name] = glob_set
+    return glob_set
+
   def get_group(self, group_name):
     """Returns AuthGroup entity reconstructing it from the cache.
 
@@ -802,16 +830,12 @@ class AuthDB(object):
       ip: instance of ipaddr.IP.
       warn_if_missing: if True and IP whitelist is missing, logs a warning.
     """
-    subnets = self._ip_whitelists.get(whitelist_name)
-    if not subnets:
+    subnet_set = self._ip_whitelist_sets.get(whitelist_name)
+    if not subnet_set:
       if warn_if_missing:
         logging.error('Unknown IP whitelist: %s', whitelist_name)
       return False
-    # TODO(vadimsh): If number of subnets to check grows it makes sense to add
-    # an internal cache to 'subnet_from_string' (sort of like in re.compile).
-    return any(
-        ipaddr.is_in_subnet(ip, ipaddr.subnet_from_string(net))
-        for net in subnets)
+    return ip in subnet_set
 
   def verify_ip_whitelisted(self, identity, ip):
     """Verifies IP is in a whitelist assigned to the Identity.
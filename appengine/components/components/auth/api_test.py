@@ -131,6 +131,9 @@ class AuthDBTest(test_case.TestCase):
     # Globs are respected.
     self.assertTrue(is_member([with_glob], joe, 'WithGlob'))
     self.assertFalse(is_member([with_glob], model.Anonymous, 'WithGlob'))
+    self.assertFalse(is_member(
+        [with_glob], model.Identity(model.IDENTITY_BOT, 'joe@example.com'),
+        'WithGlob'))
 
     # Members lists are respected.
     self.assertTrue(is_member([with_listing], joe, 'WithListing'))
@@ -7,6 +7,13 @@
 import re
 
 
+# Compiled regexps of the patterns passed to match(), keyed by pattern.
+_compiled = {}
+
+# The cache is flushed when it grows past this many patterns.
+_MAX_COMPILED = 10000
+
+
 def match(s, pat):
   """Returns True if string 's' matches glob-like pattern 'pat'.
 
@@ -17,16 +24,55 @@ def match(s, pat):
   """
   if '\n' in s or '\n' in pat:
     raise ValueError('Multiline strings are not supported')
-  return bool(re.match(_translate(pat), s))
+  return bool(_compile(pat).match(s))
+
+
+class GlobSet(object):
+  """A set of glob-like patterns that are all matched in a single pass.
+
+  Patterns without '*' are looked up in a set, the rest are compiled into one
+  regexp alternation. Same syntax as match().
+  """
+
+  def __init__(self, patterns):
+    self._exact = set()
+    wildcards = []
+    for pat in sorted(set(patterns)):
+      if '\n' in pat:
+        raise ValueError('Multiline strings are not supported')
+      if '*' in pat:
+        wildcards.append(_translate_body(pat))
+      else:
+        self._exact.add(pat)
+    self._exact = frozenset(self._exact)
+    self._re = None
+    if wildcards:
+      self._re = re.compile('^(?:%s)$' % '|'.join(wildcards))
+
+  def match(self, s):
+    """Returns True if string 's' matches any of the patterns."""
+    if '\n' in s:
+      raise ValueError('Multiline strings are not supported')
+    if s in self._exact:
+      return True
+    return bool(self._re and self._re.match(s))
+
+
+def _compile(pat):
+  """Returns the compiled regexp for a pattern, caching it."""
+  compiled = _compiled.get(pat)
+  if compiled is None:
+    if len(_compiled) >= _MAX_COMPILED:
+      _compiled.clear()
+    compiled = _compiled[pat] = re.compile(_translate(pat))
+  return compiled
 
 
 def _translate(pat):
   """Given a pattern, returns a regexp string for it."""
-  out = '^'
-  for c in pat:
-    if c == '*':
-      out += '.*'
-    else:
-      out += re.escape(c)
-  out += '$'
-  return out
+  return '^%s$' % _translate_body(pat)
+
+
+def _translate_body(pat):
+  """Given a pattern, returns an unanchored regexp string for it."""
+  return '.*'.join(re.escape(part) for part in pat.split('*'))
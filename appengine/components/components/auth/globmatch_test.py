@@ -37,6 +37,40 @@ class GlobMatchTest(unittest.TestCase):
     self.assertTrue(globmatch.match('p-abc', 'p-*'))
     self.assertFalse(globmatch.match('not-p-abc', 'p-*'))
 
+  def test_match_caches_compiled(self):
+    globmatch._compiled.clear()
+    self.assertTrue(globmatch.match('abc', 'a*'))
+    self.assertTrue(globmatch.match('abd', 'a*'))
+    self.assertEqual(['a*'], list(globmatch._compiled))
+
+  def test_glob_set(self):
+    s = globmatch.GlobSet([
+        'user:*@domain.com',
+        'user:abc@example.com',
+        'bot:p-*',
+        'user:*@domain.com',
+    ])
+    self.assertTrue(s.match('user:abc@domain.com'))
+    self.assertTrue(s.match('user:@domain.com'))
+    self.assertTrue(s.match('user:abc@example.com'))
+    self.assertTrue(s.match('bot:p-abc'))
+    self.assertFalse(s.match('bot:abc@domain.com'))
+    self.assertFalse(s.match('user:abc@example.com.evil'))
+    self.assertFalse(s.match('user:abc@notdomain.com'))
+    self.assertFalse(s.match('bot:not-p-abc'))
+    with self.assertRaises(ValueError):
+      s.match('user:a\n@domain.com')
+
+  def test_glob_set_empty(self):
+    s = globmatch.GlobSet([])
+    self.assertFalse(s.match(''))
+    self.assertFalse(s.match('abc'))
+
+  def test_glob_set_exact_only(self):
+    s = globmatch.GlobSet(['a.c'])
+    self.assertTrue(s.match('a.c'))
+    self.assertFalse(s.match('abc'))
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
@@ -16,6 +16,7 @@ __all__ = [
   'normalize_ip',
   'normalize_subnet',
   'Subnet',
+  'SubnetSet',
   'subnet_from_string',
   'subnet_to_string',
 ]
@@ -166,3 +167,37 @@ def normalize_subnet(subnet_str):
 def is_in_subnet(ip, subnet):
   """True if given IP instance belongs to Subnet."""
   return ip.bits == subnet.bits and (ip.value & subnet.mask) == subnet.base
+
+
+class SubnetSet(object):
+  """A set of parsed subnets that can be checked for membership of an IP.
+
+  Subnets are grouped by their mask, each group being a set of subnet bases.
+  Checking an IP does one set lookup per distinct mask of the IP's family, i.e.
+  at most 33 for IPv4 and 129 for IPv6, and usually a handful, regardless of
+  the number of subnets.
+  """
+
+  def __init__(self, subnets=()):
+    # {bits => {mask => set of bases}}.
+    self._by_bits = {}
+    for subnet in subnets:
+      self.add(subnet)
+
+  def add(self, subnet):
+    """Adds a Subnet instance to the set."""
+    masks = self._by_bits.setdefault(subnet.bits, {})
+    masks.setdefault(subnet.mask, set()).add(subnet.base)
+
+  def __contains__(self, ip):
+    """True if given IP instance belongs to any of the subnets."""
+    masks = self._by_bits.get(ip.bits)
+    if not masks:
+      return False
+    value = ip.value
+    return any((value & mask) in bases for mask, bases in masks.items())
+
+  def __len__(self):
+    return sum(
+        len(bases) for masks in self._by_bits.values()
+        for bases in masks.values())
@@ -0,0 +1,86 @@
+#!/usr/bin/env vpython
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Compares IP whitelist checks against a list of subnet strings with
+ipaddr.SubnetSet lookups.
+"""
+
+import argparse
+import random
+import sys
+import timeit
+
+from test_support import test_env
+test_env.setup_test_env()
+
+from components.auth import ipaddr
+
+
+def random_subnets(rnd, count):
+  """Returns a list of random IPv4 and IPv6 subnet strings."""
+  out = []
+  for _ in range(count):
+    if rnd.random() < 0.5:
+      ip = ipaddr.IP(32, rnd.getrandbits(32))
+      prefix = rnd.randint(8, 32)
+    else:
+      ip = ipaddr.IP(128, rnd.getrandbits(128))
+      prefix = rnd.randint(16, 128)
+    out.append('%s/%d' % (ipaddr.ip_to_string(ip), prefix))
+  return out
+
+
+def random_ips(rnd, count):
+  """Returns a list of random IPv4 and IPv6 IP instances."""
+  out = []
+  for _ in range(count):
+    if rnd.random() < 0.5:
+      out.append(ipaddr.IP(32, rnd.getrandbits(32)))
+    else:
+      out.append(ipaddr.IP(128, rnd.getrandbits(128)))
+  return out
+
+
+def legacy_check(ip, subnets):
+  """The check AuthDB.is_in_ip_whitelist used to do on each call."""
+  return any(
+      ipaddr.is_in_subnet(ip, ipaddr.subnet_from_string(net))
+      for net in subnets)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+  parser.add_argument(
+      '--subnets', type=int, default=5000, help='Number of subnets')
+  parser.add_argument(
+      '--ips', type=int, default=100, help='Number of IPs to check')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  rnd = random.Random(args.seed)
+  subnets = random_subnets(rnd, args.subnets)
+  ips = random_ips(rnd, args.ips)
+
+  start = timeit.default_timer()
+  subnet_set = ipaddr.SubnetSet(ipaddr.subnet_from_string(s) for s in subnets)
+  build = timeit.default_timer() - start
+
+  for ip in ips:
+    assert legacy_check(ip, subnets) == (ip in subnet_set), ip
+
+  legacy = timeit.timeit(
+      lambda: [legacy_check(ip, subnets) for ip in ips], number=1)
+  fast = timeit.timeit(lambda: [ip in subnet_set for ip in ips], number=10)
+  fast /= 10
+
+  print('%d subnets, %d IPs' % (args.subnets, args.ips))
+  print('SubnetSet build: %8.2fms' % (build * 1000.))
+  print('legacy:          %8.2fus/check' % (legacy * 1e6 / len(ips)))
+  print('SubnetSet:       %8.2fus/check' % (fast * 1e6 / len(ips)))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
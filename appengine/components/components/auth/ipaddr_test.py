@@ -192,6 +192,50 @@ class IpAddrTest(test_case.TestCase):
 
     self.assertFalse(call('0:0:0:0:0:0:0:0', '0.0.0.0/32'))
 
+  def test_subnet_set(self):
+    subnets = ipaddr.SubnetSet(
+        ipaddr.subnet_from_string(net) for net in (
+            '127.0.0.1/32',
+            '192.168.0.0/24',
+            '10.0.0.0/8',
+            '10.1.0.0/16',
+            'ffff:fffe:fffd:fffc:fffb:fffa:fff0:0/112',
+        ))
+    self.assertEqual(5, len(subnets))
+    contains = lambda ip: ipaddr.ip_from_string(ip) in subnets
+
+    self.assertTrue(contains('127.0.0.1'))
+    self.assertFalse(contains('127.0.0.2'))
+    self.assertTrue(contains('192.168.0.25'))
+    self.assertFalse(contains('192.168.1.25'))
+    self.assertTrue(contains('10.2.3.4'))
+    self.assertTrue(contains('10.1.3.4'))
+    self.assertFalse(contains('11.1.3.4'))
+
+    self.assertTrue(contains('ffff:fffe:fffd:fffc:fffb:fffa:fff0:1234'))
+    self.assertFalse(contains('ffff:fffe:fffd:fffc:fffb:fffa:fff1:1234'))
+    # IPv4 subnets do not match IPv6 addresses with the same value.
+    self.assertFalse(contains('0:0:0:0:0:0:7f00:1'))
+
+  def test_subnet_set_empty(self):
+    subnets = ipaddr.SubnetSet()
+    self.assertEqual(0, len(subnets))
+    self.assertFalse(ipaddr.ip_from_string('127.0.0.1') in subnets)
+
+  def test_subnet_set_matches_is_in_subnet(self):
+    nets = ['0.0.0.0/0', '1.2.3.4/31', '8.8.0.0/15', '100.64.0.0/10']
+    subnets = ipaddr.SubnetSet(ipaddr.subnet_from_string(n) for n in nets)
+    for ip in ('0.0.0.1', '1.2.3.5', '1.2.3.6', '8.9.1.1', '100.127.0.1'):
+      ip = ipaddr.ip_from_string(ip)
+      self.assertTrue(ip in subnets)
+    subnets = ipaddr.SubnetSet(ipaddr.subnet_from_string(n) for n in nets[1:])
+    for ip in ('1.2.3.5', '1.2.3.6', '8.10.0.0', '100.128.0.0', '9.9.9.9'):
+      ip = ipaddr.ip_from_string(ip)
+      expected = any(
+          ipaddr.is_in_subnet(ip, ipaddr.subnet_from_string(n))
+          for n in nets[1:])
+      self.assertEqual(expected, ip in subnets)
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
@@ -19,6 +19,7 @@ from components import datastore_utils
 from components import utils
 from server import acl
 from server import bot_code
+from server import bot_counts
 from server import bot_management
 from server import config
 from server import pools_config
@@ -79,11 +80,12 @@ def delete_bot(bot_id):
   """
   realms.check_bot_delete_acl(bot_id)
   bot_info_key = bot_management.get_info_key(bot_id)
-  _get_or_raise(bot_info_key)  # raises 404 if there is no such bot
+  bot = _get_or_raise(bot_info_key)  # raises 404 if there is no such bot
   # It is important to note that the bot is not there anymore, so it is not
   # a member of any task queue.
   task_queues.cleanup_after_bot(bot_id)
   bot_info_key.delete()
+  bot_counts.update(bot.counts_state(), None)
 
 
 def get_bot_events(bot_id, start, end, limit, cursor):
@@ -613,6 +615,17 @@ def count_bots(dimensions):
   except ValueError as e:
     raise handlers_exceptions.BadRequestException(str(e))
 
+  # Use the precomputed counts when possible, it is much cheaper than the
+  # queries below.
+  if bot_counts.can_count(dimensions):
+    counts = bot_counts.get_counts(dimensions)
+    if counts is not None:
+      return BotsCount(count=counts.count,
+                       dead=counts.dead,
+                       quarantined=counts.quarantined,
+                       maintenance=counts.maintenance,
+                       busy=counts.busy)
+
   f_count = q.count_async()
   f_dead = bot_management.filter_availability(q, None, None, True,
                                               None).count_async()
@@ -666,9 +679,13 @@ def count_tasks(filters, now):
     return count
 
   try:
-    count = task_result.get_result_summaries_query(filters.start, filters.end,
-                                                   filters.sort, filters.state,
-                                                   filters.tags).count()
+    if filters.sort == 'created_ts':
+      count = task_result.count_result_summaries(filters.start, filters.end,
+                                                 filters.state, filters.tags)
+    else:
+      count = task_result.get_result_summaries_query(
+          filters.start, filters.end, filters.sort, filters.state,
+          filters.tags).count()
     memcache.add(mem_key, count, 24 * 60 * 60, namespace='tasks_count')
   except ValueError as e:
     raise handlers_exceptions.BadRequestException(
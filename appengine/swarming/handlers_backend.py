@@ -20,11 +20,13 @@ from proto.plugin import plugin_pb2
 from components import decorators
 from components import datastore_utils
 from components import utils
+from server import bot_counts
 from server import bot_groups_config
 from server import bot_management
 from server import config
 from server import external_scheduler
 from server import named_caches
+from server import task_counts
 from server import task_queues
 from server import task_result
 from server import task_scheduler
@@ -88,6 +90,27 @@ class CronUpdateBotInfoComposite(_CronHandlerBase):
     bot_management.cron_update_bot_info()
 
 
+class CronReconcileBotCounts(_CronHandlerBase):
+  """Fixes the drift of the bot counts used by CountBots."""
+
+  def run_cron(self):
+    bot_management.cron_reconcile_bot_counts()
+
+
+class CronReconcileTaskCounts(_CronHandlerBase):
+  """Fixes the drift of the task counts used by CountTasks."""
+
+  def run_cron(self):
+    task_result.cron_reconcile_task_counts()
+
+
+class CronApplyTaskCounts(_CronHandlerBase):
+  """Applies the pending deltas of the task counts used by CountTasks."""
+
+  def run_cron(self):
+    task_counts.cron_apply_deltas()
+
+
 class CronNamedCachesUpdate(_CronHandlerBase):
   """Updates named caches hints."""
 
@@ -207,6 +230,30 @@ class TaskRescanMatchingTaskSetsHandler(webapp2.RequestHandler):
       self.response.set_status(429, 'Need to retry')
 
 
+class TaskFlushBotInfoHandler(webapp2.RequestHandler):
+  """Stores a batch of BotInfo from the write-behind buffer of an instance."""
+
+  @decorators.require_taskqueue('flush-bot-info')
+  def post(self):
+    bot_management.store_bot_info_batch(self.request.body)
+
+
+class TaskUpdateBotCountsHandler(webapp2.RequestHandler):
+  """Applies the bot counts deltas of a bot state transition."""
+
+  @decorators.require_taskqueue('update-bot-counts')
+  def post(self):
+    bot_counts.apply_deltas(self.request.body)
+
+
+class TaskReconcileTaskCountsHandler(webapp2.RequestHandler):
+  """Fixes the drift of the task counts of an hour."""
+
+  @decorators.require_taskqueue('reconcile-task-counts')
+  def post(self):
+    task_result.task_reconcile_task_counts(self.request.body)
+
+
 class TaskSendPubSubMessage(webapp2.RequestHandler):
   """Sends PubSub notification about task completion."""
 
@@ -271,6 +318,12 @@ def get_routes():
       ('/internal/cron/cleanup/task_dimension_sets', CronTidyTaskDimensionSets),
       ('/internal/cron/monitoring/bots/update_bot_info',
        CronUpdateBotInfoComposite),
+      ('/internal/cron/monitoring/bots/reconcile_bot_counts',
+       CronReconcileBotCounts),
+      ('/internal/cron/monitoring/tasks/reconcile_task_counts',
+       CronReconcileTaskCounts),
+      ('/internal/cron/monitoring/tasks/apply_task_counts',
+       CronApplyTaskCounts),
       ('/internal/cron/important/bot_groups_config',
        CronBotGroupsConfigHandler),
       ('/internal/cron/important/external_scheduler/cancellations',
@@ -290,6 +343,12 @@ def get_routes():
        TaskUpdateBotMatchesHandler),
       ('/internal/taskqueue/important/task_queues/rescan-matching-task-sets',
        TaskRescanMatchingTaskSetsHandler),
+      ('/internal/taskqueue/important/bots/flush-bot-info',
+       TaskFlushBotInfoHandler),
+      ('/internal/taskqueue/important/bots/update-bot-counts',
+       TaskUpdateBotCountsHandler),
+      ('/internal/taskqueue/monitoring/tasks/reconcile-task-counts',
+       TaskReconcileTaskCountsHandler),
       (r'/internal/taskqueue/important/pubsub/notify-task/<task_id:[0-9a-f]+>',
        TaskSendPubSubMessage),
       (r'/internal/taskqueue/important/buildbucket/notify-task/'
@@ -97,6 +97,12 @@ class BackendTest(test_env_handlers.AppTestBase):
          '/internal/taskqueue/important/task_queues/update-bot-matches'),
         ('rescan-matching-task-sets',
          '/internal/taskqueue/important/task_queues/rescan-matching-task-sets'),
+        ('flush-bot-info',
+         '/internal/taskqueue/important/bots/flush-bot-info'),
+        ('update-bot-counts',
+         '/internal/taskqueue/important/bots/update-bot-counts'),
+        ('reconcile-task-counts',
+         '/internal/taskqueue/monitoring/tasks/reconcile-task-counts'),
         ('named-cache-task',
          '/internal/taskqueue/important/named_cache/update-pool'),
     ],
@@ -8,6 +8,7 @@ import datetime
 import json
 import logging
 import urlparse
+import zlib
 
 import six
 
@@ -265,6 +266,59 @@ class BotCodeHandler(_BotAuthenticatingHandler):
     self.response.out.write(blob)
 
 
+class BotCodeManifestHandler(_BotAuthenticatingHandler):
+  """Returns the SHA256 of each file of a bot archive version.
+
+  Used by bots to update by downloading only the files that changed, see
+  BotCodeFilesHandler. Like the archive itself, it is cacheable.
+  """
+
+  @auth.public  # Same as BotCodeHandler for a known version.
+  def get(self, version):
+    info = _get_bot_archive_info(version)
+    if not info:
+      self.abort(404, 'Unknown version')
+    self.response.headers['Cache-Control'] = 'public, max-age=3600'
+    self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+    self.response.out.write(
+        utils.encode_to_json({'files': info.fetch_manifest()}))
+
+
+class BotCodeFilesHandler(_BotAuthenticatingHandler):
+  """Returns the content of some files of a bot archive version.
+
+  Request body is JSON {'files': [file name]}, response is JSON
+  {'files': {file name: base64 encoded content}}.
+  """
+
+  @auth.public  # Same as BotCodeHandler for a known version.
+  def post(self, version):
+    info = _get_bot_archive_info(version)
+    if not info:
+      self.abort(404, 'Unknown version')
+    try:
+      names = json.loads(self.request.body)['files']
+      files = info.fetch_files(names)
+    except (KeyError, TypeError, ValueError) as e:
+      self.abort(400, 'Invalid request: %s' % e)
+    self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+    self.response.out.write(
+        utils.encode_to_json({
+            'files': {n: base64.b64encode(c) for n, c in files.items()}
+        }))
+
+
+def _get_bot_archive_info(version):
+  """Returns the BotArchiveInfo of a known bot version or None."""
+  info = bot_code.config_bundle_rev_key().get()
+  if not info:
+    return None
+  for archive in (info.stable_bot, info.canary_bot):
+    if archive and archive.digest == version:
+      return archive
+  return None
+
+
 def _bot_id_from_auth_token():
   """Extracts bot ID from the authenticated credentials."""
   ident = auth.get_peer_identity()
@@ -1383,9 +1437,13 @@ class BotTaskUpdateHandler(_BotApiHandler):
       u'named_caches_stats',
       u'output',
       u'output_chunk_start',
+      u'output_encoding',
       u'task_id',
   }
   REQUIRED_KEYS = {u'id', u'task_id'}
+  # Encodings of 'output' accepted in addition to plain base64. They are
+  # advertised in the response so the bot can use them for the next updates.
+  OUTPUT_ENCODINGS = (u'zlib',)
 
   @decorators.silence(apiproxy_errors.RPCFailedError)
   @auth.public  # auth happens in bot_auth.authenticate_bot()
@@ -1421,6 +1479,7 @@ class BotTaskUpdateHandler(_BotApiHandler):
     cleanup_stats = request.get('cleanup_stats')
     output = request.get('output')
     output_chunk_start = request.get('output_chunk_start')
+    output_encoding = request.get('output_encoding')
     cas_output_root = request.get('cas_output_root')
     canceled = request.get('canceled')
 
@@ -1488,6 +1547,22 @@ class BotTaskUpdateHandler(_BotApiHandler):
         # and returning a HTTP 500 would only force the bot to stay in a retry
         # loop.
         logging.error('Failed to decode output\n%s\n%r', e, output)
+      if output_encoding:
+        if output_encoding not in self.OUTPUT_ENCODINGS:
+          self.abort_with_error(
+              400, error='Unsupported output_encoding %r' % output_encoding)
+        # Anything beyond the maximum output size would be discarded anyway, so
+        # don't let a small body expand into an arbitrarily large one.
+        max_len = task_result.TaskOutput.PUT_MAX_CONTENT()
+        try:
+          d = zlib.decompressobj()
+          output = d.decompress(output, max_len)
+        except zlib.error as e:
+          self.abort_with_error(
+              400, error='Failed to decompress output: %s' % e)
+        if d.unconsumed_tail:
+          self.abort_with_error(
+              400, error='Decompressed output exceeds %d bytes' % max_len)
     if cas_output_root:
       cas_output_root = task_request.CASReference(
           cas_instance=cas_output_root['cas_instance'],
@@ -1571,7 +1646,11 @@ class BotTaskUpdateHandler(_BotApiHandler):
     must_stop = state in (task_result.State.BOT_DIED, task_result.State.KILLED)
     if must_stop:
       logging.info('asking bot to kill the task')
-    self.send_response({'must_stop': must_stop, 'ok': True})
+    self.send_response({
+        'must_stop': must_stop,
+        'ok': True,
+        'output_encodings': self.OUTPUT_ENCODINGS,
+    })
 
 
 class BotTaskErrorHandler(_BotApiHandler):
@@ -1647,6 +1726,10 @@ def get_routes():
   # 40 for old sha1 digest so old bot can still update, 64 for current
   # sha256 digest.
   add('/swarming/api/v1/bot/bot_code/<version:[0-9a-f]{40,64}>', BotCodeHandler)
+  add('/swarming/api/v1/bot/bot_code/<version:[0-9a-f]{40,64}>/manifest',
+      BotCodeManifestHandler)
+  add('/swarming/api/v1/bot/bot_code/<version:[0-9a-f]{40,64}>/files',
+      BotCodeFilesHandler)
 
   # Bot API RPCs
 
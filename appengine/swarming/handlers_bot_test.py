@@ -6,6 +6,8 @@
 
 import base64
 import datetime
+import hashlib
+import json
 import logging
 import os
 import random
@@ -13,6 +15,7 @@ import StringIO
 import sys
 import unittest
 import zipfile
+import zlib
 
 import mock
 from parameterized import parameterized
@@ -46,6 +49,7 @@ from server import realms
 from server import service_accounts
 from server import task_pack
 from server import task_queues
+from server import task_result
 from server import task_scheduler
 
 
@@ -1413,7 +1417,11 @@ class BotApiTest(test_env_handlers.AppTestBase):
         'task_id': task_id,
     }
     response = self.post_json('/swarming/api/v1/bot/task_update', params)
-    self.assertEqual({u'must_stop': False, u'ok': True}, response)
+    self.assertEqual({
+        u'must_stop': False,
+        u'ok': True,
+        u'output_encodings': [u'zlib'],
+    }, response)
 
     self.set_as_user()
     response = self.client_get_results(task_id, include_performance_stats=True)
@@ -1704,7 +1712,11 @@ class BotApiTest(test_env_handlers.AppTestBase):
       """Cycles between bot update and user retrieving results."""
       self.set_as_bot()
       response = self.post_json('/swarming/api/v1/bot/task_update', params)
-      self.assertEqual({u'must_stop': must_stop, u'ok': True}, response)
+      self.assertEqual({
+          u'must_stop': must_stop,
+          u'ok': True,
+          u'output_encodings': [u'zlib'],
+      }, response)
       self.set_as_user()
       self.assertEqual(expected, self.client_get_results(task_id))
 
@@ -1714,7 +1726,11 @@ class BotApiTest(test_env_handlers.AppTestBase):
     task_id = response['manifest']['task_id']
     params = _params()
     response = self.post_json('/swarming/api/v1/bot/task_update', params)
-    self.assertEqual({u'must_stop': False, u'ok': True}, response)
+    self.assertEqual({
+        u'must_stop': False,
+        u'ok': True,
+        u'output_encodings': [u'zlib'],
+    }, response)
 
     self.set_as_user()
     response = self.client_get_results(task_id)
@@ -1819,6 +1835,85 @@ class BotApiTest(test_env_handlers.AppTestBase):
         '/swarming/api/v1/bot/task_update', params, status=500)
     self.assertEqual({u'error': u'Sorry!'}, response)
 
+  def test_task_update_zlib_output(self):
+    self.set_as_bot()
+    self.bot_poll()
+
+    self.set_as_user()
+    self.client_create_task_raw(
+        properties=dict(command=['python', 'runtest.py']))
+
+    self.set_as_bot()
+    params = self.do_handshake()
+    response = self.post_json('/swarming/api/v1/bot/poll', params)
+    task_id = response['manifest']['task_id']
+
+    params = {
+        'cost_usd': 0.1,
+        'duration': None,
+        'exit_code': None,
+        'id': 'bot1',
+        'output': base64.b64encode(zlib.compress('result string')),
+        'output_chunk_start': 0,
+        'output_encoding': 'zlib',
+        'task_id': task_id,
+    }
+    response = self.post_json('/swarming/api/v1/bot/task_update', params)
+    self.assertEqual({
+        u'must_stop': False,
+        u'ok': True,
+        u'output_encodings': [u'zlib'],
+    }, response)
+    run_result = task_pack.unpack_run_result_key(task_id).get()
+    self.assertEqual('result string', run_result.get_output(0, 0))
+
+    # Unknown encodings are rejected.
+    params['output_chunk_start'] = len('result string')
+    params['output_encoding'] = 'brotli'
+    response = self.post_json(
+        '/swarming/api/v1/bot/task_update', params, status=400)
+    self.assertEqual(
+        {u'error': u"Unsupported output_encoding u'brotli'"}, response)
+
+  def test_task_update_zlib_output_too_large(self):
+    self.mock(task_result.TaskOutput, 'PUT_MAX_CHUNKS', 1)
+    max_len = task_result.TaskOutput.PUT_MAX_CONTENT()
+    self.set_as_bot()
+    self.bot_poll()
+
+    self.set_as_user()
+    self.client_create_task_raw(
+        properties=dict(command=['python', 'runtest.py']))
+
+    self.set_as_bot()
+    params = self.do_handshake()
+    response = self.post_json('/swarming/api/v1/bot/poll', params)
+    task_id = response['manifest']['task_id']
+
+    params = {
+        'cost_usd': 0.1,
+        'duration': None,
+        'exit_code': None,
+        'id': 'bot1',
+        'output': base64.b64encode(zlib.compress('x' * (max_len + 1))),
+        'output_chunk_start': 0,
+        'output_encoding': 'zlib',
+        'task_id': task_id,
+    }
+    response = self.post_json(
+        '/swarming/api/v1/bot/task_update', params, status=400)
+    self.assertEqual(
+        {u'error': u'Decompressed output exceeds %d bytes' % max_len},
+        response)
+    run_result = task_pack.unpack_run_result_key(task_id).get()
+    self.assertEqual(None, run_result.get_output(0, 0))
+
+    # Exactly the maximum is accepted.
+    params['output'] = base64.b64encode(zlib.compress('x' * max_len))
+    self.post_json('/swarming/api/v1/bot/task_update', params)
+    run_result = task_pack.unpack_run_result_key(task_id).get()
+    self.assertEqual(max_len, len(run_result.get_output(0, 0)))
+
   def test_task_failure(self):
     self.mock(random, 'getrandbits', lambda _: 0x88)
     params = self.do_handshake(do_first_poll=True)
@@ -1941,7 +2036,11 @@ class BotApiTest(test_env_handlers.AppTestBase):
 
     self.set_as_bot()
     response = self.bot_complete_task(task_id=task_id)
-    self.assertEqual({u'must_stop': True, u'ok': True}, response)
+    self.assertEqual({
+        u'must_stop': True,
+        u'ok': True,
+        u'output_encodings': [u'zlib'],
+    }, response)
 
     self.set_as_user()
     expected = self.gen_run_result(
@@ -1986,6 +2085,32 @@ class BotApiTest(test_env_handlers.AppTestBase):
     self.assertEqual(resp.status_int, 200)
     self.assertEqual(resp.body, 'canary-1234+canary-5678')
 
+  def test_bot_code_manifest_and_files(self):
+    archive = StringIO.StringIO()
+    with zipfile.ZipFile(archive, 'w') as z:
+      z.writestr('a.py', 'a')
+      z.writestr('b.py', 'b')
+    bot_code.BotArchiveChunk(
+        key=bot_code.bot_archive_chunk_key('stable:1'),
+        data=archive.getvalue()).put()
+    bot_code.BotArchiveChunk(
+        key=bot_code.bot_archive_chunk_key('stable:2'), data='').put()
+    url = '/swarming/api/v1/bot/bot_code/%s/' % self.stable_bot_digest
+
+    resp = self.app.get(url + 'manifest')
+    self.assertEqual({
+        u'files': {
+            u'a.py': unicode(hashlib.sha256('a').hexdigest()),
+            u'b.py': unicode(hashlib.sha256('b').hexdigest()),
+        }
+    }, resp.json)
+
+    resp = self.app.post(url + 'files', json.dumps({'files': ['b.py']}))
+    self.assertEqual({u'files': {u'b.py': u'Yg=='}}, resp.json)
+    self.app.post(url + 'files', json.dumps({'files': ['c.py']}), status=400)
+    self.app.get(
+        '/swarming/api/v1/bot/bot_code/%s/manifest' % ('3' * 64), status=404)
+
   def test_bot_code_strips_query(self):
     resp = self.app.get('/swarming/api/v1/bot/bot_code/' +
                         self.stable_bot_digest + '?q=123')
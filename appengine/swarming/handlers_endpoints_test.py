@@ -2090,7 +2090,11 @@ class TaskApiTest(BaseTest):
     self.set_as_bot()
     params = _params(output=base64.b64encode('Oh '))
     response = self.post_json('/swarming/api/v1/bot/task_update', params)
-    self.assertEqual({u'must_stop': False, u'ok': True}, response)
+    self.assertEqual({
+        u'must_stop': False,
+        u'ok': True,
+        u'output_encodings': [u'zlib'],
+    }, response)
     self.set_as_user()
     expected = self.gen_result_summary(
         bot_idle_since_ts=fmtdate(self.now),
@@ -2132,7 +2136,11 @@ class TaskApiTest(BaseTest):
     self.set_as_bot()
     params = _params(output=base64.b64encode('hi'), output_chunk_start=3)
     response = self.post_json('/swarming/api/v1/bot/task_update', params)
-    self.assertEqual({u'must_stop': True, u'ok': True}, response)
+    self.assertEqual({
+        u'must_stop': True,
+        u'ok': True,
+        u'output_encodings': [u'zlib'],
+    }, response)
 
     # abandoned_ts is set but state isn't changed yet.
     self.set_as_user()
@@ -2166,7 +2174,11 @@ class TaskApiTest(BaseTest):
         duration=0.1,
         exit_code=0)
     response = self.post_json('/swarming/api/v1/bot/task_update', params)
-    self.assertEqual({u'must_stop': True, u'ok': True}, response)
+    self.assertEqual({
+        u'must_stop': True,
+        u'ok': True,
+        u'output_encodings': [u'zlib'],
+    }, response)
 
     self.set_as_user()
     expected = self.gen_result_summary(
@@ -3124,7 +3136,11 @@ class BotApiTest(BaseTest):
     self.set_as_bot()
     res = self.bot_poll()
     response = self.bot_complete_task(task_id=res['manifest']['task_id'])
-    self.assertEqual({u'must_stop': False, u'ok': True}, response)
+    self.assertEqual({
+        u'must_stop': False,
+        u'ok': True,
+        u'output_encodings': [u'zlib'],
+    }, response)
 
     now_1 = self.mock_now(self.now, 1)
     self.mock(random, 'getrandbits', lambda _: 0x55)
@@ -3134,7 +3150,11 @@ class BotApiTest(BaseTest):
     res = self.bot_poll()
     response = self.bot_complete_task(
         exit_code=1, task_id=res['manifest']['task_id'])
-    self.assertEqual({u'must_stop': False, u'ok': True}, response)
+    self.assertEqual({
+        u'must_stop': False,
+        u'ok': True,
+        u'output_encodings': [u'zlib'],
+    }, response)
 
     start = utils.datetime_to_timestamp(self.now + datetime.timedelta(
         seconds=0.5)) / 1000000.
@@ -3225,7 +3245,11 @@ class BotApiTest(BaseTest):
     t4 = self.mock_now(second_ticker())
 
     response = self.bot_complete_task(task_id=res['manifest']['task_id'])
-    self.assertEqual({u'must_stop': False, u'ok': True}, response)
+    self.assertEqual({
+        u'must_stop': False,
+        u'ok': True,
+        u'output_encodings': [u'zlib'],
+    }, response)
     params['event'] = 'bot_rebooting'
     params['message'] = 'for the best'
     t5 = self.mock_now(second_ticker())
@@ -12,12 +12,15 @@ The hash of the content of the files in the archive is used to define the
 current version of the swarming bot code.
 """
 
+import collections
 import hashlib
-import io
 import json
 import logging
 import os
-import zipfile
+import struct
+import sys
+import threading
+import zlib
 
 
 # List of files needed by the swarming bot.
@@ -414,6 +417,7 @@ FILES = (
     'utils/subprocess42.py',
     'utils/threading_utils.py',
     'utils/tools.py',
+    'utils/trash.py',
     'utils/zip_package.py',
 )
 
@@ -479,31 +483,20 @@ def get_swarming_bot_zip(
     Tuple(str being the zipped file's content, bot version (SHA256) it
     represents).
   """
-  zip_memory_file = io.BytesIO()
+  zip_writer = _ZipWriter()
   h = hashlib.sha256()
-  with zipfile.ZipFile(zip_memory_file, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-    for name, content in yield_swarming_bot_files(
-        root_dir, host, host_version, additionals, settings):
+  for name, content in yield_swarming_bot_files(
+      root_dir, host, host_version, additionals, settings):
+    # Only files whose content changed since the last call are deflated again,
+    # e.g. config/config.json when only the server settings changed.
+    zip_writer.add(name, _get_deflated(content))
 
-      # We must pass ZipInfo object, otherwise zipfile will generate ZipInfo
-      # on its own, setting date_time to the current time, thus making the zip
-      # archive non-deterministic. See zipfile.py source for where external_attr
-      # comes from. It is copy-pasta from there.
-      zinfo = zipfile.ZipInfo(filename=name)
-      zinfo.compress_type = zip_file.compression
-      if zinfo.filename.endswith('/'):
-        zinfo.external_attr = 0o40775 << 16   # drwxrwxr-x
-        zinfo.external_attr |= 0x10           # MS-DOS directory flag
-      else:
-        zinfo.external_attr = 0o600 << 16     # ?rw-------
-      zip_file.writestr(zinfo, content)
-
-      h.update(str(len(name)).encode())
-      h.update(name.encode())
-      h.update(str(len(content)).encode())
-      h.update(content)
+    h.update(str(len(name)).encode())
+    h.update(name.encode())
+    h.update(str(len(content)).encode())
+    h.update(content)
 
-  data = zip_memory_file.getvalue()
+  data = zip_writer.getvalue()
   bot_version = h.hexdigest()
   logging.info(
       'get_swarming_bot_zip(%s) is %d bytes; %s',
@@ -543,6 +536,99 @@ def get_swarming_bot_version(
 ## Private stuff.
 
 
+# Maximum number of entries in _DEFLATED. There are about 400 FILES, this keeps
+# a few versions of each.
+_DEFLATED_MAX = 2048
+
+
+# Content of a file deflated the same way zipfile.ZIP_DEFLATED does.
+_Deflated = collections.namedtuple('_Deflated', ('crc', 'size', 'data'))
+
+
+# SHA256 digest of a file content => _Deflated, least recently used first.
+_DEFLATED = collections.OrderedDict()
+_DEFLATED_LOCK = threading.Lock()
+
+
+def _get_deflated(content):
+  """Returns the _Deflated for content, reusing a previous compression."""
+  key = hashlib.sha256(content).digest()
+  with _DEFLATED_LOCK:
+    entry = _DEFLATED.pop(key, None)
+    if entry:
+      _DEFLATED[key] = entry
+      return entry
+  co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+  entry = _Deflated(
+      zlib.crc32(content) & 0xffffffff, len(content),
+      co.compress(content) + co.flush())
+  with _DEFLATED_LOCK:
+    _DEFLATED[key] = entry
+    while len(_DEFLATED) > _DEFLATED_MAX:
+      _DEFLATED.popitem(last=False)
+  return entry
+
+
+class _ZipWriter(object):
+  """Writes a zip file from already deflated content.
+
+  The output is byte for byte what zipfile.ZipFile used to write with
+  ZIP_DEFLATED and a ZipInfo with the default date_time, without the zip64
+  extension. zipfile can't be given pre-compressed data, so the records are
+  written directly.
+  """
+  # See zipfile.structFileHeader, structCentralDir and structEndArchive.
+  _FILE_HEADER = struct.Struct('<4s2B4HL2L2H')
+  _CENTRAL_DIR = struct.Struct('<4s4B4HL2L5H2L')
+  _END_ARCHIVE = struct.Struct('<4s4H2LH')
+  # zipfile.DEFAULT_VERSION and zipfile.ZIP_DEFLATED.
+  _VERSION = 20
+  _DEFLATED = 8
+  # ZipInfo default date_time of 1980-01-01 00:00:00 in MS-DOS format.
+  _DOS_TIME = 0
+  _DOS_DATE = (1 << 5) | 1
+  _CREATE_SYSTEM = 0 if sys.platform == 'win32' else 3
+
+  def __init__(self):
+    self._parts = []
+    self._offset = 0
+    self._central_dir = []
+
+  def add(self, name, deflated):
+    """Adds a file with its _Deflated content."""
+    try:
+      filename = name.encode('ascii')
+      flags = 0
+    except UnicodeError:
+      filename = name.encode('utf-8')
+      flags = 0x800
+    if name.endswith('/'):
+      external_attr = 0o40775 << 16   # drwxrwxr-x
+      external_attr |= 0x10           # MS-DOS directory flag
+    else:
+      external_attr = 0o600 << 16     # ?rw-------
+    header = self._FILE_HEADER.pack(
+        b'PK\003\004', self._VERSION, 0, flags, self._DEFLATED,
+        self._DOS_TIME, self._DOS_DATE, deflated.crc, len(deflated.data),
+        deflated.size, len(filename), 0)
+    self._central_dir.append(
+        self._CENTRAL_DIR.pack(
+            b'PK\001\002', self._VERSION, self._CREATE_SYSTEM, self._VERSION,
+            0, flags, self._DEFLATED, self._DOS_TIME, self._DOS_DATE,
+            deflated.crc, len(deflated.data), deflated.size, len(filename), 0,
+            0, 0, 0, external_attr, self._offset) + filename)
+    self._parts.extend((header, filename, deflated.data))
+    self._offset += len(header) + len(filename) + len(deflated.data)
+
+  def getvalue(self):
+    """Returns the zip file content."""
+    central_dir = b''.join(self._central_dir)
+    end = self._END_ARCHIVE.pack(
+        b'PK\005\006', 0, 0, len(self._central_dir), len(self._central_dir),
+        len(central_dir), self._offset, 0)
+    return b''.join(self._parts + [central_dir, end])
+
+
 def _make_config_json(host, host_version, settings):
   """Generates a config.json to embed in swarming_bot.zip"""
   # The keys must match ../swarming_bot/config/config.json.
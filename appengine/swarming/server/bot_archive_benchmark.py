@@ -0,0 +1,116 @@
+#!/usr/bin/env vpython
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Measures generation and serving of swarming_bot.zip, cold and warm.
+
+Generation is bot_archive.get_swarming_bot_zip() with an empty deflate cache,
+then again with the same files, then with only config/config.json changed.
+
+Serving is BotArchiveInfo.fetch_archive() against the ndb testbed stubs, first
+from the datastore, then from memcache and then from the in-process cache.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+import test_env
+test_env.setup_test_env()
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from server import bot_archive
+from server import bot_code
+from test_support import test_case
+
+
+_BOT_DIR = os.path.join(test_env.APP_DIR, 'swarming_bot')
+
+
+def _generate(host):
+  return bot_archive.get_swarming_bot_zip(
+      _BOT_DIR, host, '1', {'config/bot_config.py': '# Empty.\n'}, None)
+
+
+def _time_ms(func, number):
+  return timeit.timeit(func, number=number) * 1000. / number
+
+
+class _Benchmark(test_case.TestCase):
+  """Reuses the testbed setup of the unit tests."""
+
+  def __init__(self, number):
+    super(_Benchmark, self).__init__('measure')
+    self._number = number
+
+  def _put_archive(self, content, version):
+    chunks = []
+    for offset in range(0, len(content), 500 * 1000):
+      chunks.append(
+          bot_code.BotArchiveChunk(
+              key=bot_code.bot_archive_chunk_key('%s:%d' % (version, offset)),
+              data=content[offset:offset + 500 * 1000]))
+    ndb.put_multi(chunks)
+    return bot_code.BotArchiveInfo(
+        digest=version, chunks=[c.key.id() for c in chunks])
+
+  def measure(self):
+    def cold_generate():
+      bot_archive._DEFLATED.clear()
+      _generate('https://a.example.com')
+
+    results = [
+        ('generate cold', _time_ms(cold_generate, self._number)),
+        ('generate warm',
+         _time_ms(lambda: _generate('https://a.example.com'), self._number)),
+    ]
+    hosts = iter('https://%d.example.com' % i for i in range(self._number))
+    results.append(
+        ('generate config change',
+         _time_ms(lambda: _generate(next(hosts)), self._number)))
+
+    content, version = _generate('https://a.example.com')
+    info = self._put_archive(content, version)
+
+    def cold_fetch():
+      bot_code._archive_cache.clear()
+      memcache.flush_all()
+      ndb.get_context().clear_cache()
+      info.fetch_archive()
+
+    def memcache_fetch():
+      bot_code._archive_cache.clear()
+      ndb.get_context().clear_cache()
+      info.fetch_archive()
+
+    results.extend([
+        ('serve datastore', _time_ms(cold_fetch, self._number)),
+        ('serve memcache', _time_ms(memcache_fetch, self._number)),
+        ('serve in-process', _time_ms(info.fetch_archive, self._number)),
+    ])
+    print('swarming_bot.zip: %d bytes' % len(content))
+    for name, ms in results:
+      print('%-23s %8.2fms' % (name + ':', ms))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument(
+      '--number', type=int, default=5, help='Iterations per measurement')
+  args = parser.parse_args()
+
+  bench = _Benchmark(args.number)
+  bench.setUp()
+  try:
+    bench.measure()
+  finally:
+    bench.tearDown()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
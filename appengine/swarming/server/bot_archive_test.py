@@ -3,9 +3,11 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import io
 import json
 import os
 import unittest
+import zipfile
 
 # Import before test_env, to confirm it doesn't depend on GAE.
 import bot_archive
@@ -36,6 +38,39 @@ class Test(unittest.TestCase):
   def test_file(self):
     self.assertEqual(_EXPECTED_CONFIG_KEYS, set(_read_config()))
 
+  def test_get_swarming_bot_zip(self):
+    root_dir = os.path.join(ROOT_DIR, 'swarming_bot')
+    additionals = {'config/bot_config.py': '# Empty.\n'}
+
+    def get_zip(host):
+      return bot_archive.get_swarming_bot_zip(root_dir, host, '1', additionals,
+                                              None)
+
+    # The archive is the same as the one written by zipfile.
+    expected = io.BytesIO()
+    with zipfile.ZipFile(expected, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+      for name, content in bot_archive.yield_swarming_bot_files(
+          root_dir, 'https://a', '1', additionals, None):
+        zinfo = zipfile.ZipInfo(filename=name)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.external_attr = 0o600 << 16
+        zip_file.writestr(zinfo, content)
+    bot_archive._DEFLATED.clear()
+    content, version = get_zip('https://a')
+    self.assertEqual(expected.getvalue(), content)
+    self.assertEqual(
+        bot_archive.get_swarming_bot_version(root_dir, 'https://a', '1',
+                                             additionals, None), version)
+
+    # Only config.json is deflated again when the host changes.
+    deflated = len(bot_archive._DEFLATED)
+    content, _ = get_zip('https://b')
+    self.assertEqual(deflated + 1, len(bot_archive._DEFLATED))
+    with zipfile.ZipFile(io.BytesIO(content)) as zip_file:
+      self.assertIsNone(zip_file.testzip())
+      config = json.loads(zip_file.read('config/config.json'))
+    self.assertEqual('https://b', config['server'])
+
   def test_make(self):
     settings = config_pb2.SettingsCfg()
     config = json.loads(
@@ -0,0 +1,253 @@
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Summary of the dimensions of the alive bots in each pool.
+
+    +-----------+   +-----------+
+    |BotCapacity|   |BotCapacity|
+    |id=<pool>  |...|id=<pool>  |
+    +-----------+   +-----------+
+
+It is rebuilt periodically by bot_management.cron_update_bot_info(), which
+visits all the alive bots anyway, and is used by bot_management.has_capacity()
+to find out if a task can likely run without doing datastore queries.
+
+The "key:value" dimensions of the bots of a pool are interned; each distinct
+set of dimensions of the bots is then a bitset over the interned values. The
+"id" dimension is handled separately since it is unique per bot: each bot id
+maps to the bitset of its other dimensions.
+
+Other keys with too many distinct values in a pool (e.g. "hostname" or device
+serials) would make the bitsets grow quadratically with the number of bots, so
+they are not tracked and has_capacity() returns None for them. A pool that is
+still too large is not stored at all.
+"""
+
+import json
+import logging
+import threading
+import zlib
+
+from google.appengine.ext import ndb
+
+from components import utils
+
+
+# Keys with more distinct values than this in a pool are not tracked.
+_MAX_VALUES_PER_KEY = 256
+
+# Pools whose BotCapacity would be larger than this (compressed) are not stored,
+# well below the 1MiB entity limit.
+_MAX_ENTITY_SIZE = 512 * 1024
+
+# Seconds a pool is cached in the instance.
+_POOL_CACHE_SECS = 60
+
+# {pool name: (expiration as utils.time_time(), _Pool or None)}.
+_pool_cache = {}
+_pool_cache_lock = threading.Lock()
+
+
+### Models.
+
+
+class BotCapacity(ndb.Model):
+  """Dimensions of the alive bots in a pool.
+
+  Key id is the pool name. It is a root entity, overwritten on each rebuild.
+  """
+  # When this summary was built.
+  ts = ndb.DateTimeProperty(indexed=False)
+  # Interned "key:value" dimensions, excluding "id". The bit N of a bitset
+  # refers to values[N].
+  values = ndb.StringProperty(repeated=True, indexed=False)
+  # {'sets': [bitset as hex], 'bots': {bot id: index in sets},
+  #  'skipped': [keys not tracked]}.
+  data = ndb.JsonProperty(compressed=True)
+
+
+### Private APIs.
+
+
+class _Pool(object):
+  """In-memory form of a BotCapacity."""
+
+  def __init__(self, entity):
+    self._index = {v: i for i, v in enumerate(entity.values)}
+    self._sets = [int(h, 16) for h in entity.data['sets']]
+    self._bots = entity.data['bots']
+    self._skipped = frozenset(entity.data.get('skipped', []))
+
+  def matches(self, dimensions_flat):
+    """Returns True if a bot has all these dimensions, None if unknown."""
+    if any(d.split(u':', 1)[0] in self._skipped for d in dimensions_flat):
+      return None
+    mask = 0
+    candidates = self._sets
+    for d in dimensions_flat:
+      if d.startswith(u'id:'):
+        i = self._bots.get(d[3:])
+        if i is None:
+          return False
+        candidates = [self._sets[i]]
+        continue
+      bit = self._index.get(d)
+      if bit is None:
+        # No bot has this dimension at all.
+        return False
+      mask |= 1 << bit
+    return any(s & mask == mask for s in candidates)
+
+
+class _PoolBuilder(object):
+  """Accumulates the bots of a pool before storing them in a BotCapacity."""
+
+  def __init__(self):
+    self.dimensions = []
+    # {key: set of values}, excluding "id".
+    self.key_values = {}
+
+  def add(self, dimensions_flat):
+    self.dimensions.append(dimensions_flat)
+    for d in dimensions_flat:
+      k, v = d.split(u':', 1)
+      if k != u'id':
+        self.key_values.setdefault(k, set()).add(v)
+
+  def to_entity(self, pool, now):
+    """Returns the BotCapacity, or None if it would be too large."""
+    skipped = sorted(
+        k for k, v in self.key_values.items() if len(v) > _MAX_VALUES_PER_KEY)
+    if skipped:
+      logging.warning('Pool %s: not tracking high cardinality keys %s', pool,
+                      skipped)
+    b = _BitsetsBuilder(frozenset(skipped))
+    for dimensions_flat in self.dimensions:
+      b.add(dimensions_flat)
+    data = {
+        'sets': ['%x' % s for s in b.sets],
+        'bots': b.bots,
+        'skipped': skipped,
+    }
+    size = len(zlib.compress(json.dumps(data))) + sum(len(v) for v in b.values)
+    if size > _MAX_ENTITY_SIZE:
+      logging.warning('Pool %s: capacity is too large (%d bytes), skipping',
+                      pool, size)
+      return None
+    return BotCapacity(id=pool, ts=now, values=b.values, data=data)
+
+
+class _BitsetsBuilder(object):
+  """Interns the dimensions of the bots of a pool into bitsets."""
+
+  def __init__(self, skipped):
+    self.skipped = skipped
+    self.values = []
+    self.index = {}
+    self.sets = []
+    self.sets_index = {}
+    self.bots = {}
+
+  def add(self, dimensions_flat):
+    bitset = 0
+    bot_id = None
+    for d in dimensions_flat:
+      if d.startswith(u'id:'):
+        bot_id = d[3:]
+        continue
+      if d.split(u':', 1)[0] in self.skipped:
+        continue
+      bit = self.index.get(d)
+      if bit is None:
+        bit = len(self.values)
+        self.values.append(d)
+        self.index[d] = bit
+      bitset |= 1 << bit
+    i = self.sets_index.get(bitset)
+    if i is None:
+      i = len(self.sets)
+      self.sets.append(bitset)
+      self.sets_index[bitset] = i
+    if bot_id:
+      self.bots[bot_id] = i
+
+
+def _get_pool(name):
+  """Returns the _Pool for a pool name, or None if it is not known.
+
+  Only the requested pool is fetched, and cached for _POOL_CACHE_SECS.
+  """
+  now = utils.time_time()
+  with _pool_cache_lock:
+    cached = _pool_cache.get(name)
+  if cached and now < cached[0]:
+    return cached[1]
+  entity = BotCapacity.get_by_id(name)
+  pool = _Pool(entity) if entity else None
+  with _pool_cache_lock:
+    _pool_cache[name] = (now + _POOL_CACHE_SECS, pool)
+  return pool
+
+
+### Public APIs.
+
+
+class Builder(object):
+  """Rebuilds the BotCapacity entities from all the alive bots."""
+
+  def __init__(self):
+    self._pools = {}
+
+  def add(self, dimensions_flat):
+    """Adds an alive bot."""
+    for d in dimensions_flat:
+      if d.startswith(u'pool:'):
+        self._pools.setdefault(d[5:], _PoolBuilder()).add(dimensions_flat)
+
+  def save(self):
+    """Stores the summaries and deletes the ones of pools without bots.
+
+    Pools that are too large to be stored are deleted too, so has_capacity()
+    returns None for them.
+
+    Returns:
+      Number of pools stored.
+    """
+    now = utils.utcnow()
+    entities = []
+    for p, b in sorted(self._pools.items()):
+      e = b.to_entity(p, now)
+      if e:
+        entities.append(e)
+    stored = set(e.key.id() for e in entities)
+    stale = [
+        k for k in BotCapacity.query().iter(keys_only=True)
+        if k.id() not in stored
+    ]
+    ndb.put_multi(entities)
+    if stale:
+      ndb.delete_multi(stale)
+    logging.info('Stored capacity of %d pools, deleted %d', len(entities),
+                 len(stale))
+    return len(entities)
+
+
+def has_capacity(dimensions_flat):
+  """Returns True if an alive bot had these dimensions at the last rebuild.
+
+  Arguments:
+    dimensions_flat: list of "key:value" with exactly one "pool" dimension, as
+        returned by task_queues.expand_dimensions_to_flats().
+
+  Returns:
+    True or False, or None if the pool or one of the dimension keys is not
+    tracked.
+  """
+  pools = [d[5:] for d in dimensions_flat if d.startswith(u'pool:')]
+  if len(pools) != 1:
+    return None
+  pool = _get_pool(pools[0])
+  if not pool:
+    return None
+  return pool.matches(dimensions_flat)
@@ -0,0 +1,135 @@
+#!/usr/bin/env vpython
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import logging
+import sys
+import unittest
+
+# pylint: disable=wrong-import-position
+import test_env
+test_env.setup_test_env()
+
+from components import utils
+from server import bot_capacity
+from test_support import test_case
+
+
+class BotCapacityTest(test_case.TestCase):
+  APP_DIR = test_env.APP_DIR
+
+  def setUp(self):
+    super(BotCapacityTest, self).setUp()
+    self.mock(bot_capacity, '_pool_cache', {})
+
+  def _save(self, *bots):
+    b = bot_capacity.Builder()
+    for dimensions_flat in bots:
+      b.add(dimensions_flat)
+    count = b.save()
+    bot_capacity._pool_cache.clear()
+    return count
+
+  def test_has_capacity(self):
+    self.assertEqual(
+        2,
+        self._save([u'id:bot1', u'os:Linux', u'pool:a'],
+                   [u'id:bot2', u'os:Linux', u'pool:a'],
+                   [u'gpu:none', u'id:bot3', u'os:Mac', u'pool:a', u'pool:b']))
+    # Two distinct sets of dimensions in pool 'a' once 'id' is excluded.
+    e = bot_capacity.BotCapacity.get_by_id(u'a')
+    self.assertEqual(
+        [u'os:Linux', u'pool:a', u'gpu:none', u'os:Mac', u'pool:b'], e.values)
+    self.assertEqual(['3', '1e'], e.data['sets'])
+    self.assertEqual({u'bot1': 0, u'bot2': 0, u'bot3': 1}, e.data['bots'])
+
+    self.assertEqual(True, bot_capacity.has_capacity([u'pool:a']))
+    self.assertEqual(True, bot_capacity.has_capacity([u'os:Linux', u'pool:a']))
+    self.assertEqual(
+        True, bot_capacity.has_capacity([u'gpu:none', u'os:Mac', u'pool:a']))
+    self.assertEqual(
+        False, bot_capacity.has_capacity([u'gpu:none', u'os:Linux', u'pool:a']))
+    self.assertEqual(False, bot_capacity.has_capacity([u'os:Win', u'pool:a']))
+    self.assertEqual(True, bot_capacity.has_capacity([u'os:Mac', u'pool:b']))
+    self.assertEqual(False, bot_capacity.has_capacity([u'os:Linux', u'pool:b']))
+
+    # 'id' only matches the dimensions of that bot.
+    self.assertEqual(
+        True, bot_capacity.has_capacity([u'id:bot1', u'os:Linux', u'pool:a']))
+    self.assertEqual(
+        False, bot_capacity.has_capacity([u'id:bot3', u'os:Linux', u'pool:a']))
+    self.assertEqual(False, bot_capacity.has_capacity([u'id:bot4', u'pool:a']))
+
+    # Unknown pool.
+    self.assertIsNone(bot_capacity.has_capacity([u'pool:c']))
+    self.assertIsNone(bot_capacity.has_capacity([u'os:Linux']))
+
+  def test_pool_cache(self):
+    self._save([u'id:bot1', u'os:Linux', u'pool:a'])
+    self.assertEqual(True, bot_capacity.has_capacity([u'pool:a']))
+    self.assertIsNone(bot_capacity.has_capacity([u'pool:b']))
+    # Only the requested pools were fetched.
+    self.assertEqual([u'a', u'b'], sorted(bot_capacity._pool_cache))
+
+    # Both answers are cached until they expire.
+    b = bot_capacity.Builder()
+    b.add([u'id:bot2', u'os:Mac', u'pool:b'])
+    b.save()
+    self.assertIsNone(bot_capacity.has_capacity([u'pool:b']))
+    self.assertEqual(True, bot_capacity.has_capacity([u'os:Linux', u'pool:a']))
+    now = utils.time_time()
+    self.mock(utils, 'time_time', lambda: now + bot_capacity._POOL_CACHE_SECS)
+    self.assertEqual(True, bot_capacity.has_capacity([u'pool:b']))
+    self.assertIsNone(bot_capacity.has_capacity([u'os:Linux', u'pool:a']))
+
+  def test_save_deletes_stale_pools(self):
+    self._save([u'id:bot1', u'pool:a'], [u'id:bot2', u'pool:b'])
+    self.assertEqual(1, self._save([u'id:bot1', u'pool:a']))
+    self.assertEqual([u'a'], [
+        k.id() for k in bot_capacity.BotCapacity.query().iter(keys_only=True)
+    ])
+    self.assertIsNone(bot_capacity.has_capacity([u'pool:b']))
+
+  def test_high_cardinality_keys(self):
+    bots = [[
+        u'hostname:host%d' % i,
+        u'id:bot%d' % i,
+        u'os:Linux',
+        u'pool:a',
+        u'serial:%d' % (i % 10),
+    ] for i in range(bot_capacity._MAX_VALUES_PER_KEY + 1)]
+    self.assertEqual(1, self._save(*bots))
+    e = bot_capacity.BotCapacity.get_by_id(u'a')
+    self.assertEqual([u'hostname'], e.data['skipped'])
+    self.assertFalse([v for v in e.values if v.startswith(u'hostname:')])
+    self.assertEqual(10, len(e.data['sets']))
+
+    self.assertEqual(True, bot_capacity.has_capacity([u'os:Linux', u'pool:a']))
+    self.assertEqual(True, bot_capacity.has_capacity([u'pool:a', u'serial:3']))
+    self.assertEqual(
+        True, bot_capacity.has_capacity([u'id:bot13', u'pool:a', u'serial:3']))
+    self.assertEqual(False, bot_capacity.has_capacity([u'pool:a', u'serial:X']))
+    # Falls back to the BotInfo query.
+    self.assertIsNone(
+        bot_capacity.has_capacity([u'hostname:host1', u'pool:a']))
+    self.assertIsNone(
+        bot_capacity.has_capacity([u'hostname:unknown', u'pool:a']))
+
+  def test_save_skips_large_pools(self):
+    self._save([u'id:bot1', u'pool:a'], [u'id:bot2', u'pool:b'])
+    self.mock(bot_capacity, '_MAX_ENTITY_SIZE', 1000)
+    # Many distinct sets of dimensions.
+    bots = [[u'id:bot%d' % i, u'pool:a', u'key%d:1' % i] for i in range(200)]
+    self.assertEqual(1, self._save([u'id:bot2', u'pool:b'], *bots))
+    self.assertIsNone(bot_capacity.BotCapacity.get_by_id(u'a'))
+    self.assertIsNone(bot_capacity.has_capacity([u'pool:a']))
+    self.assertEqual(True, bot_capacity.has_capacity([u'pool:b']))
+
+
+if __name__ == '__main__':
+  if '-v' in sys.argv:
+    unittest.TestCase.maxDiff = None
+  logging.basicConfig(
+      level=logging.DEBUG if '-v' in sys.argv else logging.CRITICAL)
+  unittest.main()
@@ -11,8 +11,11 @@ bot_archive.py.
 import ast
 import collections
 import hashlib
+import io
 import logging
 import os.path
+import threading
+import zipfile
 
 from six.moves import urllib
 
@@ -50,10 +53,45 @@ class BotArchiveInfo(ndb.Model):
   bot_config_rev = ndb.StringProperty(indexed=False, name='BotConfigRev')
 
   def fetch_archive(self):
-    """Produces a blob with the bot archive."""
-    chunks = ndb.get_multi(
-        [bot_archive_chunk_key(chunk) for chunk in self.chunks])
-    return ''.join([chunk.data for chunk in chunks])
+    """Produces a blob with the bot archive.
+
+    The archive is looked up in the in-process cache first. Otherwise it is
+    assembled from BotArchiveChunk entities, that ndb caches in memcache since
+    they are immutable.
+    """
+    key = (self.digest, tuple(self.chunks))
+    blob = _archive_cache.get(key)
+    if blob is None:
+      chunks = ndb.get_multi(
+          [bot_archive_chunk_key(chunk) for chunk in self.chunks])
+      blob = ''.join([chunk.data for chunk in chunks])
+      _archive_cache.put(key, blob)
+    return blob
+
+  def fetch_manifest(self):
+    """Returns {file name: SHA256 hex digest} of the files in the archive.
+
+    Bots use it to download only the files that changed, see fetch_files().
+    """
+    key = (self.digest, tuple(self.chunks))
+    manifest = _manifest_cache.get(key)
+    if manifest is None:
+      with zipfile.ZipFile(io.BytesIO(self.fetch_archive())) as z:
+        manifest = {
+            name: hashlib.sha256(z.read(name)).hexdigest()
+            for name in z.namelist()
+        }
+      _manifest_cache.put(key, manifest)
+    return manifest
+
+  def fetch_files(self, names):
+    """Returns {file name: content} for files in the archive.
+
+    Raises:
+      KeyError if a file is not in the archive.
+    """
+    with zipfile.ZipFile(io.BytesIO(self.fetch_archive())) as z:
+      return {name: z.read(name) for name in names}
 
 
 class ConfigBundleRev(ndb.Model):
@@ -82,6 +120,46 @@ class BotArchiveChunk(ndb.Model):
   data = ndb.BlobProperty(indexed=False, name='Data')
 
 
+### Private stuff.
+
+
+class _ArchiveCache(object):
+  """In-process LRU cache of bot archives keyed by version and chunks.
+
+  Bot archives are immutable once written, so entries never need to be
+  invalidated. Only a few are kept since each is a few MB.
+  """
+
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._lock = threading.Lock()
+    self._blobs = collections.OrderedDict()
+
+  def get(self, key):
+    with self._lock:
+      blob = self._blobs.pop(key, None)
+      if blob is not None:
+        self._blobs[key] = blob
+      return blob
+
+  def put(self, key, blob):
+    with self._lock:
+      self._blobs.pop(key, None)
+      self._blobs[key] = blob
+      while len(self._blobs) > self._max_size:
+        self._blobs.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._blobs.clear()
+
+
+# Enough for the stable and canary archives and the ones they replace.
+_archive_cache = _ArchiveCache(4)
+# Manifests of the same archives, see BotArchiveInfo.fetch_manifest().
+_manifest_cache = _ArchiveCache(4)
+
+
 ### Public APIs.
 
 # Returned by get_bot_channel for stable bots.
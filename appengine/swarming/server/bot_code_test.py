@@ -11,6 +11,8 @@ import unittest
 import test_env
 test_env.setup_test_env()
 
+from google.appengine.ext import ndb
+
 from components import auth
 from test_support import test_case
 
@@ -73,6 +75,22 @@ class BotManagementTest(test_case.TestCase):
         ('canary-digest', 'canary-rev'),
     )
 
+  def test_fetch_archive(self):
+    bot_code._archive_cache.clear()
+    bot_code.BotArchiveChunk(
+        key=bot_code.bot_archive_chunk_key('v1:0'), data='abc').put()
+    bot_code.BotArchiveChunk(
+        key=bot_code.bot_archive_chunk_key('v1:3'), data='def').put()
+    info = bot_code.BotArchiveInfo(digest='v1', chunks=['v1:0', 'v1:3'])
+    self.assertEqual('abcdef', info.fetch_archive())
+
+    # The archive is then served from the in-process cache.
+    ndb.delete_multi([
+        bot_code.bot_archive_chunk_key('v1:0'),
+        bot_code.bot_archive_chunk_key('v1:3'),
+    ])
+    self.assertEqual('abcdef', info.fetch_archive())
+
   def test_get_bootstrap(self):
     def get_self_config_mock(path, revision=None, store_last_good=False):
       self.assertEqual('scripts/bootstrap.py', path)
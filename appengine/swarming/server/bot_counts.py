@@ -0,0 +1,406 @@
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Incrementally maintained counts of bots per state, used by CountBots.
+
+    +-------------------------+   +-------------------------+
+    |BotCountShard            |   |BotCountShard            |
+    |id=<gen>:<shard>:<scope> |...|id=<gen>:<shard>:<scope> |
+    +-------------------------+   +-------------------------+
+
+    +-----------------+
+    |BotCountsState   |
+    |id=state         |
+    +-----------------+
+
+A scope is a set of "key:value" dimensions, e.g. "pool:foo" and "os:Linux". A
+bot is counted in:
+  - the empty scope, i.e. all bots;
+  - one scope per each of its dimensions;
+  - one scope per each (pool, other dimension) pair.
+Dimensions that are unique per bot, like "id", are skipped, otherwise the
+number of scopes would grow with the size of the fleet.
+
+Each scope is sharded in _NUM_SHARDS BotCountShard entities to reduce
+contention. Transitions of the bot state (as reflected by BotInfo.composite) and
+dimensions are handed to the update-bot-counts task queue, which applies the
+deltas of a bot to a random shard of each affected scope, so the bot_event()
+hot path doesn't run one transaction per scope. Reading a scope costs a single
+get_multi() of its shards.
+
+Updates are best effort: BotInfo entities can disappear through the Cloud
+Datastore TTL policy and counter updates can fail. reconcile() is called
+periodically to fix the drift. It builds the counts of a new generation; the
+deltas tagged with an older generation, e.g. a task that ran late, land in
+shards that are not read anymore. Counts are neither maintained nor used until
+the first reconciliation, see BotCountsState.
+"""
+
+import collections
+import json
+import logging
+import random
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+from components import datastore_utils
+from components import utils
+from server.constants import OR_DIM_SEP
+
+
+# Number of BotCountShard entities per scope.
+_NUM_SHARDS = 16
+
+# Separator between dimensions in a scope string.
+_SCOPE_SEP = u'\n'
+
+# Keys of the dimensions whose value is usually unique per bot. They get no
+# scope.
+_PER_BOT_KEYS = frozenset([u'id', u'dut_id', u'dut_name', u'hostname'])
+
+# Maximum number of concurrent transactions.
+_MAX_CONCURRENT = 50
+
+
+BotState = collections.namedtuple(
+    'BotState',
+    [
+        # tuple of "key:value" strings.
+        'dimensions_flat',
+        # bool, BotInfo.DEAD is in BotInfo.composite.
+        'dead',
+        # bool, BotInfo.QUARANTINED is in BotInfo.composite.
+        'quarantined',
+        # bool, BotInfo.IN_MAINTENANCE is in BotInfo.composite.
+        'maintenance',
+        # bool, BotInfo.BUSY is in BotInfo.composite.
+        'busy',
+    ])
+
+
+Counts = collections.namedtuple(
+    'Counts', ['count', 'dead', 'quarantined', 'maintenance', 'busy'])
+
+
+_ZERO = Counts(0, 0, 0, 0, 0)
+
+
+### Models.
+
+
+class BotCountShard(ndb.Model):
+  """One shard of the counts for a scope in a generation.
+
+  Key id is '<generation>:<shard>:<scope>'. It is a root entity, updated in a
+  transaction.
+  """
+  generation = ndb.IntegerProperty(indexed=False)
+  scope = ndb.StringProperty(indexed=False)
+  count = ndb.IntegerProperty(indexed=False, default=0)
+  dead = ndb.IntegerProperty(indexed=False, default=0)
+  quarantined = ndb.IntegerProperty(indexed=False, default=0)
+  maintenance = ndb.IntegerProperty(indexed=False, default=0)
+  busy = ndb.IntegerProperty(indexed=False, default=0)
+
+  def to_counts(self):
+    return Counts(self.count, self.dead, self.quarantined, self.maintenance,
+                  self.busy)
+
+  def add(self, delta):
+    self.count += delta.count
+    self.dead += delta.dead
+    self.quarantined += delta.quarantined
+    self.maintenance += delta.maintenance
+    self.busy += delta.busy
+
+
+class BotCountsState(ndb.Model):
+  """Singleton tracking if the counts can be trusted and their generation.
+
+  Key id is 'state'.
+  """
+  # Last time reconcile() completed.
+  reconciled_ts = ndb.DateTimeProperty(indexed=False)
+  # Generation of the shards read by get_counts().
+  generation = ndb.IntegerProperty(indexed=False, default=0)
+  # Generation being built by a reconcile() in progress, if any. The deltas
+  # are applied to both generations meanwhile.
+  next_generation = ndb.IntegerProperty(indexed=False)
+
+
+### Private APIs.
+
+
+def _state_key():
+  return ndb.Key(BotCountsState, 'state')
+
+
+def _shard_key(generation, scope, shard):
+  return ndb.Key(BotCountShard, u'%d:%d:%s' % (generation, shard, scope))
+
+
+def _scope(dimensions_flat):
+  """Returns the scope string for a list of "key:value" dimensions."""
+  return _SCOPE_SEP.join(sorted(set(dimensions_flat)))
+
+
+def _is_per_bot(dimension):
+  return dimension.split(u':', 1)[0] in _PER_BOT_KEYS
+
+
+def _scopes(dimensions_flat):
+  """Returns the scopes a bot with these dimensions is counted in."""
+  dims = sorted(d for d in set(dimensions_flat) if not _is_per_bot(d))
+  pools = [d for d in dims if d.startswith(u'pool:')]
+  scopes = [u''] + dims
+  for p in pools:
+    scopes.extend(
+        _scope([p, d]) for d in dims if not d.startswith(u'pool:'))
+  return scopes
+
+
+def _to_counts(state):
+  return Counts(1, int(state.dead), int(state.quarantined),
+                int(state.maintenance), int(state.busy))
+
+
+def _add(a, b, sign=1):
+  return Counts(*(x + sign * y for x, y in zip(a, b)))
+
+
+def _deltas(before, after):
+  """Returns {scope: Counts} to apply to transition from before to after."""
+  deltas = {}
+  for state, sign in ((before, -1), (after, 1)):
+    if not state:
+      continue
+    counts = _to_counts(state)
+    for scope in _scopes(state.dimensions_flat):
+      deltas[scope] = _add(deltas.get(scope, _ZERO), counts, sign)
+  return {s: d for s, d in deltas.items() if d != _ZERO}
+
+
+@ndb.tasklet
+def _add_async(generation, scope, shard, delta):
+  """Transactionally adds delta to one shard of the scope."""
+  key = _shard_key(generation, scope, shard)
+
+  @ndb.tasklet
+  def txn():
+    entity = yield key.get_async()
+    if not entity:
+      entity = BotCountShard(key=key, generation=generation, scope=scope)
+    entity.add(delta)
+    yield entity.put_async()
+
+  yield datastore_utils.transaction_async(txn, retries=3)
+
+
+def _wait_limited(calls, check):
+  """Runs the futures returned by calls with at most _MAX_CONCURRENT at once.
+
+  check() is called with each future once it is done.
+  """
+  futures = []
+  for call in calls:
+    futures.append(call())
+    if len(futures) > _MAX_CONCURRENT:
+      ndb.Future.wait_any(futures)
+      for f in futures:
+        if f.done():
+          check(f)
+      futures = [f for f in futures if not f.done()]
+  for f in futures:
+    check(f)
+
+
+### Public APIs.
+
+
+def can_count(dimensions_flat):
+  """Returns True if get_counts() can answer for these dimensions.
+
+  OR dimensions and per-bot dimensions are not supported, neither is more than
+  one dimension except for the combination of a pool and another dimension.
+  """
+  dims = set(dimensions_flat)
+  if any(OR_DIM_SEP in d or _is_per_bot(d) for d in dims):
+    return False
+  if len(dims) <= 1:
+    return True
+  if len(dims) == 2:
+    return len([d for d in dims if d.startswith(u'pool:')]) == 1
+  return False
+
+
+def update(before, after):
+  """Updates the counts for a bot going from state before to after.
+
+  The deltas are tagged with the current generations and applied by the
+  update-bot-counts task queue, see apply_deltas(). They are dropped until the
+  first reconcile() started, since it counts all the bots anyway.
+
+  Arguments:
+    before: BotState as stored before the change, or None if there was no
+        BotInfo.
+    after: BotState as stored after the change, or None if BotInfo was
+        deleted.
+  """
+  deltas = _deltas(before, after)
+  if not deltas:
+    return
+  state = _state_key().get()
+  if not state:
+    return
+  generations = [state.generation]
+  if state.next_generation:
+    generations.append(state.next_generation)
+  payload = utils.encode_to_json({
+      'generations': generations,
+      'deltas': {s: list(d) for s, d in deltas.items()},
+  })
+  if not utils.enqueue_task(
+      '/internal/taskqueue/important/bots/update-bot-counts',
+      'update-bot-counts',
+      payload=payload):
+    # The drift is fixed by the next reconcile().
+    logging.warning('Failed to enqueue bot counts update')
+
+
+def apply_deltas(payload):
+  """Applies the deltas enqueued by update().
+
+  Failures are logged and not retried, since the deltas already applied would
+  be applied twice. The drift is fixed by the next reconcile().
+
+  Returns:
+    Number of shards updated.
+  """
+  data = json.loads(payload)
+  stats = {'updated': 0}
+
+  def check(f):
+    try:
+      f.get_result()
+      stats['updated'] += 1
+    except (datastore_errors.Error, datastore_utils.CommitError) as e:
+      logging.warning('Failed to update bot counts: %s', e)
+
+  shard = random.randint(0, _NUM_SHARDS - 1)
+  _wait_limited(
+      (lambda g=g, s=s, d=d: _add_async(g, s, shard, Counts(*d))
+       for g in data['generations'] for s, d in data['deltas'].items()),
+      check)
+  return stats['updated']
+
+
+def get_counts(dimensions_flat):
+  """Returns Counts for the bots matching all dimensions.
+
+  Returns None if the counts are not usable yet, e.g. reconcile() never ran.
+  """
+  assert can_count(dimensions_flat), dimensions_flat
+  state = _state_key().get()
+  if not state or not state.reconciled_ts:
+    return None
+  scope = _scope(dimensions_flat)
+  total = _ZERO
+  for e in ndb.get_multi(
+      [_shard_key(state.generation, scope, i) for i in range(_NUM_SHARDS)]):
+    if e:
+      total = _add(total, e.to_counts())
+  # Drift can temporarily make a counter negative.
+  return Counts(*(max(0, x) for x in total))
+
+
+def reconcile(states):
+  """Rebuilds the counts from the actual bots in a new generation.
+
+  The deltas enqueued while the bots are being scanned are applied to both the
+  current and the new generation. Once the new generation is complete, it is
+  the one read by get_counts() and the shards of the older ones are deleted.
+
+  Arguments:
+    states: iterable of BotState for all the BotInfo entities. It must be
+        lazy, the bots must be scanned once the new generation started.
+
+  Concurrent updates happening while the bots are being scanned may still be
+  off; they are fixed at the next run.
+
+  Returns:
+    Number of scopes whose counts had drifted.
+
+  Raises:
+    datastore_utils.CommitError if a correction failed to be committed.
+  """
+  @ndb.transactional
+  def start():
+    state = _state_key().get() or BotCountsState(key=_state_key())
+    state.next_generation = max(state.generation,
+                                state.next_generation or 0) + 1
+    state.put()
+    return state.generation, state.next_generation
+
+  old, new = start()
+
+  expected = {}
+  for state in states:
+    counts = _to_counts(state)
+    for scope in _scopes(state.dimensions_flat):
+      expected[scope] = _add(expected.get(scope, _ZERO), counts)
+
+  # Sum of the shards of the current and the new generation. The latter only
+  # holds the deltas enqueued since start().
+  actual_old = {}
+  actual_new = {}
+  stale = []
+  for e in BotCountShard.query():
+    if e.generation == new:
+      actual_new[e.scope] = _add(actual_new.get(e.scope, _ZERO),
+                                 e.to_counts())
+      continue
+    if e.generation == old:
+      actual_old[e.scope] = _add(actual_old.get(e.scope, _ZERO),
+                                 e.to_counts())
+    stale.append(e.key)
+
+  fixes = {}
+  drifted = 0
+  for scope in set(expected) | set(actual_old) | set(actual_new):
+    counts = expected.get(scope, _ZERO)
+    # The deltas enqueued since start() went to both generations.
+    before = _add(actual_old.get(scope, _ZERO), actual_new.get(scope, _ZERO),
+                  -1)
+    if counts != before:
+      drifted += 1
+    fix = _add(counts, actual_new.get(scope, _ZERO), -1)
+    if fix != _ZERO:
+      fixes[scope] = fix
+
+  _wait_limited(
+      (lambda s=s, d=d: _add_async(new, s, 0, d) for s, d in fixes.items()),
+      lambda f: f.check_success())
+
+  @ndb.transactional
+  def switch():
+    state = _state_key().get()
+    if state.next_generation != new:
+      return False
+    state.generation = new
+    state.next_generation = None
+    state.reconciled_ts = utils.utcnow()
+    state.put()
+    return True
+
+  if not switch():
+    logging.warning('Concurrent bot counts reconciliation, dropping %d', new)
+    return 0
+  # Late deltas tagged with an older generation may still recreate some of
+  # these, they are deleted at the next run.
+  ndb.delete_multi(stale)
+  logging.info(
+      'Reconciled bot counts: %d scopes, %d drifted, %d stale shards deleted',
+      len(expected), drifted, len(stale))
+  return drifted
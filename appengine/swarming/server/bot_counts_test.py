@@ -0,0 +1,229 @@
+#!/usr/bin/env vpython
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import logging
+import sys
+import unittest
+
+# pylint: disable=wrong-import-position
+import test_env
+test_env.setup_test_env()
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+from components import utils
+from server import bot_counts
+from test_support import test_case
+
+
+def _state(dimensions_flat, dead=False, quarantined=False, maintenance=False,
+           busy=False):
+  return bot_counts.BotState(
+      dimensions_flat=tuple(dimensions_flat),
+      dead=dead,
+      quarantined=quarantined,
+      maintenance=maintenance,
+      busy=busy)
+
+
+_DIMS = (u'id:bot1', u'os:Linux', u'pool:a')
+
+
+class BotCountsTest(test_case.TestCase):
+  APP_DIR = test_env.APP_DIR
+
+  def setUp(self):
+    super(BotCountsTest, self).setUp()
+    # Payloads of the update-bot-counts tasks not run yet.
+    self._payloads = []
+    # Run the tasks right away unless a test overrides it.
+    self._defer = False
+    self.mock(utils, 'enqueue_task', self._enqueue_task)
+
+  def _enqueue_task(self, url, queue_name, payload):
+    self.assertEqual(
+        '/internal/taskqueue/important/bots/update-bot-counts', url)
+    self.assertEqual('update-bot-counts', queue_name)
+    if self._defer:
+      self._payloads.append(payload)
+    else:
+      bot_counts.apply_deltas(payload)
+    return True
+
+  def _run_tasks(self):
+    payloads, self._payloads = self._payloads, []
+    return [bot_counts.apply_deltas(p) for p in payloads]
+
+  def test_scopes(self):
+    # The per-bot 'id' dimension gets no scope.
+    expected = [
+        u'',
+        u'os:Linux',
+        u'pool:a',
+        u'os:Linux\npool:a',
+    ]
+    self.assertEqual(expected, bot_counts._scopes(_DIMS))
+
+  def test_can_count(self):
+    self.assertTrue(bot_counts.can_count([]))
+    self.assertTrue(bot_counts.can_count([u'os:Linux']))
+    self.assertTrue(bot_counts.can_count([u'pool:a', u'os:Linux']))
+    self.assertFalse(bot_counts.can_count([u'os:Linux|Mac']))
+    self.assertFalse(bot_counts.can_count([u'pool:a', u'pool:b']))
+    self.assertFalse(bot_counts.can_count([u'gpu:none', u'os:Linux']))
+    self.assertFalse(
+        bot_counts.can_count([u'pool:a', u'gpu:none', u'os:Linux']))
+    self.assertFalse(bot_counts.can_count([u'id:bot1']))
+    self.assertFalse(bot_counts.can_count([u'pool:a', u'id:bot1']))
+
+  def test_get_counts_not_reconciled(self):
+    self._defer = True
+    bot_counts.update(None, _state(_DIMS))
+    # Nothing is maintained until the first reconciliation.
+    self.assertEqual([], self._payloads)
+    self.assertIsNone(bot_counts.get_counts([u'pool:a']))
+
+  def test_update(self):
+    self.assertEqual(0, bot_counts.reconcile([]))
+    bot_counts.update(None, _state(_DIMS))
+    bot_counts.update(None, _state([u'id:bot2', u'os:Mac', u'pool:a']))
+    self.assertEqual(
+        bot_counts.Counts(2, 0, 0, 0, 0), bot_counts.get_counts([u'pool:a']))
+
+    # Transition to busy then quarantined and dead.
+    bot_counts.update(_state(_DIMS), _state(_DIMS, busy=True))
+    bot_counts.update(
+        _state(_DIMS, busy=True),
+        _state(_DIMS, dead=True, quarantined=True, busy=True))
+    self.assertEqual(
+        bot_counts.Counts(2, 1, 1, 0, 1), bot_counts.get_counts([u'pool:a']))
+    self.assertEqual(
+        bot_counts.Counts(1, 1, 1, 0, 1),
+        bot_counts.get_counts([u'pool:a', u'os:Linux']))
+    self.assertEqual(
+        bot_counts.Counts(1, 0, 0, 0, 0), bot_counts.get_counts([u'os:Mac']))
+
+    # Dimensions change.
+    bot_counts.update(
+        _state([u'id:bot2', u'os:Mac', u'pool:a']),
+        _state([u'id:bot2', u'os:Linux', u'pool:a'], maintenance=True))
+    self.assertEqual(
+        bot_counts.Counts(0, 0, 0, 0, 0), bot_counts.get_counts([u'os:Mac']))
+    self.assertEqual(
+        bot_counts.Counts(2, 1, 1, 1, 1), bot_counts.get_counts([u'os:Linux']))
+
+    # Deletion.
+    bot_counts.update(_state([u'id:bot2', u'os:Linux', u'pool:a']), None)
+    self.assertEqual(
+        bot_counts.Counts(1, 1, 1, 0, 1), bot_counts.get_counts([]))
+
+  def test_update_noop(self):
+    self.assertEqual(0, bot_counts.reconcile([]))
+    self._defer = True
+    bot_counts.update(_state(_DIMS), _state(_DIMS))
+    # Only the per-bot dimension changed.
+    bot_counts.update(
+        _state(_DIMS), _state([u'id:bot2', u'os:Linux', u'pool:a']))
+    self.assertEqual([], self._payloads)
+
+  def test_apply_deltas(self):
+    self.assertEqual(0, bot_counts.reconcile([]))
+    self._defer = True
+    bot_counts.update(None, _state(_DIMS))
+    bot_counts.update(_state(_DIMS), _state(_DIMS, busy=True))
+    # One task per update, one shard per scope.
+    self.assertEqual([4, 4], self._run_tasks())
+    self.assertEqual(
+        bot_counts.Counts(1, 0, 0, 0, 1), bot_counts.get_counts([u'pool:a']))
+
+  def test_apply_deltas_datastore_error(self):
+    self.assertEqual(0, bot_counts.reconcile([]))
+
+    def add_async(*_args):
+      f = ndb.Future()
+      f.set_exception(datastore_errors.Timeout())
+      return f
+
+    self.mock(bot_counts, '_add_async', add_async)
+    # It's logged, not raised. The drift is fixed by reconcile().
+    self._defer = True
+    bot_counts.update(None, _state(_DIMS))
+    self.assertEqual([0], self._run_tasks())
+    self.assertEqual(
+        bot_counts.Counts(0, 0, 0, 0, 0), bot_counts.get_counts([u'pool:a']))
+
+  def test_reconcile(self):
+    self.assertEqual(0, bot_counts.reconcile([]))
+    bot_counts.update(None, _state(_DIMS))
+    bot_counts.update(None, _state([u'id:bot2', u'pool:b']))
+    states = [
+        _state(_DIMS, busy=True),
+        _state([u'id:bot3', u'os:Linux', u'pool:a']),
+    ]
+    # The 4 scopes of bot1 are corrected since it is now busy and bot3 was
+    # added, 'pool:b' is gone.
+    self.assertEqual(5, bot_counts.reconcile(states))
+    self.assertEqual(
+        bot_counts.Counts(2, 0, 0, 0, 1), bot_counts.get_counts([]))
+    self.assertEqual(
+        bot_counts.Counts(2, 0, 0, 0, 1), bot_counts.get_counts([u'pool:a']))
+    # The scopes of bot2 were deleted.
+    self.assertEqual(
+        bot_counts.Counts(0, 0, 0, 0, 0), bot_counts.get_counts([u'pool:b']))
+    # Only the shards of the current generation are left.
+    generation = bot_counts._state_key().get().generation
+    shards = bot_counts.BotCountShard.query().fetch()
+    self.assertEqual(
+        set(bot_counts._scopes(_DIMS)), set(e.scope for e in shards))
+    self.assertEqual(set([generation]), set(e.generation for e in shards))
+
+    # Nothing to fix the second time.
+    self.assertEqual(0, bot_counts.reconcile(states))
+
+  def test_reconcile_late_deltas(self):
+    self.assertEqual(0, bot_counts.reconcile([]))
+    self._defer = True
+    bot_counts.update(None, _state(_DIMS))
+    # The bot is counted by the scan before its task ran.
+    self.assertEqual(4, bot_counts.reconcile([_state(_DIMS)]))
+    self.assertEqual([4], self._run_tasks())
+    # The late deltas went to the previous generation, they are not counted
+    # twice.
+    self.assertEqual(
+        bot_counts.Counts(1, 0, 0, 0, 0), bot_counts.get_counts([]))
+    # The shards they recreated are deleted by the next run.
+    self.assertEqual(0, bot_counts.reconcile([_state(_DIMS)]))
+    generation = bot_counts._state_key().get().generation
+    self.assertEqual(
+        set([generation]),
+        set(e.generation for e in bot_counts.BotCountShard.query()))
+
+  def test_reconcile_concurrent_deltas(self):
+    self.assertEqual(0, bot_counts.reconcile([]))
+    bot2 = _state([u'id:bot2', u'os:Linux', u'pool:a'])
+
+    def states():
+      # The bot is added while the bots are being scanned, and the scan sees
+      # it.
+      bot_counts.update(None, bot2)
+      yield _state(_DIMS)
+      yield bot2
+
+    self.assertEqual(4, bot_counts.reconcile(states()))
+    self.assertEqual(
+        bot_counts.Counts(2, 0, 0, 0, 0), bot_counts.get_counts([u'pool:a']))
+    # bot2 disappears without an update, e.g. through the TTL policy.
+    self.assertEqual(4, bot_counts.reconcile([_state(_DIMS)]))
+    self.assertEqual(
+        bot_counts.Counts(1, 0, 0, 0, 0), bot_counts.get_counts([u'pool:a']))
+
+
+if __name__ == '__main__':
+  if '-v' in sys.argv:
+    unittest.TestCase.maxDiff = None
+  logging.basicConfig(
+      level=logging.DEBUG if '-v' in sys.argv else logging.CRITICAL)
+  unittest.main()
@@ -31,14 +31,21 @@
   state of every bots in an single query. It is basically a cache of the last
   BotEvent and additionally updated on poll. It doesn't need to be updated in a
   transaction.
+  Idle polls that only refresh BotInfo can be kept in a per-instance
+  write-behind buffer and stored in batches by a task queue, see
+  flush_bot_info_buffer().
 - BotSettings contains bot-specific settings. It must be updated in a
   transaction and contains admin-provided settings, contrary to the other
   entities which are generated from data provided by the bot itself.
 """
 
+import base64
+import copy
 import datetime
 import functools
+import json
 import logging
+import threading
 import time
 
 from google.appengine.api import datastore_errors
@@ -47,6 +54,8 @@ from google.appengine.ext import ndb
 from components import datastore_utils
 from components import utils
 from proto.api import swarming_pb2  # pylint: disable=no-name-in-module
+from server import bot_capacity
+from server import bot_counts
 from server import config
 from server import task_pack
 from server import task_queues
@@ -58,6 +67,11 @@ _OLD_BOT_EVENTS_CUT_OFF = datetime.timedelta(days=4 * 7)
 # BotInfo entities are deleted when they are older than the cutoff.
 _OLD_BOT_INFO_CUT_OFF = _OLD_BOT_EVENTS_CUT_OFF + datetime.timedelta(hours=4)
 
+# Maximum number of BotInfo in the write-behind buffer before it is flushed.
+_WRITE_BEHIND_MAX = 500
+# Maximum size of the encoded BotInfo sent in a single flush-bot-info task.
+_WRITE_BEHIND_PAYLOAD_MAX = 90 * 1024
+
 
 ### Models.
 
@@ -264,6 +278,16 @@ class BotInfo(_BotCommon):
     assert self.composite, 'Please store first'
     return self.DEAD in self.composite
 
+  def counts_state(self):
+    """Returns the bot_counts.BotState of this bot as stored."""
+    assert self.composite, 'Please store first'
+    return bot_counts.BotState(
+        dimensions_flat=tuple(self.dimensions_flat),
+        dead=self.DEAD in self.composite,
+        quarantined=self.QUARANTINED in self.composite,
+        maintenance=self.IN_MAINTENANCE in self.composite,
+        busy=self.BUSY in self.composite)
+
   def to_dict(self, exclude=None):
     out = super(BotInfo, self).to_dict(exclude=exclude)
     # Inject the bot id, since it's the entity key.
@@ -643,6 +667,9 @@ def _snapshot_bot_info(bot_info):
 _FREQUENT_EVENTS = frozenset(
     ['request_sleep', 'task_update', 'bot_idle', 'bot_polling'])
 
+# Idle polls, whose BotInfo update can go through the write-behind buffer.
+_IDLE_POLL_EVENTS = frozenset(['request_sleep', 'bot_idle', 'bot_polling'])
+
 # Events that may result in creation of new BotInfo entities (i.e. a new bot
 # appearing). Most often this is just bot_connected.
 _HEALTHY_BOT_EVENTS = frozenset([
@@ -711,6 +738,69 @@ def _insert_bot_with_txn(root_key, bot_info, event):
       time.sleep(delay)
 
 
+def _write_behind_secs():
+  """Returns how long BotInfo only refreshed by an idle poll can be buffered.
+
+  It is settings.cfg's bot_info_write_behind_secs, 0 disables the write-behind
+  buffer and stores each BotInfo right away.
+
+  The buffer of an instance is handed to a task queue by the next bot_event()
+  on this instance once it is due. An instance that stops receiving requests
+  keeps its buffer, so an idle poll is only buffered if the stored BotInfo was
+  seen less than twice this delay ago. This bounds how stale the stored
+  last_seen_ts can get, which must stay well below the bot death timeout.
+  """
+  return config.settings().bot_info_write_behind_secs
+
+
+class _BotInfoBuffer(object):
+  """Write-behind buffer of the BotInfo updated by idle polls.
+
+  It is per instance. The latest BotInfo of a bot replaces the pending one. It
+  holds copies, so the buffered entities are not shared with the requests.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # {bot_id: BotInfo}.
+    self._pending = {}
+    # time.time() when the oldest pending BotInfo was buffered.
+    self._since = None
+
+  def add(self, bot_info):
+    """Buffers a copy of a BotInfo."""
+    bot_info = copy.deepcopy(bot_info)
+    now = time.time()
+    with self._lock:
+      if not self._pending:
+        self._since = now
+      self._pending[bot_info.key.parent().id()] = bot_info
+
+  def take_due(self, delay):
+    """Returns all the pending BotInfo and empties the buffer if it is due.
+
+    The buffer is due once its oldest BotInfo is |delay| seconds old or when it
+    is full. Returns an empty list otherwise.
+    """
+    now = time.time()
+    with self._lock:
+      if not self._pending or (len(self._pending) < _WRITE_BEHIND_MAX and
+                               now - self._since < delay):
+        return []
+      pending = list(self._pending.values())
+      self._pending = {}
+      self._since = None
+      return pending
+
+  def discard(self, bot_id):
+    """Forgets the pending BotInfo of a bot, as a more recent one is stored."""
+    with self._lock:
+      self._pending.pop(bot_id, None)
+
+
+_bot_info_buffer = _BotInfoBuffer()
+
+
 def bot_event(event_type,
               bot_id,
               task_id=None,
@@ -777,8 +867,17 @@ def bot_event(event_type,
   # here. In the worst case some intermediary state changes won't be properly
   # recorded.
   info_key = get_info_key(bot_id)
+  # The BotInfo of this bot pending in the write-behind buffer, if any, is not
+  # used as the base. The stored one may have been updated by another instance
+  # since then, and it is what bot_counts is based on. The pending one is
+  # superseded by this event either way.
+  write_behind_secs = _write_behind_secs()
+  flush_bot_info_buffer(write_behind_secs)
   bot_info = info_key.get(use_cache=False, use_memcache=False)
   store_bot_info = True
+  # The state of the bot as counted in bot_counts, before any changes.
+  counts_before = (
+      bot_info.counts_state() if bot_info and bot_info.composite else None)
   if not bot_info:
     # Register only id and pool dimensions at the first handshake.
     bot_info = BotInfo(
@@ -803,6 +902,7 @@ def bot_event(event_type,
 
   # Use the exact same timestamp in both BotInfo and BotEvent for consistency.
   now = utils.utcnow()
+  last_seen_before = bot_info.last_seen_ts
 
   # Snapshot the state before any changes, used in _should_store_event.
   state_before = _snapshot_bot_info(bot_info)
@@ -849,16 +949,116 @@ def bot_event(event_type,
                      last_seen_ts=bot_info.last_seen_ts,
                      idle_since_ts=bot_info.idle_since_ts,
                      message=event_msg)
+    if store_bot_info:
+      _bot_info_buffer.discard(bot_id)
     _insert_bot_with_txn(info_key.root(), bot_info if store_bot_info else None,
                          event)
+    if store_bot_info:
+      bot_counts.update(counts_before, bot_info.counts_state())
     return event.key
 
   # No need to emit an event. Just update BotInfo on its own.
   if store_bot_info:
+    counts_after = bot_info.counts_state()
+    if (write_behind_secs and event_type in _IDLE_POLL_EVENTS
+        and counts_before == counts_after and last_seen_before and
+        now - last_seen_before < datetime.timedelta(
+            seconds=2 * write_behind_secs)):
+      # Only last_seen_ts and the ephemeral state changed, and the stored
+      # BotInfo is recent enough.
+      import ts_mon_metrics  # pylint: disable=cyclic-import
+      ts_mon_metrics.on_bot_info_write_behind('buffered', 1)
+      _bot_info_buffer.add(bot_info)
+      return None
+    _bot_info_buffer.discard(bot_id)
     _insert_bot_with_txn(info_key.root(), bot_info, None)
+    # Only status or dimensions changes affect the counts, which are also what
+    # triggers a BotEvent, so this is usually a no-op.
+    bot_counts.update(counts_before, counts_after)
   return None
 
 
+def flush_bot_info_buffer(delay=0):
+  """Hands the write-behind buffer of this instance to the flush-bot-info task
+  queue if it is due.
+
+  The BotInfo are stored by store_bot_info_batch() from the task queue, so the
+  request that crosses the window only pays for enqueuing the tasks.
+
+  Arguments:
+    delay: how old the oldest buffered BotInfo must be for the buffer to be
+        due. 0 flushes it unconditionally.
+
+  Returns:
+    Number of BotInfo handed to the task queue.
+  """
+  pending = _bot_info_buffer.take_due(delay)
+  if not pending:
+    return 0
+  import ts_mon_metrics  # pylint: disable=cyclic-import
+  # Split in batches small enough to fit in a task payload.
+  batches = [[]]
+  size = 0
+  for bot_info in pending:
+    encoded = base64.b64encode(bot_info._to_pb().Encode())
+    if batches[-1] and size + len(encoded) > _WRITE_BEHIND_PAYLOAD_MAX:
+      batches.append([])
+      size = 0
+    batches[-1].append(encoded)
+    size += len(encoded)
+  enqueued = 0
+  for batch in batches:
+    payload = utils.encode_to_json({'bot_infos': batch})
+    if utils.enqueue_task('/internal/taskqueue/important/bots/flush-bot-info',
+                          'flush-bot-info',
+                          payload=payload):
+      enqueued += len(batch)
+    else:
+      # The next poll of these bots stores them again.
+      logging.warning('flush_bot_info_buffer: failed to enqueue %d BotInfo',
+                      len(batch))
+  ts_mon_metrics.on_bot_info_write_behind('dropped', len(pending) - enqueued)
+  return enqueued
+
+
+def store_bot_info_batch(payload):
+  """Stores a batch of BotInfo from the write-behind buffer.
+
+  Called from the flush-bot-info task queue with the payload enqueued by
+  flush_bot_info_buffer().
+
+  They are stored with a single put_multi(), outside of any transaction. A
+  pending BotInfo is dropped if the bot was deleted or if another BotInfo was
+  stored meanwhile, e.g. by another instance, that is more recent or that
+  differs in anything else than what an idle poll updates.
+
+  Returns:
+    Number of BotInfo stored.
+  """
+  import ts_mon_metrics  # pylint: disable=cyclic-import
+  entity_pb = ndb.google_imports.entity_pb
+  pending = [
+      BotInfo._from_pb(entity_pb.EntityProto(base64.b64decode(e)))
+      for e in json.loads(payload)['bot_infos']
+  ]
+  stored = ndb.get_multi([b.key for b in pending],
+                         use_cache=False,
+                         use_memcache=False)
+  entities = [
+      b for b, s in zip(pending, stored)
+      if s and not (s.last_seen_ts and s.last_seen_ts > b.last_seen_ts) and
+      _snapshot_bot_info(s) == _snapshot_bot_info(b) and s.task_id == b.task_id
+  ]
+  # Datastore errors are left to propagate, so the task is retried.
+  ndb.put_multi(entities)
+  ts_mon_metrics.on_bot_info_write_behind('flushed', len(entities))
+  ts_mon_metrics.on_bot_info_write_behind('dropped',
+                                          len(pending) - len(entities))
+  logging.info('Stored %d BotInfo, dropped %d', len(entities),
+               len(pending) - len(entities))
+  return len(entities)
+
+
 def has_capacity(dimensions):
   """Returns True if there's a reasonable chance for this task request
   dimensions set to be serviced by a bot alive.
@@ -879,6 +1079,17 @@ def has_capacity(dimensions):
   # initialization and some baremetal bots (thanks SCSI firmware!).
   seconds = config.settings().bot_death_timeout_secs
 
+  flats = task_queues.intern_dimensions(dimensions).flats
+
+  # Look at the summary of the alive bots refreshed by cron_update_bot_info().
+  # It does not know about bots that appeared since, so a miss is confirmed
+  # with the queries below.
+  for flat in flats:
+    if bot_capacity.has_capacity(flat):
+      logging.info('Found capacity via BotCapacity: %s', flat)
+      task_queues.set_has_capacity(dimensions, seconds)
+      return True
+
   @ndb.tasklet
   def run_query(flat):
     # Do a query. That's slower and it's eventually consistent.
@@ -903,9 +1114,7 @@ def has_capacity(dimensions):
       raise ndb.Return(True)
     raise ndb.Return(False)
 
-  futures = [
-      run_query(f) for f in task_queues.expand_dimensions_to_flats(dimensions)
-  ]
+  futures = [run_query(f) for f in flats]
 
   ndb.tasklets.Future.wait_all(futures)
   if any(f.get_result() for f in futures):
@@ -924,7 +1133,7 @@ def get_pools_from_dimensions_flat(dimensions_flat):
 
 
 def cron_update_bot_info():
-  """Refreshes BotInfo.composite for dead bots."""
+  """Refreshes BotInfo.composite for dead bots and rebuilds bot_capacity."""
   @ndb.tasklet
   def run(bot_key):
     bot = bot_key.get()
@@ -933,10 +1142,11 @@ def cron_update_bot_info():
                     bot_key)
       raise ndb.Return(None)
     if not bot.is_dead and bot._should_be_dead():
+      counts_before = bot.counts_state()
       # `is_dead` is updated in _pre_put_hook based on should_be_dead.
       logging.info('Changing Bot status to DEAD: %s', bot.id)
       yield bot.put_async()
-      raise ndb.Return(bot)
+      raise ndb.Return((bot, counts_before))
     logging.debug('BotInfo changed since query or query was stale, %r', bot)
     raise ndb.Return(None)
 
@@ -945,11 +1155,13 @@ def cron_update_bot_info():
   # way.
   def tx_result(future, stats):
     try:
-      bot = future.get_result()
-      if not bot:
+      result = future.get_result()
+      if not result:
         stats['stale'] += 1
         return
+      bot, counts_before = result
       stats['dead'] += 1
+      bot_counts.update(counts_before, bot.counts_state())
 
       # Unregister the bot from task queues since it can't reap anything.
       task_queues.cleanup_after_bot(bot.id)
@@ -979,6 +1191,7 @@ def cron_update_bot_info():
   deadline = BotInfo._deadline()
 
   futures = []
+  capacity = bot_capacity.Builder()
   logging.debug('Finding dead based on deadline %s...', deadline)
   try:
     for info in BotInfo.yield_alive_bots():
@@ -990,7 +1203,10 @@ def cron_update_bot_info():
       # Note that an alternative would be to have an index on `last_seen_ts`,
       # but this index turns out to be very hot (being update on every poll).
       # See https://chromium.googlesource.com/infra/luci/luci-py/+/4e9aecba.
-      if info.is_dead or not info._should_be_dead(deadline):
+      if info.is_dead:
+        continue
+      if not info._should_be_dead(deadline):
+        capacity.add(info.dimensions_flat)
         continue
 
       # Transactionally flip the state of the bot to DEAD. Retry more often than
@@ -1015,9 +1231,31 @@ def cron_update_bot_info():
     for f in futures:
       tx_result(f, cron_stats)
 
+    # Only stored once all the alive bots were visited.
+    capacity.save()
+
   finally:
     logging.debug('Seen: %d, marked as dead: %d, stale: %d, failed: %d',
                   cron_stats['seen'], cron_stats['dead'], cron_stats['stale'],
                   cron_stats['failed'])
 
   return cron_stats['dead']
+
+
+def cron_reconcile_bot_counts():
+  """Recomputes bot_counts from all the BotInfo entities to fix any drift.
+
+  Returns:
+    Number of bot_counts scopes whose counts had drifted.
+  """
+  def iter_states():
+    q = BotInfo.query()
+    cursor = None
+    more = True
+    while more:
+      bots, cursor, more = q.fetch_page(1000, start_cursor=cursor)
+      for b in bots:
+        if b.composite:
+          yield b.counts_state()
+
+  return bot_counts.reconcile(iter_states())
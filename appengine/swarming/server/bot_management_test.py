@@ -25,6 +25,9 @@ from components import utils
 from test_support import test_case
 
 from proto.api import swarming_pb2  # pylint: disable=no-name-in-module
+from proto.config import config_pb2
+from server import bot_capacity
+from server import bot_counts
 from server import bot_management
 from server import config
 from server import task_queues
@@ -177,6 +180,35 @@ class BotManagementTest(test_case.TestCase):
     super(BotManagementTest, self).setUp()
     self.now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
     self.mock_now(self.now)
+    self.mock(bot_capacity, '_pool_cache', {})
+    self.mock(bot_management, '_bot_info_buffer',
+              bot_management._BotInfoBuffer())
+    self._flush_payloads = []
+    self._enqueue_task_orig = self.mock(utils, 'enqueue_task',
+                                        self._enqueue_task)
+
+  def _enqueue_task(self, url, queue_name, **kwargs):
+    if queue_name == 'update-bot-counts':
+      # Applied right away, as if the task ran.
+      bot_counts.apply_deltas(kwargs['payload'])
+      return True
+    if queue_name != 'flush-bot-info':
+      return self._enqueue_task_orig(url, queue_name, **kwargs)
+    self.assertEqual('/internal/taskqueue/important/bots/flush-bot-info', url)
+    self._flush_payloads.append(kwargs['payload'])
+    return True
+
+  def _mock_write_behind_secs(self, secs):
+    cfg = config_pb2.SettingsCfg()
+    cfg.CopyFrom(config.settings())
+    cfg.bot_info_write_behind_secs = secs
+    self.mock(config, 'settings', lambda: cfg)
+
+  def _flush(self):
+    """Flushes the write-behind buffer and runs the flush-bot-info tasks."""
+    bot_management.flush_bot_info_buffer()
+    payloads, self._flush_payloads = self._flush_payloads, []
+    return sum(bot_management.store_bot_info_batch(p) for p in payloads)
 
   def test_all_apis_are_tested(self):
     actual = frozenset(i[5:] for i in dir(self) if i.startswith('test_'))
@@ -639,11 +671,182 @@ class BotManagementTest(test_case.TestCase):
     self.assertEqual(False, bot_management.has_capacity(d))
     self.assertEqual(False, bot_management.has_capacity(or_dimensions))
 
+  def test_has_capacity_BotCapacity(self):
+    self.mock(task_queues, 'probably_has_capacity', lambda *_: None)
+    d = {u'pool': [u'default'], u'os': [u'Ubuntu-16.04']}
+    _bot_event(event_type='request_sleep')
+    self.assertEqual(0, bot_management.cron_update_bot_info())
+
+    # The BotInfo is gone but the summary still lists the bot, no BotEvent
+    # query is needed.
+    bot_management.get_info_key('id1').delete()
+    self.mock(bot_management.BotEvent, 'query', self.fail)
+    self.assertEqual(True, bot_management.has_capacity(d))
+
+  def test_flush_bot_info_buffer(self):
+    self._mock_write_behind_secs(60)
+    self.assertEqual(0, self._flush())
+    info_key = bot_management.get_info_key('id1')
+
+    # The first poll creates BotInfo and a BotEvent right away.
+    self.assertTrue(_bot_event(event_type='request_sleep'))
+    self.assertEqual(self.now, info_key.get().last_seen_ts)
+
+    # The next idle polls only go to the buffer.
+    self.mock_now(self.now, 10)
+    self.assertIsNone(_bot_event(event_type='request_sleep', state={'a': 1}))
+    self.mock_now(self.now, 20)
+    self.assertIsNone(_bot_event(event_type='request_sleep', state={'a': 2}))
+    self.assertEqual(self.now, info_key.get().last_seen_ts)
+    self.assertEqual(1, self._flush())
+    bot_info = info_key.get()
+    self.assertEqual(self.now + datetime.timedelta(seconds=20),
+                     bot_info.last_seen_ts)
+    self.assertEqual({'a': 2}, bot_info.state)
+    self.assertEqual(0, self._flush())
+
+    # A state change is stored right away and supersedes the buffered poll.
+    self.mock_now(self.now, 30)
+    self.assertIsNone(_bot_event(event_type='request_sleep'))
+    self.mock_now(self.now, 40)
+    self.assertTrue(_bot_event(event_type='request_sleep', quarantined=True))
+    self.assertTrue(info_key.get().quarantined)
+    self.assertEqual(0, self._flush())
+
+    # A more recent BotInfo stored meanwhile is not overwritten.
+    self.mock_now(self.now, 50)
+    self.assertIsNone(
+        _bot_event(event_type='request_sleep', quarantined=True))
+    bot_info = info_key.get()
+    bot_info.last_seen_ts = self.now + datetime.timedelta(seconds=60)
+    bot_info.put()
+    self.assertEqual(0, self._flush())
+    self.assertEqual(self.now + datetime.timedelta(seconds=60),
+                     info_key.get().last_seen_ts)
+
+    # A deleted bot is not recreated.
+    self.mock_now(self.now, 70)
+    self.assertIsNone(
+        _bot_event(event_type='request_sleep', quarantined=True))
+    info_key.delete()
+    self.assertEqual(0, self._flush())
+    self.assertIsNone(info_key.get())
+
+  def test_flush_bot_info_buffer_other_instance(self):
+    self._mock_write_behind_secs(60)
+    info_key = bot_management.get_info_key('id1')
+    self.assertTrue(_bot_event(event_type='request_sleep'))
+    self.mock_now(self.now, 10)
+    self.assertIsNone(_bot_event(event_type='request_sleep', state={'a': 1}))
+
+    # Another instance quarantines the bot. Its timestamp is older than the
+    # buffered poll, e.g. due to clock skew.
+    bot_info = info_key.get()
+    bot_info.quarantined = True
+    bot_info.last_seen_ts = self.now + datetime.timedelta(seconds=5)
+    bot_info.put()
+
+    # The buffered copy doesn't overwrite it.
+    self.assertEqual(0, self._flush())
+    self.assertTrue(info_key.get().quarantined)
+
+    # The next event is based on the stored BotInfo, not on a buffered copy.
+    self.mock_now(self.now, 20)
+    self.assertIsNone(_bot_event(event_type='request_sleep', quarantined=True))
+    self.mock_now(self.now, 30)
+    self.assertTrue(_bot_event(event_type='request_sleep'))
+    self.assertFalse(info_key.get().quarantined)
+    self.assertEqual(0, self._flush())
+
+  def test_flush_bot_info_buffer_due(self):
+    self._mock_write_behind_secs(60)
+    info_key = bot_management.get_info_key('id1')
+    self.assertTrue(_bot_event(event_type='request_sleep'))
+    self.mock_now(self.now, 10)
+    self.assertIsNone(_bot_event(event_type='request_sleep'))
+    self.assertEqual(self.now, info_key.get().last_seen_ts)
+
+    # The buffer is handed to the task queue by the next event of any bot once
+    # it is due.
+    bot_management._bot_info_buffer._since -= 60
+    self.assertTrue(_bot_event(event_type='request_sleep', bot_id='id2'))
+    self.assertEqual(self.now, info_key.get().last_seen_ts)
+    self.assertEqual(1, len(self._flush_payloads))
+    self.assertEqual(
+        1, bot_management.store_bot_info_batch(self._flush_payloads.pop()))
+    self.assertEqual(self.now + datetime.timedelta(seconds=10),
+                     info_key.get().last_seen_ts)
+
+    # The poll is stored right away when the stored BotInfo is too old, in case
+    # the buffer is stranded on an instance that doesn't get requests anymore.
+    self.mock_now(self.now, 200)
+    self.assertIsNone(_bot_event(event_type='request_sleep'))
+    self.assertEqual(self.now + datetime.timedelta(seconds=200),
+                     info_key.get().last_seen_ts)
+    self.assertEqual(0, self._flush())
+
+  def test_store_bot_info_batch(self):
+    self._mock_write_behind_secs(60)
+    self.mock(bot_management, '_WRITE_BEHIND_PAYLOAD_MAX', 1)
+    for bot_id in ('id1', 'id2', 'id3'):
+      self.assertTrue(_bot_event(event_type='request_sleep', bot_id=bot_id))
+    self.mock_now(self.now, 10)
+    for bot_id in ('id1', 'id2', 'id3'):
+      self.assertIsNone(
+          _bot_event(event_type='request_sleep', bot_id=bot_id, state={'a': 1}))
+    # The buffer is split in one task per BotInfo since they don't fit in the
+    # payload.
+    self.assertEqual(3, bot_management.flush_bot_info_buffer())
+    self.assertEqual(3, len(self._flush_payloads))
+    self.assertEqual(0, bot_management.flush_bot_info_buffer())
+
+    bot_management.get_info_key('id2').delete()
+    stored = [
+        bot_management.store_bot_info_batch(p) for p in self._flush_payloads
+    ]
+    self.assertEqual([1, 0, 1], stored)
+    for bot_id in ('id1', 'id3'):
+      bot_info = bot_management.get_info_key(bot_id).get()
+      self.assertEqual(self.now + datetime.timedelta(seconds=10),
+                       bot_info.last_seen_ts)
+      self.assertEqual({'a': 1}, bot_info.state)
+    self.assertIsNone(bot_management.get_info_key('id2').get())
+
   def test_get_pools_from_dimensions_flat(self):
     pools = bot_management.get_pools_from_dimensions_flat(
         ['id:id1', 'os:Linux', 'pool:pool1', 'pool:pool2'])
     self.assertEqual(pools, ['pool1', 'pool2'])
 
+  def test_cron_reconcile_bot_counts(self):
+    _bot_event(event_type='request_sleep', bot_id='id1')
+    _bot_event(event_type='request_sleep', bot_id='id2', quarantined=True)
+    _bot_event(event_type='request_task', bot_id='id3', task_id='12311')
+    # The counts are not used until the first reconciliation, which counts
+    # all the bots: '', 'pool:default', 'os:Ubuntu', 'os:Ubuntu-16.04' and the
+    # last two combined with the pool.
+    self.assertIsNone(bot_counts.get_counts([]))
+    self.assertEqual(6, bot_management.cron_reconcile_bot_counts())
+    self.assertEqual(
+        bot_counts.Counts(
+            count=3, dead=0, quarantined=1, maintenance=0, busy=2),
+        bot_counts.get_counts([u'pool:default']))
+
+    # Make the bots die; cron_update_bot_info() updates the counts.
+    timeout = bot_management.config.settings().bot_death_timeout_secs
+    self.mock_now(self.now, timeout + 1)
+    self.assertEqual(3, bot_management.cron_update_bot_info())
+    self.assertEqual(
+        bot_counts.Counts(
+            count=3, dead=3, quarantined=1, maintenance=0, busy=3),
+        bot_counts.get_counts([u'pool:default']))
+    self.assertEqual(0, bot_management.cron_reconcile_bot_counts())
+
+    # Drift caused by a deletion that bypassed the counts is fixed.
+    bot_management.get_info_key('id1').delete()
+    self.assertEqual(3, bot_counts.get_counts([]).count)
+    self.assertEqual(6, bot_management.cron_reconcile_bot_counts())
+    self.assertEqual(2, bot_counts.get_counts([]).count)
+
   def test_cron_update_bot_info(self):
     # Create two bots, one becomes dead, updating the cron job fixes composite.
     timeout = bot_management.config.settings().bot_death_timeout_secs
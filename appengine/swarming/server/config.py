@@ -146,6 +146,14 @@ def _validate_settings(cfg, ctx):
     within_year(cfg.bot_death_timeout_secs)
   with ctx.prefix('reusable_task_age_secs '):
     within_year(cfg.reusable_task_age_secs)
+  with ctx.prefix('bot_info_write_behind_secs '):
+    # A BotInfo refreshed by an idle poll may be stored up to twice this late,
+    # see bot_management.bot_event().
+    if cfg.bot_info_write_behind_secs < 0:
+      ctx.error('cannot be negative')
+    elif (cfg.bot_info_write_behind_secs * 4 >
+          (cfg.bot_death_timeout_secs or 10 * 60)):
+      ctx.error('must be at most a quarter of bot_death_timeout_secs')
 
   if cfg.HasField('cipd'):
     with ctx.prefix('cipd: '):
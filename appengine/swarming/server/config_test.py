@@ -141,6 +141,23 @@ class ConfigTest(test_case.TestCase):
                 'reusable_task_age_secs cannot be more than a year',
             ])
 
+    self.validator_test(
+        config._validate_settings,
+        config_pb2.SettingsCfg(bot_info_write_behind_secs=-1),
+        ['bot_info_write_behind_secs cannot be negative'])
+
+    self.validator_test(
+        config._validate_settings,
+        config_pb2.SettingsCfg(
+            bot_death_timeout_secs=100, bot_info_write_behind_secs=26), [
+                'bot_info_write_behind_secs must be at most a quarter of '
+                'bot_death_timeout_secs',
+            ])
+
+    self.validator_test(
+        config._validate_settings,
+        config_pb2.SettingsCfg(bot_info_write_behind_secs=150), [])
+
     self.validator_test(
         config._validate_settings,
         config_pb2.SettingsCfg(
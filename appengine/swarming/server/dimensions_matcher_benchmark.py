@@ -0,0 +1,87 @@
+#!/usr/bin/env vpython
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Compares task_to_run.dimensions_matcher() with interned subset tests.
+
+Each iteration matches one bot against the same list of task dimensions, as
+done when a bot polls. The direct check (what dimensions_matcher() does) looks
+up `k:v` of each request in the bot's flat dimensions. The interned check gets
+the cached OR expansion of each request via task_queues.intern_dimensions()
+and tests it as subsets of the bot's flat dimensions.
+"""
+
+import argparse
+import logging
+import sys
+import timeit
+
+import test_env
+test_env.setup_test_env()
+
+from server import task_queues
+from server import task_to_run
+
+
+def _bot(i):
+  return {
+      u'id': [u'bot%d' % i],
+      u'pool': [u'default'],
+      u'os': [u'Linux', u'Ubuntu', u'Ubuntu-20.04'],
+      u'cpu': [u'x86', u'x86-64'],
+      u'gpu': [u'none'],
+      u'python': [u'3', u'3.8'],
+  }
+
+
+def _requests(count):
+  requests = []
+  for i in range(count):
+    dims = {u'pool': [u'default'], u'cpu': [u'x86-64']}
+    if i % 3 == 0:
+      dims[u'os'] = [u'Ubuntu|Mac']
+    elif i % 3 == 1:
+      dims[u'os'] = [u'Windows']
+    else:
+      dims[u'id'] = [u'bot%d' % i]
+    requests.append(dims)
+  return requests
+
+
+def _time_us(func, number):
+  return timeit.timeit(func, number=number) * 1000000. / number
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument(
+      '--number', type=int, default=1000, help='Bots to match')
+  parser.add_argument(
+      '--requests', type=int, default=50, help='Task dimensions per bot')
+  args = parser.parse_args()
+  # dimensions_matcher() logs each mismatch.
+  logging.basicConfig(level=logging.ERROR)
+
+  requests = _requests(args.requests)
+  bots = iter([_bot(i) for i in range(args.number)] * 2)
+
+  def direct():
+    matcher = task_to_run.dimensions_matcher(next(bots))
+    return [matcher(r) for r in requests]
+
+  def interned():
+    bot_flat = frozenset(task_queues.bot_dimensions_to_flat(next(bots)))
+    return [
+        any(bot_flat.issuperset(f)
+            for f in task_queues.intern_dimensions(r).flats)
+        for r in requests
+    ]
+
+  for name, func in (('direct', direct), ('interned', interned)):
+    print('%-9s %8.2fus per bot' % (name + ':', _time_us(func, args.number)))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,399 @@
+#!/usr/bin/env vpython
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Offline benchmark of the native scheduler (task_to_run and task_queues).
+
+Runs task_scheduler.schedule_request(...) and task_scheduler.bot_reap_task(...)
+against the ndb testbed stubs using a synthetic workload and reports reap
+latency, datastore RPC counts, claim collision rates and queue scan sizes as
+JSON. Results of two commits can then be compared to catch regressions.
+
+The simulation runs in discrete ticks of simulated time. On each tick, new
+tasks are triggered into random pools and then every idle bot polls for a task.
+A bot that reaped a task stays busy for a few ticks.
+
+Example:
+  ./scheduler_benchmark.py --pools 2 --bots 100 --ticks 20 \\
+      --dimension os=Linux:3,Mac:1 --dimension gpu=none:4,nvidia:1 \\
+      --output results.json
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+
+# Setups environment.
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+import test_env_handlers
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+
+import ts_mon_metrics
+
+from components import utils
+
+from server import bot_management
+from server import task_queues
+from server import task_request
+from server import task_scheduler
+from server import task_to_run
+
+
+# Workload used when no --dimension is given.
+_DEFAULT_DIMENSIONS = {
+    u'os': [(u'Linux', 6), (u'Mac', 3), (u'Windows', 1)],
+    u'cpu': [(u'x86-64', 4), (u'arm64', 1)],
+}
+
+
+Workload = collections.namedtuple('Workload', [
+    'pools',  # number of pools
+    'bots',  # number of bots, spread evenly across pools
+    'ticks',  # number of simulated ticks (1 tick is 1 simulated second)
+    'trigger_rate',  # number of tasks triggered per tick
+    'dimensions',  # {key: [(value, weight)]} distribution of bot dimensions
+    'task_dimensions_ratio',  # probability a task constrains on a dimension
+    'or_ratio',  # probability a constrained task dimension uses "|"
+    'priorities',  # (min, max) range of task priorities
+    'task_duration',  # ticks a bot stays busy after reaping a task
+    'seed',  # random seed
+])
+
+
+def _percentiles(values):
+  """Returns p50/p99/max/mean of a list of numbers as a dict."""
+  if not values:
+    return {'count': 0}
+  values = sorted(values)
+  pick = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+  return {
+      'count': len(values),
+      'p50': pick(0.50),
+      'p99': pick(0.99),
+      'max': values[-1],
+      'mean': sum(values) / float(len(values)),
+  }
+
+
+def _parse_dimension(value):
+  """Parses `key=value:weight,value:weight` into (key, [(value, weight)])."""
+  key, _, spec = value.partition('=')
+  if not key or not spec:
+    raise argparse.ArgumentTypeError('expecting key=value:weight,...')
+  dist = []
+  for item in spec.split(','):
+    val, _, weight = item.partition(':')
+    try:
+      dist.append((unicode(val), int(weight or 1)))
+    except ValueError:
+      raise argparse.ArgumentTypeError('invalid weight in %r' % item)
+  return unicode(key), dist
+
+
+class _Recorder(object):
+  """Collects measurements while the simulation runs."""
+
+  def __init__(self):
+    self.rpcs = collections.Counter()
+    self.schedule_latency = []
+    self.assert_bot_latency = []
+    self.reap_latency = []
+    self.reaped = 0
+    self.empty_polls = 0
+    self.claims_obtained = 0
+    self.claims_collided = 0
+    self.scan_queues = []
+    self.scan_total = []
+    self.scan_visited = []
+    self.scan_claimed = []
+
+  def on_rpc(self, service, call, _request, _response):
+    self.rpcs['%s.%s' % (service, call)] += 1
+
+  def on_scheduler_scan(self, _pool, queues):
+    self.scan_queues.append(queues)
+
+  def on_scheduler_visits(self, pool, claimed, mismatch, stale, total,
+                          visited):
+    del pool, mismatch, stale  # unused
+    self.scan_total.append(total)
+    self.scan_visited.append(visited)
+    self.scan_claimed.append(claimed)
+
+  def report(self):
+    to_ms = lambda values: [v * 1000. for v in values]
+    rpcs_total = sum(self.rpcs.values())
+    claims = self.claims_obtained + self.claims_collided
+    return {
+        'tasks': {
+            'triggered': len(self.schedule_latency),
+            'reaped': self.reaped,
+            'empty_polls': self.empty_polls,
+        },
+        'schedule_latency_ms': _percentiles(to_ms(self.schedule_latency)),
+        'assert_bot_latency_ms': _percentiles(to_ms(self.assert_bot_latency)),
+        'reap_latency_ms': _percentiles(to_ms(self.reap_latency)),
+        'datastore_rpcs': {
+            'total': rpcs_total,
+            'per_poll': (
+                float(rpcs_total) / len(self.reap_latency)
+                if self.reap_latency else None),
+            'by_method': dict(self.rpcs),
+        },
+        'claims': {
+            'obtained': self.claims_obtained,
+            'collisions': self.claims_collided,
+            'collision_rate': (
+                float(self.claims_collided) / claims if claims else None),
+        },
+        'queue_scans': {
+            'queues': _percentiles(self.scan_queues),
+            'fetched': _percentiles(self.scan_total),
+            'visited': _percentiles(self.scan_visited),
+            'already_claimed': _percentiles(self.scan_claimed),
+        },
+    }
+
+
+class _Simulator(test_env_handlers.AppTestBase):
+  """Runs a workload, reusing the test environment setup of the unit tests."""
+
+  def __init__(self, workload):
+    super(_Simulator, self).__init__('simulate')
+    self._workload = workload
+    self._rnd = random.Random(workload.seed)
+    self._recorder = _Recorder()
+    self.now = datetime.datetime(2020, 1, 2, 3, 4, 5)
+
+  def setUp(self):
+    super(_Simulator, self).setUp()
+    self.mock_now(self.now)
+    self.mock_tq_tasks()
+    self.mock(task_scheduler, '_route_to_go', lambda **_kwargs: False)
+
+    rec = self._recorder
+    self.mock(ts_mon_metrics, 'on_scheduler_scan', rec.on_scheduler_scan)
+    self.mock(ts_mon_metrics, 'on_scheduler_visits', rec.on_scheduler_visits)
+
+    obtain = task_to_run.Claim.obtain
+
+    def obtain_and_count(to_run_key, duration=60):
+      claim = obtain(to_run_key, duration)
+      if claim:
+        rec.claims_obtained += 1
+      else:
+        rec.claims_collided += 1
+      return claim
+
+    self.mock(task_to_run.Claim, 'obtain', staticmethod(obtain_and_count))
+
+  def _enqueue_mock(self, _url, _queue_name, **_kwargs):
+    # TQ tasks not related to scheduling are irrelevant for the benchmark.
+    return True
+
+  @ndb.tasklet
+  def _enqueue_mock_async(self, url, queue_name, payload, transactional=False):
+    if queue_name in ('rescan-matching-task-sets', 'update-bot-matches'):
+      res = yield super(_Simulator, self)._enqueue_mock_async(
+          url, queue_name, payload, transactional)
+      raise ndb.Return(res)
+    raise ndb.Return(True)
+
+  def _sample(self, key):
+    dist = self._workload.dimensions[key]
+    return self._rnd.choice([v for v, w in dist for _ in range(w)])
+
+  def _gen_bots(self):
+    bots = []
+    for i in range(self._workload.bots):
+      dims = {
+          u'id': [u'bot-%d' % i],
+          u'pool': [u'pool-%d' % (i % self._workload.pools)],
+      }
+      for key in sorted(self._workload.dimensions):
+        dims[key] = [self._sample(key)]
+      bots.append(dims)
+    return bots
+
+  def _gen_task_dimensions(self):
+    dims = {
+        u'pool': [u'pool-%d' % self._rnd.randrange(self._workload.pools)],
+    }
+    for key in sorted(self._workload.dimensions):
+      if self._rnd.random() >= self._workload.task_dimensions_ratio:
+        continue
+      val = self._sample(key)
+      if self._rnd.random() < self._workload.or_ratio:
+        alt = self._sample(key)
+        if alt != val:
+          val = u'%s|%s' % (val, alt)
+      dims[key] = [val]
+    return dims
+
+  def _schedule(self):
+    props = task_request.TaskProperties(
+        command=[u'command1'],
+        dimensions_data=self._gen_task_dimensions(),
+        execution_timeout_secs=3600,
+        io_timeout_secs=None)
+    request = task_request.TaskRequest(
+        created_ts=utils.utcnow(),
+        manual_tags=[u'benchmark:1'],
+        name=u'benchmark',
+        priority=self._rnd.randint(*self._workload.priorities),
+        task_slices=[
+            task_request.TaskSlice(
+                expiration_secs=24 * 3600,
+                properties=props,
+                wait_for_capacity=True),
+        ],
+        user=u'benchmark',
+        bot_ping_tolerance_secs=120)
+    task_request.init_new_request(request, True, task_request.TEMPLATE_AUTO)
+    start = time.time()
+    task_scheduler.schedule_request(request, str(uuid.uuid4()))
+    self._recorder.schedule_latency.append(time.time() - start)
+
+  def _register(self, bot_dimensions):
+    bot_management.bot_event(
+        event_type='request_sleep',
+        bot_id=bot_dimensions[u'id'][0],
+        external_ip='1.2.3.4',
+        authenticated_as='bot@localhost',
+        dimensions=bot_dimensions,
+        state={'state': 'real'},
+        version='1234',
+        register_dimensions=True)
+
+  def _poll(self, bot_dimensions):
+    rec = self._recorder
+    bot_id = bot_dimensions[u'id'][0]
+
+    start = time.time()
+    task_queues.assert_bot(bot_dimensions)
+    rec.assert_bot_latency.append(time.time() - start)
+
+    start = time.time()
+    queues = task_queues.freshen_up_queues(bot_id)
+    try:
+      request, _, _ = task_scheduler.bot_reap_task(
+          bot_dimensions, queues, task_scheduler.BotDetails('1234', None),
+          utils.utcnow() + datetime.timedelta(seconds=60))
+    except task_to_run.ScanDeadlineError:
+      request = None
+    rec.reap_latency.append(time.time() - start)
+    if request:
+      rec.reaped += 1
+    else:
+      rec.empty_polls += 1
+    return bool(request)
+
+  def simulate(self):
+    """Runs the workload, returns the report as a dict."""
+    bots = self._gen_bots()
+    for dims in bots:
+      self._register(dims)
+
+    # RPCs done during the setup are not interesting.
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'benchmark', self._recorder.on_rpc, 'datastore_v3')
+
+    busy_until = {}
+    for tick in range(self._workload.ticks):
+      self.mock_now(self.now, tick)
+      for _ in range(self._workload.trigger_rate):
+        self._schedule()
+      idle = [d for d in bots if busy_until.get(d[u'id'][0], 0) <= tick]
+      self._rnd.shuffle(idle)
+      for dims in idle:
+        if self._poll(dims):
+          busy_until[dims[u'id'][0]] = tick + self._workload.task_duration
+      logging.info('tick %d: %d idle bots, %d reaped so far', tick, len(idle),
+                   self._recorder.reaped)
+
+    report = self._recorder.report()
+    report['workload'] = self._workload._asdict()
+    return report
+
+
+def run(workload):
+  """Runs the workload in a fresh testbed, returns the report as a dict."""
+  sim = _Simulator(workload)
+  sim.setUp()
+  try:
+    return sim.simulate()
+  finally:
+    sim.tearDown()
+
+
+def main(args):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--pools', type=int, default=2)
+  parser.add_argument('--bots', type=int, default=50)
+  parser.add_argument('--ticks', type=int, default=10)
+  parser.add_argument(
+      '--trigger-rate', type=int, default=20, help='Tasks triggered per tick.')
+  parser.add_argument(
+      '--dimension',
+      type=_parse_dimension,
+      action='append',
+      help='Bot dimension distribution as key=value:weight,value:weight. '
+      'Can be repeated.')
+  parser.add_argument(
+      '--task-dimensions-ratio',
+      type=float,
+      default=0.5,
+      help='Probability a task constrains on each dimension.')
+  parser.add_argument(
+      '--or-ratio',
+      type=float,
+      default=0.1,
+      help='Probability a task dimension uses OR ("|").')
+  parser.add_argument('--min-priority', type=int, default=20)
+  parser.add_argument('--max-priority', type=int, default=200)
+  parser.add_argument(
+      '--task-duration',
+      type=int,
+      default=3,
+      help='Ticks a bot stays busy after reaping a task.')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='Where to write the JSON report.')
+  parser.add_argument('-v', '--verbose', action='store_true')
+  options = parser.parse_args(args)
+
+  logging.basicConfig(
+      level=logging.INFO if options.verbose else logging.ERROR)
+
+  workload = Workload(
+      pools=options.pools,
+      bots=options.bots,
+      ticks=options.ticks,
+      trigger_rate=options.trigger_rate,
+      dimensions=dict(options.dimension or _DEFAULT_DIMENSIONS),
+      task_dimensions_ratio=options.task_dimensions_ratio,
+      or_ratio=options.or_ratio,
+      priorities=(options.min_priority, options.max_priority),
+      task_duration=options.task_duration,
+      seed=options.seed)
+  report = json.dumps(run(workload), indent=2, sort_keys=True)
+  if options.output:
+    with open(options.output, 'w') as f:
+      f.write(report)
+  else:
+    print(report)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
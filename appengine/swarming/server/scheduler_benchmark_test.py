@@ -0,0 +1,63 @@
+#!/usr/bin/env vpython
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import logging
+import os
+import sys
+import unittest
+
+# Setups environment.
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+import test_env_handlers
+
+from server import scheduler_benchmark
+
+
+class SchedulerBenchmarkTest(unittest.TestCase):
+
+  def test_run(self):
+    workload = scheduler_benchmark.Workload(
+        pools=2,
+        bots=4,
+        ticks=2,
+        trigger_rate=3,
+        dimensions={u'os': [(u'Linux', 1), (u'Mac', 1)]},
+        task_dimensions_ratio=0.5,
+        or_ratio=0.5,
+        priorities=(10, 100),
+        task_duration=1,
+        seed=1)
+    report = scheduler_benchmark.run(workload)
+    self.assertEqual(6, report['tasks']['triggered'])
+    self.assertEqual(
+        report['tasks']['reaped'] + report['tasks']['empty_polls'],
+        report['reap_latency_ms']['count'])
+    self.assertGreater(report['tasks']['reaped'], 0)
+    self.assertGreater(report['datastore_rpcs']['total'], 0)
+    self.assertEqual(
+        report['reap_latency_ms']['count'],
+        report['queue_scans']['queues']['count'])
+
+  def test_parse_dimension(self):
+    self.assertEqual(
+        (u'os', [(u'Linux', 3), (u'Mac', 1)]),
+        scheduler_benchmark._parse_dimension('os=Linux:3,Mac'))
+
+  def test_percentiles(self):
+    self.assertEqual({'count': 0}, scheduler_benchmark._percentiles([]))
+    self.assertEqual({
+        'count': 4,
+        'p50': 3,
+        'p99': 4,
+        'max': 4,
+        'mean': 2.5,
+    }, scheduler_benchmark._percentiles([4, 3, 2, 1]))
+
+
+if __name__ == '__main__':
+  logging.basicConfig(
+      level=logging.DEBUG if '-v' in sys.argv else logging.ERROR)
+  unittest.main()
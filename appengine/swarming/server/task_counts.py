@@ -0,0 +1,362 @@
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Hourly rollups of the number of tasks per tag and state, used by CountTasks.
+
+    +-----------------------------+   +-----------------------------+
+    |TaskCountBucket              |   |TaskCountBucket              |
+    |id=<YYYYmmddHH>:<shard>:<tag>|...|id=<YYYYmmddHH>:<shard>:<tag>|
+    +-----------------------------+   +-----------------------------+
+
+    +---------------+
+    |TaskCountsState|
+    |id=state       |
+    +---------------+
+
+A task is counted in the hour it was created in, once for all tasks (the empty
+tag) and once per each of its tags. For each of these, it is counted in all the
+states names accepted by task_result.filter_query() it matches, e.g. 'all',
+'completed', 'completed_success'.
+
+The deltas of a task state change are added to the task-counts pull queue.
+cron_apply_deltas() leases them in batches, merges the deltas of the same (hour,
+tag) and applies each of them in a single transaction, so the task update hot
+path only pays for adding the pull task.
+
+Each (hour, tag) is sharded in _NUM_SHARDS TaskCountBucket entities to reduce
+contention. They are only created when a task is counted in them, so reading a
+range of hours is a single query over the existing entities.
+
+Rollups are only maintained from the time the first task was counted, see
+TaskCountsState. Hours before that must be counted with a query.
+
+Updates are best effort: a delta can be lost, e.g. if the transaction fails or
+the instance dies right after the task was stored. reconcile() recounts the
+tasks of an hour to fix it, see task_result.cron_reconcile_task_counts().
+"""
+
+import datetime
+import json
+import logging
+import random
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from components import datastore_utils
+from components import utils
+
+
+# Number of TaskCountBucket entities per (hour, tag).
+_NUM_SHARDS = 8
+
+# Pull queue holding the deltas not applied yet.
+_QUEUE = 'task-counts'
+
+# Number of seconds the deltas are leased for. Once it expires, they are
+# available again for the next run.
+_LEASE_SECS = 60
+
+# Maximum number of pull tasks leased at once.
+_LEASE_MAX = 1000
+
+# Maximum number of concurrent transactions.
+_MAX_CONCURRENT = 50
+
+# Duration of a bucket.
+BUCKET = datetime.timedelta(hours=1)
+
+# True once TaskCountsState is known to exist in this instance.
+_start_ts_exists = False
+
+
+### Models.
+
+
+class TaskCountBucket(ndb.Model):
+  """One shard of the task counts for a tag in an hour.
+
+  It is a root entity, updated in a transaction.
+  """
+  # Start of the hour.
+  hour = ndb.DateTimeProperty()
+  # Tag as key:value, or '' for all tasks.
+  tag = ndb.StringProperty()
+  # {state name: count}.
+  counts = datastore_utils.DeterministicJsonProperty(json_type=dict)
+
+
+class TaskCountsState(ndb.Model):
+  """Singleton recording since when the rollups are complete.
+
+  Key id is 'state'.
+  """
+  # Start of the first hour for which all tasks are counted.
+  start_ts = ndb.DateTimeProperty(indexed=False)
+
+
+### Private APIs.
+
+
+def _state_key():
+  return ndb.Key(TaskCountsState, 'state')
+
+
+def _bucket_key(hour, shard, tag):
+  return ndb.Key(
+      TaskCountBucket, u'%s:%d:%s' % (_format_hour(hour), shard, tag))
+
+
+def _format_hour(hour):
+  return hour.strftime('%Y%m%d%H')
+
+
+def _parse_hour(value):
+  return datetime.datetime.strptime(value, '%Y%m%d%H')
+
+
+def _ensure_start_ts():
+  """Records the first complete hour the first time a task is counted."""
+  global _start_ts_exists
+  if _start_ts_exists:
+    return
+  if not _state_key().get():
+    TaskCountsState.get_or_insert(
+        _state_key().id(), start_ts=ceil_hour(utils.utcnow()))
+  _start_ts_exists = True
+
+
+def _deltas(before, after):
+  """Returns {tag: {state: delta}} to go from before to after."""
+  deltas = {}
+  for value, sign in ((before, -1), (after, 1)):
+    if not value:
+      continue
+    tags, states = value
+    for tag in set([u''] + list(tags)):
+      d = deltas.setdefault(tag, {})
+      for state in states:
+        d[state] = d.get(state, 0) + sign
+  out = {}
+  for tag, d in deltas.items():
+    d = {s: v for s, v in d.items() if v}
+    if d:
+      out[tag] = d
+  return out
+
+
+@ndb.tasklet
+def _add_async(hour, tag, delta):
+  """Transactionally adds delta to a random shard of the bucket."""
+  key = _bucket_key(hour, random.randint(0, _NUM_SHARDS - 1), tag)
+
+  @ndb.tasklet
+  def txn():
+    entity = yield key.get_async()
+    if not entity:
+      entity = TaskCountBucket(key=key, hour=hour, tag=tag, counts={})
+    for state, value in delta.items():
+      entity.counts[state] = entity.counts.get(state, 0) + value
+    yield entity.put_async()
+
+  yield datastore_utils.transaction_async(txn, retries=3)
+
+
+def _wait_limited(calls, check):
+  """Runs the futures returned by calls with at most _MAX_CONCURRENT at once.
+
+  check() is called with each future once it is done.
+  """
+  futures = []
+  for call in calls:
+    futures.append(call())
+    if len(futures) > _MAX_CONCURRENT:
+      ndb.Future.wait_any(futures)
+      for f in futures:
+        if f.done():
+          check(f)
+      futures = [f for f in futures if not f.done()]
+  for f in futures:
+    check(f)
+
+
+def _merge(tasks):
+  """Returns {(hour, tag): {state: delta}} merged from the pull tasks."""
+  merged = {}
+  for task in tasks:
+    payload = json.loads(task.payload)
+    hour = _parse_hour(payload['hour'])
+    for tag, delta in payload['deltas'].items():
+      d = merged.setdefault((hour, tag), {})
+      for state, value in delta.items():
+        d[state] = d.get(state, 0) + value
+  out = {}
+  for k, d in merged.items():
+    d = {s: v for s, v in d.items() if v}
+    if d:
+      out[k] = d
+  return out
+
+
+### Public APIs.
+
+
+def floor_hour(ts):
+  """Returns the start of the bucket containing ts."""
+  return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def ceil_hour(ts):
+  """Returns the start of the first bucket starting at or after ts."""
+  hour = floor_hour(ts)
+  return hour if hour == ts else hour + BUCKET
+
+
+def get_start_ts():
+  """Returns the start of the first hour fully counted, or None."""
+  state = _state_key().get()
+  return state.start_ts if state else None
+
+
+def update(created_ts, before, after):
+  """Updates the rollups for a task changing state.
+
+  The deltas are added to the pull queue and applied by cron_apply_deltas().
+
+  Arguments:
+    created_ts: task creation time, which defines its bucket.
+    before: tuple(tags, state names) as counted before the change, or None if
+        the task is new.
+    after: tuple(tags, state names) as counted after the change.
+  """
+  deltas = _deltas(before, after)
+  if not deltas:
+    return
+  payload = utils.encode_to_json({
+      'hour': _format_hour(floor_hour(created_ts)),
+      'deltas': deltas,
+  })
+  try:
+    _ensure_start_ts()
+    taskqueue.Task(payload=payload, method='PULL').add(queue_name=_QUEUE)
+  except (datastore_errors.Error, taskqueue.Error) as e:
+    # Losing a count is preferable to failing the task update, it is fixed by
+    # reconcile().
+    logging.warning('Failed to update task counts: %s', e)
+
+
+def cron_apply_deltas(max_secs=50):
+  """Applies the deltas added to the pull queue by update().
+
+  The deltas of a batch are merged per (hour, tag) and each of them is applied
+  in a single transaction. A delta that fails to be applied is dropped rather
+  than applied twice by a retry; it is fixed by reconcile().
+
+  Arguments:
+    max_secs: stop leasing new batches after this many seconds.
+
+  Returns:
+    Number of pull tasks processed.
+  """
+  queue = taskqueue.Queue(_QUEUE)
+  deadline = utils.time_time() + max_secs
+  processed = 0
+  while utils.time_time() < deadline:
+    tasks = queue.lease_tasks(_LEASE_SECS, _LEASE_MAX)
+    if not tasks:
+      break
+    merged = _merge(tasks)
+
+    def check(f):
+      try:
+        f.get_result()
+      except (datastore_errors.Error, datastore_utils.CommitError) as e:
+        logging.warning('Failed to update task counts: %s', e)
+
+    _wait_limited(
+        (lambda k=k, d=d: _add_async(k[0], k[1], d) for k, d in merged.items()),
+        check)
+    queue.delete_tasks(tasks)
+    processed += len(tasks)
+    logging.info('Applied %d task counts deltas to %d buckets', len(tasks),
+                 len(merged))
+  return processed
+
+
+def get_count(tag, state, start, end):
+  """Returns the number of tasks created in the hours [start, end).
+
+  Arguments:
+    tag: key:value tag to filter on, or '' for all tasks.
+    state: state name, as accepted by task_result.filter_query().
+    start: first hour, it must be at or after get_start_ts().
+    end: end hour, exclusive.
+  """
+  assert start == floor_hour(start) and end == floor_hour(end), (start, end)
+  q = TaskCountBucket.query(TaskCountBucket.tag == tag,
+                            TaskCountBucket.hour >= start,
+                            TaskCountBucket.hour < end)
+  return sum(e.counts.get(state, 0) for e in q)
+
+
+def reconcile(hour, values):
+  """Fixes the rollups of an hour to match the actual tasks.
+
+  Arguments:
+    hour: start of the hour, it must be at or after get_start_ts().
+    values: iterable of (tags, state names) of all the tasks created in this
+        hour, as passed to update().
+
+  Concurrent updates happening while the tasks are being scanned may still be
+  off; they are fixed at the next run.
+
+  Returns:
+    Number of tags that were corrected.
+
+  Raises:
+    datastore_utils.CommitError if a correction failed to be committed.
+  """
+  assert hour == floor_hour(hour), hour
+  expected = {}
+  for value in values:
+    for tag, delta in _deltas(None, value).items():
+      counts = expected.setdefault(tag, {})
+      for state, v in delta.items():
+        counts[state] = counts.get(state, 0) + v
+
+  actual = {}
+  keys = {}
+  for e in TaskCountBucket.query(TaskCountBucket.hour == hour):
+    counts = actual.setdefault(e.tag, {})
+    for state, v in e.counts.items():
+      counts[state] = counts.get(state, 0) + v
+    keys.setdefault(e.tag, []).append(e.key)
+
+  # Delete the shards of tags with no tasks left.
+  stale = []
+  for tag in set(actual) - set(expected):
+    stale.extend(keys[tag])
+  if stale:
+    ndb.delete_multi(stale)
+
+  fixes = {}
+  for tag, counts in expected.items():
+    have = actual.get(tag, {})
+    delta = {}
+    for state in set(counts) | set(have):
+      v = counts.get(state, 0) - have.get(state, 0)
+      if v:
+        delta[state] = v
+    if delta:
+      fixes[tag] = delta
+  _wait_limited(
+      (lambda t=t, d=d: _add_async(hour, t, d) for t, d in fixes.items()),
+      lambda f: f.check_success())
+  fixed = len(fixes)
+
+  logging.info(
+      'Reconciled task counts of %s: %d tags, %d corrected, %d deleted', hour,
+      len(expected), fixed, len(stale))
+  return fixed
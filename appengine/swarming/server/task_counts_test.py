@@ -0,0 +1,125 @@
+#!/usr/bin/env vpython
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import datetime
+import logging
+import sys
+import unittest
+
+# pylint: disable=wrong-import-position
+import test_env
+test_env.setup_test_env()
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+from server import task_counts
+from test_support import test_case
+
+
+class TaskCountsTest(test_case.TestCase):
+  APP_DIR = test_env.APP_DIR
+
+  def setUp(self):
+    super(TaskCountsTest, self).setUp()
+    self.now = datetime.datetime(2014, 1, 2, 3, 4, 5, 6)
+    self.mock_now(self.now)
+    self.mock(task_counts, '_start_ts_exists', False)
+
+  def test_floor_ceil_hour(self):
+    hour = datetime.datetime(2014, 1, 2, 3)
+    self.assertEqual(hour, task_counts.floor_hour(self.now))
+    self.assertEqual(hour, task_counts.floor_hour(hour))
+    self.assertEqual(
+        hour + task_counts.BUCKET, task_counts.ceil_hour(self.now))
+    self.assertEqual(hour, task_counts.ceil_hour(hour))
+
+  def test_update(self):
+    self.assertIsNone(task_counts.get_start_ts())
+    created = datetime.datetime(2014, 1, 2, 5, 30)
+    hour = datetime.datetime(2014, 1, 2, 5)
+    pending = ((u'a:1', u'b:2'), ('all', 'pending', 'pending_running'))
+    running = ((u'a:1', u'b:2'), ('all', 'running', 'pending_running'))
+    task_counts.update(created, (), pending)
+    task_counts.update(created, None, ((u'a:1',), ('all', 'expired')))
+    task_counts.update(created, pending, running)
+    self.assertEqual(
+        datetime.datetime(2014, 1, 2, 4), task_counts.get_start_ts())
+    # The deltas are only applied by the cron.
+    self.assertEqual(0, task_counts.TaskCountBucket.query().count())
+    self.assertEqual(3, task_counts.cron_apply_deltas())
+    # The deltas were merged, there's one bucket per tag.
+    self.assertEqual(3, task_counts.TaskCountBucket.query().count())
+    self.assertEqual(0, task_counts.cron_apply_deltas())
+
+    def get(tag, state):
+      return task_counts.get_count(tag, state, hour, hour + task_counts.BUCKET)
+
+    self.assertEqual(2, get(u'', 'all'))
+    self.assertEqual(2, get(u'a:1', 'all'))
+    self.assertEqual(1, get(u'b:2', 'all'))
+    self.assertEqual(0, get(u'a:1', 'pending'))
+    self.assertEqual(1, get(u'a:1', 'running'))
+    self.assertEqual(1, get(u'a:1', 'pending_running'))
+    self.assertEqual(1, get(u'', 'expired'))
+    # Other hours are not affected.
+    self.assertEqual(
+        0, task_counts.get_count(u'', 'all', hour - task_counts.BUCKET, hour))
+
+  def test_update_noop(self):
+    value = ((u'a:1',), ('all', 'pending'))
+    task_counts.update(self.now, value, value)
+    self.assertIsNone(task_counts.get_start_ts())
+    self.assertEqual(0, task_counts.cron_apply_deltas())
+
+  def test_cron_apply_deltas_datastore_error(self):
+    def add_async(*_args):
+      f = ndb.Future()
+      f.set_exception(datastore_errors.Timeout())
+      return f
+
+    self.mock(task_counts, '_add_async', add_async)
+    task_counts.update(self.now, None, ((u'a:1',), ('all', 'pending')))
+    # It's logged, not raised, and the deltas are not retried.
+    self.assertEqual(1, task_counts.cron_apply_deltas())
+    self.assertEqual(0, task_counts.cron_apply_deltas())
+    self.assertEqual(0, task_counts.TaskCountBucket.query().count())
+
+  def test_reconcile(self):
+    hour = datetime.datetime(2014, 1, 2, 3)
+    pending = ((u'a:1',), ('all', 'pending', 'pending_running'))
+    running = ((u'a:1',), ('all', 'running', 'pending_running'))
+    task_counts.update(self.now, None, pending)
+    task_counts.update(self.now, None, ((u'b:2',), ('all', 'expired')))
+    self.assertEqual(2, task_counts.cron_apply_deltas())
+    # The transition to running was lost, and there's a task that was never
+    # counted. b:2 was deleted.
+    values = [running, ((u'a:1',), ('all', 'pending', 'pending_running'))]
+    self.assertEqual(2, task_counts.reconcile(hour, values))
+
+    def get(tag, state):
+      return task_counts.get_count(tag, state, hour, hour + task_counts.BUCKET)
+
+    self.assertEqual(2, get(u'', 'all'))
+    self.assertEqual(2, get(u'a:1', 'all'))
+    self.assertEqual(1, get(u'a:1', 'pending'))
+    self.assertEqual(1, get(u'a:1', 'running'))
+    self.assertEqual(2, get(u'a:1', 'pending_running'))
+    self.assertEqual(0, get(u'', 'expired'))
+    self.assertEqual(0, get(u'b:2', 'all'))
+    self.assertEqual(
+        0,
+        task_counts.TaskCountBucket.query(
+            task_counts.TaskCountBucket.tag == u'b:2').count())
+    # It's now consistent.
+    self.assertEqual(0, task_counts.reconcile(hour, values))
+
+
+if __name__ == '__main__':
+  if '-v' in sys.argv:
+    unittest.TestCase.maxDiff = None
+  logging.basicConfig(
+      level=logging.DEBUG if '-v' in sys.argv else logging.CRITICAL)
+  unittest.main()
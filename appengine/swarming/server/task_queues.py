@@ -19,6 +19,7 @@ import json
 import logging
 import random
 import struct
+import threading
 import time
 import urllib
 
@@ -318,6 +319,208 @@ _TXN_EXCEPTIONS = (
 )
 
 
+# How long an in-process index of TaskDimensionsSets under some ID prefix can be
+# used before it must be rebuilt from a full datastore scan.
+_SETS_INDEX_MAX_AGE = datetime.timedelta(minutes=1)
+
+# Maximum number of ID prefixes (pools and bots) kept in the in-process index.
+_SETS_INDEX_MAX_PREFIXES = 10000
+
+
+class _PrefixIndex(object):
+  """Inverted index of TaskDimensionsSets sharing the same ID prefix.
+
+  Used internally by _TaskDimensionsSetsIndex.
+  """
+
+  def __init__(self, built_ts):
+    # When the index was built from a full datastore scan.
+    self.built_ts = built_ts
+    # Incremented on every modification, for debugging and tests.
+    self.version = 0
+    # TaskDimensionsSets ID => list of tuples with flat task dimensions.
+    self.sets = {}
+    # `k:v` => set of (TaskDimensionsSets ID, index in `sets[ID]`).
+    self.postings = collections.defaultdict(set)
+
+  def put(self, sets_id, dims_sets):
+    self.remove(sets_id)
+    dims_sets = [tuple(dims) for dims in dims_sets]
+    self.sets[sets_id] = dims_sets
+    for i, dims in enumerate(dims_sets):
+      for kv in dims:
+        self.postings[kv].add((sets_id, i))
+    self.version += 1
+
+  def remove(self, sets_id):
+    dims_sets = self.sets.pop(sets_id, None)
+    if dims_sets is None:
+      return
+    for i, dims in enumerate(dims_sets):
+      for kv in dims:
+        posting = self.postings.get(kv)
+        if posting is not None:
+          posting.discard((sets_id, i))
+          if not posting:
+            del self.postings[kv]
+    self.version += 1
+
+  def matching(self, bot_dimensions_set):
+    # A dimensions set matches if all its `k:v` pairs are among bot dimensions.
+    # Count how many pairs of each set are covered by visiting only postings of
+    # the bot's own dimensions.
+    hits = collections.Counter()
+    for kv in bot_dimensions_set:
+      posting = self.postings.get(kv)
+      if posting:
+        hits.update(posting)
+    return set(
+        sets_id for (sets_id, i), count in hits.items()
+        if count == len(self.sets[sets_id][i]))
+
+
+class _TaskDimensionsSetsIndex(object):
+  """An in-process inverted index of TaskDimensionsSets (`k:v` => sets IDs).
+
+  Allows to find TaskDimensionsSets that may match a bot by visiting only sets
+  that share at least one dimension with the bot, instead of checking every
+  set under the bot's pool and bot ID prefixes.
+
+  Each ID prefix (`bot:<id>` or `pool:<id>`) is indexed independently. It is
+  populated from a complete datastore scan in _tq_rescan_matching_task_sets_async
+  and is then updated incrementally when this process commits changes via
+  _put_task_dimensions_sets_async and _delete_task_dimensions_sets_async.
+
+  Changes made by other processes (including the cleanup cron) are not
+  observed, so the index can both miss existing sets and return deleted ones.
+  It must only be used to narrow down candidates that are then loaded from the
+  datastore. The index of a prefix expires after _SETS_INDEX_MAX_AGE and
+  callers fall back to the datastore scan.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # ID prefix => _PrefixIndex.
+    self._prefixes = {}
+    # TaskDimensionsSets ID => (datetime.datetime, dims_sets or None if removed)
+    # for changes committed by this process within the last
+    # _SETS_INDEX_MAX_AGE, oldest first. Replayed on top of scans that were
+    # running when they were committed.
+    self._recent = collections.OrderedDict()
+
+  @staticmethod
+  def _split(sets_id):
+    return sets_id[:sets_id.rfind(':')]
+
+  def _get_fresh(self, pfx, now):
+    idx = self._prefixes.get(pfx)
+    if idx and idx.built_ts <= now < idx.built_ts + _SETS_INDEX_MAX_AGE:
+      return idx
+    return None
+
+  def _record(self, sets_id, dims_sets, now):
+    self._recent.pop(sets_id, None)
+    self._recent[sets_id] = (now, dims_sets)
+    # Scans that started before the cutoff produce already expired indexes, so
+    # older changes are not needed.
+    cutoff = now - _SETS_INDEX_MAX_AGE
+    while self._recent:
+      oldest = next(iter(self._recent))
+      if self._recent[oldest][0] > cutoff:
+        break
+      del self._recent[oldest]
+
+  def clear(self):
+    """Drops all indexed data."""
+    with self._lock:
+      self._prefixes.clear()
+      self._recent.clear()
+
+  def version(self, pfx):
+    """Returns the version of the index for the prefix or None if unknown."""
+    with self._lock:
+      idx = self._prefixes.get(pfx)
+      return idx.version if idx else None
+
+  def rebuild(self, pfx, sets_ents, now):
+    """Replaces the index of the prefix with results of a complete scan.
+
+    Changes committed by this process since the scan started are applied on
+    top, since the scan may not have observed them.
+
+    Arguments:
+      pfx: an ID prefix as returned by TaskDimensionsSets.id_prefix(...).
+      sets_ents: all TaskDimensionsSets entities with this prefix.
+      now: datetime.datetime when the scan started.
+    """
+    idx = _PrefixIndex(now)
+    for ent in sets_ents:
+      idx.put(ent.key.string_id(), [s['dimensions'] for s in ent.sets])
+    with self._lock:
+      for sets_id, (ts, dims_sets) in self._recent.items():
+        if ts < now or self._split(sets_id) != pfx:
+          continue
+        if dims_sets is None:
+          idx.remove(sets_id)
+        else:
+          idx.put(sets_id, dims_sets)
+      old = self._prefixes.get(pfx)
+      if old:
+        idx.version += old.version
+      self._prefixes[pfx] = idx
+      if len(self._prefixes) > _SETS_INDEX_MAX_PREFIXES:
+        oldest = sorted(self._prefixes, key=lambda p: self._prefixes[p].built_ts)
+        for p in oldest[:len(self._prefixes) - _SETS_INDEX_MAX_PREFIXES]:
+          del self._prefixes[p]
+
+  def put(self, sets_id, dims_sets, now):
+    """Records a committed TaskDimensionsSets and updates its indexed prefix.
+
+    Arguments:
+      sets_id: string ID of TaskDimensionsSets.
+      dims_sets: a list of lists with flat task dimensions.
+      now: datetime.datetime when the change was committed.
+    """
+    with self._lock:
+      self._record(sets_id, dims_sets, now)
+      idx = self._prefixes.get(self._split(sets_id))
+      if idx:
+        idx.put(sets_id, dims_sets)
+
+  def remove(self, sets_id, now):
+    """Records a deleted TaskDimensionsSets and removes it from the index."""
+    with self._lock:
+      self._record(sets_id, None, now)
+      idx = self._prefixes.get(self._split(sets_id))
+      if idx:
+        idx.remove(sets_id)
+
+  def matching(self, pfx, bot_dimensions_set, now):
+    """Returns IDs of indexed sets that may match the bot or None if stale.
+
+    The result must be confirmed by loading the sets from the datastore, see
+    _check_matches_async.
+
+    Arguments:
+      pfx: an ID prefix as returned by TaskDimensionsSets.id_prefix(...).
+      bot_dimensions_set: a set of `k:v` pairs with bot dimensions.
+      now: datetime.datetime to check the freshness of the index against.
+
+    Returns:
+      A set of candidate TaskDimensionsSets IDs or None if the prefix is not
+      indexed or its index has expired.
+    """
+    with self._lock:
+      idx = self._get_fresh(pfx, now)
+      if not idx:
+        return None
+      return idx.matching(bot_dimensions_set)
+
+
+# The in-process index of TaskDimensionsSets, see _TaskDimensionsSetsIndex.
+_sets_index = _TaskDimensionsSetsIndex()
+
+
 def _is_bot_matching_any_task_dims(bot_dimensions_flat, task_dims_sets):
   """True if a bot can execute tasks with any of given dimensions.
 
@@ -389,6 +592,11 @@ def _put_task_dimensions_sets_async(sets_id, expiry_map):
   # to not perfectly synchronized clocks.
   next_cleanup_ts = min(expiry_map.values()) + datetime.timedelta(minutes=5)
 
+  # Update the in-process index only if the transaction lands.
+  dims_sets = [list(dims) for dims in sorted(expiry_map)]
+  ndb.get_context().call_on_commit(
+      lambda: _sets_index.put(sets_id, dims_sets, utils.utcnow()))
+
   return ndb.put_multi_async([
       TaskDimensionsSets(key=sets_key,
                          sets=_expiry_map_to_sets(expiry_map,
@@ -412,6 +620,8 @@ def _delete_task_dimensions_sets_async(sets_id):
   assert ndb.in_transaction()
   sets_key = ndb.Key(TaskDimensionsSets, sets_id)
   info_key = ndb.Key(TaskDimensionsInfo, 1, parent=sets_key)
+  ndb.get_context().call_on_commit(
+      lambda: _sets_index.remove(sets_id, utils.utcnow()))
   return ndb.delete_multi_async([sets_key, info_key])
 
 
@@ -426,6 +636,7 @@ def _check_matches_async(bot_dimensions_set, sets_ids):
   Returns:
     set(alive and still matching sets IDs), set(stale sets IDs).
   """
+  sets_ids = list(sets_ids)
   sets_ents = yield ndb.get_multi_async(
       [ndb.Key(TaskDimensionsSets, sets_id) for sets_id in sets_ids])
 
@@ -473,7 +684,7 @@ def _assert_task_dimensions_async(task_dimensions, exp_ts):
   exp_ts += _random_timedelta_mins(0, 30)
 
   # This expands e.g. `{"k": "a|b"}` into `[("k:a",), ("k:b",)]`.
-  expanded = [tuple(s) for s in expand_dimensions_to_flats(task_dimensions)]
+  expanded = intern_dimensions(task_dimensions).flats
 
   # Check all sets are known and fresh.
   fresh = True
@@ -888,8 +1099,7 @@ def _tq_rescan_matching_task_sets_async(bot_id, rescan_counter, rescan_reason):
   bot_dimensions_flat = matches.dimensions
   bot_dimensions_set = set(bot_dimensions_flat)
 
-  def scan_prefix_query(set_kind, pfx):
-    pfx = TaskDimensionsSets.id_prefix(set_kind, pfx)
+  def scan_prefix_query(pfx):
     start = '%s:%s' % (pfx, chr(ord('0') - 1))
     end = '%s:%s' % (pfx, chr(ord('9') + 1))
     query = ndb.Query(
@@ -899,32 +1109,68 @@ def _tq_rescan_matching_task_sets_async(bot_id, rescan_counter, rescan_reason):
             ndb.FilterNode('__key__', '<', ndb.Key(TaskDimensionsSets, end)),
         ),
     )
-    return query, log.derive('%s', pfx)
+    return query, pfx
 
-  # Construct queries that scan for potentially matching TaskDimensionsSets.
-  #
-  # TODO(vadimsh): Each query can be sharded to parallelize the scan even more
-  # if necessary.
-  queries = [scan_prefix_query('bot', bot_id)]
+  # All ID prefixes that may have TaskDimensionsSets matching the bot.
+  prefixes = [TaskDimensionsSets.id_prefix('bot', bot_id)]
   for kv in bot_dimensions_flat:
     k, v = kv.split(':', 1)
     if k == 'pool':
-      queries.append(scan_prefix_query('pool', v))
+      prefixes.append(TaskDimensionsSets.id_prefix('pool', v))
 
   # A set of matching TaskDimensionsSets IDs discovered by the scans.
   alive = set()
+
+  # Rescans triggered by dimension changes use the in-process index for
+  # prefixes that were scanned recently to narrow down candidates, which are
+  # then loaded from the datastore. The index doesn't observe sets created by
+  # other processes, so periodic rescans always scan the datastore to catch
+  # them. Construct queries that scan for potentially matching
+  # TaskDimensionsSets for the rest.
+  #
+  # TODO(vadimsh): Each query can be sharded to parallelize the scan even more
+  # if necessary.
+  scan_ts = utils.utcnow()
+  use_index = rescan_reason != 'periodic'
+  queries = []
+  candidates = set()
+  for pfx in prefixes:
+    indexed = None
+    if use_index:
+      indexed = _sets_index.matching(pfx, bot_dimensions_set, scan_ts)
+    if indexed is None:
+      queries.append(scan_prefix_query(pfx))
+    else:
+      log.info('%s: found %d candidates in the index', pfx, len(indexed))
+      candidates.update(indexed)
+  if candidates:
+    confirmed, _ = yield _check_matches_async(bot_dimensions_set, candidates)
+    alive.update(confirmed)
+
   # A counter of visited items for debugging.
   visited = [0]
+  # ID prefix => list of visited TaskDimensionsSets, to rebuild the index.
+  scanned = {pfx: [] for _, pfx in queries}
 
   def visit_task_dimensions_set(task_dims_sets):
     visited[0] += 1
+    sets_id = task_dims_sets.key.string_id()
+    scanned.setdefault(sets_id[:sets_id.rfind(':')], []).append(task_dims_sets)
     if task_dims_sets.matches_bot_dimensions(bot_dimensions_set):
-      alive.add(task_dims_sets.key.string_id())
+      alive.add(sets_id)
 
   # Find all TaskDimensionsSets matching the bot dimensions.
-  visited_all = yield _map_async(queries, visit_task_dimensions_set)
+  visited_all = True
+  if queries:
+    queries = [(q, log.derive('%s', pfx)) for q, pfx in queries]
+    visited_all = yield _map_async(queries, visit_task_dimensions_set)
   log.info('visited %d entities, found %d matches', visited[0], len(alive))
 
+  # Complete scans can be used to answer following rescans for a while.
+  if visited_all:
+    for pfx, ents in scanned.items():
+      _sets_index.rebuild(pfx, ents, scan_ts)
+
   # Double check any currently matched sets that were not discovered by the scan
   # are indeed dead and should be unmatched. This is particularly important if
   # scans were incomplete due to timeouts (i.e. visited_all is False), but also
@@ -1219,6 +1465,91 @@ def _map_async(queries,
   raise ndb.Return(all(ok))
 
 
+class Dimensions(object):
+  """Immutable task dimensions with cached derived forms.
+
+  Instances are interned per process by intern_dimensions(), so the flat form,
+  the OR expansion and the hash are computed once per distinct set of task
+  dimensions. Can be used as a dict key.
+  """
+  __slots__ = ('_key', '_hash', '_flats')
+
+  def __init__(self, key):
+    # Tuple of (key, tuple of values) sorted by key, see _dimensions_key().
+    self._key = key
+    self._hash = None
+    self._flats = None
+
+  def __eq__(self, other):
+    return isinstance(other, Dimensions) and self._key == other._key
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self._key)
+
+  def __repr__(self):
+    return 'Dimensions(%r)' % (self.to_dict(),)
+
+  def to_dict(self):
+    """Returns a new dict(str, [str])."""
+    return {k: list(v) for k, v in self._key}
+
+  @property
+  def dimensions_hash(self):
+    """Returns the same value as hash_dimensions()."""
+    if self._hash is None:
+      self._hash = _hash_dimensions_items(self._key)
+    return self._hash
+
+  @property
+  def flats(self):
+    """Returns a tuple of sorted tuples of `k:v`, one per OR alternative."""
+    if self._flats is None:
+      self._flats = tuple(
+          tuple(f) for f in expand_dimensions_to_flats(self.to_dict()))
+    return self._flats
+
+
+def _dimensions_key(dimensions):
+  """Returns a hashable canonical form of a dict(str, [str])."""
+  items = []
+  for k, v in dimensions.items():
+    assert isinstance(v, (list, tuple)), (k, v)
+    items.append((k, tuple(v)))
+  return tuple(sorted(items))
+
+
+def _hash_dimensions_items(items):
+  """Implements hash_dimensions() over sorted (key, values) pairs."""
+  # This horrible code is the product of micro benchmarks.
+  # TODO(maruel): This is incorrect, as it can confuse keys and values. But
+  # changing the algo is non-trivial.
+  data = ''
+  for k, values in items:
+    data += k.encode('utf8')
+    data += '\000'
+    assert isinstance(values, (list, tuple)), values
+    for v in values:
+      data += v.encode('utf8')
+      data += '\000'
+  digest = hashlib.md5(data).digest()
+  # Note that 'L' means C++ unsigned long which is (usually) 32 bits and
+  # python's int is 64 bits.
+  return int(struct.unpack('<L', digest[:4])[0]) or 1
+
+
+# Maximum number of interned Dimensions kept per process, least recently used
+# ones are evicted first.
+_INTERNED_MAX = 10000
+
+# Guards _interned.
+_interned_lock = threading.Lock()
+# Canonical key => Dimensions, least recently used first.
+_interned = collections.OrderedDict()
+
+
 ### Public APIs.
 
 
@@ -1326,21 +1657,29 @@ def hash_dimensions(dimensions):
   The return value is guaranteed to be a non-zero int so it can be used as a key
   id in a ndb.Key.
   """
-  # This horrible code is the product of micro benchmarks.
-  # TODO(maruel): This is incorrect, as it can confuse keys and values. But
-  # changing the algo is non-trivial.
-  data = ''
-  for k, values in sorted(dimensions.items()):
-    data += k.encode('utf8')
-    data += '\000'
-    assert isinstance(values, (list, tuple)), values
-    for v in values:
-      data += v.encode('utf8')
-      data += '\000'
-  digest = hashlib.md5(data).digest()
-  # Note that 'L' means C++ unsigned long which is (usually) 32 bits and
-  # python's int is 64 bits.
-  return int(struct.unpack('<L', digest[:4])[0]) or 1
+  return intern_dimensions(dimensions).dimensions_hash
+
+
+def intern_dimensions(dimensions):
+  """Returns the interned Dimensions for task dimensions dict(str, [str]).
+
+  Bot dimensions are not interned: they are mostly unique per bot and would
+  only evict task dimensions from the cache.
+
+  Arguments:
+    dimensions: dict(str, [str]) or Dimensions, which is returned as is.
+  """
+  if isinstance(dimensions, Dimensions):
+    return dimensions
+  key = _dimensions_key(dimensions)
+  with _interned_lock:
+    d = _interned.pop(key, None)
+    if d is None:
+      d = Dimensions(key)
+    _interned[key] = d
+    while len(_interned) > _INTERNED_MAX:
+      _interned.popitem(last=False)
+  return d
 
 
 def assert_bot(bot_dimensions):
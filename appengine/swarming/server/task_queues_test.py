@@ -4,6 +4,7 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import collections
 import datetime
 import json
 import logging
@@ -497,6 +498,34 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
     self.assertEqual(
         task_queues.hash_dimensions(dim1), task_queues.hash_dimensions(dim2))
 
+  def test_intern_dimensions(self):
+    dims = {u'pool': [u'a'], u'os': [u'Linux|Mac', u'x86']}
+    d = task_queues.intern_dimensions(dims)
+    self.assertIs(d, task_queues.intern_dimensions(dict(dims)))
+    self.assertIs(d, task_queues.intern_dimensions(d))
+    self.assertEqual(d, task_queues.intern_dimensions(dict(dims)))
+    self.assertEqual({d: 1}, {task_queues.intern_dimensions(dims): 1})
+    self.assertEqual(dims, d.to_dict())
+    self.assertEqual(task_queues.hash_dimensions(dims), d.dimensions_hash)
+    self.assertEqual((
+        (u'os:Linux', u'os:x86', u'pool:a'),
+        (u'os:Mac', u'os:x86', u'pool:a'),
+    ), d.flats)
+    with self.assertRaises(AssertionError):
+      task_queues.intern_dimensions({u'pool': u'a'})
+
+  def test_intern_dimensions_lru(self):
+    self.mock(task_queues, '_INTERNED_MAX', 2)
+    self.mock(task_queues, '_interned', collections.OrderedDict())
+    a = task_queues.intern_dimensions({u'pool': [u'a']})
+    b = task_queues.intern_dimensions({u'pool': [u'b']})
+    # Refreshes `a`, so `b` is evicted first.
+    self.assertIs(a, task_queues.intern_dimensions({u'pool': [u'a']}))
+    task_queues.intern_dimensions({u'pool': [u'c']})
+    self.assertEqual(2, len(task_queues._interned))
+    self.assertIs(a, task_queues.intern_dimensions({u'pool': [u'a']}))
+    self.assertIsNot(b, task_queues.intern_dimensions({u'pool': [u'b']}))
+
   def test_expand_dimensions_to_flats(self):
     expand = task_queues.expand_dimensions_to_flats
     # Without OR
@@ -1093,6 +1122,39 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
             555,
         })
 
+  def test_tq_rescan_matching_task_sets_async_index(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5)
+    self.mock_now(now)
+
+    self._create_task_dims_set('pool:pool1:1', ['pool:pool1'])
+    self._create_task_dims_set('pool:pool1:2', ['pool:pool1', 'dim:1'])
+    task_queues.BotDimensionsMatches(
+        id='bot-id',
+        dimensions=[u'dim:1', u'id:bot-id', u'pool:pool1'],
+        last_rescan_enqueued_ts=now,
+        rescan_counter=1,
+    ).put()
+
+    def rescan(reason):
+      self.assertTrue(
+          task_queues._tq_rescan_matching_task_sets_async(
+              'bot-id', 1, reason).get_result())
+      return ndb.Key(task_queues.BotDimensionsMatches, 'bot-id').get().matches
+
+    # The first rescan populates the index.
+    self.assertEqual([u'pool:pool1:1', u'pool:pool1:2'], rescan('dim:1'))
+
+    # Another process deletes one set and creates another one. The index
+    # doesn't know about either.
+    ndb.Key(task_queues.TaskDimensionsSets, 'pool:pool1:2').delete()
+    task_queues.TaskDimensionsSets(
+        id='pool:pool1:3', sets=[{'dimensions': ['pool:pool1']}]).put()
+
+    # Candidates from the index are confirmed in the datastore.
+    self.assertEqual([u'pool:pool1:1'], rescan('dim:1'))
+    # Periodic rescans don't use the index.
+    self.assertEqual([u'pool:pool1:1', u'pool:pool1:3'], rescan('periodic'))
+
   def test_tq_update_bot_matches_async_pool(self):
     now = datetime.datetime(2010, 1, 2, 3, 4, 5)
     self.mock_now(now)
@@ -1351,6 +1413,100 @@ class TestMapAsync(test_env_handlers.AppTestBase):
     self.assertEqual(sorted(seen), bots)
 
 
+class TestTaskDimensionsSetsIndex(test_env_handlers.AppTestBase):
+  NOW = datetime.datetime(2020, 1, 2, 3, 4, 5)
+
+  @staticmethod
+  def sets_ent(sets_id, dims_sets):
+    return task_queues.TaskDimensionsSets(
+        id=sets_id, sets=[{'dimensions': dims} for dims in dims_sets])
+
+  def index(self):
+    idx = task_queues._TaskDimensionsSetsIndex()
+    idx.rebuild('pool:p', [
+        self.sets_ent('pool:p:1', [['pool:p']]),
+        self.sets_ent('pool:p:2', [['os:linux', 'pool:p']]),
+        self.sets_ent('pool:p:3', [['gpu:a', 'pool:p'], ['gpu:b', 'pool:p']]),
+    ], self.NOW)
+    return idx
+
+  def test_matching(self):
+    idx = self.index()
+    self.assertEqual({'pool:p:1'},
+                     idx.matching('pool:p', {'id:b', 'pool:p'}, self.NOW))
+    self.assertEqual({'pool:p:1', 'pool:p:2'},
+                     idx.matching('pool:p', {'os:linux', 'pool:p'}, self.NOW))
+    self.assertEqual({'pool:p:1', 'pool:p:3'},
+                     idx.matching('pool:p', {'gpu:b', 'pool:p'}, self.NOW))
+    self.assertEqual(set(), idx.matching('pool:p', {'os:linux'}, self.NOW))
+    self.assertIsNone(idx.matching('pool:other', {'pool:p'}, self.NOW))
+
+  def test_expiry(self):
+    idx = self.index()
+    later = self.NOW + task_queues._SETS_INDEX_MAX_AGE
+    self.assertIsNone(idx.matching('pool:p', {'pool:p'}, later))
+
+  def test_incremental_updates(self):
+    idx = self.index()
+    version = idx.version('pool:p')
+    idx.put('pool:p:2', [['os:mac', 'pool:p']], self.NOW)
+    idx.put('pool:p:4', [['os:linux', 'pool:p']], self.NOW)
+    idx.remove('pool:p:1', self.NOW)
+    idx.put('pool:other:1', [['pool:other']], self.NOW)
+    self.assertEqual(version + 4, idx.version('pool:p'))
+    self.assertIsNone(idx.version('pool:other'))
+    self.assertEqual({'pool:p:4'},
+                     idx.matching('pool:p', {'os:linux', 'pool:p'}, self.NOW))
+
+  def test_rebuild_replays_recent_changes(self):
+    idx = task_queues._TaskDimensionsSetsIndex()
+    before = self.NOW - datetime.timedelta(seconds=1)
+    after = self.NOW + datetime.timedelta(seconds=1)
+    # Committed before the scan started, the scan has seen them.
+    idx.put('pool:p:1', [['pool:p']], before)
+    idx.remove('pool:p:2', before)
+    # Committed while the scan was running, the scan may have missed them.
+    idx.put('pool:p:3', [['pool:p']], after)
+    idx.remove('pool:p:4', after)
+    idx.put('pool:other:1', [['pool:p']], after)
+    idx.rebuild('pool:p', [
+        self.sets_ent('pool:p:2', [['pool:p']]),
+        self.sets_ent('pool:p:4', [['pool:p']]),
+    ], self.NOW)
+    self.assertEqual({'pool:p:2', 'pool:p:3'},
+                     idx.matching('pool:p', {'pool:p'}, self.NOW))
+
+  def test_recent_changes_expire(self):
+    idx = task_queues._TaskDimensionsSetsIndex()
+    idx.put('pool:p:1', [['pool:p']], self.NOW)
+    later = self.NOW + task_queues._SETS_INDEX_MAX_AGE
+    idx.put('pool:p:2', [['pool:p']], later)
+    self.assertEqual(['pool:p:2'], list(idx._recent))
+
+  def test_updated_on_commit(self):
+    self.mock_now(self.NOW)
+    task_queues._sets_index.rebuild('pool:p', [], self.NOW)
+    exp = self.NOW + datetime.timedelta(hours=1)
+
+    @ndb.transactional
+    def put():
+      task_queues._put_task_dimensions_sets_async(
+          'pool:p:1', {('pool:p',): exp}).get_result()
+
+    @ndb.transactional
+    def delete():
+      task_queues._delete_task_dimensions_sets_async('pool:p:1').get_result()
+
+    put()
+    self.assertEqual({'pool:p:1'},
+                     task_queues._sets_index.matching('pool:p', {'pool:p'},
+                                                      self.NOW))
+    delete()
+    self.assertEqual(set(),
+                     task_queues._sets_index.matching('pool:p', {'pool:p'},
+                                                      self.NOW))
+
+
 if __name__ == '__main__':
   if '-v' in sys.argv:
     unittest.TestCase.maxDiff = None
@@ -1679,6 +1679,16 @@ def datetime_to_request_base_id(now):
   return int(round(delta.total_seconds() * 1000.)) << 20
 
 
+def request_key_to_datetime(request_key):
+  """Returns the creation time encoded in a TaskRequest key, at 1ms resolution.
+
+  This is the time used when filtering queries by creation time.
+  """
+  request_id = request_key.integer_id() ^ task_pack.TASK_REQUEST_KEY_ID_MASK
+  return _BEGINING_OF_THE_WORLD + datetime.timedelta(
+      milliseconds=request_id >> 20)
+
+
 def convert_to_request_key(date, suffix=0):
   assert 0 <= suffix <= 0xffff
   request_id_base = datetime_to_request_base_id(date)
@@ -1765,6 +1765,13 @@ class TaskRequestApiTest(TestCase):
     key = task_request.convert_to_request_key(now)
     self.assertEqual(9157134072765480958, key.id())
 
+  def test_request_key_to_datetime(self):
+    now = datetime.datetime(2012, 1, 2, 3, 4, 5, 123456)
+    key = task_request.convert_to_request_key(now, suffix=0x1234)
+    self.assertEqual(
+        datetime.datetime(2012, 1, 2, 3, 4, 5, 123000),
+        task_request.request_key_to_datetime(key))
+
   def test_request_id_to_key(self):
     # Simple XOR.
     self.assertEqual(
@@ -65,7 +65,9 @@ Graph of schema:
 """
 
 import datetime
+import json
 import logging
+import zlib
 
 from google.appengine.api import datastore_errors
 from google.appengine.datastore import datastore_query
@@ -77,6 +79,7 @@ from components import utils
 from proto.api import swarming_pb2  # pylint: disable=no-name-in-module
 from server import large
 from server import resultdb
+from server import task_counts
 from server import task_pack
 from server import task_request
 from server.constants import OR_DIM_SEP
@@ -90,6 +93,15 @@ _BOT_TASK_ALLOWED_SORTS = {'created_ts', 'started_ts', 'completed_ts'}
 # - deduped relies on try_number which is not part of `task_run_result`.
 _BOT_TASK_DISALLOWED_STATES = {'pending', 'pending_running', 'deduped'}
 
+# How long after an hour ended its task_counts rollups are reconciled. Tasks
+# keep changing state after their creation hour, up to their expiration and
+# execution timeout.
+_RECONCILE_TASK_COUNTS_DELAYS = (
+    datetime.timedelta(hours=1),
+    datetime.timedelta(days=1),
+    datetime.timedelta(days=8),
+)
+
 
 class State(object):
   """Represents the current task state.
@@ -174,6 +186,22 @@ class LargeIntegerArray(ndb.BlobProperty):
     return super(LargeIntegerArray, self)._do_validate(value) or None
 
 
+# State names accepted by filter_query() matching each State, in addition to
+# 'all'. See _count_state_names().
+_STATE_NAMES = {
+    State.RUNNING: ('running', 'pending_running'),
+    State.PENDING: ('pending', 'pending_running'),
+    State.EXPIRED: ('expired',),
+    State.TIMED_OUT: ('timed_out',),
+    State.BOT_DIED: ('bot_died',),
+    State.CANCELED: ('canceled',),
+    State.COMPLETED: ('completed',),
+    State.KILLED: ('killed',),
+    State.NO_RESOURCE: ('no_resource',),
+    State.CLIENT_ERROR: ('client_error',),
+}
+
+
 def _calculate_failure(result_common):
   # When the task command times out, there may not be any exit code, it is still
   # a user process failure mode, not an infrastructure failure mode.
@@ -201,10 +229,32 @@ class TaskOutput(ndb.Model):
   # Maximum number of chunks.
   PUT_MAX_CHUNKS = 1024
 
+  # Number of chunks fetched at once when reading the output.
+  FETCH_BATCH = 16
+
+  # If True, new TaskOutputChunk are stored in TaskOutputChunk.data: the chunk
+  # being appended to is stored raw, and it is compressed once when full.
+  # Otherwise they are stored in TaskOutputChunk.chunk, which is recompressed on
+  # every append. Chunks in either format can be read in both modes; only turn
+  # on once all the readers of TaskOutputChunk support TaskOutputChunk.data.
+  COMPRESS_SEALED_CHUNKS = False
+
+  # Maximum number of chunks when COMPRESS_SEALED_CHUNKS is True. Sealed chunks
+  # of text logs are several times smaller, so more of them fit in the same
+  # storage budget.
+  PUT_MAX_CHUNKS_COMPRESSED = 4 * 1024
+
+  @classmethod
+  def max_chunks(cls):
+    """Returns the maximum number of TaskOutputChunk for a task."""
+    if cls.COMPRESS_SEALED_CHUNKS:
+      return cls.PUT_MAX_CHUNKS_COMPRESSED
+    return cls.PUT_MAX_CHUNKS
+
   # Maximum content size saved in a TaskOutput.
   @classmethod
   def PUT_MAX_CONTENT(cls):
-    return cls.PUT_MAX_CHUNKS * cls.CHUNK_SIZE
+    return cls.max_chunks() * cls.CHUNK_SIZE
 
 
 class TaskOutputChunk(ndb.Model):
@@ -214,18 +264,52 @@ class TaskOutputChunk(ndb.Model):
   since 0 is not a valid id.
 
   Each entity except the last one must have exactly
-  len(self.chunk) == self.CHUNK_SIZE.
+  len(self.content) == self.CHUNK_SIZE.
   """
+  # Encodings of self.data.
+  RAW = 'raw'
+  ZLIB = 'zlib'
+
+  # Content when self.encoding is None.
   chunk = ndb.BlobProperty(default='', compressed=True)
   # gaps is a series of 2 integer pairs, which specifies the part that are
   # invalid. Normally it should be empty. All values are relative to the start
   # of this chunk offset.
   gaps = ndb.IntegerProperty(repeated=True, indexed=False)
+  # Content when self.encoding is set, see TaskOutput.COMPRESS_SEALED_CHUNKS.
+  data = ndb.BlobProperty()
+  # One of None, RAW or ZLIB.
+  encoding = ndb.StringProperty(indexed=False)
 
   @property
   def chunk_number(self):
     return self.key.integer_id() - 1
 
+  @property
+  def content(self):
+    """Returns the decoded content of this chunk."""
+    if self.encoding == self.ZLIB:
+      return zlib.decompress(self.data)
+    if self.encoding == self.RAW:
+      return self.data
+    return self.chunk
+
+  def set_content(self, content):
+    """Sets the content of this chunk, encoded as per TaskOutput settings."""
+    if not TaskOutput.COMPRESS_SEALED_CHUNKS:
+      self.chunk = content
+      self.data = None
+      self.encoding = None
+      return
+    self.chunk = ''
+    if len(content) == TaskOutput.CHUNK_SIZE and not self.gaps:
+      # Sealed: it is not going to be appended to anymore.
+      self.data = zlib.compress(content, 9)
+      self.encoding = self.ZLIB
+    else:
+      self.data = content
+      self.encoding = self.RAW
+
 
 class OperationStats(ndb.Model):
   """Statistics for an operation.
@@ -850,10 +934,25 @@ class _TaskResultCommon(ndb.Model):
     Returns:
       str with content, None if there wasn't any content.
     """
-    run_result_key = self.run_result_key
-    if not run_result_key or not self.stdout_chunks:
+    if not self.run_result_key or not self.stdout_chunks:
       # The task was not reaped or no output was streamed yet.
       return None
+    return ''.join(self.iter_output(offset, length))
+
+  def iter_output(self, offset, length):
+    """Yields the stdout content for this task as a series of str.
+
+    Contrary to get_output(), the whole content is never held in memory at
+    once. The TaskOutputChunk entities are fetched TaskOutput.FETCH_BATCH at a
+    time, prefetching the next batch while the current one is consumed.
+
+    Arguments:
+      offset: offset in the stream which start returning the data.
+      length: chunk size to return. If 0, fetch the whole content.
+    """
+    run_result_key = self.run_result_key
+    if not run_result_key or not self.stdout_chunks:
+      return
 
     chunk_size = TaskOutput.CHUNK_SIZE
     length = length or (self.stdout_chunks * chunk_size - offset)
@@ -863,26 +962,44 @@ class _TaskResultCommon(ndb.Model):
     end = offset + length
     last_chunk = min((end + chunk_size-1) / chunk_size, self.stdout_chunks)
 
-    # Retrieve the subset of TaskOutputChunk needed.
+    # Retrieve the subset of TaskOutputChunk needed. Skip the in-process cache,
+    # it would keep all the chunks in memory until the end of the request.
     output_key = _run_result_key_to_output_key(run_result_key)
     keys = [
         _output_key_to_output_chunk_key(output_key, i)
         for i in range(first_chunk, last_chunk)
     ]
-    void = None
-    parts = []
-    for e in ndb.get_multi(keys):
-      if e:
-        parts.append(e.chunk)
-      else:
-        if not void:
-          void = '\x00' * TaskOutput.CHUNK_SIZE
-        parts.append(void)
+    batch = TaskOutput.FETCH_BATCH
+    futures = ndb.get_multi_async(keys[:batch], use_cache=False)
 
-    # Process the output.
+    # Position of the current chunk relative to the start of the first one, and
+    # the range to return in the same referential.
+    pos = 0
     start_offset = offset % chunk_size
     end_offset = end - (first_chunk * chunk_size)
-    return ''.join(parts)[start_offset:end_offset]
+    void = None
+    for i in range(0, len(keys), batch):
+      current = futures
+      if i + batch < len(keys):
+        futures = ndb.get_multi_async(
+            keys[i + batch:i + 2 * batch], use_cache=False)
+      for f in current:
+        e = f.get_result()
+        if e:
+          part = e.content
+        else:
+          if not void:
+            void = '\x00' * TaskOutput.CHUNK_SIZE
+          part = void
+        lo = max(start_offset - pos, 0)
+        hi = min(end_offset - pos, len(part))
+        pos += len(part)
+        if lo >= hi:
+          continue
+        if lo == 0 and hi == len(part):
+          yield part
+        else:
+          yield part[lo:hi]
 
   def _pre_put_hook(self):
     """Use extra validation that cannot be validated throught 'validator'."""
@@ -1061,7 +1178,7 @@ class TaskRunResult(_TaskResultCommon):
         self.stdout_chunks,
         output,
         output_chunk_start)
-    assert self.stdout_chunks <= TaskOutput.PUT_MAX_CHUNKS
+    assert self.stdout_chunks <= TaskOutput.max_chunks()
     return entities
 
   def to_dict(self, **kwargs):
@@ -1182,6 +1299,12 @@ class TaskResultSummary(_TaskResultCommon):
   # sending metrics
   _prev_state = None
 
+  # (tags, state names) this entity is counted as in task_counts, as of when it
+  # was last fetched or stored. None if unknown, e.g. loaded via a query, and
+  # () if it was never stored. _counted_before is the value as of _pre_put_hook.
+  _counted = None
+  _counted_before = None
+
   @property
   def cost_usd(self):
     """Returns the sum of the cost of each try."""
@@ -1216,23 +1339,42 @@ class TaskResultSummary(_TaskResultCommon):
   def task_id(self):
     return task_pack.pack_result_summary_key(self.key)
 
+  @classmethod
+  def _post_get_hook(cls, key, future):
+    entity = future.get_result()
+    if entity:
+      entity._counted = entity._count_key()
+
   def _pre_put_hook(self):
     super(TaskResultSummary, self)._pre_put_hook()
     self._cache_prev_state()
 
   def _cache_prev_state(self):
     """Stores previous state."""
+    self._counted_before = self._counted
     # Note: Skip when the current state is running or pending
     # since it's used only by _send_job_completed_metric at the time
     # of implementing.
-    if self.state in State.STATES_RUNNING:
+    if self.state in State.STATES_RUNNING and self._counted is not None:
       return
     # Don't use process cache to retrieve the original object
     orig = self.key.get(use_cache=False, use_memcache=False)
+    if self._counted_before is None:
+      self._counted_before = orig._count_key() if orig else ()
     if not orig:
       return
     self._prev_state = orig.state
 
+  def _count_key(self):
+    """Returns (tags, state names) as counted in task_counts."""
+    names = ['all']
+    names.extend(_STATE_NAMES[self.state])
+    if self.state == State.COMPLETED:
+      names.append('completed_failure' if self.failure else 'completed_success')
+      if self.try_number == 0:
+        names.append('deduped')
+    return tuple(self.tags), tuple(names)
+
   def _post_put_hook(self, future):
     super(TaskResultSummary, self)._post_put_hook(future)
     # Ensure that no errors are raised from future.check_success()
@@ -1241,6 +1383,18 @@ class TaskResultSummary(_TaskResultCommon):
     future.check_success()
     self._send_job_completed_metric()
     self._call_finalize_invocation()
+    self._update_task_counts()
+
+  def _update_task_counts(self):
+    """Updates the rollups in task_counts once the change is committed."""
+    before = self._counted_before
+    after = self._count_key()
+    self._counted = after
+    if before == after:
+      return
+    created_ts = task_request.request_key_to_datetime(self.request_key)
+    ndb.get_context().call_on_commit(
+        lambda: task_counts.update(created_ts, before, after))
 
   def _call_finalize_invocation(self):
     """Call FinalizeInvocation to ResultDB."""
@@ -1359,7 +1513,8 @@ def _output_append(output_key, number_chunks, output, output_chunk_start):
   Creates new TaskOutputChunk entities as necessary as children of
   TaskRunResult/TaskOutput.
 
-  It silently drops saving the output if it goes over ~100Mib.
+  It silently drops saving the output if it goes over
+  TaskOutput.PUT_MAX_CONTENT().
 
   Does one DB read by key and no puts. It's the responsibility of the caller to
   save the entities.
@@ -1377,12 +1532,13 @@ def _output_append(output_key, number_chunks, output, output_chunk_start):
   """
   assert output and isinstance(output, str), output
   assert output_key.kind() == 'TaskOutput', output_key
+  stored_chunks = number_chunks
 
   # Split everything in small bits.
   chunks = []
   while output:
     chunk_number = output_chunk_start / TaskOutput.CHUNK_SIZE
-    if chunk_number >= TaskOutput.PUT_MAX_CHUNKS:
+    if chunk_number >= TaskOutput.max_chunks():
       # TODO(maruel): Log into TaskOutput that data was dropped.
       logging.warning('Dropping output\n%d bytes were lost', len(output))
       break
@@ -1400,11 +1556,16 @@ def _output_append(output_key, number_chunks, output, output_chunk_start):
   # Get the TaskOutputChunk from the DB. Normally it would be only one entity
   # (the last incomplete one) but this code supports arbitrary overwrite.
   #
-  # number_chunks should normally be used to skip entities that are assumed to
-  # not be present but we don't assume the number_chunks is valid for safety.
-  #
-  # This means an unneeded get() is done on the missing chunk.
-  entities = ndb.get_multi(i[0] for i in chunks)
+  # The chunks at or past the stored number of chunks do not exist yet, the
+  # number of chunks being saved in the same transaction as the chunks
+  # themselves, so they are not fetched.
+  to_fetch = [
+      i for i, (key, _, _) in enumerate(chunks)
+      if key.integer_id() - 1 < stored_chunks
+  ]
+  entities = [None] * len(chunks)
+  for i, e in zip(to_fetch, ndb.get_multi(chunks[i][0] for i in to_fetch)):
+    entities[i] = e
 
   # Update the entities.
   for i, (key, start, output_chunk) in enumerate(chunks):
@@ -1412,12 +1573,18 @@ def _output_append(output_key, number_chunks, output, output_chunk_start):
       # Fill up for missing entities.
       entities[i] = TaskOutputChunk(key=key)
     chunk = entities[i]
+    content = chunk.content
+    if not chunk.gaps and len(content) == start:
+      # Fast path: appending right at the end of the chunk, which is what
+      # happens with streamed output.
+      chunk.set_content(content + output_chunk)
+      continue
     # Magically combine everything.
     end = start + len(output_chunk)
-    if len(chunk.chunk) < start:
+    if len(content) < start:
       # Insert blank data automatically.
-      chunk.gaps.extend((len(chunk.chunk), start))
-      chunk.chunk = chunk.chunk + '\x00' * (start-len(chunk.chunk))
+      chunk.gaps.extend((len(content), start))
+      content = content + '\x00' * (start-len(content))
 
     # Strip gaps that are being written to.
     new_gaps = []
@@ -1451,7 +1618,7 @@ def _output_append(output_key, number_chunks, output, output_chunk_start):
         new_gaps.extend((gap_start, gap_end))
 
     chunk.gaps = new_gaps
-    chunk.chunk = chunk.chunk[:start] + output_chunk + chunk.chunk[end:]
+    chunk.set_content(content[:start] + output_chunk + content[end:])
   return entities, number_chunks
 
 
@@ -1573,17 +1740,20 @@ def new_result_summary(request):
   The caller must save it in the DB.
   """
   key = task_pack.request_key_to_result_summary_key(request.key)
-  return TaskResultSummary(key=key,
-                           created_ts=request.created_ts,
-                           name=request.name,
-                           server_versions=[utils.get_app_version()],
-                           user=request.user,
-                           tags=request.tags,
-                           priority=request.priority,
-                           request_authenticated=request.authenticated,
-                           request_realm=request.realm,
-                           request_pool=request.pool,
-                           request_bot_id=request.bot_id)
+  out = TaskResultSummary(key=key,
+                          created_ts=request.created_ts,
+                          name=request.name,
+                          server_versions=[utils.get_app_version()],
+                          user=request.user,
+                          tags=request.tags,
+                          priority=request.priority,
+                          request_authenticated=request.authenticated,
+                          request_realm=request.realm,
+                          request_pool=request.pool,
+                          request_bot_id=request.bot_id)
+  # It is not counted in task_counts yet.
+  out._counted = ()
+  return out
 
 
 def new_run_result(request, to_run, bot_id, bot_details, bot_dimensions,
@@ -1690,6 +1860,97 @@ def get_result_summaries_query(start, end, sort, state, tags):
   return filter_query(TaskResultSummary, q, start, end, sort, state)
 
 
+def count_result_summaries(start, end, state, tags):
+  """Returns the number of TaskResultSummary created in [start, end) matching
+  the state and tags, as get_result_summaries_query(...).count() would.
+
+  Whole hours are read from the task_counts rollups when possible: a single tag
+  without OR and hours after task_counts.get_start_ts(). Only the partial hours
+  at both ends are counted with a query.
+
+  Arguments:
+    start: Earliest creation date of counted tasks.
+    end: Most recent creation date of counted tasks, or None for now.
+    state: One of State enum value as str. Use 'all' to count all tasks.
+    tags: List of search for one or multiple task tags.
+  """
+  def query_count(s, e):
+    return get_result_summaries_query(s, e, 'created_ts', state, tags).count()
+
+  # Validate the arguments, this doesn't do any RPC.
+  get_result_summaries_query(start, end, 'created_ts', state, tags)
+  if not start or len(tags) > 1 or (tags and OR_DIM_SEP in tags[0]):
+    return query_count(start, end)
+  counted_since = task_counts.get_start_ts()
+  if not counted_since:
+    return query_count(start, end)
+  first = max(task_counts.ceil_hour(start), counted_since)
+  last = task_counts.floor_hour(end or utils.utcnow())
+  if first >= last:
+    return query_count(start, end)
+
+  count = task_counts.get_count(tags[0] if tags else u'', state, first, last)
+  if start < first:
+    count += query_count(start, first)
+  if not end or last < end:
+    count += query_count(last, end)
+  return count
+
+
+def cron_reconcile_task_counts():
+  """Enqueues the reconciliation of the task_counts rollups of finished hours.
+
+  Each hour is reconciled a few times after it ended, see
+  _RECONCILE_TASK_COUNTS_DELAYS, each time by its own reconcile-task-counts
+  task. It's expected to be called once per hour.
+
+  Returns:
+    Number of hours enqueued.
+  """
+  counted_since = task_counts.get_start_ts()
+  if not counted_since:
+    return 0
+  now = utils.utcnow()
+  enqueued = 0
+  for delay in _RECONCILE_TASK_COUNTS_DELAYS:
+    hour = task_counts.floor_hour(now - delay) - task_counts.BUCKET
+    if hour < counted_since:
+      continue
+    payload = utils.encode_to_json({'hour': utils.datetime_to_timestamp(hour)})
+    if utils.enqueue_task(
+        '/internal/taskqueue/monitoring/tasks/reconcile-task-counts',
+        'reconcile-task-counts',
+        payload=payload):
+      enqueued += 1
+    else:
+      logging.warning('Failed to enqueue the reconciliation of %s', hour)
+  return enqueued
+
+
+def task_reconcile_task_counts(payload):
+  """Recomputes the task_counts rollups of an hour to fix any drift.
+
+  Called from the reconcile-task-counts task queue with the payload enqueued by
+  cron_reconcile_task_counts().
+
+  Returns:
+    Number of task_counts tags that were corrected.
+  """
+  hour = utils.timestamp_to_datetime(json.loads(payload)['hour'])
+
+  def iter_values():
+    q = get_result_summaries_query(
+        hour, hour + task_counts.BUCKET, 'created_ts', 'all', [])
+    cursor = None
+    more = True
+    while more:
+      results, cursor, more = q.fetch_page(1000, start_cursor=cursor)
+      for r in results:
+        yield r._count_key()
+
+  return task_counts.reconcile(hour, iter_values())
+
+
 def fetch_task_results(task_ids):
   """Returns the task results for the given tasks in the same order.
 
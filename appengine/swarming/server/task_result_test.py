@@ -32,6 +32,7 @@ from test_support import test_case
 
 from proto.api import swarming_pb2  # pylint: disable=no-name-in-module
 from server import large
+from server import task_counts
 from server import task_pack
 from server import task_request
 from server import task_result
@@ -166,6 +167,7 @@ class TestCase(test_case.TestCase):
   def setUp(self):
     super(TestCase, self).setUp()
     auth_testing.mock_get_current_identity(self)
+    self.mock(task_counts, '_start_ts_exists', False)
 
 
 class TaskResultApiTest(TestCase):
@@ -1120,6 +1122,93 @@ class TaskResultApiTest(TestCase):
     # Indirectly tested by API.
     pass
 
+  def test_count_result_summaries(self):
+    # The first task sets the start of the rollups to the next hour, 04:00.
+    _gen_summary_result(manual_tags=[u'tag:1'])
+    self.assertEqual(
+        datetime.datetime(2014, 1, 2, 4), task_counts.get_start_ts())
+    self.mock_now(datetime.datetime(2014, 1, 2, 5, 30))
+    _gen_summary_result(manual_tags=[u'tag:1'])
+    _gen_summary_result(manual_tags=[u'tag:2'])
+    _gen_run_result(manual_tags=[u'tag:1'])
+    self.mock_now(datetime.datetime(2014, 1, 2, 7, 10))
+    _gen_run_result(manual_tags=[u'tag:2'])
+    _gen_summary_result(manual_tags=[u'tag:1'])
+    task_counts.cron_apply_deltas()
+
+    # The whole hours 04:00 to 07:00 come from the rollups.
+    hour = datetime.datetime(2014, 1, 2, 4)
+    self.assertEqual(
+        3,
+        task_counts.get_count(u'', 'all', hour,
+                              hour + 3 * task_counts.BUCKET))
+    self.assertEqual(
+        1,
+        task_counts.get_count(u'tag:1', 'running', hour,
+                              hour + 3 * task_counts.BUCKET))
+
+    start = datetime.datetime(2014, 1, 2, 3)
+    end = datetime.datetime(2014, 1, 2, 7, 30)
+    for state in ('all', 'pending', 'running', 'pending_running', 'completed'):
+      for tags in ([], [u'tag:1'], [u'tag:2'], [u'tag:1|2'],
+                   [u'tag:1', u'pool:default']):
+        for s, e in ((start, end), (start, None), (hour, end)):
+          expected = task_result.get_result_summaries_query(
+              s, e, 'created_ts', state, tags).count()
+          self.assertEqual(
+              expected,
+              task_result.count_result_summaries(s, e, state, tags),
+              (state, tags, s, e))
+
+  def test_cron_reconcile_task_counts(self):
+    # Nothing is counted yet.
+    self.assertEqual(0, task_result.cron_reconcile_task_counts())
+    _gen_summary_result(manual_tags=[u'tag:1'])
+    self.mock_now(datetime.datetime(2014, 1, 2, 4, 30))
+    _gen_summary_result(manual_tags=[u'tag:1'])
+    _gen_run_result(manual_tags=[u'tag:2'])
+    # Lose all the deltas.
+    task_counts.cron_apply_deltas()
+    ndb.delete_multi(task_counts.TaskCountBucket.query().fetch(keys_only=True))
+
+    hour = datetime.datetime(2014, 1, 2, 4)
+
+    def get(tag, state):
+      return task_counts.get_count(tag, state, hour, hour + task_counts.BUCKET)
+
+    payloads = []
+
+    def enqueue_task(url, queue_name, payload):
+      self.assertEqual(
+          '/internal/taskqueue/monitoring/tasks/reconcile-task-counts', url)
+      self.assertEqual('reconcile-task-counts', queue_name)
+      payloads.append(payload)
+      return True
+
+    self.mock(utils, 'enqueue_task', enqueue_task)
+
+    # 04:00 to 05:00 ended less than an hour ago.
+    self.mock_now(datetime.datetime(2014, 1, 2, 5, 30))
+    self.assertEqual(0, task_result.cron_reconcile_task_counts())
+    self.mock_now(datetime.datetime(2014, 1, 2, 6, 10))
+    # One task per hour to reconcile.
+    self.assertEqual(1, task_result.cron_reconcile_task_counts())
+    # u'', tag:1 and tag:2, plus the user tag.
+    fixed = task_result.task_reconcile_task_counts(payloads[0])
+    self.assertLessEqual(3, fixed)
+    self.assertEqual(2, get(u'', 'all'))
+    self.assertEqual(1, get(u'tag:1', 'pending'))
+    self.assertEqual(1, get(u'tag:2', 'running'))
+    self.assertEqual(0, task_result.task_reconcile_task_counts(payloads[0]))
+    # The hour before the rollups started is not touched.
+    self.assertEqual(
+        0,
+        task_counts.get_count(u'', 'all', hour - task_counts.BUCKET, hour))
+
+  def test_task_reconcile_task_counts(self):
+    # Tested in test_cron_reconcile_task_counts.
+    pass
+
   def test_fetch_task_results(self):
     running_res = _gen_run_result()  # RUNNING
     pending_res = _gen_summary_result()  # PENDING
@@ -1149,7 +1238,8 @@ class TestOutput(TestCase):
   def assertTaskOutputChunk(self, expected):
     q = task_result.TaskOutputChunk.query().order(
         task_result.TaskOutputChunk.key)
-    self.assertEqual(expected, [t.to_dict() for t in q.fetch()])
+    self.assertEqual(
+        expected, [{'chunk': t.content, 'gaps': t.gaps} for t in q.fetch()])
 
   def test_append_output(self):
     # Force tedious chunking.
@@ -1165,6 +1255,100 @@ class TestOutput(TestCase):
     run('Part3\n', len('Part1P\n'))
     self.assertEqual('Part1\nPPart3\n', run_result.get_output(0, 0))
 
+  def test_append_output_fast_path(self):
+    # Force tedious chunking.
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 4)
+    run_result = _gen_run_result()
+    fetched = []
+    get_multi = ndb.get_multi
+
+    def mocked_get_multi(keys, **kwargs):
+      keys = list(keys)
+      fetched.append([k.integer_id() for k in keys])
+      return get_multi(keys, **kwargs)
+
+    self.mock(ndb, 'get_multi', mocked_get_multi)
+    ndb.put_multi(run_result.append_output('Part1\n', 0))
+    ndb.put_multi(run_result.append_output('Part2\n', 6))
+    # Only the chunks that already existed are fetched.
+    self.assertEqual([[], [2]], fetched)
+    self.assertEqual('Part1\nPart2\n', run_result.get_output(0, 0))
+    self.assertTaskOutputChunk([
+        {'chunk': 'Part', 'gaps': []},
+        {'chunk': '1\nPa', 'gaps': []},
+        {'chunk': 'rt2\n', 'gaps': []},
+    ])
+
+  def test_append_output_compressed(self):
+    # Force tedious chunking.
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 4)
+    self.mock(task_result.TaskOutput, 'COMPRESS_SEALED_CHUNKS', True)
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output('Part1\n', 0))
+    ndb.put_multi(run_result.append_output('Part2', 6))
+    self.assertEqual('Part1\nPart2', run_result.get_output(0, 0))
+    self.assertEqual('t1\nPar', run_result.get_output(3, 6))
+    chunks = task_result.TaskOutputChunk.query().order(
+        task_result.TaskOutputChunk.key).fetch()
+    # The full chunks are compressed, the last one is stored raw.
+    self.assertEqual(
+        ['zlib', 'zlib', 'raw'], [c.encoding for c in chunks])
+    self.assertEqual('rt2', chunks[2].data)
+    self.assertEqual(['', '', ''], [c.chunk for c in chunks])
+    self.assertTaskOutputChunk([
+        {'chunk': 'Part', 'gaps': []},
+        {'chunk': '1\nPa', 'gaps': []},
+        {'chunk': 'rt2', 'gaps': []},
+    ])
+
+  def test_append_output_compressed_mixed(self):
+    # Chunks written before enabling the compression are still readable and
+    # can be appended to.
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 4)
+    run_result = _gen_run_result()
+    ndb.put_multi(run_result.append_output('Part', 0))
+    ndb.put_multi(run_result.append_output('1', 4))
+    self.mock(task_result.TaskOutput, 'COMPRESS_SEALED_CHUNKS', True)
+    ndb.put_multi(run_result.append_output('\n', 5))
+    self.assertEqual('Part1\n', run_result.get_output(0, 0))
+    chunks = task_result.TaskOutputChunk.query().order(
+        task_result.TaskOutputChunk.key).fetch()
+    self.assertEqual([None, 'raw'], [c.encoding for c in chunks])
+    # And the other way around.
+    self.mock(task_result.TaskOutput, 'COMPRESS_SEALED_CHUNKS', False)
+    ndb.put_multi(run_result.append_output('X\n', 6))
+    self.assertEqual('Part1\nX\n', run_result.get_output(0, 0))
+
+  def test_append_output_compressed_max_chunk(self):
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 2)
+    self.mock(task_result.TaskOutput, 'PUT_MAX_CHUNKS', 16)
+    self.mock(task_result.TaskOutput, 'PUT_MAX_CHUNKS_COMPRESSED', 32)
+    self.mock(task_result.TaskOutput, 'COMPRESS_SEALED_CHUNKS', True)
+    self.assertEqual(2 * 32, task_result.TaskOutput.PUT_MAX_CONTENT())
+    run_result = _gen_run_result()
+    entities = run_result.append_output('x' * 2 * 32 + 'y', 0)
+    self.assertEqual(32, len(entities))
+    self.assertEqual(32, run_result.stdout_chunks)
+
+  def test_iter_output(self):
+    # Force tedious chunking.
+    self.mock(task_result.TaskOutput, 'CHUNK_SIZE', 2)
+    self.mock(task_result.TaskOutput, 'FETCH_BATCH', 2)
+    run_result = _gen_run_result()
+    self.assertEqual([], list(run_result.iter_output(0, 0)))
+    ndb.put_multi(run_result.append_output('0123456789', 0))
+    self.assertEqual(
+        ['01', '23', '45', '67', '89'], list(run_result.iter_output(0, 0)))
+    self.assertEqual(['3', '45', '6'], list(run_result.iter_output(3, 4)))
+    self.assertEqual(['9'], list(run_result.iter_output(9, 100)))
+    for offset in range(10):
+      for length in range(10):
+        self.assertEqual(
+            '0123456789'[offset:offset + length] if length else
+            '0123456789'[offset:],
+            ''.join(run_result.iter_output(offset, length)),
+            (offset, length))
+
   def test_append_output_max_chunk(self):
     # Ensures that data is dropped.
     # Force tedious chunking.
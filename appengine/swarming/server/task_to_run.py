@@ -29,10 +29,12 @@ Graph of the schema:
     +--------------+     +--------------+
 """
 
+import collections
 import datetime
 import heapq
 import logging
 import random
+import threading
 import time
 
 from google.appengine.api import datastore_errors
@@ -364,14 +366,31 @@ class _QueryStats(object):
   """Statistics for a yield_next_available_task_to_dispatch() loop."""
   claimed = 0
   mismatch = 0
+  shared = 0
   stale = 0
   total = 0
   visited = 0
+  # Number of times a query ran out of buffered items and its next page was
+  # already fetched (hit) or still in flight (miss).
+  prefetch_hits = 0
+  prefetch_misses = 0
+  # Number of fetched pages none of whose items were yielded.
+  wasted_fetches = 0
+
+  def prefetch_hit_rate(self):
+    """Returns the fraction of prefetch hits or None if nothing was prefetched.
+    """
+    attempts = self.prefetch_hits + self.prefetch_misses
+    return float(self.prefetch_hits) / attempts if attempts else None
 
   def __str__(self):
     return ('%d total, %d visited, %d already claimed, %d stale, '
-            '%d dimensions mismatch') % (self.total, self.visited, self.claimed,
-                                         self.stale, self.mismatch)
+            '%d dimensions mismatch, %d from shared fetches, '
+            '%d/%d prefetch hits, %d wasted fetches') % (
+                self.total, self.visited, self.claimed, self.stale,
+                self.mismatch, self.shared, self.prefetch_hits,
+                self.prefetch_hits + self.prefetch_misses,
+                self.wasted_fetches)
 
 
 def _get_task_to_run_query(dimensions_hash):
@@ -390,44 +409,180 @@ def _get_task_to_run_query(dimensions_hash):
   return [_query(get_shard_kind(dimensions_hash % N_SHARDS))]
 
 
-class _TaskToRunItem(object):
-  __slots__ = ('key', 'ttr')
+_MC_CLIENT = memcache.Client()
 
-  def __init__(self, ttr):
-    self.key = _queue_number_order_priority(ttr)
-    self.ttr = ttr
 
-  def __cmp__(self, other):
-    return cmp(self.key, other.key)
+def _sort_by_priority(items):
+  """Returns a list of TaskToRunShard ordered by priority.
 
+  TaskToRunShard submitted within the same 100ms interval at the same priority
+  have the same queue sorting number (see _gen_queue_number). By shuffling them
+  here we reduce chances of multiple bots contesting over the same items. This
+  is effective only for queues with more than 10 tasks per second.
+  """
+  items = list(items)
+  random.shuffle(items)
+  items.sort(key=_queue_number_order_priority)
+  return items
 
-class _PriorityQueue(object):
-  def __init__(self):
-    self._heap = []
 
-  def add_heapified(self, ttr):
-    heapq.heappush(self._heap, _TaskToRunItem(ttr))
+# How long a bot waits for a shared fetch started by another bot before giving
+# up and fetching the queue itself.
+_SHARED_FETCH_WAIT_SECS = 1.0
 
-  def add_unordered(self, ttr):
-    self._heap.append(_TaskToRunItem(ttr))
+# How many items to fetch per bot participating in a shared fetch.
+_SHARED_FETCH_ITEMS_PER_BOT = 5
 
-  def heapify(self):
-    heapq.heapify(self._heap)
+# Upper bound on the page size of a shared fetch.
+_SHARED_FETCH_MAX_PAGE_SIZE = 200
+
+# How long the number of participants of a shared fetch is used to size the
+# next fetch of the same queue, and for how many queues it is kept.
+_SHARED_FETCH_HINT_SECS = 60
+_SHARED_FETCH_MAX_HINTS = 1000
 
-  def pop(self):
-    return heapq.heappop(self._heap).ttr
 
-  def size(self):
-    return len(self._heap)
+class _SharedFetch(object):
+  """The first page of a queue fetched once on behalf of multiple bots."""
 
-  def empty(self):
-    return not self._heap
+  def __init__(self):
+    # Set when `result` is populated.
+    self.done = threading.Event()
+    # Number of bots that didn't take their share of items yet.
+    self.participants = 1
+    # (list of TaskToRunShard, cursor, more) or None if the fetch failed.
+    self.result = None
+    # Fetched items not reserved by any participant yet.
+    self.unreserved = []
+
+
+class _SharedFetches(object):
+  """Coalesces concurrent fetches of the first page of the same queue.
+
+  When many bots poll at once (e.g. right after a large trigger), all of them
+  query the same TaskToRunShard queues and then fight over the same items in
+  Claim.obtain(...). Instead, the first bot to poll a queue in this process (the
+  leader) fetches a larger page on behalf of all bots that start polling this
+  queue while the fetch is in flight (the followers). Each participant gets the
+  whole page, starting with a disjoint share of items matching its dimensions,
+  so bots first try different items, but items not claimed by their owner are
+  still seen by everyone.
+
+  Followers run in other request threads, whose ndb event loops can't be woken
+  up by the leader, so they block on `_SharedFetch.done` instead. A thread that
+  leads a fetch that isn't published yet never blocks, so threads can't wait
+  for each other.
+
+  The fetch is shared only between concurrently polling bots, so its results
+  are as fresh as the ones a bot would get by running the query itself.
+  """
 
+  def __init__(self):
+    self._lock = threading.Lock()
+    # dimensions hash => _SharedFetch in flight.
+    self._inflight = {}
+    # dimensions hash => (number of participants, time.time() of the fetch)
+    # for the last shared fetches with more than 1 participant, least recently
+    # updated first. Used to pick the page size of the next fetch.
+    self._last_participants = collections.OrderedDict()
+    # `count` is the number of unpublished fetches led by the current thread.
+    self._leading = threading.local()
+
+  def join(self, dim_hash):
+    """Joins a fetch in flight or starts a new one.
 
-_MC_CLIENT = memcache.Client()
+    Returns:
+      (_SharedFetch, True if the caller is the leader and must fetch the page).
+    """
+    with self._lock:
+      fetch = self._inflight.get(dim_hash)
+      if fetch:
+        fetch.participants += 1
+        return fetch, False
+      fetch = _SharedFetch()
+      self._inflight[dim_hash] = fetch
+    self._leading.count = getattr(self._leading, 'count', 0) + 1
+    return fetch, True
+
+  def can_wait(self):
+    """True if the current thread can block waiting for a fetch of another."""
+    return not getattr(self._leading, 'count', 0)
+
+  def page_size(self, dim_hash, default):
+    """Returns the page size for a fetch started by the leader."""
+    with self._lock:
+      bots, ts = self._last_participants.get(dim_hash, (1, None))
+    if ts is None or time.time() - ts > _SHARED_FETCH_HINT_SECS:
+      bots = 1
+    return min(_SHARED_FETCH_MAX_PAGE_SIZE,
+               max(default, bots * _SHARED_FETCH_ITEMS_PER_BOT))
+
+  def publish(self, dim_hash, fetch, result):
+    """Called by the leader with results of the fetch or None on errors."""
+    with self._lock:
+      if self._inflight.get(dim_hash) is fetch:
+        del self._inflight[dim_hash]
+      self._last_participants.pop(dim_hash, None)
+      if fetch.participants > 1:
+        self._last_participants[dim_hash] = (fetch.participants, time.time())
+        while len(self._last_participants) > _SHARED_FETCH_MAX_HINTS:
+          self._last_participants.popitem(last=False)
+      fetch.result = result
+      fetch.unreserved = list(result[0]) if result else []
+    self._leading.count -= 1
+    fetch.done.set()
+
+  def leave(self, fetch):
+    """Called by a follower that gave up waiting for the results."""
+    with self._lock:
+      fetch.participants -= 1
+
+  def take(self, fetch, bot_dims_matcher):
+    """Takes the fetched items, starting with a share reserved for the caller.
+
+    Each participant reserves roughly an equal share of unreserved items
+    matching its dimensions. The rest of the page follows, so items reserved by
+    other participants are still tried if they don't claim them. Both parts are
+    ordered by priority.
+
+    Returns:
+      ([list of TaskToRunShard], cursor, more).
+    """
+    with self._lock:
+      share = -(-len(fetch.unreserved) // max(fetch.participants, 1))
+      fetch.participants -= 1
+      reserved = []
+      left = []
+      for ttr in fetch.unreserved:
+        if len(reserved) < share and bot_dims_matcher(ttr.dimensions):
+          reserved.append(ttr)
+        else:
+          left.append(ttr)
+      fetch.unreserved = left
+    items, cursor, more = fetch.result
+    reserved_ids = set(id(ttr) for ttr in reserved)
+    rest = [ttr for ttr in items if id(ttr) not in reserved_ids]
+    return _sort_by_priority(reserved) + _sort_by_priority(rest), cursor, more
+
+
+_SHARED_FETCHES = _SharedFetches()
 
 
 class _ActiveQuery(object):
+  """Pages through TaskToRunShard entities of a single queue.
+
+  Fetched items are kept in a buffer ordered by priority. When the buffer runs
+  low, the next page is prefetched in the background, so that it is usually
+  ready by the time the consumer is done claiming already buffered items.
+
+  The page size adapts to the consumption rate: it grows slowly while the
+  prefetched pages arrive in time and doubles when the consumer has to wait.
+  """
+
+  # Bounds of the adaptive page size.
+  _MIN_PAGE_SIZE = 10
+  _MAX_PAGE_SIZE = 50
+
   def __init__(self, query, dim_hash, bot_id, stats, bot_dims_matcher,
                deadline):
     self._query = query
@@ -438,32 +593,83 @@ class _ActiveQuery(object):
     self._deadline = deadline
     self._canceled = False
     self._pages = 0
-    self._page_size = 10
+    # We start with a small page size to get pending items ASAP to start
+    # processing them sooner.
+    self._page_size = self._MIN_PAGE_SIZE
+    # Fetched and not yet consumed items, ordered by priority.
+    self._buffer = collections.deque()
+    # [number of unconsumed items, number of items] for each buffered page.
+    self._buffered_pages = collections.deque()
+    self._cursor = None
+    self._more = True
     self._future = self._fetch_and_filter(None)
 
   @property
   def dim_hash(self):
     return self._dim_hash
 
+  @property
+  def active(self):
+    """True if the query may produce more items."""
+    return bool(self._buffer or self._future)
+
+  @property
+  def fetching(self):
+    """True if there's a fetch in flight or its results were not polled yet."""
+    return bool(self._future)
+
   def ready(self):
-    return self._future and self._future.done()
-
-  def page(self):
-    results, _cursor, _more = self._future.get_result()
-    return results
-
-  def advance(self):
-    _results, cursor, more = self._future.get_result()
-    if more:
-      # We start with a small page size to get pending items ASAP to start
-      # processing them sooner. If the backlog is large (i.e. we end up fetching
-      # many pages), make pages larger with each iteration to reduce number of
-      # datastore calls we make.
-      self._page_size = min(50, self._page_size + 5)
-      self._future = self._fetch_and_filter(cursor)
-    else:
-      self._future = None
-    return more
+    """True if there are buffered items or the in-flight fetch is done."""
+    return bool(self._buffer or (self._future and self._future.done()))
+
+  def buffered(self):
+    """Returns the number of fetched items not consumed yet."""
+    return len(self._buffer)
+
+  def head_key(self):
+    """Returns the sorting key of the highest priority buffered item."""
+    return _queue_number_order_priority(self._buffer[0])
+
+  def poll(self):
+    """Moves the fetched page, if any, into the buffer without blocking.
+
+    Returns:
+      True if new items were added to the buffer.
+    """
+    if not self._future or not self._future.done():
+      return False
+    results, self._cursor, self._more = self._future.get_result()
+    self._future = None
+    if results:
+      # Already ordered by priority by _fetch_and_filter.
+      self._buffer.extend(results)
+      self._buffered_pages.append([len(results), len(results)])
+    self._maybe_prefetch()
+    return bool(results)
+
+  def pop(self):
+    """Pops the highest priority buffered item, prefetching more if needed."""
+    ttr = self._buffer.popleft()
+    self._buffered_pages[0][0] -= 1
+    if not self._buffered_pages[0][0]:
+      self._buffered_pages.popleft()
+    if not self._buffer and self._future:
+      if self._future.done():
+        self._stats.prefetch_hits += 1
+      else:
+        self._stats.prefetch_misses += 1
+        # The consumer is faster than the fetches, make pages larger to reduce
+        # the number of datastore calls we make.
+        self._page_size = min(self._MAX_PAGE_SIZE, self._page_size * 2)
+    self._maybe_prefetch()
+    return ttr
+
+  def finish(self):
+    """Accounts pages that were fetched, but never consumed."""
+    if self._future:
+      self._stats.wasted_fetches += 1
+    self._stats.wasted_fetches += sum(
+        1 for left, total in self._buffered_pages if left == total)
 
   def cancel(self):
     self._canceled = True
@@ -472,6 +678,18 @@ class _ActiveQuery(object):
   def canceled(self):
     return self._canceled
 
+  def _maybe_prefetch(self):
+    """Starts fetching the next page if the buffer is running low."""
+    if self._future or not self._more:
+      return
+    if len(self._buffer) > self._page_size // 2:
+      return
+    # If the backlog is large (i.e. we end up fetching many pages), make pages
+    # larger with each iteration to reduce number of datastore calls we make.
+    if self._pages:
+      self._page_size = min(self._MAX_PAGE_SIZE, self._page_size + 5)
+    self._future = self._fetch_and_filter(self._cursor)
+
   @ndb.tasklet
   def _fetch_and_filter(self, cursor):
     """Fetches a page of query results and filters out unusable items.
@@ -492,8 +710,12 @@ class _ActiveQuery(object):
       try:
         self._pages += 1
         self._log('fetching page #%d (deadline %.3fs)', self._pages, deadline)
-        fetched, cursor, more = yield self._query.fetch_page_async(
-            self._page_size, start_cursor=cursor, deadline=deadline)
+        if cursor is None:
+          fetched, cursor, more = yield self._fetch_first_page_async(deadline)
+        else:
+          fetched, cursor, more = yield self._query.fetch_page_async(
+              self._page_size, start_cursor=cursor, deadline=deadline)
+          fetched = _sort_by_priority(fetched)
       except (apiproxy_errors.DeadlineExceededError, datastore_errors.Timeout):
         # TODO(vadimsh): Maybe it makes sense to use a smaller RPC deadline and
         # instead retry the call a bunch of times until reaching the overall
@@ -554,6 +776,39 @@ class _ActiveQuery(object):
       self._log('exhausted')
     raise ndb.Return((matched, cursor, more))
 
+  @ndb.tasklet
+  def _fetch_first_page_async(self, deadline):
+    """Fetches the first page, sharing the fetch with concurrent pollers.
+
+    Yields:
+      ([list of TaskToRunShard ordered by priority], cursor, more).
+    """
+    fetch, leader = _SHARED_FETCHES.join(self._dim_hash)
+    if leader:
+      result = None
+      try:
+        page_size = _SHARED_FETCHES.page_size(self._dim_hash, self._page_size)
+        result = yield self._query.fetch_page_async(page_size,
+                                                    deadline=deadline)
+      finally:
+        _SHARED_FETCHES.publish(self._dim_hash, fetch, result)
+      raise ndb.Return(_SHARED_FETCHES.take(fetch, self._bot_dims_matcher))
+
+    # The leader runs in another thread, wait for it to publish the page.
+    if _SHARED_FETCHES.can_wait():
+      fetch.done.wait(min(deadline, _SHARED_FETCH_WAIT_SECS))
+    if fetch.done.is_set() and fetch.result is not None:
+      result = _SHARED_FETCHES.take(fetch, self._bot_dims_matcher)
+      self._stats.shared += len(result[0])
+      self._log('got %d items from a shared fetch', len(result[0]))
+      raise ndb.Return(result)
+
+    _SHARED_FETCHES.leave(fetch)
+    self._log('shared fetch is not available, fetching the queue')
+    fetched, cursor, more = yield self._query.fetch_page_async(
+        self._page_size, deadline=deadline)
+    raise ndb.Return((_sort_by_priority(fetched), cursor, more))
+
   def _log(self, msg, *args):
     logging.debug('_ActiveQuery(%s, %d): %s', self._bot_id, self._dim_hash,
                   msg % args)
@@ -618,12 +873,17 @@ def _yield_potential_tasks(bot_id, pool, queues, stats, bot_dims_matcher,
     if r > 0:
       time.sleep(r)
 
+  # Move all first pages we managed to fetch in 1 sec above into the buffers of
+  # their queries. This also starts prefetching the following pages.
+  for q in queries:
+    q.poll()
+
   # Log how many items we actually got. On loaded servers it will actually
   # be 0 pretty often, since 1 sec is not that much.
   logging.debug(
       '_yield_potential_tasks(%s): waited %.3fs for %d items from queues '
       '%s', bot_id,
-      time.time() - start, sum(len(q.page()) for q in queries if q.ready()),
+      time.time() - start, sum(q.buffered() for q in queries),
       [q.dim_hash for q in queries])
 
   # We may be running of time already if the initial fetch above was
@@ -631,93 +891,96 @@ def _yield_potential_tasks(bot_id, pool, queues, stats, bot_dims_matcher,
   if utils.utcnow() >= deadline:
     for q in queries:
       q.cancel()
+      q.finish()
     logging.debug('_yield_potential_tasks(%s): deadline before the poll loop',
                   bot_id)
     raise ScanDeadlineError('initializing', 'Deadline before the poll loop')
 
-  # A priority queue with TaskToRunShard ordered by the priority+timestamp,
-  # extracted from queue_number using _queue_number_order_priority.
-  queue = _PriorityQueue()
-
-  def _poll_queries(queries, use_heap):
-    enqueue = queue.add_heapified if use_heap else queue.add_unordered
-
-    # Get items from pages we already fetched and add them into `queue`. We
-    # don't block here, just pick what already was fetched.
+  # A lazy k-way merge of buffers of all queries. Each query buffer is ordered
+  # by the priority+timestamp, extracted from queue_number using
+  # _queue_number_order_priority. The heap contains at most one entry per query
+  # with buffered items, keyed by its top item. Queries with empty buffers that
+  # are still fetching are kept in `waiting`.
+  heap = []
+  waiting = []
+  counter = [0]
+
+  def _push(q):
+    counter[0] += 1
+    heapq.heappush(heap, (q.head_key(), counter[0], q))
+
+  def _poll_waiting(queries):
+    # Pick up pages that were already fetched, we don't block here.
     pending = []
     changed = False
     for q in queries:
-      # Retain in the pending list if still working on some page.
-      if not q.ready():
-        pending.append(q)
-        continue
-
-      runs = q.page()
-      if runs:
-        # TaskToRunShard submitted within the same 100ms interval at the same
-        # priority have the same queue sorting number (see _gen_queue_number).
-        # By shuffling them here we reduce chances of multiple bots contesting
-        # over the same items. This is effective only for queues with more
-        # than 10 tasks per second.
-        random.shuffle(runs)
-
-        # Add them to the local priority queue.
+      q.poll()
+      if q.buffered():
+        _push(q)
         changed = True
-        for r in runs:
-          enqueue(r)
-
-      # Start fetching the next page, if any.
-      if q.advance():
+      elif q.active:
         pending.append(q)
       else:
         # The queue has no more results, don't add it to `pending`.
         changed = True
-
     # Log the final stats if anything changed.
     if changed:
       logging.debug(
           '_yield_potential_tasks(%s): %s items pending. active queues %s',
-          bot_id, queue.size(), [q.dim_hash for q in pending])
+          bot_id, sum(q.buffered() for _, _, q in heap),
+          [q.dim_hash for q in pending])
     return pending
 
-  # Pick up all first pages we managed to fetch in 1 sec above and put them
-  # into the list in whatever order they were fetched.
-  active = _poll_queries(queries, use_heap=False)
-
-  # Transform the list into an actual priority queue before polling from it.
-  queue.heapify()
-
-  while not queue.empty() or active:
-    # Grab the top-priority item and let the caller try to process it.
-    if not queue.empty():
-      yield queue.pop()
-    else:
-      # No pending items, but there are some pending futures. Run one step of
-      # ndb event loop to move things forward.
-      ndb.eventloop.run1()
-    # On the overall deadline asynchronously cancel remaining queries and exit.
-    if utils.utcnow() >= deadline:
-      for q in active:
-        q.cancel()
-      break
-    # Poll for any new query pages, adding fetched items to the local queue.
-    # Do it only if the local queue is sufficiently shallow. If it is not,
-    # then the consumer is too slow. Adding more items will just result in
-    # eventually running out of memory.
-    if queue.size() < 1000:
-      active = _poll_queries(active, use_heap=True)
+  try:
+    for q in queries:
+      if q.buffered():
+        _push(q)
+      elif q.active:
+        waiting.append(q)
+
+    while heap or waiting:
+      # Grab the top-priority item and let the caller try to process it. The
+      # next page of its query is prefetched while the caller is busy claiming
+      # the item, if the query buffer is running low.
+      if heap:
+        _, _, q = heapq.heappop(heap)
+        ttr = q.pop()
+        q.poll()
+        if q.buffered():
+          _push(q)
+        elif q.active:
+          waiting.append(q)
+        yield ttr
+      else:
+        # No pending items, but there are some pending futures. Run one step of
+        # ndb event loop to move things forward.
+        ndb.eventloop.run1()
+      # On the overall deadline asynchronously cancel remaining queries and
+      # exit.
+      if utils.utcnow() >= deadline:
+        for q in queries:
+          if q.fetching:
+            q.cancel()
+        break
+      # Poll for any new query pages of queries that ran out of items.
+      if waiting:
+        waiting = _poll_waiting(waiting)
+  finally:
+    for q in queries:
+      q.finish()
 
+  dropped = sum(q.buffered() for q in queries)
   canceled = [q for q in queries if q.canceled]
   if canceled:
     logging.debug(
         '_yield_potential_tasks(%s): deadline in queues %s, dropping %d items',
-        bot_id, [q.dim_hash for q in canceled], queue.size())
+        bot_id, [q.dim_hash for q in canceled], dropped)
     raise ScanDeadlineError('fetching', 'Deadline fetching queues')
 
   if utils.utcnow() >= deadline:
     logging.debug(
         '_yield_potential_tasks(%s): deadline processing, dropping %d items',
-        bot_id, queue.size())
+        bot_id, dropped)
     raise ScanDeadlineError('processing', 'Deadline processing fetched items')
 
   logging.debug('_yield_potential_tasks(%s): all queues exhausted', bot_id)
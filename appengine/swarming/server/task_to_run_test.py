@@ -8,6 +8,7 @@ import logging
 import os
 import random
 import sys
+import time
 import unittest
 
 # Setups environment.
@@ -917,6 +918,53 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     collected.sort(key=lambda ttr: ttr['created_ts'])
     self.assertEqual(submitted, collected)
 
+  def test_yield_potential_tasks_prefetch_stats(self):
+    request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'p1']}
+    for i in range(40):
+      self.mock_now(self.now, i)
+      request = self.mkreq(
+          _gen_request(
+              properties=_gen_properties(dimensions=request_dimensions),
+              priority=50))
+      task_to_run.new_task_to_run(request, 0).put()
+
+    bot_id = u'localhost'
+    bot_dimensions = {
+        u'id': [bot_id],
+        u'os': [u'Windows-3.1.1'],
+        u'pool': [u'p1'],
+    }
+    task_queues.assert_bot(bot_dimensions)
+    self.execute_tasks()
+    queues = task_queues.freshen_up_queues(bot_id)
+    matcher = task_to_run.dimensions_matcher(bot_dimensions)
+    deadline = utils.utcnow() + datetime.timedelta(minutes=1)
+
+    def scan(limit=None):
+      stats = task_to_run._QueryStats()
+      gen = task_to_run._yield_potential_tasks(bot_id, 'pool', queues, stats,
+                                               matcher, deadline)
+      seen = []
+      for ttr in gen:
+        seen.append(ttr.created_ts)
+        if len(seen) == limit:
+          gen.close()
+          break
+      return seen, stats
+
+    # All items are yielded and all fetched pages are used.
+    seen, stats = scan()
+    self.assertEqual(40, len(set(seen)))
+    self.assertTrue(stats.prefetch_hits + stats.prefetch_misses)
+    self.assertIsNotNone(stats.prefetch_hit_rate())
+    self.assertEqual(0, stats.wasted_fetches)
+
+    # The next page is prefetched once the buffer is half consumed and it is
+    # wasted if the consumer is done before getting to it.
+    seen, stats = scan(limit=6)
+    self.assertEqual(6, len(seen))
+    self.assertEqual(1, stats.wasted_fetches)
+
   def test_yield_next_available_task_checks_cache(self):
     request_dimensions = {u'os': [u'Windows-3.1.1'], u'pool': [u'p1']}
     bot_dimensions = {
@@ -1111,6 +1159,71 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
 
     self.assertEqual(from_parts, to_run.key)
 
+  def test_shared_fetches(self):
+    class FakeTaskToRun(object):
+      def __init__(self, name, dims, queue_number):
+        self.name = name
+        self.dimensions = dims
+        self.queue_number = queue_number
+
+    linux = task_to_run.dimensions_matcher({u'id': [u'b1'], u'os': [u'linux']})
+    mac = task_to_run.dimensions_matcher({u'id': [u'b2'], u'os': [u'mac']})
+    items = [
+        FakeTaskToRun('l1', {u'os': [u'linux']}, 1),
+        FakeTaskToRun('m1', {u'os': [u'mac']}, 2),
+        FakeTaskToRun('l2', {u'os': [u'linux']}, 3),
+        FakeTaskToRun('l3', {u'os': [u'linux']}, 4),
+    ]
+
+    shared = task_to_run._SharedFetches()
+    fetch, leader = shared.join(123)
+    self.assertTrue(leader)
+    # The leader doesn't wait for other fetches until it publishes its own.
+    self.assertFalse(shared.can_wait())
+    self.assertEqual((fetch, False), shared.join(123))
+    self.assertEqual((fetch, False), shared.join(123))
+    shared.publish(123, fetch, (items, 'cursor', True))
+    self.assertTrue(shared.can_wait())
+
+    # The next fetch is sized for all participants of the previous one.
+    self.assertEqual(15, shared.page_size(123, 10))
+    # A new fetch is started once the previous one has completed.
+    self.assertTrue(shared.join(123)[1])
+
+    # Each participant gets the whole page, starting with its own share.
+    names = lambda res: ([ttr.name for ttr in res[0]],) + res[1:]
+    self.assertEqual((['l1', 'l2', 'm1', 'l3'], 'cursor', True),
+                     names(shared.take(fetch, linux)))
+    self.assertEqual((['m1', 'l1', 'l2', 'l3'], 'cursor', True),
+                     names(shared.take(fetch, mac)))
+    self.assertEqual((['l1', 'm1', 'l2', 'l3'], 'cursor', True),
+                     names(shared.take(fetch, mac)))
+
+  def test_shared_fetches_page_size_hints(self):
+    now = [1000.]
+    self.mock(time, 'time', lambda: now[0])
+    self.mock(task_to_run, '_SHARED_FETCH_MAX_HINTS', 2)
+    shared = task_to_run._SharedFetches()
+
+    def shared_fetch(dim_hash, participants):
+      fetch, _ = shared.join(dim_hash)
+      for _ in range(participants - 1):
+        shared.join(dim_hash)
+      shared.publish(dim_hash, fetch, ([], None, False))
+
+    shared_fetch(1, 4)
+    shared_fetch(2, 4)
+    self.assertEqual(20, shared.page_size(1, 10))
+    # Old hints are not used.
+    now[0] += task_to_run._SHARED_FETCH_HINT_SECS + 1
+    self.assertEqual(10, shared.page_size(1, 10))
+    # Only the most recent hints are kept.
+    shared_fetch(3, 4)
+    self.assertEqual([2, 3], list(shared._last_participants))
+    # A fetch without followers drops the hint.
+    shared_fetch(3, 1)
+    self.assertEqual([2], list(shared._last_participants))
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
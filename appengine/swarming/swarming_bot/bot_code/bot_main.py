@@ -25,6 +25,7 @@ import argparse
 import contextlib
 import fnmatch
 import functools
+import hashlib
 import json
 import logging
 import os
@@ -61,6 +62,7 @@ from utils import net
 from utils import on_error
 from utils import subprocess42
 from utils import tools
+from utils import trash
 from utils import zip_package
 
 
@@ -114,6 +116,7 @@ PASSLIST = (
     'swarming_bot.2.zip',
     'swarming_bot.zip',
     'tmp',
+    'trash',
     _CAS_KVS_CACHE_DB,
 )
 
@@ -142,6 +145,12 @@ DEFAULT_SETTINGS = {
     },
 }
 
+# Time and read bandwidth budget of the CAS cache rehash done by
+# `run_isolated --clean` between tasks. It resumes where it stopped on the next
+# clean, so the whole cache is eventually rehashed without delaying tasks.
+_CACHE_REHASH_MAX_SECS = 10
+_CACHE_REHASH_MAX_BYTES_PER_SEC = 100 * 1024 * 1024
+
 # Keep in sync with ../../ts_mon_metrics.py
 _IGNORED_DIMENSIONS = (
     'android_devices', 'caches', 'id', 'server_version', 'temp_band')
@@ -739,7 +748,7 @@ def _cleanup_bot_directory(botobj):
     try:
       p = os.path.join(botobj.base_dir, i)
       if fs.isdir(p):
-        file_path.rmtree(p)
+        trash.move(p, _get_trash_dir(botobj))
       else:
         file_path.remove(p)
     except (IOError, OSError) as e:
@@ -747,6 +756,14 @@ def _cleanup_bot_directory(botobj):
           'Failed to remove %s from bot\'s directory: %s' % (i, e))
 
 
+def _get_trash_dir(botobj):
+  """Returns the directory where directories are moved for deferred deletion.
+
+  It is emptied by the thread started in _run_bot_inner(), see utils/trash.py.
+  """
+  return os.path.join(botobj.base_dir, 'trash')
+
+
 def _run_isolated_flags(botobj):
   """Returns flags to pass to run_isolated.
 
@@ -771,6 +788,9 @@ def _run_isolated_flags(botobj):
       # Named cache option.
       '--named-cache-root',
       os.path.join(botobj.base_dir, 'c'),
+      # Deferred deletion of the task directories.
+      '--trash-dir',
+      _get_trash_dir(botobj),
   ]
 
   use_kvs = True
@@ -828,12 +848,15 @@ def _clean_cache(botobj):
   up the mess properly.
 
   It will remove unexpected files, remove corrupted files, trim the cache size
-  based on the policies and update state.json.
+  based on the policies and update state.json. It also rehashes part of the
+  CAS cache within _CACHE_REHASH_MAX_SECS.
   """
   cmd = [
     sys.executable, THIS_FILE, 'run_isolated',
     '--clean',
     '--log-file', os.path.join(botobj.base_dir, 'logs', 'run_isolated.log'),
+    '--rehash-max-duration', str(_CACHE_REHASH_MAX_SECS),
+    '--rehash-max-bytes-per-sec', str(_CACHE_REHASH_MAX_BYTES_PER_SEC),
   ]
   cmd.extend(_run_isolated_flags(botobj))
   logging.info('Running: %s', cmd)
@@ -910,7 +933,7 @@ def _run_manifest(botobj, manifest, rbe_session):
   try:
     try:
       if fs.isdir(work_dir):
-        file_path.rmtree(work_dir)
+        trash.move(work_dir, _get_trash_dir(botobj))
     except OSError:
       # If a previous task created an undeleteable file/directory inside 'w',
       # make sure that following tasks are not affected. This is done by working
@@ -1080,7 +1103,7 @@ def _run_manifest(botobj, manifest, rbe_session):
                     task_dimensions, task_result)
     if fs.isdir(work_dir):
       try:
-        file_path.rmtree(work_dir)
+        trash.move(work_dir, _get_trash_dir(botobj))
       except Exception:
         botobj.post_error('Failed to delete work directory %s: %s' %
                           (work_dir, traceback.format_exc()[-2048:]))
@@ -1206,6 +1229,9 @@ def _run_bot_inner(arg_error, quit_bit):
   _call_hook_safe(True, botobj, 'on_handshake')
 
   _cleanup_bot_directory(botobj)
+  # Deletes what is left in the trash by a previous bot process, then what is
+  # moved into it while the bot is running.
+  trash.start_worker(_get_trash_dir(botobj))
   _clean_cache(botobj)
 
   if quit_bit.is_set():
@@ -2125,15 +2151,76 @@ def _update_bot(botobj, version):
     new_zip = 'swarming_bot.2.zip'
   new_zip = os.path.join(botobj.base_dir, new_zip)
 
-  # Download as a new file.
+  # Download as a new file, fetching only the files that changed if possible.
   try:
-    botobj.remote.get_bot_code(new_zip, version)
+    if not _update_bot_from_delta(botobj, version, new_zip):
+      botobj.remote.get_bot_code(new_zip, version)
   except remote_client.BotCodeError as e:
     botobj.post_error(str(e))
   else:
     _bot_restart(botobj, 'Updating to %s' % version, filepath=new_zip)
 
 
+def _update_bot_from_delta(botobj, version, new_zip):
+  """Writes the new bot code from the current one and the files that changed.
+
+  The server publishes the SHA256 of each file of a bot version. Only the files
+  that are missing or differ from the current bot code are downloaded. The
+  rebuilt archive must hash to the requested version.
+
+  Returns True if new_zip was written, False if the whole archive needs to be
+  downloaded instead.
+  """
+  if not os.path.isfile(THIS_FILE) or not zipfile.is_zipfile(THIS_FILE):
+    return False
+  manifest = botobj.remote.get_bot_code_manifest(version)
+  if not manifest:
+    return False
+
+  with zipfile.ZipFile(THIS_FILE) as z:
+    files = {n: z.read(n) for n in z.namelist() if n in manifest}
+  changed = sorted(
+      n for n, digest in manifest.items()
+      if n not in files or hashlib.sha256(files[n]).hexdigest() != digest)
+  if changed:
+    fetched = botobj.remote.get_bot_code_files(version, changed)
+    if fetched is None:
+      return False
+    files.update(fetched)
+  if set(files) != set(manifest):
+    logging.warning('Delta update to %s is missing files', version)
+    return False
+  actual = _hash_bot_files(files)
+  if actual != version:
+    logging.warning('Delta update to %s produced %s', version, actual)
+    return False
+
+  with zipfile.ZipFile(new_zip, 'w', zipfile.ZIP_DEFLATED) as z:
+    for name in sorted(files):
+      # Use a ZipInfo so the archive doesn't depend on the current time.
+      zinfo = zipfile.ZipInfo(filename=name)
+      zinfo.compress_type = zipfile.ZIP_DEFLATED
+      zinfo.external_attr = 0o600 << 16
+      z.writestr(zinfo, files[name])
+  logging.info('Delta update to %s: downloaded %d of %d files', version,
+               len(changed), len(manifest))
+  return True
+
+
+def _hash_bot_files(files):
+  """Returns the bot version of {file name: content}.
+
+  Same as zip_package.generate_version() for an archive of these files.
+  """
+  h = hashlib.sha256()
+  for name in sorted(files):
+    h.update(str(len(name)).encode())
+    h.update(name.encode())
+    h.update(str(len(files[name])).encode())
+    h.update(files[name])
+  return h.hexdigest()
+
+
 def _bot_restart(botobj, message, filepath=None):
   """Restarts the bot process, optionally in a new file.
 
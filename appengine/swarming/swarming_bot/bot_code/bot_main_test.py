@@ -5,6 +5,7 @@
 
 import copy
 import datetime
+import hashlib
 import json
 import logging
 import os
@@ -36,6 +37,7 @@ from utils import logging_utils
 from utils import net
 from utils import subprocess42
 from utils import tools
+from utils import trash
 from utils import zip_package
 
 
@@ -290,6 +292,8 @@ class TestBotMain(TestBotBase):
               os.path.join(test_env_bot_code.BOT_DIR, 'swarming_bot.zip'))
     # Need to disable this otherwise it'd kill the current checkout.
     self.mock(bot_main, '_cleanup_bot_directory', lambda _: None)
+    # Do not delete anything in the background.
+    self.mock(trash, 'start_worker', lambda _: None)
     # Test results shouldn't depend on where they run. And they should not use
     # real GCE tokens.
     self.mock(gce, 'is_gce', lambda: False)
@@ -959,6 +963,39 @@ class TestBotMain(TestBotBase):
     self.assertEqual(expected, clean)
     self.assertEqual(None, self.bot.bot_restart_msg())
 
+  def test_clean_cache(self):
+    cmds = []
+
+    class FakeProc(object):
+      returncode = 0
+
+      def communicate(self, _input):
+        return 'output', None
+
+    def popen(botobj, cmd):
+      self.assertIs(self.bot, botobj)
+      cmds.append(cmd)
+      return FakeProc()
+
+    self.mock(bot_main, '_Popen', popen)
+    self.mock(bot_main, '_run_isolated_flags', lambda _: ['--cas-cache', 'c'])
+    self.mock(self.bot, 'post_error', self.fail)
+    bot_main._clean_cache(self.bot)
+    self.assertEqual([[
+        sys.executable,
+        bot_main.THIS_FILE,
+        'run_isolated',
+        '--clean',
+        '--log-file',
+        os.path.join(self.bot.base_dir, 'logs', 'run_isolated.log'),
+        '--rehash-max-duration',
+        str(bot_main._CACHE_REHASH_MAX_SECS),
+        '--rehash-max-bytes-per-sec',
+        str(bot_main._CACHE_REHASH_MAX_BYTES_PER_SEC),
+        '--cas-cache',
+        'c',
+    ]], cmds)
+
   def test_poll_server_update(self):
     update = []
 
@@ -2271,6 +2308,61 @@ class TestBotMain(TestBotBase):
     bot_main._update_bot(self.bot, '123')
     self.assertEqual([1], restarts)
 
+  def test_update_bot_delta(self):
+    restarts = []
+    def bot_restart(_botobj, message, filepath):
+      self.assertEqual('Updating to %s' % version, message)
+      self.assertEqual(new_zip, filepath)
+      restarts.append(1)
+    self.mock(bot_main, '_bot_restart', bot_restart)
+    this_file = os.path.join(self.root_dir, 'swarming_bot.1.zip')
+    self.mock(bot_main, 'THIS_FILE', this_file)
+    new_zip = os.path.join(self.root_dir, 'swarming_bot.2.zip')
+    # This is necessary otherwise zipfile will crash.
+    self.mock(time, 'time', lambda: 1400000000)
+    with zipfile.ZipFile(this_file, 'w') as z:
+      z.writestr('__main__.py', 'print("hi")')
+      z.writestr('a.py', 'old')
+      z.writestr('gone.py', 'gone')
+    files = {
+        '__main__.py': b'print("hi")',
+        'a.py': b'new',
+        'b.py': b'added',
+    }
+    version = bot_main._hash_bot_files(files)
+    manifest = {n: hashlib.sha256(c).hexdigest() for n, c in files.items()}
+
+    def get_bot_code_files(bot_version, names):
+      self.assertEqual(version, bot_version)
+      self.assertEqual(['a.py', 'b.py'], names)
+      return {n: files[n] for n in names}
+
+    self.mock(self.bot.remote, 'get_bot_code_manifest', lambda _: manifest)
+    self.mock(self.bot.remote, 'get_bot_code_files', get_bot_code_files)
+    self.mock(self.bot.remote, 'get_bot_code', self.fail)
+    bot_main._update_bot(self.bot, version)
+    self.assertEqual([1], restarts)
+    with zipfile.ZipFile(new_zip) as z:
+      self.assertEqual(files, {n: z.read(n) for n in z.namelist()})
+
+  def test_update_bot_delta_mismatch(self):
+    self.mock(bot_main, '_bot_restart', lambda *_args, **_kwargs: None)
+    this_file = os.path.join(self.root_dir, 'swarming_bot.1.zip')
+    self.mock(bot_main, 'THIS_FILE', this_file)
+    self.mock(time, 'time', lambda: 1400000000)
+    with zipfile.ZipFile(this_file, 'w') as z:
+      z.writestr('a.py', 'a')
+    manifest = {'a.py': hashlib.sha256(b'a').hexdigest()}
+    self.mock(self.bot.remote, 'get_bot_code_manifest', lambda _: manifest)
+    self.mock(self.bot.remote, 'get_bot_code_files', self.fail)
+    # The version doesn't match the files, the whole archive is downloaded.
+    downloads = []
+    self.mock(self.bot.remote, 'get_bot_code',
+              lambda *args: downloads.append(args))
+    bot_main._update_bot(self.bot, '123')
+    self.assertEqual(
+        [(os.path.join(self.root_dir, 'swarming_bot.2.zip'), '123')], downloads)
+
   def test_main(self):
 
     def check(x):
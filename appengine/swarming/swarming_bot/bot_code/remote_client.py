@@ -16,6 +16,7 @@ import threading
 import time
 import traceback
 import uuid
+import zlib
 
 from utils import net
 
@@ -55,6 +56,13 @@ NET_CONNECTION_TIMEOUT_SEC = 4 * 60
 # How many attempts to make when sending a request (1 == no retries).
 NET_MAX_ATTEMPTS = net.URL_OPEN_MAX_ATTEMPTS
 
+# Task output encoding used once the server advertised it in a task_update
+# response.
+OUTPUT_ENCODING_ZLIB = 'zlib'
+
+# Task output smaller than this is not worth compressing.
+MIN_COMPRESSED_OUTPUT_SIZE = 1024
+
 
 def createRemoteClient(server, auth, hostname, work_dir):
   return RemoteClientNative(server, auth, hostname, work_dir)
@@ -122,6 +130,9 @@ class RemoteClientNative(object):
     self._bot_work_dir = work_dir
     self._bot_id = None
     self._poll_request_uuid = None
+    # Task output encodings accepted by the server, as advertised in the last
+    # task_update response.
+    self._output_encodings = ()
 
   @property
   def server(self):
@@ -271,8 +282,12 @@ class RemoteClientNative(object):
                        exit_code=None):
     """Posts task update to task_update.
 
+    The output is compressed with zlib if the server advertised support for it
+    in a previous task_update response.
+
     Arguments:
-      stdout: Incremental output since last call, if any.
+      stdout: Incremental output since last call, if any. Any bytes-like
+          object.
       stdout_chunk_start: Total number of stdout previously sent, for coherency
           with the server.
       params: Default JSON parameters for the POST.
@@ -293,7 +308,14 @@ class RemoteClientNative(object):
     data.update(params)
     # Preserving prior behaviour: empty stdout is not transmitted
     if stdout_and_chunk and stdout_and_chunk[0]:
-      data['output'] = base64.b64encode(stdout_and_chunk[0]).decode()
+      output = stdout_and_chunk[0]
+      if (OUTPUT_ENCODING_ZLIB in self._output_encodings and
+          len(output) >= MIN_COMPRESSED_OUTPUT_SIZE):
+        compressed = zlib.compress(output)
+        if len(compressed) < len(output):
+          output = compressed
+          data['output_encoding'] = OUTPUT_ENCODING_ZLIB
+      data['output'] = base64.b64encode(output).decode()
       data['output_chunk_start'] = stdout_and_chunk[1]
     if exit_code != None:
       data['exit_code'] = exit_code
@@ -304,6 +326,7 @@ class RemoteClientNative(object):
     if not resp or resp.get('error'):
       raise InternalError(
           resp.get('error') if resp else 'Failed to contact server')
+    self._output_encodings = tuple(resp.get('output_encodings') or ())
     return not resp.get('must_stop', False)
 
   def post_task_error(self,
@@ -458,6 +481,35 @@ class RemoteClientNative(object):
     if not self._url_retrieve(new_zip_path, url_path):
       raise BotCodeError(new_zip_path, self._server + url_path, bot_version)
 
+  def get_bot_code_manifest(self, bot_version):
+    """Returns {file name: SHA256 hex digest} of the files of a bot version.
+
+    Returns None if the server doesn't publish the manifest of this version.
+    """
+    resp = self._url_read_json(
+        '/swarming/api/v1/bot/bot_code/%s/manifest' % bot_version,
+        expected_error_codes=(404,),
+        retry_transient=False)
+    if not isinstance(resp, dict) or not isinstance(resp.get('files'), dict):
+      return None
+    return resp['files']
+
+  def get_bot_code_files(self, bot_version, names):
+    """Returns {file name: content} for the requested files of a bot version.
+
+    Returns None if the files couldn't be fetched.
+    """
+    resp = self._url_read_json(
+        '/swarming/api/v1/bot/bot_code/%s/files' % bot_version,
+        data={'files': names},
+        expected_error_codes=(400, 404))
+    if not isinstance(resp, dict) or not isinstance(resp.get('files'), dict):
+      return None
+    return {
+        name: base64.b64decode(content)
+        for name, content in resp['files'].items()
+    }
+
   def ping(self):
     """Unlike all other methods, this one isn't authenticated."""
     resp = net.url_read(self._server + '/swarming/api/v1/bot/server_ping')
@@ -3,6 +3,7 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import base64
 import datetime
 import logging
 import os
@@ -12,6 +13,7 @@ import tempfile
 import threading
 import time
 import unittest
+import zlib
 
 import test_env_bot_code
 test_env_bot_code.setup_test_env()
@@ -110,6 +112,63 @@ class TestRemoteClient(auto_stub.TestCase):
     self.mock(time, 'time', lambda: 103500)
     self.assertEqual({'Now': '103500'}, c.get_authentication_headers())
 
+  def test_post_task_update_compression(self):
+    c = remote_client.RemoteClientNative('http://localhost:1', None,
+                                         'localhost', '/')
+    c.bot_id = 'bot_id'
+    posted = []
+
+    def mocked_call(url_path, data):
+      self.assertEqual('/swarming/api/v1/bot/task_update/task_id', url_path)
+      posted.append(data)
+      return {'must_stop': False, 'ok': True, 'output_encodings': ['zlib']}
+    self.mock(c, '_url_read_json', mocked_call)
+
+    output = bytearray(b'a' * remote_client.MIN_COMPRESSED_OUTPUT_SIZE)
+    # The server didn't advertise zlib yet.
+    self.assertTrue(c.post_task_update('task_id', {}, (output, 0)))
+    self.assertNotIn('output_encoding', posted[-1])
+    self.assertEqual(output, base64.b64decode(posted[-1]['output']))
+
+    self.assertTrue(c.post_task_update('task_id', {}, (output, 1024)))
+    self.assertEqual('zlib', posted[-1]['output_encoding'])
+    self.assertEqual(
+        output, zlib.decompress(base64.b64decode(posted[-1]['output'])))
+    self.assertEqual(1024, posted[-1]['output_chunk_start'])
+
+    # Small output is sent as-is.
+    self.assertTrue(c.post_task_update('task_id', {}, (b'small', 2048)))
+    self.assertNotIn('output_encoding', posted[-1])
+
+  def test_get_bot_code_manifest(self):
+    c = remote_client.RemoteClientNative('http://localhost:1', None,
+                                         'localhost', '/')
+
+    def mocked_call(url_path, expected_error_codes, retry_transient):
+      self.assertEqual('/swarming/api/v1/bot/bot_code/123/manifest', url_path)
+      self.assertEqual((404,), expected_error_codes)
+      self.assertFalse(retry_transient)
+      return resp
+    self.mock(c, '_url_read_json', mocked_call)
+
+    resp = {'files': {'a.py': 'abc'}}
+    self.assertEqual({'a.py': 'abc'}, c.get_bot_code_manifest('123'))
+    resp = None
+    self.assertIsNone(c.get_bot_code_manifest('123'))
+
+  def test_get_bot_code_files(self):
+    c = remote_client.RemoteClientNative('http://localhost:1', None,
+                                         'localhost', '/')
+
+    def mocked_call(url_path, data, expected_error_codes):
+      self.assertEqual('/swarming/api/v1/bot/bot_code/123/files', url_path)
+      self.assertEqual({'files': ['a.py']}, data)
+      self.assertEqual((400, 404), expected_error_codes)
+      return {'files': {'a.py': base64.b64encode(b'content').decode()}}
+    self.mock(c, '_url_read_json', mocked_call)
+
+    self.assertEqual({'a.py': b'content'}, c.get_bot_code_files('123', ['a.py']))
+
   def test_mint_oauth_token_ok(self):
     fake_resp = {
         'service_account': 'blah@example.com',
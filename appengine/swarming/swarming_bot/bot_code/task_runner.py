@@ -576,8 +576,9 @@ class _OutputBuffer:
     self._max_packet_interval = self._MAX_PACKET_INTERVAL
 
     # Mutable:
-    # Buffered data to send to the server.
-    self._stdout = b''
+    # Buffered data to send to the server. It is grown in place and handed over
+    # as-is by pop(), so the output is never copied before being encoded.
+    self._stdout = bytearray()
     # Offset at which the buffered data shall be sent to the server.
     self._output_chunk_start = 0
     # Last time proc.yield_any() yielded.
@@ -612,7 +613,7 @@ class _OutputBuffer:
     o = self._output_chunk_start
     s = self._stdout
     self._output_chunk_start += len(self._stdout)
-    self._stdout = b''
+    self._stdout = bytearray()
     self._last_pop = monotonic_time()
     return (s, o)
 
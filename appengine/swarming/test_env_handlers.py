@@ -61,6 +61,7 @@ class AppTestBase(test_case.TestCase):
     self.testbed.init_user_stub()
 
     gae_ts_mon.reset_for_unittest(disable=True)
+    task_queues._sets_index.clear()
 
     # By default requests in tests are coming from bot with fake IP.
     # WSGI app that implements auth REST API.
@@ -132,6 +133,9 @@ class AppTestBase(test_case.TestCase):
         data=data,
     ).put()
 
+    # Archives are cached in-process by digest and chunk IDs.
+    bot_code._archive_cache.clear()
+    bot_code._manifest_cache.clear()
     put_chunk('stable:1', 'stable-1234+')
     put_chunk('stable:2', 'stable-5678')
     put_chunk('canary:1', 'canary-1234+')
@@ -499,7 +503,11 @@ class AppTestBase(test_case.TestCase):
     res = self.bot_poll()
     task_id = res['manifest']['task_id']
     response = self.bot_complete_task(task_id=task_id)
-    self.assertEqual({u'must_stop': False, u'ok': True}, response)
+    self.assertEqual({
+        u'must_stop': False,
+        u'ok': True,
+        u'output_encodings': [u'zlib'],
+    }, response)
     return task_id
 
   # Client
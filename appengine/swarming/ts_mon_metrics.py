@@ -268,6 +268,15 @@ _handler_timeouts = gae_ts_mon.CounterMetric(
         gae_ts_mon.StringField('exception'),
     ])
 
+# Number of BotInfo updates handled by the write-behind buffer of
+# bot_management. Metric fields:
+# - outcome: 'buffered', 'flushed' or 'dropped'.
+_bot_info_write_behind = gae_ts_mon.CounterMetric(
+    'swarming/bots/info_write_behind',
+    'Number of BotInfo updates going through the write-behind buffer.', [
+        gae_ts_mon.StringField('outcome'),
+    ])
+
 
 ### Private stuff.
 
@@ -460,3 +469,8 @@ def on_handler_timeout(endpoint, stage, exception):
       'stage': stage,
       'exception': exception,
   })
+
+
+def on_bot_info_write_behind(outcome, count):
+  if count:
+    _bot_info_write_behind.increment_by(count, fields={'outcome': outcome})
@@ -13,6 +13,7 @@ import os
 import platform
 import re
 import shutil
+import stat
 import sys
 import tempfile
 import time
@@ -37,6 +38,13 @@ _DEFAULT_CIPD_CLIENT_PACKAGE = 'infra/tools/cipd/${platform}'
 
 _DEFAULT_CIPD_CLIENT_VERSION = 'latest'
 
+# Seconds a ref (e.g. "latest") resolved to an instance id is reused before
+# asking the backend again. Tags are immutable and cached much longer.
+_REF_TTL_SECS = 5 * 60
+
+# Number of trees kept by DeployedCache.
+_DEPLOYED_MAX_ITEMS = 5
+
 if sys.platform == 'win32':
 
   def _ensure_batfile(client_path):
@@ -100,6 +108,13 @@ def add_cipd_options(parser):
       'if `--cipd-enabled` so it would only be tmpdir during testing'
       'scenarios. ',
       default='')
+  group.add_option(
+      '--cipd-reuse-deployed',
+      action='store_true',
+      help='Keep the last trees deployed by "cipd ensure" in --cipd-cache and '
+      'hardlink them for the tasks with the same resolved packages instead of '
+      'running "cipd ensure". Only use it if the tasks do not modify their '
+      'packages in place.')
   parser.add_option_group(group)
 
 
@@ -270,6 +285,190 @@ class CipdClient:
       fs.remove(json_file_path)
 
 
+class DeployedCache:
+  """Trees deployed by 'cipd ensure', reused by tasks with the same packages.
+
+  An entry is keyed by the service URL and the packages resolved to instance
+  ids, see key(). It holds a copy of the site root as deployed by
+  'cipd ensure', with the files hardlinked, the pins it returned and the modes
+  of the files.
+
+  Installing an entry hardlinks its files into the site root, so they are
+  shared with the cache and must not be modified in place. Their modes are
+  shared too, e.g. the run dir teardown makes them writable, so install()
+  restores the modes recorded by add().
+  """
+
+  def __init__(self, cache_dir, max_items=_DEPLOYED_MAX_ITEMS):
+    """Initializes DeployedCache.
+
+    Args:
+      cache_dir (str): CIPD cache directory, as passed to get_client(). The
+        trees are stored in its 'deployed' subdirectory.
+      max_items (int): number of trees to keep.
+    """
+    self.cache_dir = cache_dir
+    self.root = os.path.join(cache_dir, 'deployed')
+    self.max_items = max_items
+
+  def key(self, service_url, packages, timeout=None):
+    """Returns the key of packages or None if they can't be cached.
+
+    Versions are resolved with resolve_version_cached().
+
+    Args:
+      service_url (str): URL of the CIPD backend.
+      packages: dict of subdir -> list of (package_template, version) tuples,
+        as passed to CipdClient.ensure().
+      timeout (int): if not None, timeout in seconds for this function.
+    """
+    timeoutfn = tools.sliding_timeout(timeout)
+    resolved = {}
+    for subdir, pkgs in sorted(packages.items()):
+      for template, version in pkgs:
+        name = template.lower().replace('${platform}', get_platform())
+        if '${' in name:
+          # Other template parameters are expanded by the CIPD client.
+          return None
+        instance_id = resolve_version_cached(
+            self.cache_dir, service_url, name, version, timeout=timeoutfn())
+        resolved.setdefault(subdir, []).append([name, instance_id])
+    return hashlib.sha256(
+        json.dumps([service_url, resolved], sort_keys=True).encode()
+    ).hexdigest()
+
+  def install(self, key, site_root):
+    """Hardlinks the tree of an entry into site_root.
+
+    Returns:
+      Pinned packages as returned by CipdClient.ensure(), or None if there is
+      no such entry or it failed to be installed.
+    """
+    entry = os.path.join(self.root, key)
+    try:
+      pins = tools.read_json(os.path.join(entry, 'pins.json'))
+    except (IOError, OSError, ValueError):
+      return None
+    try:
+      modes = tools.read_json(os.path.join(entry, 'modes.json'))
+    except (IOError, OSError, ValueError):
+      # Stored before the modes were recorded.
+      modes = {}
+    existing = set(fs.listdir(site_root)) if fs.isdir(site_root) else set()
+    try:
+      _link_tree(os.path.join(entry, 'tree'), site_root)
+      for rel, mode in modes.items():
+        fs.chmod(os.path.join(site_root, rel), mode)
+      # Marks the entry as the most recently used.
+      os.utime(os.path.join(entry, 'pins.json'))
+    except OSError as e:
+      logging.warning('Failed to install deployed CIPD packages %s: %s', key, e)
+      # Leave the site root as it was for 'cipd ensure'.
+      for name in set(fs.listdir(site_root)) - existing:
+        _remove_path(os.path.join(site_root, name))
+      _remove_path(entry)
+      return None
+    logging.info('Installed deployed CIPD packages %s into %s', key, site_root)
+    return {
+        subdir: [tuple(p) for p in pkgs] for subdir, pkgs in pins.items()
+    }
+
+  def add(self, key, site_root, pins):
+    """Stores site_root as deployed by 'cipd ensure' and trims the cache.
+
+    Failures are logged and ignored.
+    """
+    entry = os.path.join(self.root, key)
+    if fs.isdir(entry):
+      return
+    tmp = None
+    try:
+      file_path.ensure_tree(self.root)
+      tmp = tempfile.mkdtemp(prefix='tmp', dir=self.root)
+      _link_tree(site_root, os.path.join(tmp, 'tree'))
+      with open(os.path.join(tmp, 'modes.json'), 'w') as f:
+        json.dump(_get_modes(site_root), f)
+      with open(os.path.join(tmp, 'pins.json'), 'w') as f:
+        json.dump(pins, f)
+      fs.rename(tmp, entry)
+      tmp = None
+      logging.info('Stored deployed CIPD packages %s', key)
+    except (IOError, OSError) as e:
+      logging.warning('Failed to store deployed CIPD packages %s: %s', key, e)
+    finally:
+      if tmp:
+        file_path.rmtree(tmp)
+    self.trim()
+
+  def trim(self):
+    """Deletes the least recently used entries above max_items."""
+    if not fs.isdir(self.root):
+      return
+    entries = []
+    for name in fs.listdir(self.root):
+      path = os.path.join(self.root, name)
+      try:
+        mtime = fs.stat(os.path.join(path, 'pins.json')).st_mtime
+      except OSError:
+        # Leftover of a failed add().
+        mtime = 0
+      entries.append((mtime, path))
+    entries.sort()
+    for _, path in entries[:max(0, len(entries) - self.max_items)]:
+      try:
+        file_path.rmtree(path)
+      except OSError as e:
+        logging.warning('Failed to delete %s: %s', path, e)
+
+
+def _get_modes(root):
+  """Returns {relative path: mode} of the files in root, symlinks excluded."""
+  modes = {}
+  for dirpath, _dirs, files in fs.walk(root):
+    for name in files:
+      p = os.path.join(dirpath, name)
+      if not fs.islink(p):
+        modes[os.path.relpath(p, root)] = stat.S_IMODE(fs.stat(p).st_mode)
+  return modes
+
+
+def _remove_path(path):
+  """Deletes a file or a tree, logging failures."""
+  try:
+    if fs.isdir(path) and not fs.islink(path):
+      file_path.rmtree(path)
+    else:
+      file_path.remove(path)
+  except OSError as e:
+    logging.warning('Failed to delete %s: %s', path, e)
+
+
+def _link_tree(src, dst):
+  """Recreates the tree src in dst, hardlinking the files.
+
+  Symlinks are copied as is, they must be relative and stay in the tree.
+  """
+  src = os.path.abspath(src)
+  file_path.ensure_tree(dst)
+  for root, dirs, files in fs.walk(src):
+    rel = os.path.relpath(root, src)
+    out = os.path.normpath(os.path.join(dst, rel))
+    for name in dirs + files:
+      s = os.path.join(root, name)
+      d = os.path.join(out, name)
+      if fs.islink(s):
+        target = fs.readlink(s)
+        resolved = os.path.normpath(os.path.join(root, target))
+        if os.path.isabs(target) or not resolved.startswith(src + os.sep):
+          raise OSError('%s is a symlink to %s outside of the tree' %
+                        (s, target))
+        fs.symlink(target, d)
+      elif name in files:
+        file_path.link_file(d, s, file_path.HARDLINK_WITH_FALLBACK)
+      elif not fs.isdir(d):
+        fs.mkdir(d)
+
+
 def get_platform():
   """Returns ${platform} parameter value."""
   # Specifically known OSes. See also os_utilities.get_cipd_os().
@@ -351,6 +550,83 @@ def resolve_version(cipd_server, package_name, version, timeout=None):
   return instance_id
 
 
+def _resolve_ref_cached(cache_dir, service_url, package_name, ref, timeout):
+  """Resolves a ref, reusing the result for _REF_TTL_SECS.
+
+  The results are stored in cache_dir/refs.json as
+  {hash(service_url, package_name, ref): [instance id, resolution time]}.
+  """
+  path = os.path.join(cache_dir, 'refs.json')
+  key = hashlib.sha256(
+      ('%s\n%s\n%s' % (service_url, package_name, ref)).encode()).hexdigest()
+  now = time.time()
+  try:
+    refs = tools.read_json(path)
+  except (IOError, OSError, ValueError):
+    refs = {}
+  instance_id, ts = refs.get(key, ('', 0))
+  if instance_id and 0 <= now - ts < _REF_TTL_SECS:
+    logging.info('instance_id %s from the refs cache', instance_id)
+    return instance_id
+
+  instance_id = resolve_version(service_url, package_name, ref, timeout=timeout)
+  refs = {k: v for k, v in refs.items() if 0 <= now - v[1] < _REF_TTL_SECS}
+  refs[key] = [instance_id, now]
+  try:
+    file_path.ensure_tree(cache_dir)
+    file_path.atomic_replace(path, json.dumps(refs).encode())
+  except (IOError, OSError) as e:
+    logging.warning('Failed to save %s: %s', path, e)
+  return instance_id
+
+
+def resolve_version_cached(cache_dir, service_url, package_name, version,
+                           timeout=None):
+  """Resolves a version to an instance id, caching the result in cache_dir.
+
+  Instance ids are returned as is. Immutable tags (e.g. "git_revision:...") are
+  cached for weeks, refs (e.g. "latest") for _REF_TTL_SECS.
+  """
+  # Is it an instance id already? They look like HEX SHA1.
+  if _is_valid_hash(version):
+    return version
+  if ':' not in version:
+    return _resolve_ref_cached(cache_dir, service_url, package_name, version,
+                               timeout)
+
+  # It's an immutable tag, cache the resolved version.
+  # version_cache is {hash(package_name, tag) -> instance id} mapping.
+  # It does not take a lot of disk space.
+  version_cache = local_caching.DiskContentAddressedCache(
+      os.path.join(cache_dir, 'versions'),
+      local_caching.CachePolicies(
+          # 1GiB.
+          max_cache_size=1024 * 1024 * 1024,
+          min_free_space=0,
+          max_items=300,
+          # 3 weeks.
+          max_age_secs=21 * 24 * 60 * 60),
+      trim=True)
+  # Convert (package_name, version) to a string that may be used as a
+  # filename in disk cache by hashing it.
+  version_digest = hashlib.sha256(
+      ('%s\n%s' % (package_name, version)).encode()).hexdigest()
+  try:
+    with version_cache.getfileobj(version_digest) as f:
+      instance_id = f.read().decode()
+    logging.info("instance_id %s", instance_id)
+  except local_caching.CacheMiss:
+    logging.info("version_cache miss for %s", version_digest)
+    instance_id = ''
+
+  if not instance_id:
+    instance_id = resolve_version(
+        service_url, package_name, version, timeout=timeout)
+    version_cache.write(version_digest, [instance_id.encode()])
+  version_cache.trim()
+  return instance_id
+
+
 def get_client_fetch_url(service_url, package_name, instance_id, timeout=None):
   """Returns a fetch URL of CIPD client binary contents.
 
@@ -440,43 +716,8 @@ def get_client(cache_dir,
   # TODO(maruel): Assert instead?
   package_name = package_template.lower().replace('${platform}', get_platform())
 
-  # Resolve version to instance id.
-  # Is it an instance id already? They look like HEX SHA1.
-  if _is_valid_hash(version):
-    instance_id = version
-  elif ':' in version:  # it's an immutable tag, cache the resolved version
-    # version_cache is {hash(package_name, tag) -> instance id} mapping.
-    # It does not take a lot of disk space.
-    version_cache = local_caching.DiskContentAddressedCache(
-        os.path.join(cache_dir, 'versions'),
-        local_caching.CachePolicies(
-            # 1GiB.
-            max_cache_size=1024 * 1024 * 1024,
-            min_free_space=0,
-            max_items=300,
-            # 3 weeks.
-            max_age_secs=21 * 24 * 60 * 60),
-        trim=True)
-    # Convert (package_name, version) to a string that may be used as a
-    # filename in disk cache by hashing it.
-    version_digest = hashlib.sha256(
-        ('%s\n%s' % (package_name, version)).encode()).hexdigest()
-    try:
-      with version_cache.getfileobj(version_digest) as f:
-        instance_id = f.read().decode()
-      logging.info("instance_id %s", instance_id)
-    except local_caching.CacheMiss:
-      logging.info("version_cache miss for %s", version_digest)
-      instance_id = ''
-
-    if not instance_id:
-      instance_id = resolve_version(
-          service_url, package_name, version, timeout=timeoutfn())
-      version_cache.write(version_digest, [instance_id.encode()])
-    version_cache.trim()
-  else:  # it's a ref, hit the backend
-    instance_id = resolve_version(
-        service_url, package_name, version, timeout=timeoutfn())
+  instance_id = resolve_version_cached(
+      cache_dir, service_url, package_name, version, timeout=timeoutfn())
 
   # instance_cache is {instance_id -> client binary} mapping.
   # It is bounded by 5 client versions.
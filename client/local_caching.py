@@ -9,12 +9,14 @@ from __future__ import print_function
 import errno
 import hashlib
 import io
+import json
 import logging
 import os
 import random
 import string
 import subprocess
 import sys
+import threading
 import time
 
 from utils import file_path
@@ -22,12 +24,20 @@ from utils import fs
 from utils import lru
 from utils import threading_utils
 from utils import tools
+from utils import trash
 from utils import logging_utils
 
 # The file size to be used when we don't know the correct file size,
 # generally used for .isolated files.
 UNKNOWN_FILE_SIZE = None
 
+# Maximum number of threads used by DiskContentAddressedCache.verify().
+_VERIFY_THREADS = 8
+
+# Number of items verified by DiskContentAddressedCache.verify() between two
+# checkpoints.
+_VERIFY_CHECKPOINT_INTERVAL = 1000
+
 
 def file_write(path, content_generator):
   """Writes file content as generated by content_generator.
@@ -68,7 +78,25 @@ def is_valid_file(path, size):
   return True
 
 
-def trim_caches(caches, path, min_free_space, max_age_secs):
+def _content_size(size):
+  """Returns the size accounted for a DiskContentAddressedCache LRU entry."""
+  return size or 0
+
+
+def _named_cache_size(value):
+  """Returns the size accounted for a NamedCache LRU entry.
+
+  Entries in the pre-v2 format (a bare relative path) and entries with a
+  malformed size count as 0; they are upgraded or rejected right after load.
+  """
+  if isinstance(value, (list, tuple)) and len(value) == 2:
+    size = value[1]
+    if isinstance(size, int):
+      return size
+  return 0
+
+
+def trim_caches(caches, path, min_free_space, max_age_secs, trash_dir=None):
   """Trims multiple caches.
 
   The goal here is to coherently trim all caches in a coherent LRU fashion,
@@ -80,11 +108,16 @@ def trim_caches(caches, path, min_free_space, max_age_secs):
 
   Once that's done, then we enforce each cache's own policies.
 
+  If trash_dir is set and there isn't enough free space, the trash is emptied
+  before evicting any item, see utils/trash.py.
+
   Returns:
     Slice containing the size of all items evicted.
   """
   min_ts = time.time() - max_age_secs if max_age_secs else 0
   free_disk = file_path.get_free_space(path) if min_free_space else 0
+  if trash_dir and free_disk < min_free_space and trash.empty(trash_dir):
+    free_disk = file_path.get_free_space(path)
   logging_utils.user_logs(
       "Trimming caches. min_ts: %d, free_disk: %d, min_free_space: %d", min_ts,
       free_disk, min_free_space)
@@ -111,6 +144,30 @@ def trim_caches(caches, path, min_free_space, max_age_secs):
   return total
 
 
+class _BandwidthLimiter:
+  """Caps the rate at which bytes are read, across threads."""
+
+  def __init__(self, max_bytes_per_sec):
+    """Args:
+      max_bytes_per_sec: maximum read rate. 0 means unlimited.
+    """
+    self._max_bytes_per_sec = max_bytes_per_sec
+    self._lock = threading.Lock()
+    # Time at which the bytes consumed so far are paid for.
+    self._next = 0.
+
+  def consume(self, size):
+    """Blocks until |size| more bytes can be read without exceeding the cap."""
+    if not self._max_bytes_per_sec:
+      return
+    with self._lock:
+      now = time.time()
+      start = max(now, self._next)
+      self._next = start + float(size) / self._max_bytes_per_sec
+    if start > now:
+      time.sleep(start - now)
+
+
 class NamedCacheError(Exception):
   """Named cache specific error."""
 
@@ -314,8 +371,8 @@ class MemoryContentAddressedCache(ContentAddressedCache):
     """
     super(MemoryContentAddressedCache, self).__init__(None)
     self._file_mode_mask = file_mode_mask
-    # Items in a LRU lookup dict(digest: size).
-    self._lru = lru.LRUDict()
+    # Items in a LRU lookup dict(digest: data).
+    self._lru = lru.LRUDict(size_fn=len)
 
   # Cache interface implementation.
 
@@ -334,7 +391,7 @@ class MemoryContentAddressedCache(ContentAddressedCache):
   @property
   def total_size(self):
     with self._lock:
-      return sum(len(i) for i in self._lru.values())
+      return self._lru.total_size
 
   def oldest_evictable_ts(self):
     with self._lock:
@@ -396,9 +453,15 @@ class MemoryContentAddressedCache(ContentAddressedCache):
 class DiskContentAddressedCache(ContentAddressedCache):
   """Stateful LRU cache in a flat hash table in a directory.
 
-  Saves its state as json file.
+  Saves its state as a binary journal file, see lru.LRUDict. A JSON copy is
+  kept in the file older clients read, rewritten each time the journal is
+  compacted, so a client rolled back to before the journal still finds a valid,
+  if slightly stale, state.
   """
   STATE_FILE = 'state.json'
+  JOURNAL_FILE = 'state.journal'
+  # Progress of an interrupted verify().
+  VERIFY_STATE_FILE = 'verify.json'
 
   def __init__(self, cache_dir, policies, trim, time_fn=None):
     """
@@ -413,8 +476,9 @@ class DiskContentAddressedCache(ContentAddressedCache):
     super(DiskContentAddressedCache, self).__init__(cache_dir)
     self.policies = policies
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
+    self.journal_file = os.path.join(cache_dir, self.JOURNAL_FILE)
     # Items in a LRU lookup dict(digest: size).
-    self._lru = lru.LRUDict()
+    self._lru = lru.LRUDict(size_fn=_content_size, journal=True)
     # Current cached free disk space. It is updated by self._trim().
     file_path.ensure_tree(self.cache_dir)
     self._free_disk = file_path.get_free_space(self.cache_dir)
@@ -446,7 +510,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
   @property
   def total_size(self):
     with self._lock:
-      return sum(self._lru.values())
+      return self._lru.total_size
 
   def oldest_evictable_ts(self):
     with self._lock:
@@ -485,9 +549,10 @@ class DiskContentAddressedCache(ContentAddressedCache):
       fs.chmod(self.cache_dir, 0o700)
       # Ensure that all files listed in the state still exist and add new ones.
       previous = set(self._lru)
-      # It'd be faster if there were a readdir() function.
-      for filename in fs.listdir(self.cache_dir):
-        if filename == self.STATE_FILE:
+      for entry in os.scandir(fs.extend(self.cache_dir)):
+        filename = entry.name
+        if filename in (self.STATE_FILE, self.JOURNAL_FILE,
+                        self.VERIFY_STATE_FILE):
           fs.chmod(os.path.join(self.cache_dir, filename), 0o600)
           continue
         if filename in previous:
@@ -500,7 +565,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
             'DiskContentAddressedCache.cleanup(): Removing unknown file %s',
             filename)
         p = self._path(filename)
-        if fs.isdir(p):
+        if entry.is_dir(follow_symlinks=False):
           try:
             file_path.rmtree(p)
           except OSError:
@@ -518,43 +583,96 @@ class DiskContentAddressedCache(ContentAddressedCache):
           self._lru.pop(filename)
         self._save()
 
-    # Verify hash of every single item to detect corruption. the corrupted
+    # Verify hash of the modified items to detect corruption. The corrupted
     # files will be evicted.
+    self.verify()
+
+  def verify(self, rehash=False, max_bytes_per_sec=0, max_duration=None):
+    """Verifies the hash of the cached items and evicts the corrupted ones.
+
+    Items are stat'ed and hashed on a thread pool without holding the cache
+    lock, and each corrupted item is evicted as soon as it is found, so the
+    cache stays usable meanwhile.
+
+    Progress is saved in VERIFY_STATE_FILE every _VERIFY_CHECKPOINT_INTERVAL
+    items, separately for each |rehash| value. A verification stopped by
+    |max_duration| or by a bot restart resumes from there on the next call
+    with the same |rehash| value.
+
+    Arguments:
+      rehash: if True, hashes every item. Otherwise only hashes the items whose
+          mtime is more recent than their timestamp in the LRU.
+      max_bytes_per_sec: maximum read bandwidth used for hashing. 0 means
+          unlimited.
+      max_duration: if set, stops after the first checkpoint past this many
+          seconds.
+
+    Returns:
+      True if all the items were verified, False if it stopped early.
+    """
+    start = time.time()
+    mode = 'all' if rehash else 'modified'
+    checkpoints = self._load_verify_checkpoints()
+    cursor = checkpoints.get(mode, '')
+    with self._lock:
+      items = sorted(
+          (digest, ts) for digest, ts in self._lru.items_with_ts()
+          if digest > cursor)
+    logging.info(
+        'DiskContentAddressedCache.verify(): Verifying %s files from %r',
+        mode, cursor)
+    limiter = _BandwidthLimiter(max_bytes_per_sec)
     total = 0
     verified = 0
     deleted = 0
-    logging.info(
-        'DiskContentAddressedCache.cleanup(): Verifying modified files')
+    with threading_utils.ThreadPool(
+        0, _VERIFY_THREADS, 0, prefix='verify') as pool:
+      for i in range(0, len(items), _VERIFY_CHECKPOINT_INTERVAL):
+        if max_duration is not None and time.time() - start >= max_duration:
+          logging.info(
+              'DiskContentAddressedCache.verify(): Stopped after %d files',
+              total)
+          return False
+        batch = items[i:i + _VERIFY_CHECKPOINT_INTERVAL]
+        for digest, timestamp in batch:
+          pool.add_task(
+              0, self._verify_item, digest, timestamp, rehash, limiter)
+        for digest, timestamp, is_valid in pool.iter_results():
+          total += 1
+          if is_valid is None:
+            continue
+          verified += 1
+          logging.warning(
+              'DiskContentAddressedCache.verify(): verified. is_valid: %s, '
+              'item: %s', is_valid, digest)
+          with self._lock:
+            item = self._lru._items.get(digest)
+            if not item or item[1] != timestamp:
+              # Evicted or rewritten in the meantime.
+              continue
+            if is_valid:
+              # Update timestamp in the state.
+              self._lru.touch(digest)
+              continue
+            # Remove corrupted file from LRU and file system.
+            self._lru.pop(digest)
+            self._delete_file(digest, UNKNOWN_FILE_SIZE)
+            deleted += 1
+          logging.error(
+              'DiskContentAddressedCache.verify(): Deleted corrupted item: %s',
+              digest)
+        with self._lock:
+          self._save()
+        checkpoints[mode] = batch[-1][0]
+        self._save_verify_checkpoints(checkpoints)
     with self._lock:
-      for digest, (_, timestamp) in list(self._lru._items.items()):
-        total += 1
-        # verify only if the mtime is grather than the timestamp in state.json
-        # to avoid take too long time.
-        if self._get_mtime(digest) <= timestamp:
-          continue
-        logging.warning(
-            'DiskContentAddressedCache.cleanup(): Item has been modified.'
-            ' verifying item: %s', digest)
-        is_valid = self._is_valid_hash(digest)
-        verified += 1
-        logging.warning(
-            'DiskContentAddressedCache.cleanup(): verified. is_valid: %s, '
-            'item: %s', is_valid, digest)
-        if is_valid:
-          # Update timestamp in state.json
-          self._lru.touch(digest)
-          continue
-        # remove corrupted file from LRU and file system
-        self._lru.pop(digest)
-        self._delete_file(digest, UNKNOWN_FILE_SIZE)
-        deleted += 1
-        logging.error(
-            'DiskContentAddressedCache.cleanup(): Deleted corrupted item: %s',
-            digest)
       self._save()
+    if checkpoints.pop(mode, None) is not None:
+      self._save_verify_checkpoints(checkpoints)
     logging.info(
-        'DiskContentAddressedCache.cleanup(): Verified modified files.'
+        'DiskContentAddressedCache.verify(): Verified files.'
         ' total: %d, verified: %d, deleted: %d', total, verified, deleted)
+    return True
 
   # ContentAddressedCache interface implementation.
 
@@ -641,19 +759,35 @@ class DiskContentAddressedCache(ContentAddressedCache):
     """
     self._lock.assert_locked()
 
-    if not fs.isfile(self.state_file):
+    # The journal is the most recent state, unless an older client that only
+    # knows about the JSON state ran since.
+    candidates = [
+        p for p in (self.journal_file, self.state_file) if fs.isfile(p)
+    ]
+    if (len(candidates) == 2 and fs.stat(self.state_file).st_mtime_ns >
+        fs.stat(self.journal_file).st_mtime_ns):
+      candidates.reverse()
+    if not candidates:
       if not fs.isdir(self.cache_dir):
         fs.makedirs(self.cache_dir)
-    else:
+    for i, path in enumerate(candidates):
       # Load state of the cache.
       try:
-        self._lru = lru.LRUDict.load(self.state_file)
+        self._lru = lru.LRUDict.load(
+            path, size_fn=_content_size, journal=True)
       except ValueError as err:
         logging.error('Failed to load cache state: %s' % (err,))
+        if i + 1 < len(candidates):
+          continue
         # Don't want to keep broken cache dir.
         file_path.rmtree(self.cache_dir)
         fs.makedirs(self.cache_dir)
         self._free_disk = file_path.get_free_space(self.cache_dir)
+        break
+      if path == self.state_file and fs.isfile(self.journal_file):
+        # The journal is stale or broken, it is rewritten on the next save.
+        fs.remove(self.journal_file)
+      break
     if time_fn:
       self._lru.time_fn = time_fn
     if trim:
@@ -667,9 +801,10 @@ class DiskContentAddressedCache(ContentAddressedCache):
       if fs.isdir(d):
         # Necessary otherwise the file can't be created.
         file_path.set_read_only(d, False)
-    if fs.isfile(self.state_file):
-      file_path.set_read_only(self.state_file, False)
-    self._lru.save(self.state_file)
+    for p in (self.state_file, self.journal_file):
+      if fs.isfile(p):
+        file_path.set_read_only(p, False)
+    self._lru.save(self.journal_file, json_file=self.state_file)
 
   def _trim(self):
     """Trims anything we don't know, make sure enough free space exists."""
@@ -688,11 +823,8 @@ class DiskContentAddressedCache(ContentAddressedCache):
 
     # Ensure maximum cache size.
     if self.policies.max_cache_size:
-      total_size = sum(self._lru.values())
-      while total_size > self.policies.max_cache_size:
-        e = self._remove_lru_file(True)
-        evicted.append(e)
-        total_size -= e
+      while self._lru.total_size > self.policies.max_cache_size:
+        evicted.append(self._remove_lru_file(True))
 
     # Ensure maximum number of items in the cache.
     if self.policies.max_items and len(self._lru) > self.policies.max_items:
@@ -709,7 +841,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
       evicted.append(self._remove_lru_file(True))
 
     if evicted:
-      total_usage = sum(self._lru.values())
+      total_usage = self._lru.total_size
       usage_percent = 0.
       if total_usage:
         usage_percent = 100. * float(total_usage) / self.policies.max_cache_size
@@ -736,7 +868,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
     try:
       digest, _ = self._lru.get_oldest()
       if not allow_protected and digest == self._protected:
-        total_size = sum(self._lru.values())
+        total_size = self._lru.total_size
         msg = ('Not enough space to fetch the whole isolated tree.\n'
                ' %s\n  cache=%d bytes (%.3f GiB), %d items; '
                '%s bytes (%.3f GiB) free_space') % (
@@ -794,7 +926,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
     """Get mtime of cache file."""
     return  os.path.getmtime(self._path(digest))
 
-  def _is_valid_hash(self, digest):
+  def _is_valid_hash(self, digest, limiter=None):
     """Verify digest with supported hash algos."""
     d = hashlib.sha256()
     with fs.open(self._path(digest), 'rb') as f:
@@ -802,9 +934,50 @@ class DiskContentAddressedCache(ContentAddressedCache):
         chunk = f.read(1024 * 1024)
         if not chunk:
           break
+        if limiter:
+          limiter.consume(len(chunk))
         d.update(chunk)
     return digest == d.hexdigest()
 
+  def _verify_item(self, digest, timestamp, rehash, limiter):
+    """Checks one item on a verify() worker thread.
+
+    Returns:
+      tuple(digest, timestamp, is_valid), where is_valid is None if the item
+      didn't need to be hashed.
+    """
+    try:
+      if not rehash and self._get_mtime(digest) <= timestamp:
+        return digest, timestamp, None
+      logging.warning(
+          'DiskContentAddressedCache.verify(): verifying item: %s', digest)
+      return digest, timestamp, self._is_valid_hash(digest, limiter)
+    except (IOError, OSError) as e:
+      logging.warning(
+          'DiskContentAddressedCache.verify(): Can\'t read item %s: %s',
+          digest, e)
+      return digest, timestamp, False
+
+  def _load_verify_checkpoints(self):
+    """Returns the last digest verified by an interrupted verify(), per mode."""
+    try:
+      with fs.open(os.path.join(self.cache_dir, self.VERIFY_STATE_FILE)) as f:
+        checkpoints = json.load(f)
+    except (IOError, OSError, ValueError):
+      return {}
+    if not isinstance(checkpoints, dict):
+      return {}
+    return {k: v for k, v in checkpoints.items() if isinstance(v, str)}
+
+  def _save_verify_checkpoints(self, checkpoints):
+    """Saves the verify() progress, deleting the file once it is empty."""
+    path = os.path.join(self.cache_dir, self.VERIFY_STATE_FILE)
+    if not checkpoints:
+      file_path.try_remove(path)
+      return
+    with fs.open(path, 'w') as f:
+      json.dump(checkpoints, f)
+
 
 class NamedCache(Cache):
   """Manages cache directories.
@@ -819,8 +992,15 @@ class NamedCache(Cache):
   _DIR_ALPHABET = string.ascii_letters + string.digits
   STATE_FILE = 'state.json'
   NAMED_DIR = 'named'
-
-  def __init__(self, cache_dir, policies, time_fn=None, keep=None):
+  # Directory with the file_path.get_recursive_size() snapshot of each cache.
+  SIZES_DIR = 'sizes'
+
+  def __init__(self,
+               cache_dir,
+               policies,
+               time_fn=None,
+               keep=None,
+               incremental_size=False):
     """Initializes NamedCaches.
 
     Arguments:
@@ -831,18 +1011,24 @@ class NamedCache(Cache):
     - keep: list of str representing cache items which must not be evicted from
       cache under any circumstances. No cache eviction policy will be applied
       to any of these items.
+    - incremental_size: if True, uninstall() measures the size of a cache with
+      the snapshot saved by the previous uninstall(), so only the directories
+      modified since install() are listed. Files modified in place are not
+      noticed since it doesn't change the mtime of their directory.
     """
     super(NamedCache, self).__init__(cache_dir)
     self._policies = policies
+    self._incremental_size = incremental_size
     # LRU {cache_name -> tuple(cache_location, size)}
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
-    self._lru = lru.LRUDict()
+    self._lru = lru.LRUDict(size_fn=_named_cache_size)
     self._keep = set(keep or [])
     if not fs.isdir(self.cache_dir):
       fs.makedirs(self.cache_dir)
     elif fs.isfile(self.state_file):
       try:
-        self._lru = lru.LRUDict.load(self.state_file)
+        self._lru = lru.LRUDict.load(
+            self.state_file, size_fn=_named_cache_size)
         for _, size in self._lru.values():
           if not isinstance(size, int):
             with open(self.state_file, 'r') as f:
@@ -855,7 +1041,7 @@ class NamedCache(Cache):
             'NamedCache: failed to load named cache state file; obliterating')
         file_path.rmtree(self.cache_dir)
         fs.makedirs(self.cache_dir)
-        self._lru = lru.LRUDict()
+        self._lru = lru.LRUDict(size_fn=_named_cache_size)
       with self._lock:
         self._try_upgrade()
     if time_fn:
@@ -936,7 +1122,7 @@ class NamedCache(Cache):
       finally:
         self._save()
 
-  def uninstall(self, src, name):
+  def uninstall(self, src, name, stats=None):
     """Moves the cache directory back into the named cache hive for an eventual
     reuse.
 
@@ -945,6 +1131,9 @@ class NamedCache(Cache):
     src must be absolute and unicode. Its content is moved back into the local
     named caches cache.
 
+    stats is an optional dict filled with the statistics of the size
+    measurement.
+
     Returns the named cache size in bytes.
 
     Raises NamedCacheError if cannot uninstall the cache.
@@ -968,10 +1157,14 @@ class NamedCache(Cache):
         # Calculate the size of the named cache to keep. It's important because
         # if size is zero (it's empty), we do not want to add it back to the
         # named caches cache.
-        size = file_path.get_recursive_size(src)
+        snapshot = None
+        if self._incremental_size:
+          snapshot = self._load_size_snapshot(name)
+        size = file_path.get_recursive_size(src, snapshot, stats)
         logging.info('- Size is %d', size)
         if not size:
           # Do not save empty named cache.
+          self._remove_size_snapshot(name)
           return size
 
         # Move the dir and create an entry for the named cache.
@@ -984,6 +1177,8 @@ class NamedCache(Cache):
 
         self._lru.add(name, (rel_cache, size))
         self._added.append(size)
+        if snapshot is not None:
+          self._save_size_snapshot(name, snapshot)
 
         # Create symlink <cache_dir>/<named>/<name> -> <cache_dir>/<short name>
         # for user convenience.
@@ -1038,7 +1233,7 @@ class NamedCache(Cache):
   @property
   def total_size(self):
     with self._lock:
-      return sum(size for _rel_path, size in self._lru.values())
+      return self._lru.total_size
 
   def _oldest_evictable_item(self):
     self._lock.assert_locked()
@@ -1120,8 +1315,7 @@ class NamedCache(Cache):
       # Trim according to maximum total size.
       if self._policies.max_cache_size:
         while self._lru:
-          total = sum(size for _rel_cache, size in self._lru.values())
-          if total <= self._policies.max_cache_size:
+          if self._lru.total_size <= self._policies.max_cache_size:
             break
           name, size = self._remove_lru_item()
           if not name:
@@ -1147,6 +1341,7 @@ class NamedCache(Cache):
         actual = set(fs.listdir(self.cache_dir))
         actual.discard(self.NAMED_DIR)
         actual.discard(self.STATE_FILE)
+        actual.discard(self.SIZES_DIR)
         expected = {v[0]: k for k, v in self._lru.items()}
         # First, handle the actual cache content.
         # Remove missing entries.
@@ -1201,6 +1396,13 @@ class NamedCache(Cache):
             except (IOError, OSError) as e:
               logging.error('Failed to remove %s: %s', unexpected, e)
               success = False
+
+        # Third, remove the size snapshots of unknown caches.
+        sizes = os.path.join(self.cache_dir, self.SIZES_DIR)
+        if fs.isdir(sizes):
+          for f in fs.listdir(sizes):
+            if os.path.splitext(f)[0] not in self._lru:
+              file_path.try_remove(os.path.join(sizes, f))
       finally:
         self._save()
     return success
@@ -1233,6 +1435,7 @@ class NamedCache(Cache):
       _, size = self._lru.get(name)
       logging.info('Removing named cache %r, %d', name, size)
       self._remove(name)
+      self._remove_size_snapshot(name)
       return name, size
     return None, None
 
@@ -1286,3 +1489,28 @@ class NamedCache(Cache):
 
   def _get_named_path(self, name):
     return os.path.join(self.cache_dir, self.NAMED_DIR, name)
+
+  def _get_size_snapshot_path(self, name):
+    return os.path.join(self.cache_dir, self.SIZES_DIR, name + '.json')
+
+  def _load_size_snapshot(self, name):
+    """Returns the file_path.get_recursive_size() snapshot of a cache."""
+    try:
+      with fs.open(self._get_size_snapshot_path(name)) as f:
+        snapshot = json.load(f)
+    except (IOError, OSError, ValueError):
+      return {}
+    return snapshot if isinstance(snapshot, dict) else {}
+
+  def _save_size_snapshot(self, name, snapshot):
+    path = self._get_size_snapshot_path(name)
+    try:
+      file_path.ensure_tree(os.path.dirname(path))
+      with fs.open(path, 'w') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    except (IOError, OSError) as e:
+      # The next uninstall() lists the whole cache.
+      logging.warning('Failed to save the size snapshot of %r: %s', name, e)
+
+  def _remove_size_snapshot(self, name):
+    file_path.try_remove(self._get_size_snapshot_path(name))
@@ -61,6 +61,7 @@ import re
 import shutil
 import sys
 import tempfile
+import threading
 import time
 
 from utils import tools
@@ -77,10 +78,13 @@ import local_caching
 from libs import luci_context
 from utils import file_path
 from utils import fs
+from utils import large
 from utils import logging_utils
 from utils import net
 from utils import on_error
 from utils import subprocess42
+from utils import threading_utils
+from utils import trash
 
 
 # Magic variables that can be found in the isolate task command line.
@@ -158,6 +162,9 @@ MAX_AGE_SECS = 21*24*60*60
 
 _CAS_KVS_CACHE_THRESHOLD = 5 * 1024 * 1024 * 1024  # 5 GiB
 
+# Number of threads used to link the outputs, see _TreeLinker.
+_LINK_THREADS = 8
+
 TaskData = collections.namedtuple(
     'TaskData',
     [
@@ -211,6 +218,9 @@ TaskData = collections.namedtuple(
         # Function to trim caches before installing cipd packages and
         # downloading isolated files.
         'trim_caches_fn',
+        # Directory to move the task directories into for deferred deletion,
+        # see utils/trash.py. If None, they are deleted right away.
+        'trash_dir',
     ])
 
 def make_temp_dir(prefix, root_dir):
@@ -633,16 +643,36 @@ def _fetch_and_map(cas_client, digest, instance, output_dir, cache_dir,
     file_path.rmtree(profile_dir)
 
 
+def _items_args(stats):
+  """Returns the file counts and bytes of CAS download or upload stats."""
+  args = {}
+  for k in ('items_cold', 'items_hot'):
+    if stats.get(k):
+      sizes = large.unpack(base64.b64decode(stats[k]))
+      args['files_' + k[6:]] = len(sizes)
+      args['bytes_' + k[6:]] = sum(sizes)
+  return args
+
+
 def link_outputs_to_outdir(run_dir, out_dir, outputs):
   """Links any named outputs to out_dir so they can be uploaded.
 
   Raises an error if the file already exists in that directory.
+
+  Returns:
+    dict with the number of files and bytes linked and copied, or None if
+    there is no output.
   """
   if not outputs:
-    return
+    return None
+  start = time.time()
   file_path.create_directories(out_dir, outputs)
-  for o in outputs:
-    copy_recursively(os.path.join(run_dir, o), os.path.join(out_dir, o))
+  linker = _TreeLinker()
+  linker.link([(os.path.join(run_dir, o), os.path.join(out_dir, o))
+               for o in outputs])
+  stats = linker.stats.copy()
+  stats['duration'] = time.time() - start
+  return stats
 
 
 def copy_recursively(src, dst):
@@ -656,30 +686,138 @@ def copy_recursively(src, dst):
   (newly created) directory structure if possible, unlike Python's
   shutil.copytree().
   """
-  orig_src = src
-  try:
-    # Replace symlinks with their final target.
-    while fs.islink(src):
-      res = fs.readlink(src)
-      src = os.path.realpath(os.path.join(os.path.dirname(src), res))
-    # TODO(sadafm): Explicitly handle cyclic symlinks.
+  _TreeLinker().link([(src, dst)])
 
-    if not fs.exists(src):
-      logging.warning('Path %s does not exist or %s is a broken symlink', src,
-                      orig_src)
-      return
 
-    if fs.isfile(src):
-      file_path.link_file(dst, src, file_path.HARDLINK_WITH_FALLBACK)
-      return
+class _TreeLinker:
+  """Hardlinks files and directory trees, falling back to copies.
 
-    if not fs.exists(dst):
-      os.makedirs(dst)
+  Directories are listed with os.scandir() and its cached entry types are used
+  instead of stat'ing each entry. Each directory is a task on a thread pool, so
+  large trees are linked in parallel.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.stats = {
+        'files_linked': 0,
+        'bytes_linked': 0,
+        'files_copied': 0,
+        'bytes_copied': 0,
+    }
 
-    for child in fs.listdir(src):
-      copy_recursively(os.path.join(src, child), os.path.join(dst, child))
+  def link(self, items):
+    """Links a list of (src, dst), see copy_recursively()."""
+    with threading_utils.ThreadPool(
+        0, _LINK_THREADS, 0, prefix='copy_recursively') as pool:
+      dirs = []
+      for src, dst in items:
+        dirs.extend(self._link_path(src, dst, top=True))
+      for src, dst in dirs:
+        pool.add_task(0, self._link_dir, src, dst)
+      for subdirs in pool.iter_results():
+        for src, dst in subdirs:
+          pool.add_task(0, self._link_dir, src, dst)
+
+  def _link_path(self, src, dst, top=False):
+    """Links a file or directory that may be a symlink.
+
+    Returns:
+      list of (src, dst) directories to link.
+    """
+    orig_src = src
+    try:
+      # Replace symlinks with their final target.
+      while fs.islink(src):
+        res = fs.readlink(src)
+        src = os.path.realpath(os.path.join(os.path.dirname(src), res))
+      # TODO(sadafm): Explicitly handle cyclic symlinks.
+
+      if not fs.exists(src):
+        logging.warning('Path %s does not exist or %s is a broken symlink', src,
+                        orig_src)
+        return []
+
+      if fs.isfile(src):
+        self._link_file(src, dst, fs.stat(src).st_size)
+        return []
+
+      if top:
+        if not fs.exists(dst):
+          os.makedirs(dst)
+      else:
+        self._mkdir(dst)
+      return [(src, dst)]
+
+    except OSError as e:
+      self._log_error(src, orig_src, e)
+      return []
 
-  except OSError as e:
+  def _link_dir(self, src, dst):
+    """Links the content of the directory src into the existing dst.
+
+    Returns:
+      list of (src, dst) subdirectories to link.
+    """
+    subdirs = []
+    files = []
+    try:
+      with os.scandir(src) as it:
+        for entry in it:
+          d = os.path.join(dst, entry.name)
+          if file_path._is_symlink_entry(entry):
+            subdirs.extend(self._link_path(entry.path, d))
+          elif entry.is_dir(follow_symlinks=False):
+            subdirs.append((entry.path, d))
+          else:
+            files.append((entry, d))
+    except OSError as e:
+      self._log_error(src, src, e)
+      return subdirs
+
+    # Create all the subdirectories first, so the tasks linking them can start
+    # while the files are being linked.
+    created = []
+    for s, d in subdirs:
+      try:
+        self._mkdir(d)
+        created.append((s, d))
+      except OSError as e:
+        self._log_error(s, s, e)
+    for entry, d in files:
+      try:
+        size = entry.stat(follow_symlinks=False).st_size
+        self._link_file(entry.path, d, size)
+      except OSError as e:
+        self._log_error(entry.path, entry.path, e)
+    return created
+
+  def _link_file(self, src, dst, size):
+    """Hardlinks a file, copying it if it can't be hardlinked."""
+    try:
+      file_path.hardlink(src, dst)
+      kind = 'linked'
+    except OSError:
+      if fs.exists(dst):
+        raise
+      # e.g. a different volume.
+      file_path.readable_copy(dst, src)
+      kind = 'copied'
+    with self._lock:
+      self.stats['files_' + kind] += 1
+      self.stats['bytes_' + kind] += size
+
+  @staticmethod
+  def _mkdir(path):
+    try:
+      fs.mkdir(path)
+    except OSError as e:
+      # The outputs may overlap.
+      if e.errno != errno.EEXIST:
+        raise
+
+  @staticmethod
+  def _log_error(src, orig_src, e):
     if e.errno == errno.ENOENT:
       logging.warning('Path %s does not exist or %s is a broken symlink',
                       src, orig_src)
@@ -852,7 +990,8 @@ def map_and_run(data, constant_run_path):
   cas_client_dir = make_temp_dir(_CAS_CLIENT_DIR, data.root_dir)
   cas_client = os.path.join(cas_client_dir, 'cas' + cipd.EXECUTABLE_SUFFIX)
 
-  data.trim_caches_fn(result['stats']['trim_caches'])
+  with tools.phase('trim_caches'):
+    data.trim_caches_fn(result['stats']['trim_caches'])
 
   try:
     with data.install_packages_fn(run_dir, cas_client_dir) as cipd_info:
@@ -863,15 +1002,17 @@ def map_and_run(data, constant_run_path):
       isolated_stats = result['stats'].setdefault('isolated', {})
 
       if data.cas_digest:
-        stats = _fetch_and_map(
-            cas_client=cas_client,
-            digest=data.cas_digest,
-            instance=data.cas_instance,
-            output_dir=run_dir,
-            cache_dir=data.cas_cache_dir,
-            policies=data.cas_cache_policies,
-            kvs_dir=data.cas_kvs,
-            tmp_dir=tmp_dir)
+        with tools.phase('cas_download') as span:
+          stats = _fetch_and_map(
+              cas_client=cas_client,
+              digest=data.cas_digest,
+              instance=data.cas_instance,
+              output_dir=run_dir,
+              cache_dir=data.cas_cache_dir,
+              policies=data.cas_cache_policies,
+              kvs_dir=data.cas_kvs,
+              tmp_dir=tmp_dir)
+          span.args.update(_items_args(stats))
         isolated_stats['download'].update(stats)
         logging_utils.user_logs('Fetched CAS inputs')
 
@@ -914,17 +1055,27 @@ def map_and_run(data, constant_run_path):
             command = process_command(command, out_dir, data.bot_file)
             file_path.ensure_command_has_abs_path(command, cwd)
 
-            result['exit_code'], result['had_hard_timeout'] = run_command(
-                command, cwd, env, data.hard_timeout, data.grace_period,
-                data.lower_priority, data.containment)
+            with tools.phase('command'):
+              result['exit_code'], result['had_hard_timeout'] = run_command(
+                  command, cwd, env, data.hard_timeout, data.grace_period,
+                  data.lower_priority, data.containment)
         finally:
           result['duration'] = max(time.time() - start, 0)
 
       # Try to link files to the output directory, if specified.
-      link_outputs_to_outdir(run_dir, out_dir, data.outputs)
+      with tools.phase('link_outputs') as span:
+        link_stats = link_outputs_to_outdir(run_dir, out_dir, data.outputs)
+        if link_stats:
+          span.args.update(
+              (k, v) for k, v in link_stats.items() if k != 'duration')
       isolated_stats = result['stats'].setdefault('isolated', {})
-      result['cas_output_root'], upload_stats = upload_outdir(
-          cas_client, data.cas_instance, out_dir, tmp_dir)
+      if link_stats:
+        isolated_stats['link'] = link_stats
+      with tools.phase('upload') as span:
+        result['cas_output_root'], upload_stats = upload_outdir(
+            cas_client, data.cas_instance, out_dir, tmp_dir)
+        if upload_stats:
+          span.args.update(_items_args(upload_stats))
       if upload_stats:
         isolated_stats['upload'] = upload_stats
 
@@ -971,27 +1122,33 @@ def map_and_run(data, constant_run_path):
         dirs_to_remove = [run_dir, tmp_dir, cas_client_dir]
         if out_dir:
           dirs_to_remove.append(out_dir)
-        for directory in dirs_to_remove:
-          if not fs.isdir(directory):
-            continue
-          start = time.time()
-          try:
-            file_path.rmtree(directory)
-          except OSError as e:
-            logging.error('rmtree(%r) failed: %s', directory, e)
-            success = False
-          finally:
-            logging.info('Cleanup: rmtree(%r) took %d seconds', directory,
-                         time.time() - start)
-          if not success:
-            sys.stderr.write(
-                OUTLIVING_ZOMBIE_MSG % (directory, data.grace_period))
-            if sys.platform == 'win32':
-              subprocess42.check_call(['tasklist.exe', '/V'], stdout=sys.stderr)
-            else:
-              subprocess42.check_call(['ps', 'axu'], stdout=sys.stderr)
-            if result['exit_code'] == 0:
-              result['exit_code'] = 1
+        with tools.phase('cleanup'):
+          for directory in dirs_to_remove:
+            if not fs.isdir(directory):
+              continue
+            start = time.time()
+            try:
+              if data.trash_dir:
+                # Falls back to rmtree() if the directory can't be moved.
+                trash.move(directory, data.trash_dir)
+              else:
+                file_path.rmtree(directory)
+            except OSError as e:
+              logging.error('rmtree(%r) failed: %s', directory, e)
+              success = False
+            finally:
+              logging.info('Cleanup: rmtree(%r) took %d seconds', directory,
+                           time.time() - start)
+            if not success:
+              sys.stderr.write(
+                  OUTLIVING_ZOMBIE_MSG % (directory, data.grace_period))
+              if sys.platform == 'win32':
+                subprocess42.check_call(['tasklist.exe', '/V'],
+                                        stdout=sys.stderr)
+              else:
+                subprocess42.check_call(['ps', 'axu'], stdout=sys.stderr)
+              if result['exit_code'] == 0:
+                result['exit_code'] = 1
 
       if not success and result['exit_code'] == 0:
         result['exit_code'] = 1
@@ -1009,6 +1166,14 @@ def map_and_run(data, constant_run_path):
   return result
 
 
+def get_trace_json_path(result_json):
+  """Returns the path of the trace of the phases written next to result_json.
+
+  It is in the Trace Event Format and can be loaded in chrome://tracing.
+  """
+  return os.path.splitext(result_json)[0] + '.trace.json'
+
+
 def run_tha_test(data, result_json):
   """Runs an executable and records execution metadata.
 
@@ -1023,7 +1188,8 @@ def run_tha_test(data, result_json):
   Arguments:
   - data: TaskData instance.
   - result_json: File path to dump result metadata into. If set, the process
-    exit code is always 0 unless an internal error occurred.
+    exit code is always 0 unless an internal error occurred. The trace of the
+    phases is written next to it, see get_trace_json_path().
 
   Returns:
     Process exit code that should be used.
@@ -1041,7 +1207,10 @@ def run_tha_test(data, result_json):
     tools.write_json(result_json, result, dense=True)
 
   # run_isolated exit code. Depends on if result_json is used or not.
-  result = map_and_run(data, True)
+  with tools.PhaseTimer() as timer:
+    with tools.phase('run_isolated'):
+      result = map_and_run(data, True)
+  result['stats']['phases'] = timer.spans()
   logging.info('Result:\n%s', tools.format_json(result, dense=True))
 
   if result_json:
@@ -1049,6 +1218,8 @@ def run_tha_test(data, result_json):
     # here. Try to recreate the directory if necessary.
     file_path.ensure_tree(os.path.dirname(result_json))
     tools.write_json(result_json, result, dense=True)
+    tools.write_json(
+        get_trace_json_path(result_json), timer.trace_events(), dense=True)
     # Only return 1 if there was an internal error.
     return int(bool(result['internal_failure']))
 
@@ -1087,7 +1258,12 @@ def copy_local_packages(_run_dir, cas_dir):
   yield None
 
 
-def _install_packages(run_dir, cipd_cache_dir, client, packages, timeout=None):
+def _install_packages(run_dir,
+                      cipd_cache_dir,
+                      client,
+                      packages,
+                      timeout=None,
+                      deployed_cache=None):
   """Calls 'cipd ensure' for packages.
 
   Args:
@@ -1096,6 +1272,8 @@ def _install_packages(run_dir, cipd_cache_dir, client, packages, timeout=None):
     client (CipdClient): the cipd client to use
     packages: packages to install, list [(path, package_name, version), ...].
     timeout (int): if not None, timeout in seconds for cipd ensure to run.
+    deployed_cache (cipd.DeployedCache): if set, reuses the tree deployed for
+      the same packages instead of running 'cipd ensure' when possible.
 
   Returns: list of pinned packages.  Looks like [
     {
@@ -1122,15 +1300,30 @@ def _install_packages(run_dir, cipd_cache_dir, client, packages, timeout=None):
       path = ''
     by_path[path].append((name, version, i))
 
-  pins = client.ensure(
-      run_dir,
-      {
-          subdir: [(name, vers) for name, vers, _ in pkgs]
-          for subdir, pkgs in by_path.items()
-      },
-      cache_dir=cipd_cache_dir,
-      timeout=timeout,
-  )
+  ensure_packages = {
+      subdir: [(name, vers) for name, vers, _ in pkgs]
+      for subdir, pkgs in by_path.items()
+  }
+  pins = None
+  key = None
+  if deployed_cache:
+    try:
+      key = deployed_cache.key(
+          client.service_url, ensure_packages, timeout=timeout)
+    except cipd.Error as e:
+      # Let 'cipd ensure' report it.
+      logging.warning('Failed to resolve CIPD packages: %s', e)
+    if key:
+      pins = deployed_cache.install(key, run_dir)
+  if pins is None:
+    pins = client.ensure(
+        run_dir,
+        ensure_packages,
+        cache_dir=cipd_cache_dir,
+        timeout=timeout,
+    )
+    if key:
+      deployed_cache.add(key, run_dir, pins)
 
   for subdir, pin_list in sorted(pins.items()):
     this_subdir = by_path[subdir]
@@ -1143,9 +1336,14 @@ def _install_packages(run_dir, cipd_cache_dir, client, packages, timeout=None):
 
 
 @contextlib.contextmanager
-def install_client_and_packages(run_dir, packages, service_url,
-                                client_package_name, client_version, cache_dir,
-                                cas_dir):
+def install_client_and_packages(run_dir,
+                                packages,
+                                service_url,
+                                client_package_name,
+                                client_version,
+                                cache_dir,
+                                cas_dir,
+                                reuse_deployed=False):
   """Bootstraps CIPD client and installs CIPD packages.
 
   Yields CipdClient, stats, client info and pins (as single CipdInfo object).
@@ -1178,6 +1376,8 @@ def install_client_and_packages(run_dir, packages, service_url,
     client_version (str): Version of CIPD client.
     cache_dir (str): where to keep cache of cipd clients, packages and tags.
     cas_dir (str): where to download cas client.
+    reuse_deployed (bool): reuse the trees deployed by earlier tasks with the
+      same packages, see cipd.DeployedCache.
   """
   assert cache_dir
 
@@ -1187,29 +1387,39 @@ def install_client_and_packages(run_dir, packages, service_url,
   cipd_cache_dir = os.path.join(cache_dir, 'cache')  # tag and instance caches
   run_dir = os.path.abspath(run_dir)
   packages = packages or []
+  deployed_cache = cipd.DeployedCache(cache_dir) if reuse_deployed else None
 
   get_client_start = time.time()
   client_manager = cipd.get_client(cache_dir, service_url, client_package_name,
                                    client_version)
 
-  with client_manager as client:
-    logging_utils.user_logs('Installed CIPD client')
-    get_client_duration = time.time() - get_client_start
-
-    package_pins = []
-    if packages:
-      package_pins = _install_packages(run_dir, cipd_cache_dir, client,
-                                       packages)
-      logging_utils.user_logs('Installed task packages')
-
-    # Install cas client to |cas_dir|.
-    _install_packages(cas_dir,
-                      cipd_cache_dir,
-                      client, [('', _CAS_PACKAGE, _LUCI_GO_REVISION)],
-                      timeout=10 * 60)
-    logging_utils.user_logs('Installed CAS client')
-
-    file_path.make_tree_files_read_only(run_dir)
+  with contextlib.ExitStack() as stack:
+    with tools.phase('cipd_install', packages=len(packages)):
+      with tools.phase('cipd_get_client'):
+        client = stack.enter_context(client_manager)
+      logging_utils.user_logs('Installed CIPD client')
+      get_client_duration = time.time() - get_client_start
+
+      package_pins = []
+      if packages:
+        with tools.phase('cipd_packages'):
+          package_pins = _install_packages(run_dir,
+                                           cipd_cache_dir,
+                                           client,
+                                           packages,
+                                           deployed_cache=deployed_cache)
+        logging_utils.user_logs('Installed task packages')
+
+      # Install cas client to |cas_dir|.
+      with tools.phase('cas_client'):
+        _install_packages(cas_dir,
+                          cipd_cache_dir,
+                          client, [('', _CAS_PACKAGE, _LUCI_GO_REVISION)],
+                          timeout=10 * 60,
+                          deployed_cache=deployed_cache)
+      logging_utils.user_logs('Installed CAS client')
+
+      file_path.make_tree_files_read_only(run_dir)
 
     total_duration = time.time() - start
     logging_utils.user_logs(
@@ -1332,6 +1542,12 @@ def create_option_parser():
       '--named-cache-root',
       default='named_caches',
       help='Cache root directory. Default=%default')
+  group.add_option(
+      '--named-cache-incremental-size',
+      action='store_true',
+      help='When uninstalling a named cache, only list the directories '
+      'modified since it was installed to measure its size. Files modified '
+      'in place are not noticed.')
   parser.add_option_group(group)
 
   group = optparse.OptionGroup(parser, 'Process containment')
@@ -1394,6 +1610,26 @@ def add_cas_cache_options(parser):
       default=2 * 1024 * 1024 * 1024,
       help='Trim if disk free space becomes lower than this value, '
       'default=%default')
+  group.add_option(
+      '--trash-dir',
+      metavar='DIR',
+      help='Directory to move the task directories into instead of deleting '
+      'them, for deletion in the background. It is emptied before evicting '
+      'caches to free disk space. It must be on the same volume as --root-dir.')
+  group.add_option(
+      '--rehash-max-duration',
+      type='float',
+      metavar='SECS',
+      help='With --clean, also rehashes all the items of the CAS cache for up '
+      'to this many seconds, resuming where the previous run stopped. By '
+      'default only the items modified since they were cached are hashed.')
+  group.add_option(
+      '--rehash-max-bytes-per-sec',
+      type='int',
+      metavar='NNN',
+      default=0,
+      help='Maximum read bandwidth used by --rehash-max-duration, 0 means '
+      'unlimited. Default=%default')
   parser.add_option_group(group)
 
 
@@ -1441,10 +1677,12 @@ def process_named_cache_options(parser, options, time_fn=None):
         max_age_secs=MAX_AGE_SECS)
     keep = [name for name, _, _ in options.named_caches]
     root_dir = os.path.abspath(options.named_cache_root)
-    cache = local_caching.NamedCache(root_dir,
-                                     policies,
-                                     time_fn=time_fn,
-                                     keep=keep)
+    cache = local_caching.NamedCache(
+        root_dir,
+        policies,
+        time_fn=time_fn,
+        keep=keep,
+        incremental_size=options.named_cache_incremental_size)
     # Touch any named caches we're going to use to minimize thrashing
     # between tasks that request some (but not all) of the same named caches.
     cache.touch(*[name for name, _, _ in options.named_caches])
@@ -1521,12 +1759,23 @@ def _clean_cmd(parser, options, caches, root):
       caches,
       root,
       min_free_space=options.min_free_space,
-      max_age_secs=MAX_AGE_SECS)
+      max_age_secs=MAX_AGE_SECS,
+      trash_dir=options.trash_dir)
   logging.info("free space after trim: %d", file_path.get_free_space(root))
   for c in caches:
     c.cleanup()
   logging.info("free space after cleanup: %d", file_path.get_free_space(root))
 
+  if options.rehash_max_duration is not None:
+    for c in caches:
+      if not isinstance(c, local_caching.DiskContentAddressedCache):
+        continue
+      done = c.verify(
+          rehash=True,
+          max_bytes_per_sec=options.rehash_max_bytes_per_sec,
+          max_duration=options.rehash_max_duration)
+      logging.info("rehash %s", "completed" if done else "stopped early")
+
 
 def main(args):
   # Warning: when --argsfile is used, the strings are unicode instances, when
@@ -1591,7 +1840,11 @@ def main(args):
   def trim_caches_fn(stats):
     start = time.time()
     local_caching.trim_caches(
-        caches, root, min_free_space=min_free_space, max_age_secs=MAX_AGE_SECS)
+        caches,
+        root,
+        min_free_space=min_free_space,
+        max_age_secs=MAX_AGE_SECS,
+        trash_dir=options.trash_dir)
     duration = time.time() - start
     stats['duration'] = duration
     logging_utils.user_logs('trim_caches: took %d seconds', duration)
@@ -1657,7 +1910,8 @@ def main(args):
         options.cipd_client_package,
         options.cipd_client_version,
         cache_dir=cache_dir,
-        cas_dir=cas_dir))
+        cas_dir=cas_dir,
+        reuse_deployed=options.cipd_reuse_deployed))
 
   @contextlib.contextmanager
   def install_named_caches(run_dir, stats):
@@ -1668,8 +1922,9 @@ def main(args):
     named_caches = [(os.path.join(run_dir, str(relpath)), name)
                     for name, relpath, _ in options.named_caches]
     install_start = time.time()
-    for path, name in named_caches:
-      named_cache.install(path, name)
+    with tools.phase('named_caches_install', caches=len(named_caches)):
+      for path, name in named_caches:
+        named_cache.install(path, name)
     install_duration = time.time() - install_start
     stats['install']['duration'] = install_duration
     logging.info('named_caches: install took %d seconds', install_duration)
@@ -1683,22 +1938,34 @@ def main(args):
       # If the Swarming bot cannot clean up the cache, it will handle it like
       # any other bot file that could not be removed.
       uninstall_start = time.time()
-      for path, name in reversed(named_caches):
-        try:
-          # uninstall() doesn't trim but does call save() implicitly. Trimming
-          # *must* be done manually via periodic 'run_isolated.py --clean'.
-          named_cache.uninstall(path, name)
-        except local_caching.NamedCacheError:
-          if sys.platform == 'win32':
-            # Show running processes.
-            sys.stderr.write("running process\n")
-            subprocess42.check_call(['tasklist.exe', '/V'], stdout=sys.stderr)
-
-          error = (
-              'Error while removing named cache %r at %r. The cache will be'
-              ' lost.' % (path, name))
-          logging.exception(error)
-          on_error.report(error)
+      with tools.phase('named_caches_uninstall',
+                       caches=len(named_caches)) as span:
+        for path, name in reversed(named_caches):
+          # Statistics of the size measurement, summed over all the caches.
+          size_stats = stats['uninstall'].setdefault('size', {})
+          try:
+            # uninstall() doesn't trim but does call save() implicitly. Trimming
+            # *must* be done manually via periodic 'run_isolated.py --clean'.
+            cache_stats = {}
+            named_cache.uninstall(path, name, stats=cache_stats)
+            for k, v in cache_stats.items():
+              size_stats[k] = size_stats.get(k, 0) + v
+          except local_caching.NamedCacheError:
+            if sys.platform == 'win32':
+              # Show running processes.
+              sys.stderr.write("running process\n")
+              subprocess42.check_call(['tasklist.exe', '/V'],
+                                      stdout=sys.stderr)
+
+            error = (
+                'Error while removing named cache %r at %r. The cache will be'
+                ' lost.' % (path, name))
+            logging.exception(error)
+            on_error.report(error)
+        size_stats = stats['uninstall'].get('size', {})
+        for k in ('files', 'dirs'):
+          if k in size_stats:
+            span.args[k] = size_stats[k]
       uninstall_duration = time.time() - uninstall_start
       stats['uninstall']['duration'] = uninstall_duration
       logging.info('named_caches: uninstall took %d seconds',
@@ -1746,7 +2013,8 @@ def main(args):
                   env_prefix=options.env_prefix,
                   lower_priority=bool(options.lower_priority),
                   containment=containment,
-                  trim_caches_fn=trim_caches_fn)
+                  trim_caches_fn=trim_caches_fn,
+                  trash_dir=options.trash_dir)
   try:
     return run_tha_test(data, options.json)
   except (cipd.Error, local_caching.NamedCacheError,
@@ -0,0 +1,113 @@
+#!/usr/bin/env vpython3
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import threading
+import time
+import unittest
+
+# Mutates sys.path.
+import test_env
+
+# third_party/
+from depot_tools import auto_stub
+from google.protobuf import duration_pb2
+from infra_libs import bqh
+
+
+class FakeBigQueryClient(object):
+  """Records the inserted rows and fails the rows set in self.failures."""
+
+  def __init__(self, delay=0):
+    self.delay = delay
+    # {row: number of times it fails to be inserted}.
+    self.failures = {}
+    self.calls = []
+    self.in_flight = 0
+    self.max_in_flight = 0
+    self._lock = threading.Lock()
+
+  def dataset(self, dataset_id):
+    return self
+
+  def table(self, table_id):
+    return table_id
+
+  def get_table(self, table_ref):
+    return table_ref
+
+  def create_rows(self, table, rows):
+    with self._lock:
+      self.calls.append(rows)
+      self.in_flight += 1
+      self.max_in_flight = max(self.max_in_flight, self.in_flight)
+    try:
+      time.sleep(self.delay)
+      errors = []
+      for i, row in enumerate(rows):
+        if self.failures and self.failures.get(row):
+          self.failures[row] -= 1
+          errors.append({'index': i, 'errors': ['boom %s' % (row,)]})
+      return errors
+    finally:
+      with self._lock:
+        self.in_flight -= 1
+
+
+class BqhTest(auto_stub.TestCase):
+  def test_send_rows_messages(self):
+    client = FakeBigQueryClient()
+    rows = [duration_pb2.Duration(seconds=i) for i in range(3)]
+    bqh.send_rows(client, 'd', 't', rows, batch_size=2)
+    self.assertEqual([
+        [{'seconds': 0, 'nanos': 0}, {'seconds': 1, 'nanos': 0}],
+        [{'seconds': 2, 'nanos': 0}],
+    ], client.calls)
+
+  def test_send_rows_max_in_flight(self):
+    client = FakeBigQueryClient(delay=0.05)
+    rows = [(i,) for i in range(10)]
+    bqh.send_rows(client, 'd', 't', rows, batch_size=2, max_in_flight=2)
+    self.assertEqual(5, len(client.calls))
+    self.assertEqual(rows, sorted(r for c in client.calls for r in c))
+    self.assertEqual(2, client.max_in_flight)
+
+  def test_send_rows_retries_failed_rows(self):
+    client = FakeBigQueryClient()
+    client.failures = {(1,): 1, (3,): 1}
+    rows = [(i,) for i in range(5)]
+    bqh.send_rows(client, 'd', 't', rows, batch_size=5, retries=1)
+    # Only the failed rows are sent again.
+    self.assertEqual([rows, [(1,), (3,)]], client.calls)
+
+  def test_send_rows_global_indexes(self):
+    client = FakeBigQueryClient()
+    rows = [(i,) for i in range(6)]
+    # (3,) is at index 0 of the retry, at index 1 of its batch.
+    client.failures = {(3,): 2}
+    with self.assertRaises(bqh.BigQueryInsertError) as ctx:
+      bqh.send_rows(client, 'd', 't', rows, batch_size=2, retries=1)
+    self.assertEqual('Error inserting row 3: boom (3,)\n', str(ctx.exception))
+    # The next batches are not sent once a row failed.
+    self.assertEqual([[(0,), (1,)], [(2,), (3,)], [(3,)]], client.calls)
+
+  def test_send_rows_conversion_error(self):
+    client = FakeBigQueryClient()
+    rows = [duration_pb2.Duration(seconds=i) for i in range(3)]
+    message_to_dict = bqh.message_to_dict
+
+    def fail_last(msg):
+      if msg.seconds == 2:
+        raise ValueError('bad message')
+      return message_to_dict(msg)
+
+    self.mock(bqh, 'message_to_dict', fail_last)
+    with self.assertRaises(ValueError):
+      bqh.send_rows(client, 'd', 't', rows, batch_size=2)
+    # All the messages are converted before any is sent.
+    self.assertEqual([], client.calls)
+
+
+if __name__ == '__main__':
+  test_env.main()
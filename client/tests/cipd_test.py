@@ -0,0 +1,189 @@
+#!/usr/bin/env vpython3
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import os
+import stat
+import sys
+import tempfile
+import unittest
+
+# Mutates sys.path.
+import test_env
+
+# third_party/
+from depot_tools import auto_stub
+
+import cipd
+from utils import file_path
+from utils import fs
+
+
+def write_file(path, contents):
+  with fs.open(path, 'wb') as f:
+    f.write(contents)
+
+
+def read_file(path):
+  with fs.open(path, 'rb') as f:
+    return f.read()
+
+
+class CipdTest(auto_stub.TestCase):
+  def setUp(self):
+    super(CipdTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix='cipd_test')
+    self.cache_dir = os.path.join(self.tempdir, 'cipd_cache')
+    self.now = 1000.
+    self.mock(cipd.time, 'time', lambda: self.now)
+    self.resolved = []
+
+    def resolve_version(service_url, package_name, version, timeout=None):
+      self.assertEqual('https://cipd', service_url)
+      self.assertIsNone(timeout)
+      self.resolved.append((package_name, version))
+      return ('%x' % len(self.resolved)) * 40
+
+    self.mock(cipd, 'resolve_version', resolve_version)
+    self.mock(cipd, 'get_platform', lambda: 'linux-amd64')
+
+  def tearDown(self):
+    # Unmock first.
+    try:
+      super(CipdTest, self).tearDown()
+    finally:
+      file_path.rmtree(self.tempdir)
+
+  def _resolve(self, version):
+    return cipd.resolve_version_cached(self.cache_dir, 'https://cipd', 'pkg',
+                                       version)
+
+  def test_resolve_version_cached_instance_id(self):
+    self.assertEqual('f' * 40, self._resolve('f' * 40))
+    self.assertEqual([], self.resolved)
+
+  def test_resolve_version_cached_tag(self):
+    self.assertEqual('1' * 40, self._resolve('git:a'))
+    self.now += 24 * 60 * 60
+    self.assertEqual('1' * 40, self._resolve('git:a'))
+    self.assertEqual([('pkg', 'git:a')], self.resolved)
+
+  def test_resolve_version_cached_ref(self):
+    self.assertEqual('1' * 40, self._resolve('latest'))
+    self.assertEqual('2' * 40, self._resolve('canary'))
+    self.now += cipd._REF_TTL_SECS - 1
+    self.assertEqual('1' * 40, self._resolve('latest'))
+    self.now += 1
+    self.assertEqual('3' * 40, self._resolve('latest'))
+    self.assertEqual([
+        ('pkg', 'latest'),
+        ('pkg', 'canary'),
+        ('pkg', 'latest'),
+    ], self.resolved)
+
+  def test_deployed_cache_key(self):
+    cache = cipd.DeployedCache(self.cache_dir)
+    packages = {
+        '': [('infra/a/${platform}', 'latest')],
+        'bin': [('infra/b', 'c' * 40)],
+    }
+    key = cache.key('https://cipd', packages)
+    self.assertTrue(key)
+    self.assertEqual(key, cache.key('https://cipd', packages))
+    self.assertEqual([('infra/a/linux-amd64', 'latest')], self.resolved)
+    # The ref now resolves to another instance.
+    self.now += cipd._REF_TTL_SECS
+    self.assertNotEqual(key, cache.key('https://cipd', packages))
+    self.assertIsNone(
+        cache.key('https://cipd', {'': [('infra/a/${os}', 'latest')]}))
+
+  @unittest.skipIf(sys.platform == 'win32', 'needs symlinks')
+  def test_deployed_cache(self):
+    cache = cipd.DeployedCache(self.cache_dir, max_items=1)
+    site_root = os.path.join(self.tempdir, 'site1')
+    os.makedirs(os.path.join(site_root, '.cipd', 'pkgs', '0', 'abc', 'bin'))
+    write_file(
+        os.path.join(site_root, '.cipd', 'pkgs', '0', 'abc', 'bin', 'tool'),
+        b'tool')
+    fs.symlink('abc', os.path.join(site_root, '.cipd', 'pkgs', '0', '_current'))
+    os.mkdir(os.path.join(site_root, 'bin'))
+    fs.symlink(
+        os.path.join('..', '.cipd', 'pkgs', '0', '_current', 'bin', 'tool'),
+        os.path.join(site_root, 'bin', 'tool'))
+    pins = {'': [('infra/tool', 'a' * 40)]}
+    self.assertIsNone(cache.install('k1', site_root))
+    cache.add('k1', site_root, pins)
+
+    site_root2 = os.path.join(self.tempdir, 'site2')
+    os.mkdir(site_root2)
+    self.assertEqual(pins, cache.install('k1', site_root2))
+    self.assertEqual(b'tool', read_file(os.path.join(site_root2, 'bin',
+                                                     'tool')))
+    self.assertEqual(
+        os.path.join('..', '.cipd', 'pkgs', '0', '_current', 'bin', 'tool'),
+        fs.readlink(os.path.join(site_root2, 'bin', 'tool')))
+
+    # The run dir teardown makes the files writable, which affects the cache
+    # since they are hardlinked. Their mode is restored on install.
+    tool = os.path.join(site_root2, '.cipd', 'pkgs', '0', 'abc', 'bin', 'tool')
+    mode = stat.S_IMODE(fs.stat(tool).st_mode)
+    file_path.make_tree_deleteable(site_root2)
+    fs.chmod(tool, 0o777)
+    site_root3 = os.path.join(self.tempdir, 'site3')
+    self.assertEqual(pins, cache.install('k1', site_root3))
+    self.assertEqual(mode, stat.S_IMODE(fs.stat(tool).st_mode))
+
+    # Adding another entry evicts the first one.
+    cache.add('k2', site_root, pins)
+    self.assertEqual(['k2'], fs.listdir(cache.root))
+
+  @unittest.skipIf(sys.platform == 'win32', 'needs symlinks')
+  def test_deployed_cache_install_failure(self):
+    cache = cipd.DeployedCache(self.cache_dir)
+    site_root = os.path.join(self.tempdir, 'site')
+    os.makedirs(os.path.join(site_root, 'a'))
+    write_file(os.path.join(site_root, 'a', 'file1'), b'1')
+    write_file(os.path.join(site_root, 'file2'), b'2')
+    cache.add('k', site_root, {})
+
+    site_root2 = os.path.join(self.tempdir, 'site2')
+    os.mkdir(site_root2)
+    write_file(os.path.join(site_root2, 'existing'), b'e')
+    link_file = file_path.link_file
+    linked = []
+
+    def link_file_once(*args):
+      if linked:
+        raise OSError('disk full')
+      linked.append(args)
+      link_file(*args)
+
+    rmtree_orig = file_path.rmtree
+
+    def rmtree(path):
+      if path.startswith(cache.root):
+        raise OSError('access denied')
+      rmtree_orig(path)
+
+    self.mock(file_path, 'link_file', link_file_once)
+    self.mock(file_path, 'rmtree', rmtree)
+    self.assertIsNone(cache.install('k', site_root2))
+    self.assertEqual(1, len(linked))
+    # The partially linked files were removed, only the entry failed to be
+    # deleted.
+    self.assertEqual(['existing'], fs.listdir(site_root2))
+    self.assertEqual(['k'], fs.listdir(cache.root))
+
+  @unittest.skipIf(sys.platform == 'win32', 'needs symlinks')
+  def test_deployed_cache_symlink_outside(self):
+    cache = cipd.DeployedCache(self.cache_dir)
+    site_root = os.path.join(self.tempdir, 'site')
+    os.mkdir(site_root)
+    fs.symlink(self.tempdir, os.path.join(site_root, 'out'))
+    cache.add('k', site_root, {})
+    self.assertEqual([], fs.listdir(cache.root))
+
+
+if __name__ == '__main__':
+  test_env.main()
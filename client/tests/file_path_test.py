@@ -443,6 +443,56 @@ class FilePathTest(auto_stub.TestCase):
   def test_get_recursive_size(self):
     self._check_get_recursive_size()
 
+  def test_get_recursive_size_snapshot(self):
+    nested_dir = os.path.join(self.tempdir, 'dir1', 'dir2')
+    os.makedirs(nested_dir)
+    os.makedirs(os.path.join(self.tempdir, 'dir3'))
+    with open(os.path.join(self.tempdir, '1'), 'w') as f:
+      f.write('0')
+    with open(os.path.join(nested_dir, '2'), 'w') as f:
+      f.write('01')
+
+    # Directories modified just now are always listed again.
+    snapshot = {}
+    stats = {}
+    self.assertEqual(
+        3, file_path.get_recursive_size(self.tempdir, snapshot, stats))
+    self.assertEqual(4, stats['dirs_scanned'])
+    self.assertEqual(
+        3, file_path.get_recursive_size(self.tempdir, snapshot, stats))
+    self.assertEqual(4, stats['dirs_scanned'])
+
+    def age_dirs():
+      for root, dirs, _ in os.walk(self.tempdir):
+        for d in [root] + [os.path.join(root, d) for d in dirs]:
+          os.utime(d, (0, 0))
+
+    age_dirs()
+    self.assertEqual(
+        3, file_path.get_recursive_size(self.tempdir, snapshot, stats))
+    self.assertEqual(
+        ['', 'dir1', os.path.join('dir1', 'dir2'), 'dir3'], sorted(snapshot))
+    self.assertLessEqual(0, stats.pop('duration'))
+    expected = {
+        'dirs': 3,
+        'dirs_scanned': 4,
+        'files': 2,
+        'links': 0,
+        'others': 0,
+    }
+    self.assertEqual(expected, stats)
+
+    # Only the modified directory is listed again.
+    self.assertEqual(
+        3, file_path.get_recursive_size(self.tempdir, snapshot, stats))
+    self.assertEqual(0, stats['dirs_scanned'])
+    with open(os.path.join(nested_dir, '3'), 'w') as f:
+      f.write('012')
+    self.assertEqual(
+        6, file_path.get_recursive_size(self.tempdir, snapshot, stats))
+    self.assertEqual(1, stats['dirs_scanned'])
+    self.assertEqual(3, stats['files'])
+
   @unittest.skipUnless(sys.platform == 'win32', 'Windows specific')
   def test_get_recursive_size_win_junction(self):
     self._check_get_recursive_size(symlink='junction')
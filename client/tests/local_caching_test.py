@@ -24,6 +24,7 @@ import local_caching
 from utils import file_path
 from utils import fs
 from utils import lru
+from utils import trash
 
 
 def write_file(path, contents):
@@ -316,18 +317,21 @@ class DiskContentAddressedCacheTest(TestCase, ContentAddressedCacheTestMixin):
   def test_save_disk(self):
     cache = self.get_cache(_get_policies())
     self.assertEqual(
-        sorted([cache.STATE_FILE]), sorted(fs.listdir(cache.cache_dir)))
+        sorted([cache.JOURNAL_FILE, cache.STATE_FILE]),
+        sorted(fs.listdir(cache.cache_dir)))
 
     h = self._add_one_item(cache, 2)
     self.assertEqual(
-        sorted([h, cache.STATE_FILE]), sorted(fs.listdir(cache.cache_dir)))
-    items = lru.LRUDict.load(os.path.join(cache.cache_dir, cache.STATE_FILE))
+        sorted([h, cache.JOURNAL_FILE, cache.STATE_FILE]),
+        sorted(fs.listdir(cache.cache_dir)))
+    items = lru.LRUDict.load(os.path.join(cache.cache_dir, cache.JOURNAL_FILE))
     self.assertEqual(0, len(items))
 
     cache.save()
     self.assertEqual(
-        sorted([h, cache.STATE_FILE]), sorted(fs.listdir(cache.cache_dir)))
-    items = lru.LRUDict.load(os.path.join(cache.cache_dir, cache.STATE_FILE))
+        sorted([h, cache.JOURNAL_FILE, cache.STATE_FILE]),
+        sorted(fs.listdir(cache.cache_dir)))
+    items = lru.LRUDict.load(os.path.join(cache.cache_dir, cache.JOURNAL_FILE))
     self.assertEqual(1, len(items))
     self.assertEqual((h, [2, 1000]), items.get_oldest())
 
@@ -351,9 +355,11 @@ class DiskContentAddressedCacheTest(TestCase, ContentAddressedCacheTestMixin):
     # Still hasn't realized that the file is missing.
     self.assertEqual([h_foo], [i[0] for i in cache._lru._items.items()])
     self.assertEqual(
-        sorted([h_a, cache.STATE_FILE]), sorted(fs.listdir(cache.cache_dir)))
+        sorted([h_a, cache.JOURNAL_FILE, cache.STATE_FILE]),
+        sorted(fs.listdir(cache.cache_dir)))
     cache.cleanup()
-    self.assertEqual([cache.STATE_FILE], fs.listdir(cache.cache_dir))
+    self.assertCountEqual([cache.JOURNAL_FILE, cache.STATE_FILE],
+                          fs.listdir(cache.cache_dir))
 
   def test_cleanup_disk_evict_corrupted_files(self):
     self._free_disk = 1003
@@ -376,13 +382,13 @@ class DiskContentAddressedCacheTest(TestCase, ContentAddressedCacheTestMixin):
     self.mock(cache, '_get_mtime', _get_mtime)
     self.assertEqual([(h_a, (1, mtime_a)), (h_b, (1, mtime_b))],
                      list(cache._lru._items.items()))
-    self.assertCountEqual(([h_a, h_b, cache.STATE_FILE]),
+    self.assertCountEqual([h_a, h_b, cache.JOURNAL_FILE, cache.STATE_FILE],
                           (fs.listdir(cache.cache_dir)))
 
     # if the mtime is same with the timestamp in state.json,
     # the varification won't run.
     cache.cleanup()
-    self.assertCountEqual(([h_a, h_b, cache.STATE_FILE]),
+    self.assertCountEqual([h_a, h_b, cache.JOURNAL_FILE, cache.STATE_FILE],
                           (fs.listdir(cache.cache_dir)))
 
     # if the mtime is after the timestamp in the state.json
@@ -391,10 +397,78 @@ class DiskContentAddressedCacheTest(TestCase, ContentAddressedCacheTestMixin):
     mtime_b += 1
     self.mock(cache._lru, 'time_fn', lambda: mtime_b)
     cache.cleanup()
-    self.assertCountEqual(([h_b, cache.STATE_FILE]),
+    self.assertCountEqual([h_b, cache.JOURNAL_FILE, cache.STATE_FILE],
                           (fs.listdir(cache.cache_dir)))
     self.assertCountEqual([(h_b, (1, mtime_b))], cache._lru._items.items())
 
+  def test_verify_rehash(self):
+    cache = self.get_cache(_get_policies())
+    h_a = self._algo(b'a').hexdigest()
+    cache.write(h_a, [b'A'])
+    h_b = self._algo(b'b').hexdigest()
+    cache.write(h_b, [b'b'])
+    # Only modified files are hashed by default.
+    self.mock(cache, '_get_mtime', lambda _: 0)
+    self.assertTrue(cache.verify())
+    self.assertEqual([h_a, h_b], list(cache._lru))
+    self.assertTrue(cache.verify(rehash=True))
+    self.assertEqual([h_b], list(cache._lru))
+    self.assertCountEqual([h_b, cache.JOURNAL_FILE, cache.STATE_FILE],
+                          fs.listdir(cache.cache_dir))
+
+  def test_verify_resume(self):
+    self.mock(local_caching, '_VERIFY_CHECKPOINT_INTERVAL', 1)
+    cache = self.get_cache(_get_policies())
+    h_a = self._algo(b'a').hexdigest()
+    cache.write(h_a, [b'A'])
+    h_b = self._algo(b'b').hexdigest()
+    cache.write(h_b, [b'B'])
+    first, second = sorted([h_a, h_b])
+
+    # Each checkpoint takes 10 seconds.
+    def _is_valid_hash(digest, limiter):
+      self._now += 10
+      return old_is_valid_hash(digest, limiter)
+    old_is_valid_hash = self.mock(cache, '_is_valid_hash', _is_valid_hash)
+    self.assertFalse(cache.verify(rehash=True, max_duration=5))
+    # The first item was evicted, the second one wasn't verified yet.
+    self.assertEqual([second], list(cache._lru))
+    self.assertCountEqual(
+        [second, cache.JOURNAL_FILE, cache.STATE_FILE,
+         cache.VERIFY_STATE_FILE],
+        fs.listdir(cache.cache_dir))
+
+    # A new instance, e.g. after a bot restart, resumes after the checkpoint.
+    cache = self.get_cache(_get_policies())
+    verified = []
+    self.mock(
+        cache, '_is_valid_hash',
+        lambda digest, limiter: verified.append(digest) or False)
+    # cleanup() checks the modified files independently of the checkpoint.
+    self.mock(cache, '_get_mtime', lambda _: 0)
+    cache.cleanup()
+    self.assertEqual([], verified)
+    self.assertIn(cache.VERIFY_STATE_FILE, fs.listdir(cache.cache_dir))
+    self.assertTrue(cache.verify(rehash=True))
+    self.assertEqual([second], verified)
+    self.assertEqual([], list(cache._lru))
+    self.assertCountEqual([cache.JOURNAL_FILE, cache.STATE_FILE],
+                          fs.listdir(cache.cache_dir))
+
+  def test_bandwidth_limiter(self):
+    sleeps = []
+    def sleep(secs):
+      sleeps.append(secs)
+      self._now += secs
+    self.mock(time, 'sleep', sleep)
+    limiter = local_caching._BandwidthLimiter(100)
+    limiter.consume(50)
+    limiter.consume(100)
+    limiter.consume(100)
+    self.assertEqual([0.5, 1.0], sleeps)
+    local_caching._BandwidthLimiter(0).consume(1000)
+    self.assertEqual([0.5, 1.0], sleeps)
+
   def test_policies_active_trimming(self):
     # Start with a larger cache, add many object.
     # Reload the cache with smaller policies, the cache should be trimmed on
@@ -433,7 +507,7 @@ class DiskContentAddressedCacheTest(TestCase, ContentAddressedCacheTestMixin):
 
     # At this point, after the implicit trim in __exit__(), h_a and h_large were
     # evicted.
-    self.assertEqual(sorted([h_b, h_c, cache.STATE_FILE]),
+    self.assertEqual(sorted([h_b, h_c, cache.JOURNAL_FILE, cache.STATE_FILE]),
                      sorted(fs.listdir(cache.cache_dir)))
 
     # Allow 3 items and 101 bytes so h_large is kept.
@@ -448,7 +522,7 @@ class DiskContentAddressedCacheTest(TestCase, ContentAddressedCacheTestMixin):
     self.assertEqual([], cache.trim())
 
     self.assertEqual(
-        sorted([h_b, h_c, h_large, cache.STATE_FILE]),
+        sorted([h_b, h_c, h_large, cache.JOURNAL_FILE, cache.STATE_FILE]),
         sorted(fs.listdir(cache.cache_dir)))
 
     # Assert that trimming is done in constructor too.
@@ -502,6 +576,43 @@ class DiskContentAddressedCacheTest(TestCase, ContentAddressedCacheTestMixin):
     # 'touch' evicted the entry.
     self.assertEqual([], list(cache))
 
+  def test_state_readable_by_old_clients(self):
+    cache = self.get_cache(_get_policies())
+    h_a = self._add_one_item(cache, 1)
+    cache.save()
+    # The JSON state is rewritten when the journal is compacted, it lags behind
+    # the records appended to the journal since.
+    json_state = os.path.join(cache.cache_dir, cache.STATE_FILE)
+    self.assertEqual([h_a], list(lru.LRUDict.load(json_state)))
+    h_b = self._add_one_item(cache, 2)
+    cache.save()
+    self.assertEqual([h_a], list(lru.LRUDict.load(json_state)))
+
+    # An older client reads and writes only the JSON state.
+    old = lru.LRUDict.load(json_state)
+    old.pop(h_a)
+    old.add(h_b, 2)
+    self._now += 1
+    old.save(json_state)
+    os.utime(json_state, ns=(1, fs.stat(cache.journal_file).st_mtime_ns + 1))
+    cache = self.get_cache(_get_policies())
+    # The stale journal was ignored and replaced.
+    self.assertEqual([h_b], list(cache))
+    cache.save()
+    self.assertEqual([h_b], list(lru.LRUDict.load(cache.journal_file)))
+
+  def test_broken_journal(self):
+    cache = self.get_cache(_get_policies())
+    h_a = self._add_one_item(cache, 1)
+    cache.save()
+    with open(cache.journal_file, 'wb') as f:
+      f.write(b'LRUJ')
+    # The JSON state is used instead of wiping the cache.
+    cache = self.get_cache(_get_policies())
+    self.assertEqual([h_a], list(cache))
+    cache.save()
+    self.assertEqual([h_a], list(lru.LRUDict.load(cache.journal_file)))
+
   def test_invalid_state(self):
     file_path.ensure_tree(self.cache_dir())
     statefile = os.path.join(self.cache_dir(),
@@ -512,7 +623,8 @@ class DiskContentAddressedCacheTest(TestCase, ContentAddressedCacheTestMixin):
       f.write('invalid')
 
     _ = self.get_cache(_get_policies())
-    self.assertEqual(fs.listdir(self.cache_dir()), ['state.json'])
+    self.assertEqual(['state.journal', 'state.json'],
+                     sorted(fs.listdir(self.cache_dir())))
 
 
 class NamedCacheTest(TestCase, CacheTestMixin):
@@ -661,6 +773,39 @@ class NamedCacheTest(TestCase, CacheTestMixin):
                      fs.listdir(
                          os.path.join(cache.cache_dir, cache.NAMED_DIR, '1')))
 
+  def test_uninstall_incremental_size(self):
+    cache = local_caching.NamedCache(
+        self.cache_dir, _get_policies(), incremental_size=True)
+    dest_dir = os.path.join(self.tempdir, 'dest')
+    sub_dir = os.path.join(dest_dir, 'sub')
+    snapshot_path = os.path.join(cache.cache_dir, cache.SIZES_DIR, '1.json')
+
+    def cycle(expected_size, expected_scanned):
+      stats = {}
+      self.assertEqual(expected_size, cache.uninstall(dest_dir, '1', stats))
+      self.assertEqual(expected_scanned, stats['dirs_scanned'])
+      self.assertTrue(fs.isfile(snapshot_path))
+      cache.install(dest_dir, '1')
+
+    self.assertEqual(0, cache.install(dest_dir, '1'))
+    fs.mkdir(sub_dir)
+    write_file(os.path.join(sub_dir, 'x'), b'x')
+    # Directories modified just now are not reused.
+    cycle(1, 2)
+    os.utime(dest_dir, (0, 0))
+    os.utime(sub_dir, (0, 0))
+    cycle(1, 2)
+    cycle(1, 0)
+    write_file(os.path.join(sub_dir, 'y'), b'y')
+    cycle(2, 1)
+
+    # The snapshot is deleted along the cache.
+    self.assertEqual(2, cache.uninstall(dest_dir, '1'))
+    self.assertEqual(True, cache.cleanup())
+    self.assertTrue(fs.isfile(snapshot_path))
+    self.assertEqual(2, cache.remove_oldest_evictable_item())
+    self.assertFalse(fs.isfile(snapshot_path))
+
   def test_save_named(self):
     cache = self.get_cache(_get_policies())
     self.assertEqual([], sorted(fs.listdir(cache.cache_dir)))
@@ -910,10 +1055,17 @@ class FnTest(TestCase):
         self._algo(_gen_data(n)).hexdigest(): _gen_data(n)
         for n in items
     }
-    expected[cache.STATE_FILE] = _gen_state(
-        [[self._algo(_gen_data(n)).hexdigest(), [n, self._now + n - 1]]
-         for n in items])
-    self.assertEqual(expected, read_tree(cache.cache_dir))
+    actual = read_tree(cache.cache_dir)
+    # The state is in the binary journal format; compare its decoded items.
+    del actual[cache.STATE_FILE]
+    del actual[cache.JOURNAL_FILE]
+    self.assertEqual(expected, actual)
+    state = lru.LRUDict.load(os.path.join(cache.cache_dir, cache.JOURNAL_FILE))
+    self.assertEqual(
+        [(self._algo(_gen_data(n)).hexdigest(), n, self._now + n - 1)
+         for n in items],
+        [(k, v, ts) for (k, v), (_, ts) in zip(state.items(),
+                                                state.items_with_ts())])
 
   def _prepare_named_cache(self, cache):
     self._prepare_cache(cache)
@@ -1014,6 +1166,24 @@ class FnTest(TestCase):
     # sum(range(1, 15)) == 105, the first value after 100.
     self.assertEqual(list(range(1, 15)), trimmed)
 
+  def test_clean_caches_memory_trash(self):
+    # The trash is emptied before evicting any item.
+    caches = self._get_5_caches()
+    trash_dir = os.path.join(self.tempdir, 'trash')
+    old_dir = os.path.join(self.tempdir, 'old')
+    fs.mkdir(old_dir)
+    write_file(os.path.join(old_dir, 'x'), _gen_data(100))
+    self.assertTrue(trash.move(old_dir, trash_dir))
+    self._free_disk = 900
+    trimmed = local_caching.trim_caches(
+        caches,
+        self.tempdir,
+        min_free_space=1000,
+        max_age_secs=0,
+        trash_dir=trash_dir)
+    self.assertEqual([], trimmed)
+    self.assertEqual([], fs.listdir(trash_dir))
+
   def test_clean_caches_memory_time(self):
     # Test that cleaning is correctly distributed independent of the cache
     # location.
@@ -150,6 +150,43 @@ class LRUDictTest(unittest.TestCase):
     lru_dict.transform(lambda k, v: v + '*')
     self.assert_same_data([('ka', 'va*'), ('kb', 'vb*')], lru_dict)
 
+  def test_total_size(self):
+    lru_dict = lru.LRUDict(size_fn=len)
+    self.assertEqual(0, lru_dict.total_size)
+    lru_dict.add('ka', 'a')
+    lru_dict.add('kb', 'bb')
+    lru_dict.add('kc', 'ccc')
+    self.assertEqual(6, lru_dict.total_size)
+    # Replacing a value only accounts for the new one.
+    lru_dict.add('kb', 'bbbb')
+    self.assertEqual(8, lru_dict.total_size)
+    lru_dict.touch('ka')
+    self.assertEqual(8, lru_dict.total_size)
+    self.assertEqual('bbbb', lru_dict.pop('kb'))
+    self.assertEqual(4, lru_dict.total_size)
+    self.assertEqual('kc', lru_dict.pop_oldest()[0])
+    self.assertEqual(1, lru_dict.total_size)
+    lru_dict.transform(lambda k, v: v * 5)
+    self.assertEqual(5, lru_dict.total_size)
+
+  def test_total_size_without_size_fn(self):
+    lru_dict = _prepare_lru_dict([(1, 10), (2, 20)])
+    self.assertEqual(0, lru_dict.total_size)
+
+  def test_total_size_load(self):
+    handle, tmp_name = tempfile.mkstemp(prefix='lru_test')
+    os.close(handle)
+    try:
+      lru_dict = lru.LRUDict(size_fn=lambda v: v)
+      lru_dict.add('ka', 3)
+      lru_dict.add('kb', 4)
+      lru_dict.save(tmp_name)
+      loaded = lru.LRUDict.load(tmp_name, size_fn=lambda v: v)
+      self.assertEqual(7, loaded.total_size)
+      self.assertEqual(0, lru.LRUDict.load(tmp_name).total_size)
+    finally:
+      os.unlink(tmp_name)
+
   def test_load_save_empty(self):
     self.assertFalse(_save_and_load(lru.LRUDict()))
 
@@ -213,5 +250,136 @@ class LRUDictTest(unittest.TestCase):
       ]))
 
 
+class JournalTest(unittest.TestCase):
+  def setUp(self):
+    super(JournalTest, self).setUp()
+    handle, self.state_file = tempfile.mkstemp(prefix='lru_test')
+    os.close(handle)
+    self.now = 100
+
+  def tearDown(self):
+    try:
+      os.unlink(self.state_file)
+    finally:
+      super(JournalTest, self).tearDown()
+
+  def _new(self, **kwargs):
+    lru_dict = lru.LRUDict(journal=True, **kwargs)
+    lru_dict.time_fn = lambda: self.now
+    return lru_dict
+
+  def _load(self):
+    return lru.LRUDict.load(self.state_file, journal=True)
+
+  def test_save_load(self):
+    lru_dict = self._new()
+    lru_dict.add('aa' * 20, 1)
+    lru_dict.add('bb' * 20, None)
+    self.assertTrue(lru_dict.save(self.state_file))
+    with open(self.state_file, 'rb') as f:
+      self.assertTrue(f.read().startswith(b'LRUJ'))
+    loaded = self._load()
+    self.assertEqual([('aa' * 20, 1), ('bb' * 20, None)], list(loaded.items()))
+    self.assertEqual(
+        [('aa' * 20, 100), ('bb' * 20, 100)], list(loaded.items_with_ts()))
+    self.assertFalse(loaded.save(self.state_file))
+
+  def test_append(self):
+    lru_dict = self._new()
+    for i in range(4):
+      lru_dict.add('%02x' % i * 20, i)
+    lru_dict.save(self.state_file)
+    size = os.path.getsize(self.state_file)
+    record_size = (size - 6) // 4
+
+    lru_dict = self._load()
+    lru_dict.time_fn = lambda: 200
+    lru_dict.touch('00' * 20)
+    lru_dict.pop('02' * 20)
+    lru_dict.add('01' * 20, 10)
+    lru_dict.pop_oldest()
+    self.assertTrue(lru_dict.save(self.state_file))
+    # Only the 4 operations are appended.
+    self.assertEqual(
+        size + 4 * record_size, os.path.getsize(self.state_file))
+    loaded = self._load()
+    self.assertEqual(
+        [('00' * 20, 0), ('01' * 20, 10)], list(loaded.items()))
+    self.assertEqual(
+        [('00' * 20, 200), ('01' * 20, 200)], list(loaded.items_with_ts()))
+
+  def test_compact(self):
+    old_compact_min = lru._COMPACT_MIN_RECORDS
+    lru._COMPACT_MIN_RECORDS = 0
+    try:
+      lru_dict = self._new()
+      lru_dict.add('aa' * 20, 1)
+      lru_dict.save(self.state_file)
+      size = os.path.getsize(self.state_file)
+      for _ in range(3):
+        lru_dict.touch('aa' * 20)
+        lru_dict.save(self.state_file)
+      # The journal never grows past 2 records per item.
+      self.assertLessEqual(
+          os.path.getsize(self.state_file), size + 2 * (size - 6))
+      self.assertEqual([('aa' * 20, 1)], list(self._load().items()))
+    finally:
+      lru._COMPACT_MIN_RECORDS = old_compact_min
+
+  def test_migrate_json(self):
+    lru_dict = lru.LRUDict()
+    lru_dict.time_fn = lambda: self.now
+    lru_dict.add('aa' * 20, 1)
+    lru_dict.save(self.state_file)
+    loaded = self._load()
+    self.assertTrue(loaded.save(self.state_file))
+    with open(self.state_file, 'rb') as f:
+      self.assertTrue(f.read().startswith(b'LRUJ'))
+    self.assertEqual([('aa' * 20, 1)], list(self._load().items()))
+
+  def test_fallback_json(self):
+    lru_dict = self._new()
+    lru_dict.add('aa' * 20, 1)
+    lru_dict.save(self.state_file)
+    lru_dict.add('not a digest', 'value')
+    lru_dict.save(self.state_file)
+    with open(self.state_file, 'r') as f:
+      self.assertEqual(lru.CURRENT_VERSION, json.load(f)['version'])
+    self.assertEqual(
+        [('aa' * 20, 1), ('not a digest', 'value')],
+        list(self._load().items()))
+
+  def test_json_copy(self):
+    json_file = self.state_file + '.json'
+    self.addCleanup(os.remove, json_file)
+    lru_dict = self._new()
+    lru_dict.add('aa' * 20, 1)
+    lru_dict.save(self.state_file, json_file=json_file)
+    self.assertEqual(
+        [('aa' * 20, 1)], list(lru.LRUDict.load(json_file).items()))
+    # Appended records don't rewrite the JSON copy.
+    lru_dict.add('bb' * 20, 2)
+    lru_dict.save(self.state_file, json_file=json_file)
+    self.assertEqual(
+        [('aa' * 20, 1)], list(lru.LRUDict.load(json_file).items()))
+    self.assertEqual(
+        [('aa' * 20, 1), ('bb' * 20, 2)], list(self._load().items()))
+
+  def test_truncated_record(self):
+    lru_dict = self._new()
+    lru_dict.add('aa' * 20, 1)
+    lru_dict.add('bb' * 20, 2)
+    lru_dict.save(self.state_file)
+    with open(self.state_file, 'rb+') as f:
+      f.truncate(os.path.getsize(self.state_file) - 1)
+    loaded = self._load()
+    self.assertEqual([('aa' * 20, 1)], list(loaded.items()))
+    # The next save rewrites the file instead of appending after garbage.
+    loaded.add('cc' * 20, 3)
+    loaded.save(self.state_file)
+    self.assertEqual(
+        [('aa' * 20, 1), ('cc' * 20, 3)], list(self._load().items()))
+
+
 if __name__ == '__main__':
   test_env.main()
@@ -133,6 +133,9 @@ class RunIsolatedTest(unittest.TestCase):
     super(RunIsolatedTest, self).setUp()
     self.tempdir = run_isolated.make_temp_dir('run_isolated_smoke_test',
                                               test_env.CLIENT_DIR)
+    # Registered before anything can fail in setUp(), tearDown() is not called
+    # then.
+    self.addCleanup(file_path.rmtree, self.tempdir)
     logging.debug(self.tempdir)
     self._root_dir = os.path.join(self.tempdir, 'w')
     # The run_isolated local cache.
@@ -150,7 +153,6 @@ class RunIsolatedTest(unittest.TestCase):
   def tearDown(self):
     try:
       self._fakecas.stop()
-      file_path.rmtree(self.tempdir)
     finally:
       super(RunIsolatedTest, self).tearDown()
 
@@ -8,6 +8,7 @@ from __future__ import unicode_literals
 
 import base64
 import contextlib
+import errno
 import functools
 import json
 import logging
@@ -346,7 +347,8 @@ class RunIsolatedTest(RunIsolatedTestBase):
         env_prefix={},
         lower_priority=lower_priority,
         containment=None,
-        trim_caches_fn=trim_caches_stub)
+        trim_caches_fn=trim_caches_stub,
+        trash_dir=None)
     ret = run_isolated.run_tha_test(data, None)
     self.assertEqual(0, ret)
     return make_tree_call
@@ -607,6 +609,71 @@ class RunIsolatedTest(RunIsolatedTestBase):
         echo_cmd[0])
     self.assertEqual(echo_cmd[1:], ['hello', 'world'])
 
+  def test_main_naked_with_packages_reuse_deployed(self):
+    self.mock(cipd, 'get_platform', lambda: 'linux-amd64')
+
+    suffix = '.exe' if sys.platform == 'win32' else ''
+    ensured = []
+
+    def fake_ensure(args, **kwargs):
+      if (args[0].endswith(os.path.join('bin', 'cipd' + suffix)) and
+          args[1] == 'ensure' and '-json-output' in args):
+        site_root = args[args.index('-root') + 1]
+        ensure_file = args[args.index('-ensure-file') + 1]
+        with open(ensure_file) as f:
+          lines = [l.split() for l in f.read().splitlines()]
+        pkgs = [l for l in lines if l[0] != '@Subdir']
+        ensured.append(pkgs[0][0])
+        with open(os.path.join(site_root, pkgs[0][0].replace('/', '_')),
+                  'w') as f:
+          f.write('deployed')
+        with open(args[args.index('-json-output') + 1], 'w') as json_out:
+          json.dump(
+              {
+                  'result': {
+                      '': [{
+                          'package': pkg,
+                          'instance_id': 'a' * 40
+                      } for pkg, _ in pkgs]
+                  }
+              }, json_out)
+        return 0
+      self.fail('unexpected: %s, %s' % (args, kwargs))
+      return 1
+
+    self.popen_fakes.append(fake_ensure)
+    cipd_cache = os.path.join(self.tempdir, 'cipd_cache')
+
+    def install(name):
+      run_dir = os.path.join(self.tempdir, name, 'ir')
+      cas_dir = os.path.join(self.tempdir, name, 'cc')
+      os.makedirs(run_dir)
+      os.makedirs(cas_dir)
+      with run_isolated.install_client_and_packages(
+          run_dir, [('.', 'infra/data/x', 'latest')],
+          self.cipd_server.url,
+          'infra/tools/cipd/${platform}',
+          'git:wowza',
+          cipd_cache,
+          cas_dir,
+          reuse_deployed=True) as info:
+        self.assertEqual([{
+            'package_name': 'infra/data/x',
+            'path': '.',
+            'version': 'a' * 40,
+        }], info.pins['packages'])
+      with open(os.path.join(run_dir, 'infra_data_x')) as f:
+        self.assertEqual('deployed', f.read())
+
+    install('task1')
+    self.assertEqual(
+        ['infra/data/x', 'infra/tools/luci/cas/${platform}'], ensured)
+    # The second task with the same packages doesn't run 'cipd ensure'.
+    install('task2')
+    self.assertEqual(
+        ['infra/data/x', 'infra/tools/luci/cas/${platform}'], ensured)
+    self.assertEqual(2, len(fs.listdir(os.path.join(cipd_cache, 'deployed'))))
+
   def test_main_naked_with_invalid_cas_input(self):
     def dump_bad_digest_json(cmd, _):
       json_path = cmd[cmd.index('-dump-json') + 1]
@@ -826,8 +893,9 @@ class RunIsolatedTest(RunIsolatedTestBase):
     # for it to be kept, we need the tool to write to it. This is tested in the
     # smoke test.
     trimmed = []
-    def trim_caches(caches, root, min_free_space, max_age_secs):
+    def trim_caches(caches, root, min_free_space, max_age_secs, trash_dir):
       trimmed.append(True)
+      self.assertIsNone(trash_dir)
       self.assertEqual(2, len(caches))
       self.assertTrue(root)
       # The name cache root is increased by the sum of the two hints and buffer.
@@ -896,9 +964,11 @@ class RunIsolatedTest(RunIsolatedTestBase):
         kvs_dir,
     ]
 
-    def trim_caches_mock(caches, _root_dir, min_free_space, max_age_secs):
+    def trim_caches_mock(caches, _root_dir, min_free_space, max_age_secs,
+                         trash_dir):
       self.assertEqual(min_free_space, min_free_space)
       self.assertEqual(max_age_secs, run_isolated.MAX_AGE_SECS)
+      self.assertIsNone(trash_dir)
 
       # CAS cache.
       cas_cache = caches[0]
@@ -929,6 +999,37 @@ class RunIsolatedTest(RunIsolatedTestBase):
       # kvs dir should be removed.
       fs.stat(kvs_dir)
 
+  def test_main_clean_rehash(self):
+    cas_cache_dir = os.path.join(self.tempdir, 'cas_cache')
+    verified = []
+
+    def verify(cache, **kwargs):
+      self.assertEqual(cas_cache_dir, cache.cache_dir)
+      verified.append(kwargs)
+      return False
+
+    self.mock(local_caching.DiskContentAddressedCache, 'verify', verify)
+    cmd = [
+        '--no-log',
+        '--clean',
+        '--cas-cache',
+        cas_cache_dir,
+        '--rehash-max-duration',
+        '10',
+        '--rehash-max-bytes-per-sec',
+        '1000',
+    ]
+    self.assertEqual(0, run_isolated.main(cmd))
+    # The first call is from cleanup().
+    self.assertEqual([
+        {},
+        {
+            'rehash': True,
+            'max_bytes_per_sec': 1000,
+            'max_duration': 10.
+        },
+    ], verified)
+
   def test_modified_cwd(self):
     self._run_tha_test(command=['../out/some.exe', 'arg'], relative_cwd='some')
     self.assertEqual([
@@ -1048,7 +1149,8 @@ class RunIsolatedTestRun(RunIsolatedTestBase):
         env_prefix={},
         lower_priority=False,
         containment=None,
-        trim_caches_fn=trim_caches_stub)
+        trim_caches_fn=trim_caches_stub,
+        trash_dir=None)
 
     result_json = os.path.join(self.tempdir, 'result.json')
     ret = run_isolated.run_tha_test(data, result_json)
@@ -1096,7 +1198,8 @@ with open(outpath, "w") as f:
         env_prefix={},
         lower_priority=False,
         containment=None,
-        trim_caches_fn=trim_caches_stub)
+        trim_caches_fn=trim_caches_stub,
+        trash_dir=None)
 
     result_json = os.path.join(self.tempdir, 'result.json')
     ret = run_isolated.run_tha_test(data, result_json)
@@ -1137,7 +1240,8 @@ class RunIsolatedTestCase(RunIsolatedTestRun):
         env_prefix={},
         lower_priority=False,
         containment=None,
-        trim_caches_fn=trim_caches_stub)
+        trim_caches_fn=trim_caches_stub,
+        trash_dir=None)
 
     result_json = os.path.join(self.tempdir, 'result.json')
     run_isolated.run_tha_test(data, result_json)
@@ -1171,7 +1275,8 @@ class RunIsolatedTestCase(RunIsolatedTestRun):
         env_prefix={},
         lower_priority=False,
         containment=None,
-        trim_caches_fn=trim_caches_stub)
+        trim_caches_fn=trim_caches_stub,
+        trash_dir=None)
 
     result_json = os.path.join(self.tempdir, 'result.json')
     ret = run_isolated.run_tha_test(data, result_json)
@@ -1207,7 +1312,8 @@ class RunIsolatedTestCase(RunIsolatedTestRun):
         env_prefix={},
         lower_priority=False,
         containment=None,
-        trim_caches_fn=trim_caches_stub)
+        trim_caches_fn=trim_caches_stub,
+        trash_dir=None)
 
     result_json = os.path.join(self.tempdir, 'result.json')
     ret = run_isolated.run_tha_test(data, result_json)
@@ -1250,7 +1356,7 @@ class RunIsolatedTestOutputs(RunIsolatedTestBase):
     fs.mkdir(run_dir)
     fs.mkdir(out_dir)
     self.create_src_tree(run_dir, src_dir)
-    run_isolated.link_outputs_to_outdir(run_dir, out_dir, outputs)
+    return run_isolated.link_outputs_to_outdir(run_dir, out_dir, outputs)
 
   def test_file(self):
     src_dir = {
@@ -1467,6 +1573,55 @@ class RunIsolatedTestOutputs(RunIsolatedTestBase):
     self.link_outputs_test(src_dir, outputs)
     self.assertExpectedTree(expected)
 
+  def test_nested_dirs_stats(self):
+    src_dir = {
+        'a': (DIR, {
+            'b': (DIR, {
+                'c': (DIR, {
+                    'child_c': (FILE, 'ccc'),
+                }),
+                'child_b': (FILE, 'bb'),
+                'link_c': (RELATIVE_LINK, 'c'),
+            }),
+            'child_a': (FILE, 'a'),
+        }),
+    }
+    outputs = ['a']
+    expected = {
+        os.path.join('a', 'child_a'): 'a',
+        os.path.join('a', 'b', 'child_b'): 'bb',
+        os.path.join('a', 'b', 'c', 'child_c'): 'ccc',
+        os.path.join('a', 'b', 'link_c', 'child_c'): 'ccc',
+    }
+    stats = self.link_outputs_test(src_dir, outputs)
+    self.assertExpectedTree(expected)
+    self.assertEqual(4, stats['files_linked'])
+    self.assertEqual(9, stats['bytes_linked'])
+    self.assertEqual(0, stats['files_copied'])
+    self.assertEqual(0, stats['bytes_copied'])
+
+  def test_copy_fallback_stats(self):
+    def hardlink(_source, _link_name):
+      raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    self.mock(file_path, 'hardlink', hardlink)
+    src_dir = {
+        'subdir': (DIR, {
+            'child_a': (FILE, 'contents of a'),
+        }),
+        'foo_file': (FILE, 'contents of foo'),
+    }
+    outputs = ['subdir', 'foo_file']
+    expected = {
+        os.path.join('subdir', 'child_a'): 'contents of a',
+        'foo_file': 'contents of foo',
+    }
+    stats = self.link_outputs_test(src_dir, outputs)
+    self.assertExpectedTree(expected)
+    self.assertEqual(0, stats['files_linked'])
+    self.assertEqual(2, stats['files_copied'])
+    self.assertEqual(28, stats['bytes_copied'])
+
 
 class RunIsolatedTestOutputFiles(RunIsolatedTestBase):
 
@@ -1534,7 +1689,8 @@ class RunIsolatedTestOutputFiles(RunIsolatedTestBase):
         env_prefix={},
         lower_priority=False,
         containment=None,
-        trim_caches_fn=trim_caches_stub)
+        trim_caches_fn=trim_caches_stub,
+        trash_dir=None)
     result_json = os.path.join(self.tempdir, 'result.json')
     ret = run_isolated.run_tha_test(data, result_json)
     self.assertEqual(0, ret)
@@ -1647,6 +1803,22 @@ class RunIsolatedJsonTest(RunIsolatedTestBase):
     self.assertLessEqual(0, named_caches_stats['install'].pop('duration'))
     self.assertLessEqual(0, named_caches_stats['uninstall'].pop('duration'))
     self.assertLessEqual(0, actual['stats']['cleanup'].pop('duration'))
+    phases = actual['stats'].pop('phases')
+    self.assertEqual([
+        'run_isolated',
+        'trim_caches',
+        'named_caches_install',
+        'command',
+        'named_caches_uninstall',
+        'link_outputs',
+        'upload',
+        'cleanup',
+    ], [p['name'] for p in phases])
+    self.assertEqual([0, 1, 1, 1, 1, 1, 1, 1], [p['depth'] for p in phases])
+    trace = tools.read_json(run_isolated.get_trace_json_path(out))
+    self.assertEqual(
+        sorted(p['name'] for p in phases),
+        sorted(e['name'] for e in trace['traceEvents']))
     for i in ('items_cold', 'items_hot'):
       if actual_upload_stats[i]:
         actual_upload_stats[i] = large.unpack(
@@ -131,5 +131,72 @@ class FindExecutableTest(auto_stub.TestCase):
     self.assertEqual([os.path.join('.', 'not_real')], self._fe(['./not_real']))
 
 
+class PhaseTimerTest(auto_stub.TestCase):
+
+  def setUp(self):
+    super(PhaseTimerTest, self).setUp()
+    self.now = 100.
+    self.mock(tools.time, 'time', lambda: self.now)
+
+  def test_spans(self):
+    with tools.PhaseTimer() as timer:
+      with tools.phase('task'):
+        self.now += 1
+        with tools.phase('download', files=2) as span:
+          self.now += 2
+          span.args['bytes'] = 10
+        with tools.phase('run'):
+          self.now += 3
+    # Not recorded once the timer is done.
+    with tools.phase('cleanup'):
+      pass
+
+    expected = [
+        {
+            'name': 'task',
+            'start': 0.,
+            'duration': 6.,
+            'depth': 0,
+            'args': {},
+        },
+        {
+            'name': 'download',
+            'start': 1.,
+            'duration': 2.,
+            'depth': 1,
+            'args': {
+                'bytes': 10,
+                'files': 2
+            },
+        },
+        {
+            'name': 'run',
+            'start': 3.,
+            'duration': 3.,
+            'depth': 1,
+            'args': {},
+        },
+    ]
+    self.assertEqual(expected, timer.spans())
+
+    events = timer.trace_events()['traceEvents']
+    self.assertEqual(['download', 'run', 'task'], [e['name'] for e in events])
+    self.assertEqual('X', events[0]['ph'])
+    self.assertEqual(101000000, events[0]['ts'])
+    self.assertEqual(2000000, events[0]['dur'])
+    self.assertEqual({'bytes': 10, 'files': 2}, events[0]['args'])
+
+  def test_exception(self):
+    with tools.PhaseTimer() as timer:
+      with self.assertRaises(ValueError):
+        with tools.phase('fail'):
+          self.now += 1
+          raise ValueError()
+      with tools.phase('next'):
+        pass
+    self.assertEqual([('fail', 0), ('next', 0)],
+                     [(s['name'], s['depth']) for s in timer.spans()])
+
+
 if __name__ == '__main__':
   test_env.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env vpython3
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import os
+import tempfile
+import unittest
+
+# Mutates sys.path.
+import test_env
+
+# third_party/
+from depot_tools import auto_stub
+
+from utils import file_path
+from utils import fs
+from utils import trash
+
+
+def write_file(path, contents):
+  with fs.open(path, 'wb') as f:
+    f.write(contents)
+
+
+class TrashTest(auto_stub.TestCase):
+  def setUp(self):
+    super(TrashTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix='trash_test')
+    self.trash_dir = os.path.join(self.tempdir, 'trash')
+
+  def tearDown(self):
+    # Unmock first.
+    try:
+      super(TrashTest, self).tearDown()
+    finally:
+      file_path.rmtree(self.tempdir)
+
+  def _make_dir(self, name):
+    p = os.path.join(self.tempdir, name)
+    fs.mkdir(p)
+    write_file(os.path.join(p, 'a'), b'a')
+    return p
+
+  def test_move(self):
+    a = self._make_dir('a')
+    b = self._make_dir('b')
+    self.assertTrue(trash.move(a, self.trash_dir))
+    self.assertTrue(trash.move(b, self.trash_dir))
+    self.assertFalse(fs.exists(a))
+    self.assertFalse(fs.exists(b))
+    items = fs.listdir(self.trash_dir)
+    self.assertEqual(2, len(items))
+    self.assertEqual(
+        [['a'], ['a']],
+        [fs.listdir(os.path.join(self.trash_dir, i)) for i in items])
+
+  def test_move_concurrent_empty(self):
+    # The trash is emptied concurrently, e.g. by the worker thread.
+    rename = fs.rename
+
+    def rename_after_empty(src, dst):
+      trash.empty(self.trash_dir)
+      rename(src, dst)
+
+    self.mock(fs, 'rename', rename_after_empty)
+    trash.move(self._make_dir('b'), self.trash_dir)
+    a = self._make_dir('a')
+    self.assertTrue(trash.move(a, self.trash_dir))
+    self.assertFalse(fs.exists(a))
+    self.assertEqual(1, len(fs.listdir(self.trash_dir)))
+
+  def test_move_fallback(self):
+    # e.g. the trash is on another volume.
+    def rename(_src, _dst):
+      raise OSError('Invalid cross-device link')
+
+    self.mock(fs, 'rename', rename)
+    a = self._make_dir('a')
+    self.assertFalse(trash.move(a, self.trash_dir))
+    self.assertFalse(fs.exists(a))
+    self.assertEqual([], fs.listdir(self.trash_dir))
+
+  def test_empty(self):
+    self.assertEqual(0, trash.empty(self.trash_dir))
+    trash.move(self._make_dir('a'), self.trash_dir)
+    trash.move(self._make_dir('b'), self.trash_dir)
+    write_file(os.path.join(self.trash_dir, 'file'), b'f')
+    self.assertEqual(3, trash.empty(self.trash_dir))
+    self.assertEqual([], fs.listdir(self.trash_dir))
+
+  def test_empty_failure(self):
+    trash.move(self._make_dir('a'), self.trash_dir)
+
+    def rmtree(_path):
+      raise OSError('Access denied')
+
+    self.mock(file_path, 'rmtree', rmtree)
+    self.assertEqual(0, trash.empty(self.trash_dir))
+    self.assertEqual(1, len(fs.listdir(self.trash_dir)))
+
+
+if __name__ == '__main__':
+  test_env.main()
@@ -29,6 +29,9 @@ def message_to_dict(msg):
   https://godoc.org/go.chromium.org/luci/tools/cmd/bqschemaupdater
   Also omits Nones and empty lists values.
 
+  The conversion code is derived once per message type from its descriptor,
+  see _get_converter().
+
   Args:
     msg: an instance of google.protobuf.message.Message.
 
@@ -36,60 +39,112 @@ def message_to_dict(msg):
     A dict with BQ-compatible fields. If there are no BQ-compatible fields,
     returns None.
   """
-  row = {}
-  for f in msg.DESCRIPTOR.fields:
-    if f.message_type:
-      if _is_empty_message_type(f.message_type):
-        # Omit message fields that would result in RECORD fields with no fields.
+  return _get_converter(msg.DESCRIPTOR)(msg)
+
+
+# Message full name => function(msg) -> dict or None.
+_CONVERTERS = {}
+_CONVERTERS_LOCK = threading.Lock()
+
+
+def _get_converter(desc):
+  """Returns the function converting messages of this type to a dict."""
+  conv = _CONVERTERS.get(desc.full_name)
+  if conv is None:
+    conv = _compile_converter(desc)
+    with _CONVERTERS_LOCK:
+      conv = _CONVERTERS.setdefault(desc.full_name, conv)
+  return conv
+
+
+def _compile_converter(desc):
+  """Returns a function(msg) implementing message_to_dict() for desc."""
+  # List of (name, is_repeated, is_message, function(value) -> BQ value).
+  fields = []
+  for f in desc.fields:
+    if f.message_type and _is_empty_message_type(f.message_type):
+      # Omit message fields that would result in RECORD fields with no fields.
+      continue
+    is_repeated = f.label == f.LABEL_REPEATED
+    if is_repeated and f.message_type and f.message_type.GetOptions().map_entry:
+      conv = _compile_map_converter(f.message_type)
+    elif is_repeated:
+      conv = _compile_repeated_converter(_compile_value_converter(f))
+    else:
+      conv = _compile_value_converter(f)
+    fields.append((f.name, is_repeated, bool(f.message_type), conv))
+
+  def convert(msg):
+    row = {}
+    for name, is_repeated, is_message, conv in fields:
+      if is_repeated:
+        val = getattr(msg, name)
+        if val:  # Omit empty arrays.
+          row[name] = conv(val)
         continue
-      if f.label != f.LABEL_REPEATED and not msg.HasField(f.name):
+      if is_message and not msg.HasField(name):
         # Omit non-repeated message fields that we don't have.
         continue
-
-    val = getattr(msg, f.name)
-    if f.label == f.LABEL_REPEATED:
-      if val:  # Omit empty arrays.
-        if hasattr(val, 'items'):  # it's a map<K, V>
-          # Get the synthesized key/value message type
-          synthDESC = f.message_type
-          row[f.name] = [
-            {
-              'key': _to_bq_value(key, synthDESC.fields_by_name['key']),
-              'value': _to_bq_value(value, synthDESC.fields_by_name['value']),
-            }
-            for key, value in sorted(val.items())
-          ]
-        else:
-          row[f.name] = [_to_bq_value(elem, f) for elem in val]
-    else:
-      bq_value = _to_bq_value(val, f)
+      bq_value = conv(getattr(msg, name))
       if bq_value is not None:  # Omit NULL values.
-        row[f.name] = bq_value
-  return row or None  # return None if there are no fields.
+        row[name] = bq_value
+    return row or None  # return None if there are no fields.
+  return convert
+
+
+def _compile_repeated_converter(elem_conv):
+  """Returns a function converting all the elements of a repeated field."""
+  return lambda val: [elem_conv(elem) for elem in val]
+
+
+def _compile_map_converter(entry_desc):
+  """Returns a function converting a map<K, V> to a list of key/value dicts."""
+  key_conv = _compile_value_converter(entry_desc.fields_by_name['key'])
+  value_conv = _compile_value_converter(entry_desc.fields_by_name['value'])
 
+  def convert(val):
+    return [
+      {
+        'key': key_conv(key),
+        'value': value_conv(value),
+      }
+      for key, value in sorted(val.items())
+    ]
+  return convert
 
-def _to_bq_value(value, field_desc):
+
+def _compile_value_converter(field_desc):
+  """Returns a function converting a single value of field_desc."""
   if field_desc.enum_type:
-    # Enums are stored as strings.
-    enum_val = field_desc.enum_type.values_by_number.get(value)
-    if not enum_val:
-      raise ValueError('Invalid value %r for enum type %s' % (
-          value, field_desc.enum_type.full_name))
-    return enum_val.name
-  if isinstance(value, duration_pb2.Duration):
-    return value.ToTimedelta().total_seconds()
-  if isinstance(value, struct_pb2.Struct):
+    names = {v.number: v.name for v in field_desc.enum_type.values}
+    full_name = field_desc.enum_type.full_name
+
+    def convert_enum(value):
+      # Enums are stored as strings.
+      name = names.get(value)
+      if name is None:
+        raise ValueError('Invalid value %r for enum type %s' % (
+            value, full_name))
+      return name
+    return convert_enum
+  if not field_desc.message_type:
+    return lambda value: value
+  name = field_desc.message_type.full_name
+  if name == duration_pb2.Duration.DESCRIPTOR.full_name:
+    return lambda value: value.ToTimedelta().total_seconds()
+  if name == struct_pb2.Struct.DESCRIPTOR.full_name:
     # Structs are stored as JSONPB strings,
     # see https://bit.ly/chromium-bq-struct
-    return json_format.MessageToJson(value)
-  if isinstance(value, timestamp_pb2.Timestamp):
-    return value.ToDatetime().isoformat()
-  if isinstance(value, message_pb.Message):
-    return message_to_dict(value)
-  return value
+    return json_format.MessageToJson
+  if name == timestamp_pb2.Timestamp.DESCRIPTOR.full_name:
+    return lambda value: value.ToDatetime().isoformat()
+  # Looked up on each call rather than compiled here, message types can be
+  # recursive.
+  return message_to_dict
 
 
-def send_rows(bq_client, dataset_id, table_id, rows, batch_size=_BATCH_DEFAULT):
+def send_rows(bq_client, dataset_id, table_id, rows, batch_size=_BATCH_DEFAULT,
+              max_in_flight=1, retries=0):
   """Sends rows to BigQuery.
 
   Args:
@@ -104,6 +159,14 @@ def send_rows(bq_client, dataset_id, table_id, rows, batch_size=_BATCH_DEFAULT):
     batch_size (int): the max number of rows to send to BigQuery in a single
       request. Values exceeding the limit will use the limit. Values less than 1
       will use _BATCH_DEFAULT.
+    max_in_flight (int): the max number of concurrent insert requests.
+    retries (int): how many times the rows reported as failed by BigQuery are
+      sent again. Only these rows are sent again, not their whole batch.
+
+  Raises:
+    BigQueryInsertError once no more requests are in flight if some rows still
+    failed. Its row indexes are relative to rows. Batches that were not sent
+    yet are not sent.
 
   Please use google.protobuf.message.Message instances moving forward.
   Tuples are deprecated.
@@ -112,28 +175,122 @@ def send_rows(bq_client, dataset_id, table_id, rows, batch_size=_BATCH_DEFAULT):
     batch_size = _BATCH_LIMIT
   elif batch_size <= 0:
     batch_size = _BATCH_DEFAULT
+  max_in_flight = max(1, max_in_flight)
 
-  rows_to_send = []
+  rows = list(rows)
   for row in rows:
-    if isinstance(row, tuple):
-      rows_to_send.append(row)
-      continue
-    if isinstance(row, message_pb.Message):
-      rows_to_send.append(message_to_dict(row))
-    else:
+    if not isinstance(row, (tuple, message_pb.Message)):
       raise UnsupportedTypeError(type(row).__name__)
+  # Convert all the rows before sending any, so a conversion error doesn't
+  # leave some of them inserted.
+  rows = [
+      message_to_dict(row) if isinstance(row, message_pb.Message) else row
+      for row in rows
+  ]
 
   table = bq_client.get_table(bq_client.dataset(dataset_id).table(table_id))
-  for row_set in _batch(rows_to_send, batch_size):
-    insert_errors = bq_client.create_rows(table, row_set)
-    if insert_errors:
-      logging.error('Failed to send event to bigquery: %s', insert_errors)
-      raise BigQueryInsertError(insert_errors)
+  sender = _Sender(bq_client, table, max_in_flight, retries)
+  try:
+    for offset, row_set in _batch(rows, batch_size):
+      if sender.failed() or not sender.send(offset, row_set):
+        break
+  finally:
+    insert_errors = sender.wait()
+  if insert_errors:
+    logging.error('Failed to send event to bigquery: %s', insert_errors)
+    raise BigQueryInsertError(insert_errors)
 
 
 def _batch(rows, batch_size):
   for i in range(0, len(rows), batch_size):
-    yield rows[i:i + batch_size]
+    yield i, rows[i:i + batch_size]
+
+
+class _Sender(object):
+  """Sends batches of rows with a bounded number of concurrent requests."""
+
+  def __init__(self, bq_client, table, max_in_flight, retries):
+    self._bq_client = bq_client
+    self._table = table
+    self._retries = retries
+    self._slots = threading.BoundedSemaphore(max_in_flight)
+    self._lock = threading.Lock()
+    self._threads = []
+    # Insert errors with indexes relative to all the rows.
+    self._insert_errors = []
+    # First exception raised by create_rows().
+    self._exc = None
+
+  def failed(self):
+    with self._lock:
+      return bool(self._insert_errors or self._exc)
+
+  def send(self, offset, row_set):
+    """Sends the rows starting at offset in a new thread.
+
+    Returns False without sending them if a previous request failed while
+    waiting for a slot.
+    """
+    self._slots.acquire()
+    if self.failed():
+      self._slots.release()
+      return False
+    t = threading.Thread(target=self._run, args=(offset, row_set))
+    t.daemon = True
+    t.start()
+    self._threads.append(t)
+    return True
+
+  def wait(self):
+    """Waits for all the requests, returns the insert errors.
+
+    Re-raises the first exception raised by create_rows(), if any.
+    """
+    for t in self._threads:
+      t.join()
+    if self._exc:
+      raise self._exc
+    return sorted(self._insert_errors, key=lambda e: e.get('index'))
+
+  def _run(self, offset, row_set):
+    try:
+      insert_errors = self._insert(row_set)
+      with self._lock:
+        for err in insert_errors:
+          err = dict(err)
+          err['index'] = offset + err['index']
+          self._insert_errors.append(err)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception('Failed to send rows to bigquery')
+      with self._lock:
+        if not self._exc:
+          self._exc = e
+    finally:
+      self._slots.release()
+
+  def _insert(self, row_set):
+    """Inserts rows, retrying only the failed ones.
+
+    Returns the insert errors of the last attempt, with indexes relative to
+    row_set.
+    """
+    # Indexes in row_set of the rows sent in this attempt.
+    indexes = list(range(len(row_set)))
+    for attempt in range(self._retries + 1):
+      insert_errors = self._bq_client.create_rows(
+          self._table, [row_set[i] for i in indexes])
+      if not insert_errors:
+        return []
+      # Map back to row_set indexes.
+      insert_errors = [
+          dict(err, index=indexes[err['index']]) for err in insert_errors
+      ]
+      if attempt < self._retries:
+        logging.warning(
+            'Retrying %d rows failed to be sent to bigquery: %s',
+            len(insert_errors), insert_errors)
+        indexes = sorted(set(err['index'] for err in insert_errors))
+    return insert_errors
 
 
 class UnsupportedTypeError(Exception):
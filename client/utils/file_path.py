@@ -24,12 +24,21 @@ import time
 
 from utils import fs
 from utils import subprocess42
+from utils import threading_utils
 from utils import tools
 
 # Types of action accepted by link_file().
 HARDLINK, HARDLINK_WITH_FALLBACK, SYMLINK, SYMLINK_WITH_FALLBACK, COPY = range(
     1, 6)
 
+# Number of threads listing directories in get_recursive_size().
+_SIZE_THREADS = 8
+
+# Directories modified less than this many nanoseconds before a
+# get_recursive_size() walk are not reused from its snapshot, as they could be
+# modified again without their mtime changing.
+_SIZE_RACY_NS = 2 * 10**9
+
 
 ## OS-specific imports
 
@@ -1030,24 +1039,41 @@ def rmtree(root):
   raise errors[0][2][1]
 
 
-def get_recursive_size(path):
-  # type: (str) -> int
+def get_recursive_size(path, snapshot=None, stats=None):
+  # type: (str, dict, dict) -> int
   """Returns the total data size for the specified path.
 
   This function can be surprisingly slow on OSX, so its output should be cached.
+
+  Arguments:
+    path: directory to measure.
+    snapshot: optional dict describing the tree as of a previous call, updated
+        in place to describe it as measured now. Start with an empty dict. The
+        directories whose inode and mtime did not change since the snapshot
+        are not listed again. Note that a file modified in place doesn't change
+        the mtime of its directory, so its new size is not noticed.
+    stats: optional dict filled with the walk statistics.
   """
   start = time.time()
   try:
-    total, n_dirs, n_files, n_links, n_others = _get_recur_size_with_scandir(
-        path)
+    total, counts, new_snapshot = _get_recur_size_with_scandir(path, snapshot)
     elapsed = time.time() - start
     logging.debug(
         '_get_recursive_size: traversed %s took %s seconds. '
-        'files: %d, links: %d, dirs: %d, others: %d', path, elapsed, n_files,
-        n_links, n_dirs, n_others)
+        'files: %d, links: %d, dirs: %d, others: %d, scanned dirs: %d', path,
+        elapsed, counts['files'], counts['links'], counts['dirs'],
+        counts['others'], counts['dirs_scanned'])
+    if snapshot is not None:
+      snapshot.clear()
+      snapshot.update(new_snapshot)
+    if stats is not None:
+      stats.update(counts)
+      stats['duration'] = elapsed
     return total
   except (IOError, OSError, UnicodeEncodeError):
     logging.exception('Exception while getting the size of %s', path)
+    if snapshot is not None:
+      snapshot.clear()
     return None
 
 
@@ -1065,28 +1091,70 @@ def _is_symlink_entry(entry):
               & stat.FILE_ATTRIBUTE_REPARSE_POINT)
 
 
-def _get_recur_size_with_scandir(path):
-  total = 0
-  n_dirs = 0
+def _scan_dir_size(root, rel, previous, racy_ns):
+  """Lists one directory of the tree walked by _get_recur_size_with_scandir().
+
+  Returns:
+    tuple(rel, snapshot entry, True if the directory was listed). A snapshot
+    entry is [st_ino, st_mtime_ns, files size, files, links, others, subdirs].
+  """
+  path = os.path.join(root, rel) if rel else root
+  st = os.stat(path)
+  if previous and previous[:2] == [st.st_ino, st.st_mtime_ns]:
+    return rel, previous, False
+  # None is never reused.
+  mtime = st.st_mtime_ns if st.st_mtime_ns < racy_ns else None
+  size = 0
   n_files = 0
   n_links = 0
   n_others = 0
-  stack = [path]
-  while stack:
-    try:
-      for entry in os.scandir(stack.pop()):
-        if _is_symlink_entry(entry):
-          n_links += 1
-          continue
-        if entry.is_file():
-          n_files += 1
-          total += entry.stat().st_size
-        elif entry.is_dir():
-          n_dirs += 1
-          stack.append(entry.path)
-        else:
-          n_others += 1
-          logging.warning('non directory/file entry: %s', entry)
-    except PermissionError:
-      logging.warning('Failed to scan directory', exc_info=True)
-  return total, n_dirs, n_files, n_links, n_others
+  subdirs = []
+  try:
+    for entry in os.scandir(path):
+      if _is_symlink_entry(entry):
+        n_links += 1
+        continue
+      if entry.is_file():
+        n_files += 1
+        size += entry.stat().st_size
+      elif entry.is_dir():
+        subdirs.append(entry.name)
+      else:
+        n_others += 1
+        logging.warning('non directory/file entry: %s', entry)
+  except PermissionError:
+    logging.warning('Failed to scan directory', exc_info=True)
+    # Never reuse a partial listing.
+    mtime = None
+  return rel, [st.st_ino, mtime, size, n_files, n_links, n_others,
+               subdirs], True
+
+
+def _get_recur_size_with_scandir(path, snapshot=None):
+  """Walks the tree with one task per directory on a thread pool.
+
+  Returns:
+    tuple(total size, dict of counts, new snapshot).
+  """
+  snapshot = snapshot or {}
+  racy_ns = time.time_ns() - _SIZE_RACY_NS
+  new_snapshot = {}
+  total = 0
+  counts = {'dirs': 0, 'dirs_scanned': 0, 'files': 0, 'links': 0, 'others': 0}
+  with threading_utils.ThreadPool(
+      0, _SIZE_THREADS, 0, prefix='get_recursive_size') as pool:
+    pool.add_task(0, _scan_dir_size, path, '', snapshot.get(''), racy_ns)
+    for rel, entry, scanned in pool.iter_results():
+      new_snapshot[rel] = entry
+      _ino, _mtime, size, n_files, n_links, n_others, subdirs = entry
+      total += size
+      counts['dirs'] += len(subdirs)
+      counts['dirs_scanned'] += int(scanned)
+      counts['files'] += n_files
+      counts['links'] += n_links
+      counts['others'] += n_others
+      for name in subdirs:
+        sub = os.path.join(rel, name) if rel else name
+        pool.add_task(0, _scan_dir_size, path, sub, snapshot.get(sub),
+                      racy_ns)
+  return total, counts, new_snapshot
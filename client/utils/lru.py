@@ -4,12 +4,53 @@
 
 """Defines a dictionary that can evict least recently used items."""
 
+import binascii
 import collections
 import json
+import os
+import struct
 import time
 
 CURRENT_VERSION = 3
 
+# Version of the binary journal state format.
+BINARY_VERSION = 4
+
+# The binary state file starts with this header: magic, version, key size.
+_BINARY_MAGIC = b'LRUJ'
+_BINARY_HEADER = struct.Struct('<4sBB')
+
+# Journal operations.
+_OP_ADD = 1
+_OP_TOUCH = 2
+_OP_POP = 3
+
+# The journal is compacted on save once it holds more than this many records
+# and more than _COMPACT_RATIO records per live item.
+_COMPACT_MIN_RECORDS = 1000
+_COMPACT_RATIO = 2
+
+# Size of a journal record without the key.
+_RECORD_OVERHEAD = struct.calcsize('<Bqq')
+
+
+def _record_struct(key_size):
+  """Returns the struct of a journal record: op, key, value, timestamp."""
+  return struct.Struct('<B%dsqq' % key_size)
+
+
+def _encode_record(record, op, key, value, timestamp):
+  """Returns a packed journal record.
+
+  Raises ValueError or struct.error if the item can't be represented, i.e. the
+  key is not a hex string of the right size or the value or timestamp is not
+  an integer.
+  """
+  raw = binascii.unhexlify(key)
+  if len(raw) != record.size - _RECORD_OVERHEAD:
+    raise ValueError('Key %r has an unexpected size' % (key,))
+  return record.pack(op, raw, -1 if value is None else value, timestamp)
+
 
 class LRUDict:
   """Dictionary that can evict least recently used items.
@@ -21,6 +62,18 @@ class LRUDict:
   That is, the first item in self._items is the oldest item.
 
   Can also store its state as *.json file on disk.
+
+  If |size_fn| is given, it is called with each stored value and the dict keeps
+  a running total of the returned sizes, available as |total_size| without
+  iterating over the items.
+
+  If |journal| is True, the state is saved in a binary format instead: a header
+  followed by fixed-width (op, key, value, timestamp) records. The first save
+  writes one add record per item, then each save only appends the operations
+  done since the previous one, and the file is rewritten once the journal gets
+  too long. This requires keys to be hex digests of the same size and values
+  to be integers or None, like in a content addressed cache; otherwise the
+  state is saved as JSON. load() reads both formats.
   """
   @staticmethod
   def time_fn():
@@ -30,12 +83,27 @@ class LRUDict:
     """
     return int(round(time.time()))
 
-  def __init__(self):
+  def __init__(self, size_fn=None, journal=False):
     # Ordered key -> (value, timestamp) mapping,
     # newest items at the bottom.
     self._items = collections.OrderedDict()
     # True if was modified after loading.
     self._dirty = True
+    # Returns the size of a value, or None if sizes are not tracked.
+    self._size_fn = size_fn
+    # Sum of self._size_fn() over all stored values.
+    self._total_size = 0
+    # Packed journal records not yet appended to the binary state file, or None
+    # if the state is saved as JSON.
+    self._journal = [] if journal else None
+    # True if the binary state file must be rewritten from scratch on save.
+    self._compact = True
+    # The binary state file the dict was loaded from or last saved to.
+    self._state_file = None
+    # Struct of the records in self._state_file.
+    self._record = None
+    # Number of records in self._state_file.
+    self._file_records = 0
 
   def __nonzero__(self):
     """False if dict is empty."""
@@ -57,19 +125,33 @@ class LRUDict:
     """Returns value for |key| or raises KeyError if not found."""
     return self._items[key][0]
 
+  @property
+  def total_size(self):
+    """Sum of the sizes of all stored values, as returned by |size_fn|.
+
+    Always 0 if the dict was created without |size_fn|.
+    """
+    return self._total_size
+
   @classmethod
-  def load(cls, state_file):
+  def load(cls, state_file, size_fn=None, journal=False):
     """Loads previously saved state and returns LRUDict in that state.
 
+    A JSON state file loaded with |journal| set is converted to the binary
+    format on the next save.
+
     Raises ValueError if state file is corrupted.
     """
 
     try:
       json_state = None
-      with open(state_file, 'r') as f:
+      with open(state_file, 'rb') as f:
         json_state = f.read()
-        state = json.loads(json_state)
-    except (IOError, ValueError) as e:
+      if json_state.startswith(_BINARY_MAGIC):
+        return cls._load_binary(state_file, json_state, size_fn, journal)
+      json_state = json_state.decode('utf-8')
+      state = json.loads(json_state)
+    except (IOError, ValueError, struct.error) as e:
       raise ValueError(
           'Broken state file %s with "%s": %s' % (state_file, json_state, e))
     if not isinstance(state, dict):
@@ -84,7 +166,7 @@ class LRUDict:
     if not isinstance(state_items, list):
       raise ValueError(
           'Broken state file %s, items should be json list' % (state_file,))
-    lru = cls()
+    lru = cls(size_fn=size_fn, journal=journal)
     # Items are stored oldest to newest. Put them back in the same order.
     for item in state_items:
       if not isinstance(item, list) or len(item) != 2:
@@ -100,21 +182,77 @@ class LRUDict:
             'to be a number: %s' % (state_file, item))
 
     lru._items = collections.OrderedDict(state_items)
+    lru._total_size = lru._sum_sizes()
 
     # Check for duplicate keys.
     if len(lru) != len(state_items):
       raise ValueError(
           'Broken state file %s, found duplicate keys' % (state_file,))
 
-    # Now state from the file corresponds to state in the memory.
-    lru._dirty = False
+    # Now state from the file corresponds to state in the memory, unless it
+    # has to be converted to the binary format.
+    lru._dirty = journal
     return lru
 
-  def save(self, state_file):
-    """Saves cache state to a file if it was modified."""
+  @classmethod
+  def _load_binary(cls, state_file, data, size_fn, journal):
+    """Replays a binary state file and returns LRUDict in that state."""
+    _magic, version, key_size = _BINARY_HEADER.unpack_from(data)
+    if version != BINARY_VERSION:
+      raise ValueError(
+          'Unsupported state file %s, version is %s. '
+          'Latest supported is %d' % (state_file, version, BINARY_VERSION))
+    record = _record_struct(key_size)
+    # A partially written trailing record is ignored.
+    count = (len(data) - _BINARY_HEADER.size) // record.size
+    end = _BINARY_HEADER.size + count * record.size
+    items = collections.OrderedDict()
+    for op, raw, value, timestamp in record.iter_unpack(
+        data[_BINARY_HEADER.size:end]):
+      key = binascii.hexlify(raw).decode('ascii')
+      if op == _OP_ADD:
+        items.pop(key, None)
+        items[key] = [None if value < 0 else value, timestamp]
+      elif op == _OP_TOUCH and key in items:
+        items[key] = [items.pop(key)[0], timestamp]
+      elif op == _OP_POP and key in items:
+        del items[key]
+      else:
+        raise ValueError(
+            'Broken state file %s, unexpected record %d for %s' %
+            (state_file, op, key))
+
+    lru = cls(size_fn=size_fn, journal=journal)
+    lru._items = items
+    lru._total_size = lru._sum_sizes()
+    lru._compact = False
+    lru._state_file = state_file
+    lru._record = record
+    lru._file_records = count
+    # Now state from the file corresponds to state in the memory, unless it
+    # has to be converted to JSON.
+    lru._dirty = not journal
+    return lru
+
+  def save(self, state_file, json_file=None):
+    """Saves cache state to a file if it was modified.
+
+    If |json_file| is set and the state is journaled, a JSON copy of the state
+    is also written there each time the binary state file is rewritten from
+    scratch, for clients that can't read the binary format. It lags behind the
+    records appended since.
+    """
     if not self._dirty:
       return False
 
+    if self._journal is None or not self._save_binary(state_file, json_file):
+      self._save_json(state_file)
+      self._state_file = None
+
+    self._dirty = False
+    return True
+
+  def _save_json(self, state_file):
     with open(state_file, 'w') as f:
       contents = {
           'version': CURRENT_VERSION,
@@ -122,13 +260,69 @@ class LRUDict:
       }
       json.dump(contents, f, sort_keys=True, separators=(',', ':'))
 
-    self._dirty = False
+  def _save_binary(self, state_file, json_file):
+    """Appends the pending journal records to the binary state file, or
+    rewrites it.
+
+    Returns False if the items can't be represented in the binary format.
+    """
+    if (not self._compact and state_file == self._state_file and
+        self._file_records + len(self._journal) <= max(
+            _COMPACT_MIN_RECORDS, _COMPACT_RATIO * len(self._items)) and
+        self._file_size() == _get_size(state_file)):
+      with open(state_file, 'ab') as f:
+        f.write(b''.join(self._journal))
+      self._file_records += len(self._journal)
+      del self._journal[:]
+      return True
+
+    key_size = 0
+    for key in self._items:
+      key_size = len(key) // 2
+      break
+    record = _record_struct(key_size)
+    try:
+      data = b''.join(
+          _encode_record(record, _OP_ADD, key, value, timestamp)
+          for key, (value, timestamp) in self._items.items())
+    except (TypeError, ValueError, struct.error):
+      return False
+    if json_file:
+      # Written first, so the binary state file is never older.
+      self._save_json(json_file)
+    with open(state_file, 'wb') as f:
+      f.write(_BINARY_HEADER.pack(_BINARY_MAGIC, BINARY_VERSION, key_size))
+      f.write(data)
+    self._compact = False
+    self._state_file = state_file
+    self._record = record
+    self._file_records = len(self._items)
+    del self._journal[:]
     return True
 
+  def _file_size(self):
+    """Expected size of the binary state file in bytes."""
+    return _BINARY_HEADER.size + self._file_records * self._record.size
+
+  def _log(self, op, key, value=None, timestamp=0):
+    """Records an operation in the journal, if the state is journaled."""
+    if self._journal is None or self._compact:
+      return
+    try:
+      self._journal.append(
+          _encode_record(self._record, op, key, value, timestamp))
+    except (TypeError, ValueError, struct.error):
+      # Rewrite the state file, falling back to JSON if need be.
+      self._compact = True
+
   def add(self, key, value):
     """Adds or replaces a |value| for |key|, marks it as most recently used."""
-    self._items.pop(key, None)
-    self._items[key] = (value, self.time_fn())
+    old = self._items.pop(key, None)
+    if old is not None:
+      self._total_size -= self._size(old[0])
+    item = self._items[key] = (value, self.time_fn())
+    self._total_size += self._size(value)
+    self._log(_OP_ADD, key, *item)
     self._dirty = True
 
   def get(self, key, default=None):
@@ -141,7 +335,8 @@ class LRUDict:
 
     Raises KeyError if |key| is not in the dict.
     """
-    self._items[key] = (self._items.pop(key)[0], self.time_fn())
+    item = self._items[key] = (self._items.pop(key)[0], self.time_fn())
+    self._log(_OP_TOUCH, key, None, item[1])
     self._dirty = True
 
   def pop(self, key):
@@ -150,6 +345,8 @@ class LRUDict:
     Raises KeyError if |key| is not in the dict.
     """
     item = self._items.pop(key)
+    self._total_size -= self._size(item[0])
+    self._log(_OP_POP, key)
     self._dirty = True
     return item[0]
 
@@ -170,6 +367,8 @@ class LRUDict:
     Raises KeyError if dict is empty.
     """
     item = self._items.popitem(last=False)
+    self._total_size -= self._size(item[1][0])
+    self._log(_OP_POP, item[0])
     self._dirty = True
     return item
 
@@ -192,4 +391,24 @@ class LRUDict:
     """Updates the data format and saves immediately."""
     for key, (val, timestamp) in self._items.items():
       self._items[key] = (mutator(key, val), timestamp)
+    self._total_size = self._sum_sizes()
+    self._compact = True
     self._dirty = True
+
+  def _size(self, value):
+    """Returns the size of |value| as accounted in |total_size|."""
+    return self._size_fn(value) if self._size_fn else 0
+
+  def _sum_sizes(self):
+    """Recomputes the total size from scratch."""
+    if not self._size_fn:
+      return 0
+    return sum(self._size_fn(val) for val, _ in self._items.values())
+
+
+def _get_size(path):
+  """Returns the size of a file, or None if it doesn't exist."""
+  try:
+    return os.path.getsize(path)
+  except OSError:
+    return None
@@ -122,6 +122,124 @@ class ProfileCounter:
         self._call_count += 1
 
 
+class PhaseTimer:
+  """Records nested spans of time, e.g. the phases of a task.
+
+  While a PhaseTimer is active (inside its `with` block), phase() records a span
+  in it. This lets any code annotate its phases without passing the timer
+  around.
+
+  The spans can be exported in the Trace Event Format, which is understood by
+  chrome://tracing and Perfetto.
+  """
+
+  _active = None
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._spans = []
+    self._start = None
+    self._previous = None
+
+  def __enter__(self):
+    self._start = time.time()
+    self._previous = PhaseTimer._active
+    PhaseTimer._active = self
+    return self
+
+  def __exit__(self, _exc_type, _exec_value, _traceback):
+    PhaseTimer._active = self._previous
+    self._previous = None
+
+  def spans(self):
+    """Returns the spans as a list of dicts sorted by start time.
+
+    'start' is in seconds relative to the timer start and 'depth' is the
+    nesting level of the span in its thread.
+    """
+    with self._lock:
+      spans = sorted(self._spans, key=lambda s: (s.start_time, s.depth))
+    return [{
+        'name': s.name,
+        'start': round(s.start_time - self._start, 6),
+        'duration': round(s.duration, 6),
+        'depth': s.depth,
+        'args': s.args,
+    } for s in spans]
+
+  def trace_events(self):
+    """Returns the spans in the Trace Event Format, as a dict."""
+    pid = os.getpid()
+    with self._lock:
+      spans = list(self._spans)
+    return {
+        'traceEvents': [{
+            'name': s.name,
+            'ph': 'X',
+            'ts': int(s.start_time * 1e6),
+            'dur': int(s.duration * 1e6),
+            'pid': pid,
+            'tid': s.tid,
+            'args': s.args,
+        } for s in spans],
+        'displayTimeUnit': 'ms',
+    }
+
+  def _push(self):
+    depth = getattr(self._local, 'depth', 0)
+    self._local.depth = depth + 1
+    return depth
+
+  def _pop(self, span):
+    self._local.depth -= 1
+    with self._lock:
+      self._spans.append(span)
+
+
+class _Span(Profiler):
+  """Profiler that also records itself in a PhaseTimer."""
+
+  def __init__(self, timer, name, args):
+    super(_Span, self).__init__(name)
+    self.args = args
+    self.depth = None
+    self.duration = None
+    self.tid = None
+    self._timer = timer
+
+  def __enter__(self):
+    # pylint: disable=protected-access
+    self.depth = self._timer._push()
+    self.tid = threading.current_thread().ident
+    return super(_Span, self).__enter__()
+
+  def __exit__(self, exc_type, exec_value, traceback):
+    self.duration = time.time() - self.start_time
+    super(_Span, self).__exit__(exc_type, exec_value, traceback)
+    # pylint: disable=protected-access
+    self._timer._pop(self)
+
+
+def phase(name, **args):
+  """Returns a context manager recording a span in the active PhaseTimer.
+
+  The span is only logged if there is no active PhaseTimer.
+
+  Arguments:
+    name: name of the span.
+    args: initial values of the span arguments, e.g. file counts. More can be
+        added to the `args` dict of the object returned by the `with`
+        statement.
+  """
+  timer = PhaseTimer._active
+  if timer is None:
+    p = Profiler(name)
+    p.args = args
+    return p
+  return _Span(timer, name, args)
+
+
 def profile(func):
   """Decorator that profiles a function if SWARMING_PROFILE env var is set.
 
@@ -0,0 +1,112 @@
+# Copyright 2024 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Deferred deletion of directories.
+
+Deleting a large directory tree can take minutes. Instead, move() renames it
+into a trash directory, which is atomic and cheap, and the trash is emptied
+later, either explicitly with empty() or by a background thread started with
+start_worker().
+
+The trash directory must be on the same volume as the directories moved into
+it, otherwise they are deleted right away. Since the trash is a plain
+directory, the items left when the process exits are deleted by the next
+worker.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+
+from utils import file_path
+from utils import fs
+
+
+# Seconds between two scans of the trash directory by the worker.
+_POLL_SECS = 30.
+
+# Seconds to pause between two items deleted by the worker, to limit the I/O
+# load it puts on the tasks.
+_PAUSE_SECS = 1.
+
+
+def move(path, trash_dir):
+  """Moves a directory into the trash, or deletes it if it can't be moved.
+
+  Raises:
+    OSError if the directory couldn't be moved nor deleted.
+
+  Returns:
+    True if the directory was moved, False if it was deleted.
+  """
+  # The directory is renamed directly to a unique name, so there's nothing for
+  # a concurrent empty() to delete in between.
+  item = os.path.join(trash_dir, uuid.uuid4().hex)
+  try:
+    file_path.ensure_tree(trash_dir)
+    fs.rename(path, item)
+    logging.info('trash.move(%s): moved to %s', path, item)
+    return True
+  except OSError as e:
+    # e.g. a different volume, or files in use on Windows.
+    logging.info('trash.move(%s): failed to move: %s', path, e)
+  file_path.rmtree(path)
+  return False
+
+
+def empty(trash_dir, pause=0):
+  """Deletes all the items in the trash.
+
+  Items that fail to be deleted are kept for the next call.
+
+  Arguments:
+    trash_dir: trash directory.
+    pause: seconds to wait between items.
+
+  Returns:
+    Number of items deleted.
+  """
+  if not fs.isdir(trash_dir):
+    return 0
+  deleted = 0
+  for i, name in enumerate(sorted(fs.listdir(trash_dir))):
+    if i and pause:
+      time.sleep(pause)
+    p = os.path.join(trash_dir, name)
+    start = time.time()
+    try:
+      if fs.isdir(p) and not fs.islink(p):
+        file_path.rmtree(p)
+      else:
+        file_path.remove(p)
+      deleted += 1
+    except OSError as e:
+      # It may be deleted concurrently by another process.
+      logging.warning('trash.empty(): failed to delete %s: %s', p, e)
+    finally:
+      logging.info('trash.empty(): deleting %s took %d seconds', p,
+                   time.time() - start)
+  return deleted
+
+
+def start_worker(trash_dir):
+  """Starts a daemon thread that empties the trash periodically.
+
+  Returns:
+    The threading.Thread.
+  """
+  def run():
+    while True:
+      try:
+        empty(trash_dir, pause=_PAUSE_SECS)
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('trash worker failed')
+      time.sleep(_POLL_SECS)
+
+  thread = threading.Thread(target=run, name='trash')
+  thread.daemon = True
+  thread.start()
+  return thread